@@ -0,0 +1,94 @@
+from library.compression import compressor
+from library.blobstore import blob_store
+from library.storage import PostgreSQL
+import zstandard
+import tarfile
+import asyncio
+
+class repository_archive:
+    """
+    Streams the files of a repository as a tar archive, optionally compressed with zstd.
+
+    The archive is made as it is sent. Files are opened one at a time and read a block at a time,
+    so the memory used stays the same however big the repository is. As an async generator, the next block
+    is only read once the server has sent the last one, so a slow client slows the reading down
+    instead of the blocks piling up in memory.
+    """
+    BLOCK_SIZE = 256 * 1024
+    FORMATS = {
+        'tar': 'application/x-tar',
+        'tar.zst': 'application/zstd',
+    }
+
+    @staticmethod
+    def _open_blob(blob_hash: str):
+        # The connection goes back to the pool as soon as the blob is open, not once it has been read.
+        conn = PostgreSQL.shared().get_connection(readonly=True)
+        cur = conn.cursor()
+        try:
+            return blob_store.open_reader(cur, blob_hash)
+        finally:
+            cur.close()
+            conn.close()
+
+    @staticmethod
+    def _header(file: dict) -> bytes:
+        info = tarfile.TarInfo(name=file['path'].lstrip('/'))
+        info.size = file['size']
+        info.mode = 0o644
+        if file['commit_date'] is not None:
+            info.mtime = int(file['commit_date'].timestamp())
+        # PAX headers, so long and non-ASCII paths survive.
+        return info.tobuf(format=tarfile.PAX_FORMAT)
+
+    @staticmethod
+    async def _tar_blocks(files: list):
+        written = 0
+        for file in files:
+            header = repository_archive._header(file)
+            yield header
+            written += len(header)
+
+            reader = await asyncio.to_thread(repository_archive._open_blob, file['blob_hash'])
+            try:
+                remaining = file['size']
+                while remaining > 0:
+                    block = await asyncio.to_thread(reader.read, min(repository_archive.BLOCK_SIZE, remaining))
+                    if not block:
+                        # The header already promised the size, so the archive can not be finished now.
+                        raise RuntimeError(f"The content of {file['path']} ended {remaining} bytes early.")
+                    remaining -= len(block)
+                    yield block
+            finally:
+                await asyncio.to_thread(reader.close)
+            written += file['size']
+
+            padding = -file['size'] % tarfile.BLOCKSIZE
+            if padding:
+                yield tarfile.NUL * padding
+                written += padding
+
+        # Two empty blocks end the archive, then it is padded to a whole record like tarfile does.
+        end = 2 * tarfile.BLOCKSIZE
+        end += -(written + end) % tarfile.RECORDSIZE
+        yield tarfile.NUL * end
+
+    @staticmethod
+    async def stream(files: list, compress=False):
+        """
+        Makes the archive, a block at a time.
+
+        :param files: The files to put in it, as AsyncPostgreSQL.snapshot_files() lists them.
+        :param compress: Whether to compress the archive with zstd.
+        """
+        if not compress:
+            async for block in repository_archive._tar_blocks(files):
+                yield block
+            return
+
+        compress_object = zstandard.ZstdCompressor(level=compressor.LEVEL).compressobj()
+        async for block in repository_archive._tar_blocks(files):
+            compressed = compress_object.compress(block)
+            if compressed:
+                yield compressed
+        yield compress_object.flush()
@@ -0,0 +1,792 @@
+from library.storage import var, dt, PostgreSQL, replica_router, request_consistency, read_cache, query_stats
+from library.errors import error
+from library.refs import ref_store
+import asyncpg
+import datetime
+import asyncio
+import logging
+import time
+import os
+
+class AsyncPostgreSQL:
+    """
+    The asyncio version of PostgreSQL, for use inside the Quart API so queries do not block the event loop.
+    It has the same data methods as PostgreSQL, but they must be awaited. It keeps its own asyncpg pool.
+    """
+    _shared = None
+    # What a read replica fails a query with when it has gone away, or cancelled the query to replay changes.
+    # A read-only query that fails so is run again on the primary, as replica_cursor does for PostgreSQL.
+    REPLICA_ERRORS = (OSError, asyncpg.PostgresConnectionError, asyncpg.InterfaceError, asyncpg.SerializationError)
+
+    def __init__(self):
+        self._pool = None
+        self._pool_loop = None
+        self._pool_lock = None
+        self._replica_pools = {}  # Replica key: asyncpg pool, all belonging to self._pool_loop
+
+    @staticmethod
+    def shared() -> 'AsyncPostgreSQL':
+        """
+        Gets the async storage object shared by everything in this process.
+        """
+        if AsyncPostgreSQL._shared is None or AsyncPostgreSQL._shared[0] != os.getpid():
+            AsyncPostgreSQL._shared = (os.getpid(), AsyncPostgreSQL())
+        return AsyncPostgreSQL._shared[1]
+
+    async def _make_pool(self, details: dict = None) -> asyncpg.Pool:
+        details = details if details is not None else PostgreSQL.get_details()
+        config = var.get('db').get('pool', dt.SETTINGS['db']['pool'])
+        return await asyncpg.create_pool(
+            host=details['host'],
+            port=int(details['port']) if details['port'] is not None else None,
+            user=details['user'],
+            password=details['password'],
+            database=details['database'],
+            min_size=int(config.get('min_size', 1)),
+            max_size=int(config.get('max_size', 10)),
+            max_inactive_connection_lifetime=float(config.get('idle_timeout', 300)),
+        )
+
+    async def get_pool(self) -> asyncpg.Pool:
+        """
+        Gets the asyncpg pool, making it on first use. The pool belongs to the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self._pool is not None and self._pool_loop is loop:
+            return self._pool
+
+        if self._pool_lock is None or self._pool_loop is not loop:
+            self._pool_lock = asyncio.Lock()
+            self._pool_loop = loop
+            self._pool = None
+            self._replica_pools = {}
+
+        async with self._pool_lock:
+            if self._pool is None:
+                try:
+                    self._pool = await self._make_pool()
+                except (OSError, asyncpg.PostgresError):
+                    # Let the blocking storage layer start the database container and wait for it, then retry.
+                    logging.info("Could not reach the database from the async pool. Trying to bring it up.")
+                    conn = await asyncio.to_thread(PostgreSQL.shared().get_connection)
+                    conn.close()
+                    self._pool = await self._make_pool()
+        return self._pool
+
+    async def get_read_pool(self) -> asyncpg.Pool:
+        """
+        Gets a pool to a healthy, caught up read replica, or the primary's pool if there is none
+        or something was already written in this request.
+        """
+        if request_consistency.must_use_primary() or not replica_router.config()['replicas']:
+            return await self.get_pool()
+
+        primary = await self.get_pool()  # Also makes sure the pools belong to the running loop.
+        for details in replica_router.shuffled():
+            key = replica_router.key(details)
+            if not replica_router.needs_check(key) and not replica_router.usable(key):
+                continue
+
+            try:
+                if key not in self._replica_pools:
+                    self._replica_pools[key] = await self._make_pool(details)
+                pool = self._replica_pools[key]
+                if replica_router.needs_check(key):
+                    replica_router.record(key, float(await pool.fetchval(replica_router.LAG_QUERY)))
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+                replica_router.record(key, None)
+                continue
+
+            if replica_router.usable(key):
+                return pool
+        return primary
+
+    async def _move_to_primary(self, pool: asyncpg.Pool) -> asyncpg.Pool | None:
+        """
+        Stops reading from a replica whose query failed, until its next health check.
+
+        :return: The primary's pool to run the query on instead, or None if pool already is the primary's.
+        """
+        key = next((key for key, replica_pool in self._replica_pools.items() if replica_pool is pool), None)
+        if key is None:
+            return None
+        logging.warning("A query failed on a read replica. Running it on the primary instead.", exc_info=True)
+        replica_router.record(key, None)
+        return await self.get_pool()
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+        for pool in self._replica_pools.values():
+            await pool.close()
+        self._replica_pools = {}
+
+    @query_stats.skip
+    async def _run(self, kind: str, query: str, args: tuple, readonly: bool):
+        """
+        Runs a query with the given asyncpg connection method, timing it for query_stats.
+        """
+        method = query_stats.caller()
+        started = time.perf_counter()
+        pool = await (self.get_read_pool() if readonly else self.get_pool())
+        try:
+            return await self._run_on(pool, method, started, kind, query, args)
+        except AsyncPostgreSQL.REPLICA_ERRORS:
+            primary = await self._move_to_primary(pool)
+            if primary is None:
+                raise
+            return await self._run_on(primary, method, time.perf_counter(), kind, query, args)
+
+    async def _run_on(self, pool: asyncpg.Pool, method: str, started: float, kind: str, query: str, args: tuple):
+        async with pool.acquire() as conn:
+            wait = time.perf_counter() - started
+            started = time.perf_counter()
+            result = await getattr(conn, kind)(query, *args)
+            elapsed = time.perf_counter() - started
+
+            if kind == 'fetch':
+                rows = len(result)
+            elif kind == 'execute':
+                # The status looks like 'UPDATE 3'
+                count = result.rsplit(' ', 1)[-1]
+                rows = int(count) if count.isdigit() else 0
+            else:
+                rows = int(result is not None)
+
+            query_stats.record(method, elapsed, rows, wait)
+            if query_stats.is_slow(elapsed):
+                plan = await self._explain(conn, query, args) if query_stats.should_explain(method, query) else None
+                query_stats.log_slow(method, query, elapsed, rows, wait, plan)
+        return result
+
+    @staticmethod
+    async def _explain(conn: asyncpg.Connection, query: str, args: tuple) -> str:
+        try:
+            return '\n'.join(row[0] for row in await conn.fetch(f'EXPLAIN {query}', *args))
+        except asyncpg.PostgresError as exc:
+            return f"Could not get the query plan: {exc}"
+
+    @query_stats.skip
+    async def fetch(self, query, *args, readonly=False) -> list:
+        """
+        Runs a query on a pooled connection and returns every row. Queries use $1, $2... placeholders.
+
+        :param readonly: If True, the query may run on a read replica.
+        """
+        return await self._run('fetch', query, args, readonly)
+
+    @query_stats.skip
+    async def fetchrow(self, query, *args, readonly=False) -> asyncpg.Record | None:
+        return await self._run('fetchrow', query, args, readonly)
+
+    @query_stats.skip
+    async def fetchval(self, query, *args, readonly=False):
+        return await self._run('fetchval', query, args, readonly)
+
+    @query_stats.skip
+    async def execute(self, query, *args) -> str:
+        result = await self._run('execute', query, args, False)
+        request_consistency.mark_write()
+        return result
+
+    async def save_token(self, belongs_to, token):
+        """
+        Saves a token for a user in the database.
+
+        :param belongs_to: The username of the user the token belongs to.
+        :param token: The token to save.
+        """
+        assert type(belongs_to) is str, "The username must be a string."
+        assert type(token) is str, "The token must be a string."
+        await self.check_exists(belongs_to)
+
+        await self.execute(
+            """
+            INSERT INTO tokens (username, token)
+            VALUES ($1, $2)
+            ON CONFLICT (username) DO UPDATE SET token = EXCLUDED.token;
+            """,
+            belongs_to, token
+        )
+
+    async def get_token_owner(self, token):
+        """
+        Retrieves the username associated with a given token.
+
+        :param token: The token to look up.
+        :return: The username associated with the token.
+        """
+        assert type(token) is str, "The token must be a string."
+        return await self.fetchval(
+            """
+            SELECT username
+            FROM tokens
+            WHERE token = $1;
+            """,
+            token
+        )
+
+    async def validate_token(self, token):
+        """
+        Validates if the provided token exists in the database.
+
+        :param token: The token to validate.
+        :return: True if the token is valid, False otherwise.
+        """
+        assert type(token) is str, "The token must be a string."
+        return await self.get_token_owner(token) is not None
+
+    async def resolve_principal(self, token):
+        """
+        Works out who a token belongs to, whether they are an administrator and whether they are restricted,
+        all in one query.
+
+        :param token: The token to look up.
+        :return: A tuple of (username, is_admin, is_restricted), or None if the token is not valid.
+        """
+        assert type(token) is str, "The token must be a string."
+        row = await self.fetchrow(
+            """
+            SELECT accounts.username,
+                   COALESCE((
+                       SELECT bool_or(administrator)
+                       FROM user_permissions
+                       WHERE user_permissions.username = accounts.username
+                   ), FALSE),
+                   COALESCE(accounts.restricted, FALSE)
+            FROM tokens
+            JOIN accounts ON accounts.username = tokens.username
+            WHERE tokens.token = $1;
+            """,
+            token
+        )
+        return tuple(row) if row is not None else None
+
+    async def walk_repository(self, repo_name, repo_owner, view_private=False, changeset_id=None, ref=None):
+        """
+        Constructs a dictionary of all the files, their versions, their commit msg, and their relative paths.
+        The newest files of the default branch are one range scan of repo_head_files. Other branches and older
+        changesets are read from their trees, which PostgreSQL.walk_repository caches, so those run in a thread.
+        """
+        if changeset_id is None and ref in (None, ref_store.DEFAULT_BRANCH):
+            rows = await self.fetch(
+                f"""
+                SELECT repo_head_files.rel_file_path, version_major, version_minor, version_patch, commit_message
+                FROM repo_head_files
+                JOIN repositories ON repositories.repo_id = repo_head_files.repo_id
+                WHERE repositories.owner = $1 AND repositories.name = $2
+                {'' if view_private else 'AND repositories.private = FALSE'}
+                ORDER BY repo_head_files.rel_file_path;
+                """,
+                repo_owner, repo_name,
+                readonly=True
+            )
+            return {
+                row['rel_file_path']: {
+                    'version': [row['version_major'], row['version_minor'], row['version_patch']],
+                    'commit_msg': row['commit_message']
+                }
+                for row in rows
+            }
+
+        return await asyncio.to_thread(
+            PostgreSQL.shared().walk_repository, repo_name, repo_owner, view_private, changeset_id, ref
+        )
+
+    async def list_refs(self, repo_owner: str, repo_name: str, view_private=False) -> list | None:
+        return await asyncio.to_thread(PostgreSQL.shared().list_refs, repo_owner, repo_name, view_private)
+
+    async def changeset_log(self, repo_owner: str, repo_name: str, ref: str = None, changeset_id: int = None,
+                            since: int = None, limit: int = 50, view_private=False) -> list | None:
+        return await asyncio.to_thread(
+            PostgreSQL.shared().changeset_log, repo_owner, repo_name, ref, changeset_id, since, limit, view_private
+        )
+
+    async def is_ancestor(self, repo_owner: str, repo_name: str, ancestor: int, descendant: int,
+                          view_private=False) -> bool | None:
+        return await asyncio.to_thread(
+            PostgreSQL.shared().is_ancestor, repo_owner, repo_name, ancestor, descendant, view_private
+        )
+
+    # Checking candidates for matches is CPU bound, so it runs in a thread rather than holding up the event loop.
+    async def search_code(self, query: str, regex=False, ignore_case=False, username: str = None,
+                          repo_owner: str = None, repo_name: str = None, limit: int = 50) -> dict:
+        return await asyncio.to_thread(
+            PostgreSQL.shared().search_code, query, regex, ignore_case, username, repo_owner, repo_name, limit
+        )
+
+    async def compare_changesets(self, repo_owner: str, repo_name: str, old_changeset: int, new_changeset: int,
+                                 view_private=False) -> dict | None:
+        return await asyncio.to_thread(
+            PostgreSQL.shared().compare_changesets, repo_owner, repo_name, old_changeset, new_changeset, view_private
+        )
+
+    # Diffing is CPU bound, so it runs in a thread rather than holding up the event loop.
+    async def diff_file(self, repo_owner: str, repo_name: str, rel_file_path: str, old_version: tuple,
+                        new_version: tuple, view_private=False, context: int = 3, ref: str = None) -> dict:
+        return await asyncio.to_thread(
+            PostgreSQL.shared().diff_file, repo_owner, repo_name, rel_file_path, old_version, new_version,
+            view_private, context, ref
+        )
+
+    async def diff_changesets(self, repo_owner: str, repo_name: str, old_changeset: int, new_changeset: int,
+                              view_private=False, context: int = 3) -> list | None:
+        return await asyncio.to_thread(
+            PostgreSQL.shared().diff_changesets, repo_owner, repo_name, old_changeset, new_changeset,
+            view_private, context
+        )
+
+    async def add_user(self, username: str, password: str):
+        """
+        Adds a new user to the database.
+
+        :return: True if the user was added successfully, False if the username already exists.
+        """
+        assert type(username) is str, "The username must be a string."
+        assert type(password) is str, "The password must be a string."
+        try:
+            await self.execute(
+                """
+                INSERT INTO accounts (username, password)
+                VALUES ($1, $2)
+                """,
+                username, password
+            )
+        except asyncpg.exceptions.UniqueViolationError:
+            return False
+        return True
+
+    async def delete_user(self, username: str):
+        assert type(username) is str, "The username must be a string."
+        await self.check_exists(username)
+
+        await self.execute(
+            """
+            DELETE FROM accounts
+            WHERE username = $1;
+            """,
+            username
+        )
+        read_cache.invalidate_user(username)
+
+    async def get_repository_owner(self, repo_name, hide_private=True):
+        """
+        Retrieves the owner of a repository.
+
+        :param repo_name: The name of the repository.
+        :param hide_private: If True, only considers public repositories.
+        """
+        return await self.fetchval(
+            f"""
+            SELECT owner
+            FROM repositories
+            WHERE name = $1{';' if not hide_private else ' AND private = FALSE;'}
+            """,
+            repo_name, readonly=True
+        )
+
+    async def check_exists(self, username: str, not_exist_ok=False):
+        """
+        Checks if a user exists in the database.
+        :param username: The username to check.
+        :param not_exist_ok: If True, does not raise an error if the user does not exist.
+        """
+        assert type(username) is str, "The username must be a string."
+        exists = await self.fetchval(
+            """
+            SELECT username
+            FROM accounts
+            WHERE username = $1;
+            """,
+            username
+        ) is not None
+
+        if not exists:
+            if not_exist_ok is False:
+                raise error.user_nonexistant
+            return False
+        return True
+
+    async def is_user_administrator(self, username: str):
+        assert type(username) is str, "The username must be a string."
+        await self.check_exists(username)
+
+        is_admin = await self.fetchval(
+            """
+            SELECT administrator
+            FROM user_permissions
+            WHERE username = $1;
+            """,
+            username
+        )
+        return bool(is_admin)
+
+    async def update_password(self, username: str, password: str):
+        await self.check_exists(username)
+        await self.execute(
+            """
+            UPDATE accounts
+            SET password = $1
+            WHERE username = $2;
+            """,
+            password, username
+        )
+
+    async def get_password(self, username: str):
+        await self.check_exists(username)
+        return await self.fetchval(
+            """
+            SELECT password
+            FROM accounts
+            WHERE username = $1;
+            """,
+            username
+        )
+
+    async def set_bio(self, username, bio):
+        await self.check_exists(username)
+        await self.execute(
+            """
+            UPDATE accounts
+            SET bio = $1
+            WHERE username = $2;
+            """,
+            bio, username
+        )
+        read_cache.invalidate(('bio', username))
+
+    @read_cache.cached('bio')
+    async def get_bio(self, username):
+        await self.check_exists(username)
+        return await self.fetchval(
+            """
+            SELECT bio
+            FROM accounts
+            WHERE username = $1;
+            """,
+            username, readonly=True
+        )
+
+    async def is_restricted(self, username):
+        await self.check_exists(username)
+        return await self.fetchval(
+            """
+            SELECT restricted
+            FROM accounts
+            WHERE username = $1;
+            """,
+            username
+        )
+
+    async def commit_activity(self, username: str, start: datetime.date, end: datetime.date) -> dict:
+        """
+        The async version of PostgreSQL.commit_activity(). username may be '*' for everyone's commits.
+        """
+        return await asyncio.to_thread(PostgreSQL.shared().commit_activity, username, start, end)
+
+    async def storage_usage(self, username: str) -> dict:
+        """
+        The async version of PostgreSQL.storage_usage().
+        """
+        return await asyncio.to_thread(PostgreSQL.shared().storage_usage, username)
+
+    async def set_storage_quota(self, username: str, quota: int | None):
+        assert quota is None or (isinstance(quota, int) and quota >= 0), "The quota must be a number of bytes."
+        await self.check_exists(username)
+        await self.execute(
+            """
+            UPDATE accounts
+            SET storage_quota = $1
+            WHERE username = $2;
+            """,
+            quota, username
+        )
+
+    async def set_restricted(self, username, new_status: bool):
+        await self.check_exists(username)
+        await self.execute(
+            """
+            UPDATE accounts
+            SET restricted = $1
+            WHERE username = $2;
+            """,
+            new_status, username
+        )
+
+    async def make_user_administrator(self, username):
+        await self.check_exists(username)
+        await self.execute(
+            """
+            INSERT INTO user_permissions (username, administrator)
+            VALUES ($1, TRUE)
+            ON CONFLICT (username) DO UPDATE SET administrator = TRUE;
+            """,
+            username
+        )
+
+    async def remove_user_administrator(self, username):
+        await self.check_exists(username)
+        await self.execute(
+            """
+            INSERT INTO user_permissions (username, administrator)
+            VALUES ($1, FALSE)
+            ON CONFLICT (username) DO UPDATE SET administrator = FALSE;
+            """,
+            username
+        )
+
+    async def add_repository(self, owner: str, name: str, description: str, is_private: bool):
+        """
+        Adds a new repository to the database.
+
+        :return: True if the repository was added, False if the owner already has a repository with that name.
+        """
+        assert isinstance(is_private, bool)
+        assert isinstance(name, str)
+        assert isinstance(description, str)
+        assert isinstance(owner, str)
+        await self.check_exists(owner)
+
+        try:
+            await self.execute(
+                """
+                INSERT INTO repositories (owner, name, description, private)
+                VALUES ($1, $2, $3, $4);
+                """,
+                owner, name, description, is_private
+            )
+        except asyncpg.exceptions.UniqueViolationError:
+            return False
+        read_cache.invalidate_repository(owner, name)
+        return True
+
+    async def delete_repository(self, owner: str, name: str) -> bool:
+        """
+        Deletes a repository, taking its commits and storage out of its owner's counts. The accounting is done
+        once, in PostgreSQL.delete_repository(), which runs in a thread.
+
+        :return: Whether the owner had a repository of that name to delete.
+        """
+        return await asyncio.to_thread(PostgreSQL.shared().delete_repository, owner, name)
+
+    async def update_repository_is_private(self, owner, name, is_private):
+        assert isinstance(is_private, bool)
+        assert isinstance(name, str)
+        assert isinstance(owner, str)
+        await self.check_exists(owner)
+
+        await self.execute(
+            """
+            UPDATE repositories
+            SET private = $1
+            WHERE owner = $2 AND name = $3;
+            """,
+            is_private, owner, name
+        )
+        read_cache.invalidate_repository(owner, name)
+
+    async def update_repository_name(self, owner, old_name, new_name):
+        assert isinstance(new_name, str)
+        assert isinstance(old_name, str)
+        assert isinstance(owner, str)
+        await self.check_exists(owner)
+
+        await self.execute(
+            """
+            UPDATE repositories
+            SET name = $1
+            WHERE owner = $2 AND name = $3;
+            """,
+            new_name, owner, old_name
+        )
+        read_cache.invalidate_repository(owner, old_name)
+        read_cache.invalidate_repository(owner, new_name)
+
+    async def update_repository_description(self, owner, name, description):
+        assert isinstance(description, str)
+        assert isinstance(name, str)
+        assert isinstance(owner, str)
+        await self.check_exists(owner)
+
+        await self.execute(
+            """
+            UPDATE repositories
+            SET description = $1
+            WHERE owner = $2 AND name = $3;
+            """,
+            description, owner, name
+        )
+        read_cache.invalidate_repository(owner, name)
+
+    async def add_commit(self, owner: str, repo_name: str, author: str, rel_file_path: str, version: tuple,
+                         data: bytes, commit_message: str = None) -> int:
+        """
+        Stores a new version of a file. Blob writes are blocking file IO, so PostgreSQL.add_commit runs in a thread.
+        """
+        return await asyncio.to_thread(
+            PostgreSQL.shared().add_commit, owner, repo_name, author, rel_file_path, version, data, commit_message
+        )
+
+    async def get_file(self, owner: str, repo_name: str, rel_file_path: str, version: tuple = None,
+                       view_private=False, ref: str = None) -> bytes:
+        """
+        Reads a file from a repository. Blob reads are blocking file IO, so PostgreSQL.get_file runs in a thread.
+        """
+        return await asyncio.to_thread(
+            PostgreSQL.shared().get_file, owner, repo_name, rel_file_path, version, view_private, ref
+        )
+
+    async def snapshot_files(self, owner: str, repo_name: str, version: tuple = None,
+                             view_private=False, ref: str = None) -> list[dict] | None:
+        """
+        The async version of PostgreSQL.snapshot_files(). The newest files of the default branch are read from
+        repo_head_files here. Other versions and branches need the history, which is read in a thread.
+        """
+        if version is not None or (ref is not None and ref != ref_store.DEFAULT_BRANCH):
+            return await asyncio.to_thread(
+                PostgreSQL.shared().snapshot_files, owner, repo_name, version, view_private, ref
+            )
+
+        repo = await self.fetchrow(
+            'SELECT repo_id, private FROM repositories WHERE owner = $1 AND name = $2;', owner, repo_name, readonly=True
+        )
+        if repo is None or (repo['private'] and not view_private):
+            return None
+
+        rows = await self.fetch(
+            """
+            SELECT rel_file_path, blob_hash, size, version_major, version_minor, version_patch, commit_date
+            FROM repo_head_files
+            WHERE repo_id = $1
+            ORDER BY rel_file_path;
+            """,
+            repo['repo_id'],
+            readonly=True
+        )
+        return [
+            {
+                'path': row['rel_file_path'],
+                'blob_hash': row['blob_hash'],
+                'size': row['size'],
+                'version': (row['version_major'], row['version_minor'], row['version_patch']),
+                'commit_date': row['commit_date'],
+            }
+            for row in rows
+        ]
+
+    async def iter_repos(self, username, private=None, after=0, limit=None):
+        """
+        Streams a user's repositories in repo_id order, through a server-side cursor.
+        Takes the same arguments as PostgreSQL.iter_repos.
+        """
+        await self.check_exists(username)
+
+        started = time.perf_counter()
+        rows = 0
+        pool = await self.get_read_pool()
+        while True:
+            try:
+                async with pool.acquire() as conn:
+                    # Server-side cursors only live as long as their transaction.
+                    async with conn.transaction(readonly=True):
+                        cursor = conn.cursor(
+                            f"""
+                            SELECT repo_id, name, description, owner, created_on, last_updated, private,
+                                COALESCE(usage.bytes, 0) AS stored_bytes, COALESCE(usage.files, 0) AS stored_files
+                            FROM repositories
+                            LEFT JOIN LATERAL (
+                                SELECT SUM(bytes)::BIGINT AS bytes, SUM(files)::BIGINT AS files
+                                FROM repository_usage
+                                WHERE repository_usage.repo_id = repositories.repo_id
+                            ) AS usage ON TRUE
+                            WHERE owner = $1 AND repo_id > $2{'' if private is None else ' AND private = $4'}
+                            ORDER BY repo_id
+                            LIMIT $3;
+                            """,
+                            *((username, after, limit) if private is None else (username, after, limit, private)),
+                            prefetch=PostgreSQL.LISTING_BATCH_SIZE
+                        )
+                        async for row in cursor:
+                            rows += 1
+                            yield dict(row)
+                break
+            except AsyncPostgreSQL.REPLICA_ERRORS:
+                # Only if nothing has been streamed yet, or the rows would be listed twice.
+                primary = await self._move_to_primary(pool) if rows == 0 else None
+                if primary is None:
+                    raise
+                pool = primary
+        query_stats.record('AsyncPostgreSQL.iter_repos', time.perf_counter() - started, rows, 0.0)
+
+    @read_cache.cached('public_repos', key_args=1)
+    async def list_public_repos(self, username, after=0, limit=None):
+        return [repo async for repo in self.iter_repos(username, private=False, after=after, limit=limit)]
+
+    async def list_private_repos(self, username, after=0, limit=None):
+        return [repo async for repo in self.iter_repos(username, private=True, after=after, limit=limit)]
+
+    async def list_repos(self, username, after=0, limit=None):
+        """
+        Lists both the public and private repositories of a user, in one repo_id order.
+        """
+        return [repo async for repo in self.iter_repos(username, after=after, limit=limit)]
+
+    @read_cache.cached('repo')
+    async def get_repo(self, owner, name):
+        await self.check_exists(owner)
+        row = await self.fetchrow(
+            """
+            SELECT repo_id, name, description, owner, created_on, last_updated, private
+            FROM repositories
+            WHERE owner = $1 AND name = $2;
+            """,
+            owner, name, readonly=True
+        )
+        return tuple(row) if row is not None else None
+
+    @read_cache.cached('repo_exists', key_args=2)
+    async def repository_exists(self, owner, repo_name, view_private=False):
+        """
+        Checks if a repository exists. Private repositories are reported as not existing, unless view_private.
+        Both answers are cached under the repository, so invalidate_repository() clears them together.
+        """
+        return await self.fetchval(
+            f"""
+            SELECT EXISTS(
+                SELECT 1 FROM repositories WHERE owner = $1 AND name = $2{'' if view_private else ' AND private = FALSE'}
+            )
+            """,
+            owner, repo_name, readonly=True
+        )
+
+    async def list_users_docker_containers(self, username):
+        await self.check_exists(username)
+        rows = await self.fetch(
+            """
+            SELECT container_id
+            FROM user_containers
+            WHERE owner = $1;
+            """,
+            username
+        )
+        return [tuple(row) for row in rows]
+
+    async def register_docker_container(self, username, container_id):
+        await self.check_exists(username)
+        await self.execute(
+            """
+            INSERT INTO user_containers (container_id, owner)
+            VALUES ($1, $2);
+            """,
+            container_id, username
+        )
+
+    async def remove_docker_container(self, container_id):
+        await self.execute(
+            """
+            DELETE FROM user_containers
+            WHERE container_id = $1;
+            """,
+            container_id
+        )
@@ -0,0 +1,548 @@
+from library.delta import delta, base_cache
+from library.compression import compressor
+from library.settings import var, dt
+from library.errors import error
+import threading
+import datetime
+import tempfile
+import hashlib
+import logging
+import io
+import os
+
+class blob_store:
+    """
+    Content-addressed storage for file contents. Each distinct content is kept once, under the SHA-256 of its bytes,
+    no matter how many versions or repositories use it. Commits point at their content by that hash.
+
+    Where the bytes live is set by blobs.backend in settings.json. 'disk' keeps them in files under blobs.path,
+    'database' keeps them in the bytea column of the blobs table. Either way, the blobs table knows every blob.
+    All methods take a cursor so blobs are written in the same transaction as the commits that use them.
+
+    A blob may be stored as a delta against another blob (see library.packs). Reading one rebuilds it
+    from the chain of deltas down to a whole blob, so callers always get the full content.
+    What is stored, whole or delta, is compressed (see library.compression), and decompressed again on reading.
+    """
+    BACKENDS = ('disk', 'database')
+    # Blobs younger than this are never garbage collected, as an upload may be about to use them.
+    GC_GRACE_PERIOD = datetime.timedelta(hours=1)
+    # A longer chain than this can only come from a loop of deltas, which would be a bug.
+    MAX_CHAIN = 64
+    # How much of a file is read at a time when hashing or storing it from disk.
+    BLOCK_SIZE = 1024 * 1024
+
+    _lock = threading.Lock()
+    _config_cache = None
+    stats = {
+        'stored': 0,  # Blobs written for the first time
+        'deduplicated': 0,  # Writes of content that was already stored
+        'read': 0,
+    }
+
+    @staticmethod
+    def config() -> dict:
+        if blob_store._config_cache is None:
+            # Settings files made before blobs existed do not have the section, so fall back to the defaults.
+            backend = var.get('blobs.backend', dt.SETTINGS['blobs']['backend'])
+            assert backend in blob_store.BACKENDS, f"blobs.backend must be one of {', '.join(blob_store.BACKENDS)}."
+            blob_store._config_cache = {
+                'backend': backend,
+                'path': var.get('blobs.path', dt.SETTINGS['blobs']['path']),
+            }
+        return blob_store._config_cache
+
+    @staticmethod
+    def hash_bytes(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def path_for(blob_hash: str, delta_base: str = None, codec='none', dict_id: int = None) -> str:
+        """
+        Gets where a blob is kept on disk. Blobs are spread over two levels of folders so none gets too big.
+
+        The file name says how the blob is stored: what it is a delta against, and how it is compressed.
+        Changing how a blob is stored so always writes a new file, and never overwrites the one a reader
+        may be about to open. The old file is removed by discard_stale_files() once the change is committed.
+        """
+        path = os.path.join(blob_store.config()['path'], blob_hash[:2], blob_hash[2:4], blob_hash)
+        if delta_base is not None:
+            path += f'.delta-{delta_base[:16]}'
+        if codec != 'none':
+            path += f'.{codec}-{dict_id}' if dict_id is not None else f'.{codec}'
+        return path
+
+    @staticmethod
+    def hash_file(path: str) -> str:
+        """
+        Hashes a file on disk a block at a time, the same way hash_bytes() hashes content in memory.
+        """
+        hasher = hashlib.sha256()
+        with open(path, 'rb') as source:
+            for block in iter(lambda: source.read(blob_store.BLOCK_SIZE), b''):
+                hasher.update(block)
+        return hasher.hexdigest()
+
+    @staticmethod
+    def _write_file_with(folder: str, write) -> str:
+        """
+        Writes a blob file through a temporary file, so a crash never leaves a half written blob under its real name.
+
+        :param write: Writes the content to the open temporary file it is given, and returns the path to move it to.
+        :return: That path.
+        """
+        os.makedirs(folder, exist_ok=True)
+        descriptor, temp_path = tempfile.mkstemp(dir=folder, prefix='.incoming-')
+        try:
+            with os.fdopen(descriptor, 'w+b') as temp_file:
+                path = write(temp_file)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            os.replace(temp_path, path)
+            return path
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    @staticmethod
+    def _write_file(path: str, data: bytes):
+        def write(temp_file):
+            temp_file.write(data)
+            return path
+        blob_store._write_file_with(os.path.dirname(path), write)
+
+    @staticmethod
+    def _claim(cur, blob_hash: str) -> bool:
+        """
+        Checks if a blob is already stored. If it is, its row is locked, which stops garbage collection
+        deleting it before the caller's commit uses it.
+        """
+        cur.execute('SELECT 1 FROM blobs WHERE hash = %s FOR KEY SHARE;', (blob_hash,))
+        if cur.fetchone() is None:
+            return False
+        with blob_store._lock:
+            blob_store.stats['deduplicated'] += 1
+        return True
+
+    @staticmethod
+    def _record(cur, blob_hash: str, size: int, stored_size: int, backend: str, stored: bytes | None, codec: str,
+                dict_id: int | None):
+        cur.execute(
+            """
+            INSERT INTO blobs (hash, size, stored_size, location, data, codec, dict_id)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (hash) DO NOTHING;
+            """,
+            (blob_hash, size, stored_size, backend, None if backend == 'disk' else stored, codec, dict_id)
+        )
+        with blob_store._lock:
+            blob_store.stats['stored'] += 1
+
+    @staticmethod
+    def put(cur, data: bytes, repo_id: int = None) -> str:
+        """
+        Stores file content, unless the same content is already stored.
+
+        :param cur: The cursor to record the blob with. The caller commits.
+        :param data: The raw file content.
+        :param repo_id: The repository the content is committed to, whose dictionary it is compressed with.
+        :return: The hash of the content, to reference it by.
+        """
+        assert isinstance(data, (bytes, bytearray, memoryview)), "Blob data must be bytes."
+        data = bytes(data)
+        blob_hash = blob_store.hash_bytes(data)
+        if blob_store._claim(cur, blob_hash):
+            return blob_hash
+
+        stored, codec, dict_id = compressor.compress(cur, data, repo_id)
+        backend = blob_store.config()['backend']
+        if backend == 'disk':
+            blob_store._write_file(blob_store.path_for(blob_hash, None, codec, dict_id), stored)
+        blob_store._record(cur, blob_hash, len(data), len(stored), backend, stored, codec, dict_id)
+        return blob_hash
+
+    @staticmethod
+    def put_file(cur, path: str, blob_hash: str, repo_id: int = None) -> str:
+        """
+        Stores the content of a file on disk, unless the same content is already stored. The file is read
+        a block at a time and compressed straight into the blob store, so memory use does not depend on its size.
+        The database backend is the exception, as there the content has to go into a single bytea value.
+
+        :param cur: The cursor to record the blob with. The caller commits.
+        :param path: The file to store.
+        :param blob_hash: The hash of the file, which the caller has already checked with hash_file().
+        :param repo_id: The repository the content is committed to, whose dictionary it is compressed with.
+        :return: blob_hash.
+        """
+        if blob_store._claim(cur, blob_hash):
+            return blob_hash
+
+        size = os.path.getsize(path)
+        backend = blob_store.config()['backend']
+        if backend != 'disk':
+            with open(path, 'rb') as source:
+                stored, codec, dict_id = compressor.compress(cur, source.read(), repo_id)
+            blob_store._record(cur, blob_hash, size, len(stored), backend, stored, codec, dict_id)
+            return blob_hash
+
+        stored_as = {}
+
+        def write(temp_file):
+            with open(path, 'rb') as source:
+                codec, dict_id = compressor.compress_stream(cur, source, temp_file, size, repo_id)
+            stored_as.update(codec=codec, dict_id=dict_id, stored_size=temp_file.tell())
+            return blob_store.path_for(blob_hash, None, codec, dict_id)
+
+        blob_store._write_file_with(os.path.dirname(blob_store.path_for(blob_hash)), write)
+        blob_store._record(
+            cur, blob_hash, size, stored_as['stored_size'], backend, None, stored_as['codec'], stored_as['dict_id']
+        )
+        return blob_hash
+
+    @staticmethod
+    def exists(cur, blob_hash: str) -> bool:
+        cur.execute('SELECT EXISTS (SELECT 1 FROM blobs WHERE hash = %s);', (blob_hash,))
+        return cur.fetchone()[0]
+
+    @staticmethod
+    def _read_stored(cur, blob_hash: str) -> tuple[bytes, str | None]:
+        """
+        Reads a blob the way it is stored, decompressed but without rebuilding it from its deltas.
+
+        :return: The whole content or the delta, and the hash of the blob they are a delta against, or None if they are whole.
+        """
+        # The packer may change how the blob is stored between reading the row and opening the file,
+        # and then removes the old file. Reading the row again finds the new one.
+        for attempt in range(2):
+            cur.execute(
+                'SELECT location, data, delta_base, codec, dict_id FROM blobs WHERE hash = %s;', (blob_hash,)
+            )
+            row = cur.fetchone()
+            if row is None:
+                raise error.blob_not_found(blob_hash)
+
+            location, data, delta_base, codec, dict_id = row
+            if location == 'disk':
+                try:
+                    with open(blob_store.path_for(blob_hash, delta_base, codec, dict_id), 'rb') as blob_file:
+                        data = blob_file.read()
+                except FileNotFoundError:
+                    continue
+            return compressor.decompress(cur, bytes(data), codec, dict_id), delta_base
+        raise error.blob_not_found(blob_hash)
+
+    @staticmethod
+    def get(cur, blob_hash: str) -> bytes:
+        """
+        Reads the content of a blob, rebuilding it from its deltas if it is stored as one.
+
+        :raises error.blob_not_found: If no blob has that hash.
+        """
+        # Follow the chain down to a whole blob, or one whose content is cached.
+        patches = []
+        current = blob_hash
+        while True:
+            content = base_cache.get(current) if patches else None
+            if content is not None:
+                break
+            stored, delta_base = blob_store._read_stored(cur, current)
+            if delta_base is None:
+                content = stored
+                if patches:
+                    base_cache.put(current, content)
+                break
+            patches.append((current, stored))
+            if len(patches) > blob_store.MAX_CHAIN:
+                raise RuntimeError(f"The deltas of blob {blob_hash} loop back on themselves.")
+            current = delta_base
+
+        # Then apply the deltas back up, keeping each rebuilt base for next time.
+        for position, (patched_hash, patch) in enumerate(reversed(patches)):
+            content = delta.apply(content, patch)
+            if position < len(patches) - 1:
+                base_cache.put(patched_hash, content)
+
+        with blob_store._lock:
+            blob_store.stats['read'] += 1
+        return content
+
+    @staticmethod
+    def open_reader(cur, blob_hash: str):
+        """
+        Opens a blob to be read a block at a time. A whole blob on disk is read and decompressed straight from
+        its file, so memory use does not depend on its size. Deltas and blobs in the database have to be
+        rebuilt in memory first. The newest version of a file is always whole, once its repository is repacked.
+
+        The cursor is only used while opening, so the caller can give its connection back before reading.
+
+        :return: A file-like object with the content, which the caller closes.
+        :raises error.blob_not_found: If no blob has that hash.
+        """
+        # As in _read_stored(), a repack may replace the file between reading the row and opening it.
+        for attempt in range(2):
+            cur.execute('SELECT location, delta_base, codec, dict_id FROM blobs WHERE hash = %s;', (blob_hash,))
+            row = cur.fetchone()
+            if row is None:
+                raise error.blob_not_found(blob_hash)
+
+            location, delta_base, codec, dict_id = row
+            if location != 'disk' or delta_base is not None:
+                return io.BytesIO(blob_store.get(cur, blob_hash))
+            try:
+                source = open(blob_store.path_for(blob_hash, delta_base, codec, dict_id), 'rb')
+            except FileNotFoundError:
+                continue
+            # Once open, the file can still be read after the packer removes it.
+            return compressor.open_stream(cur, source, codec, dict_id)
+        raise error.blob_not_found(blob_hash)
+
+    @staticmethod
+    def representation(cur, blob_hash: str) -> tuple[str | None, int]:
+        """
+        :return: The hash of the blob this one is a delta against (None if it is whole), and its chain depth.
+        """
+        cur.execute('SELECT delta_base, depth FROM blobs WHERE hash = %s;', (blob_hash,))
+        row = cur.fetchone()
+        if row is None:
+            raise error.blob_not_found(blob_hash)
+        return row[0], row[1]
+
+    @staticmethod
+    def _restore(cur, blob_hash: str, stored: bytes, codec: str, dict_id: int | None, delta_base: str | None,
+                 depth: int):
+        backend = blob_store.config()['backend']
+        if backend == 'disk':
+            blob_store._write_file(blob_store.path_for(blob_hash, delta_base, codec, dict_id), stored)
+        cur.execute(
+            """
+            UPDATE blobs
+            SET delta_base = %s, depth = %s, stored_size = %s, location = %s, data = %s, codec = %s, dict_id = %s
+            WHERE hash = %s;
+            """,
+            (
+                delta_base, depth, len(stored), backend, None if backend == 'disk' else stored, codec, dict_id,
+                blob_hash
+            )
+        )
+
+    @staticmethod
+    def store_as_delta(cur, blob_hash: str, base_hash: str, patch: bytes, depth: int, repo_id: int = None):
+        """
+        Switches a blob to being stored as a delta. Once the caller has committed,
+        discard_stale_files() removes the file of the old representation.
+
+        :param repo_id: The repository whose dictionary the delta is compressed with.
+        """
+        blob_store._restore(cur, blob_hash, *compressor.compress(cur, patch, repo_id), base_hash, depth)
+
+    @staticmethod
+    def store_as_whole(cur, blob_hash: str, content: bytes, repo_id: int = None):
+        """
+        Switches a blob to being stored whole. Once the caller has committed,
+        discard_stale_files() removes the file of the old representation.
+
+        :param repo_id: The repository whose dictionary the content is compressed with.
+        """
+        blob_store._restore(cur, blob_hash, *compressor.compress(cur, content, repo_id), None, 0)
+
+    @staticmethod
+    def recompress(cur, blob_hash: str, repo_id: int) -> bool:
+        """
+        Compresses a blob with the dictionary of a repository, if it was stored before the repository had one,
+        keeping it whole or a delta as it is. Once the caller has committed, discard_stale_files() removes
+        the old file. Blobs already compressed with a dictionary, even an older one, are left alone.
+
+        :return: Whether the blob was rewritten.
+        """
+        cur.execute(
+            'SELECT codec, dict_id, delta_base, depth, stored_size FROM blobs WHERE hash = %s;', (blob_hash,)
+        )
+        row = cur.fetchone()
+        if row is None:
+            raise error.blob_not_found(blob_hash)
+        codec, dict_id, delta_base, depth, stored_size = row
+        if dict_id is not None or (codec != 'none' and compressor.latest_dictionary(cur, repo_id) is None):
+            return False
+
+        stored, codec, dict_id = compressor.compress(cur, blob_store._read_stored(cur, blob_hash)[0], repo_id)
+        if len(stored) >= stored_size:
+            return False
+        blob_store._restore(cur, blob_hash, stored, codec, dict_id, delta_base, depth)
+        return True
+
+    @staticmethod
+    def discard_stale_files(cur, blob_hash: str):
+        """
+        Removes the files of the ways a blob is no longer stored. Only call it once the change is committed.
+        """
+        cur.execute('SELECT location, delta_base, codec, dict_id FROM blobs WHERE hash = %s;', (blob_hash,))
+        row = cur.fetchone()
+        current = blob_store.path_for(blob_hash, *row[1:]) if row is not None and row[0] == 'disk' else None
+
+        folder = os.path.dirname(blob_store.path_for(blob_hash))
+        try:
+            names = os.listdir(folder)
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(folder, name)
+            # Files being garbage collected end in .deleting, and the collector removes those itself.
+            if name.startswith(blob_hash) and path != current and not name.endswith('.deleting'):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except PermissionError:
+                    # Windows does not remove files that are open, such as one a pull is streaming.
+                    # It is removed the next time the blob's representation changes.
+                    logging.warning(f"Could not remove the stale blob file {path}, as it is in use.")
+
+    @staticmethod
+    def collect_garbage(conn) -> int:
+        """
+        Deletes the blobs no commit uses any more. Blobs stored within GC_GRACE_PERIOD are kept.
+        Then removes the files no blob is stored in (see _sweep_orphan_files()).
+
+        :param conn: The connection to use. It is committed.
+        :return: How many blobs were deleted.
+        """
+        cur = conn.cursor()
+        moved = []
+        try:
+            cur.execute(
+                """
+                DELETE FROM blobs
+                WHERE created_on < %s
+                  AND NOT EXISTS (SELECT 1 FROM commits WHERE commits.blob_hash = blobs.hash)
+                  -- Blobs other blobs are deltas against are kept, or those could not be read any more.
+                  AND NOT EXISTS (SELECT 1 FROM blobs AS dependant WHERE dependant.delta_base = blobs.hash)
+                RETURNING hash, location, delta_base, codec, dict_id;
+                """,
+                (datetime.datetime.now() - blob_store.GC_GRACE_PERIOD,)
+            )
+            deleted = cur.fetchall()
+
+            # Dictionaries no blob uses any more. One is only deleted once a newer dictionary of its repository
+            # has been around for the grace period too, as until then a process may still compress with it.
+            cur.execute(
+                """
+                DELETE FROM compression_dicts
+                WHERE NOT EXISTS (SELECT 1 FROM blobs WHERE blobs.dict_id = compression_dicts.dict_id)
+                  AND EXISTS (
+                      SELECT 1 FROM compression_dicts AS newer
+                      WHERE newer.repo_id = compression_dicts.repo_id
+                        AND newer.dict_id > compression_dicts.dict_id
+                        AND newer.trained_on < %s
+                  );
+                """,
+                (datetime.datetime.now() - blob_store.GC_GRACE_PERIOD,)
+            )
+
+            # The files are moved aside before the commit. A put of the same content waits on the deleted rows,
+            # so once we commit it writes a fresh file that nothing here touches.
+            for blob_hash, location, delta_base, codec, dict_id in deleted:
+                path = blob_store.path_for(blob_hash, delta_base, codec, dict_id)
+                if location == 'disk' and os.path.exists(path):
+                    os.replace(path, f'{path}.deleting')
+                    moved.append(path)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            for path in moved:
+                os.replace(f'{path}.deleting', path)
+            raise
+        finally:
+            cur.close()
+
+        for path in moved:
+            os.remove(f'{path}.deleting')
+        logging.info(f"Garbage collected {len(deleted)} unused blobs.")
+
+        cur = conn.cursor()
+        try:
+            swept = blob_store._sweep_orphan_files(cur)
+        finally:
+            cur.close()
+            conn.rollback()
+        if swept:
+            logging.info(f"Removed {swept} blob files no blob is stored in.")
+        return len(deleted)
+
+    @staticmethod
+    def _sweep_orphan_files(cur) -> int:
+        """
+        Removes the files under blobs.path that are older than GC_GRACE_PERIOD and are not how any blob is stored.
+        Blob files are written before the transaction that records them commits, so one that rolls back,
+        such as a push that lost a race for its branch, leaves its files behind. So does a process that
+        dies between writing a temporary file and moving it into place, or before discard_stale_files().
+
+        Younger files are kept, as the transaction that wrote them may not have committed yet.
+        Files being garbage collected, which end in .deleting, are left to the collector.
+
+        :return: How many files were removed.
+        """
+        root = blob_store.config()['path']
+        cutoff = (datetime.datetime.now() - blob_store.GC_GRACE_PERIOD).timestamp()
+        removed = 0
+        # Blobs are spread over two levels of folders, as in path_for().
+        folders = [folder for top in blob_store._list_folders(root) for folder in blob_store._list_folders(top)]
+        for folder in folders:
+            old = []
+            for name in os.listdir(folder):
+                path = os.path.join(folder, name)
+                if name.endswith('.deleting'):
+                    continue
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        old.append(path)
+                except FileNotFoundError:
+                    pass
+            if not old:
+                continue
+
+            # Look the rows up after listing, so a file moved into place and committed since is never missed.
+            cur.execute(
+                'SELECT hash, delta_base, codec, dict_id FROM blobs WHERE hash = ANY(%s) AND location = %s;',
+                (list({os.path.basename(path)[:64] for path in old}), 'disk')
+            )
+            current = {blob_store.path_for(*row) for row in cur.fetchall()}
+            for path in old:
+                if path in current:
+                    continue
+                try:
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+                except PermissionError:
+                    logging.warning(f"Could not remove the orphaned blob file {path}, as it is in use.")
+        return removed
+
+    @staticmethod
+    def _list_folders(folder: str) -> list[str]:
+        try:
+            return [entry.path for entry in os.scandir(folder) if entry.is_dir()]
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def statistics(cur) -> dict:
+        cur.execute(
+            """
+            SELECT location, COUNT(*), COUNT(delta_base), COALESCE(SUM(size), 0), COALESCE(SUM(stored_size), 0)
+            FROM blobs
+            GROUP BY location;
+            """
+        )
+        stats = {
+            'backend': blob_store.config()['backend'],
+            'locations': {
+                location: {'blobs': count, 'deltas': deltas, 'bytes': int(size), 'stored_bytes': int(stored_size)}
+                for location, count, deltas, size, stored_size in cur.fetchall()
+            },
+            'base_cache': base_cache.statistics(),
+            'compression': compressor.statistics(cur),
+        }
+        with blob_store._lock:
+            stats.update(blob_store.stats)
+        return stats
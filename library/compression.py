@@ -0,0 +1,268 @@
+from library.settings import var, dt
+from library.errors import error
+import threading
+import zstandard
+import logging
+import shutil
+import time
+
+class compressor:
+    """
+    Compresses blobs with zstd.
+
+    Each repository gets a dictionary trained on a sample of its own files, so the boilerplate they share
+    (licence headers, imports, the same few keywords) is in the dictionary instead of in every blob.
+    That is what makes small files compress well, as on their own they are too short to find anything to reuse.
+    Blobs record the id of the dictionary they were compressed with, so an old dictionary is kept for as long
+    as a blob needs it, and retraining only changes how new blobs are stored.
+    """
+    CODECS = ('none', 'zstd')
+    LEVEL = 3
+    # Content shorter than this never gets smaller, as the frame header alone is a few bytes.
+    MIN_SIZE = 32
+    DICTIONARY_SIZE = 64 * 1024
+    # Training needs at least this many files, and this much content, to make a dictionary worth having.
+    MIN_SAMPLES = 8
+    MIN_SAMPLE_BYTES = 8 * 1024
+    MAX_SAMPLES = 2000
+    # Only the start of each file is sampled, so a few big files do not crowd out the boilerplate of the rest.
+    SAMPLE_PREFIX = 16 * 1024
+    MAX_SAMPLE_BYTES = 8 * 1024 * 1024
+    # How long the newest dictionary of a repository is remembered before it is looked up again.
+    LOOKUP_TTL = 60
+
+    _lock = threading.Lock()
+    _config_cache = None
+    _dictionaries = {}  # dict_id: zstandard.ZstdCompressionDict
+    _latest = {}  # repo_id: (looked up at, dict_id or None)
+    stats = {
+        'compressed': 0,
+        'stored_raw': 0,  # Blobs compression did not make smaller
+        'bytes_in': 0,
+        'bytes_out': 0,
+        'trained': 0,
+    }
+
+    @staticmethod
+    def config() -> dict:
+        if compressor._config_cache is None:
+            compressor._config_cache = {
+                'compression': bool(var.get('blobs.compression', dt.SETTINGS['blobs']['compression'])),
+                'dictionary_retrain_interval': float(var.get(
+                    'blobs.dictionary_retrain_interval', dt.SETTINGS['blobs']['dictionary_retrain_interval']
+                )),
+            }
+        return compressor._config_cache
+
+    @staticmethod
+    def _load_dictionary(cur, dict_id: int) -> zstandard.ZstdCompressionDict:
+        with compressor._lock:
+            dictionary = compressor._dictionaries.get(dict_id)
+        if dictionary is not None:
+            return dictionary
+
+        cur.execute('SELECT data FROM compression_dicts WHERE dict_id = %s;', (dict_id,))
+        row = cur.fetchone()
+        if row is None:
+            raise error.blob_not_found(f"compression dictionary {dict_id}")
+        dictionary = zstandard.ZstdCompressionDict(bytes(row[0]))
+        # Dictionaries are immutable, so they are cached for good.
+        dictionary.precompute_compress(level=compressor.LEVEL)
+        with compressor._lock:
+            compressor._dictionaries[dict_id] = dictionary
+        return dictionary
+
+    @staticmethod
+    def latest_dictionary(cur, repo_id: int) -> int | None:
+        """
+        :return: The id of the newest dictionary of a repository, or None if it does not have one yet.
+        """
+        with compressor._lock:
+            cached = compressor._latest.get(repo_id)
+        if cached is not None and time.monotonic() - cached[0] < compressor.LOOKUP_TTL:
+            return cached[1]
+
+        cur.execute(
+            'SELECT dict_id FROM compression_dicts WHERE repo_id = %s ORDER BY dict_id DESC LIMIT 1;',
+            (repo_id,)
+        )
+        row = cur.fetchone()
+        dict_id = row[0] if row is not None else None
+        with compressor._lock:
+            compressor._latest[repo_id] = (time.monotonic(), dict_id)
+        return dict_id
+
+    @staticmethod
+    def _context(cur, repo_id: int | None) -> tuple[zstandard.ZstdCompressor, int | None]:
+        """
+        :return: A compressor using the newest dictionary of the repository, and that dictionary's id.
+        Without a repository, or if it has no dictionary yet, the compressor uses none and the id is None.
+        """
+        dict_id = compressor.latest_dictionary(cur, repo_id) if repo_id is not None else None
+        if dict_id is None:
+            return zstandard.ZstdCompressor(level=compressor.LEVEL), None
+        return zstandard.ZstdCompressor(
+            level=compressor.LEVEL, dict_data=compressor._load_dictionary(cur, dict_id)
+        ), dict_id
+
+    @staticmethod
+    def compress(cur, data: bytes, repo_id: int = None) -> tuple[bytes, str, int | None]:
+        """
+        Compresses content for storage, with the dictionary of the repository it belongs to if it has one.
+
+        :param repo_id: The repository the content was committed to, or None to compress without a dictionary.
+        :return: The bytes to store, the codec they are in, and the id of the dictionary used (None if none was).
+        """
+        if not compressor.config()['compression'] or len(data) < compressor.MIN_SIZE:
+            return data, 'none', None
+
+        context, dict_id = compressor._context(cur, repo_id)
+        compressed = context.compress(data)
+
+        with compressor._lock:
+            compressor.stats['bytes_in'] += len(data)
+            if len(compressed) >= len(data):
+                compressor.stats['stored_raw'] += 1
+                compressor.stats['bytes_out'] += len(data)
+                return data, 'none', None
+            compressor.stats['compressed'] += 1
+            compressor.stats['bytes_out'] += len(compressed)
+        return compressed, 'zstd', dict_id
+
+    @staticmethod
+    def compress_stream(cur, source, target, size: int, repo_id: int = None) -> tuple[str, int | None]:
+        """
+        Like compress(), but from one open file to another, a block at a time.
+
+        :param source: The file to compress, at its start.
+        :param target: The empty file to write the result to. It must be readable and seekable too.
+        :param size: The size of source.
+        :return: The codec the result is in, and the id of the dictionary used (None if none was).
+        """
+        if compressor.config()['compression'] and size >= compressor.MIN_SIZE:
+            context, dict_id = compressor._context(cur, repo_id)
+            # The size goes in the frame header, which decompress() needs.
+            context.copy_stream(source, target, size=size)
+            written = target.tell()
+
+            with compressor._lock:
+                compressor.stats['bytes_in'] += size
+                if written < size:
+                    compressor.stats['compressed'] += 1
+                    compressor.stats['bytes_out'] += written
+                    return 'zstd', dict_id
+                compressor.stats['stored_raw'] += 1
+                compressor.stats['bytes_out'] += size
+
+            # It did not get smaller, so store it as it is after all.
+            source.seek(0)
+            target.seek(0)
+            target.truncate()
+        shutil.copyfileobj(source, target)
+        return 'none', None
+
+    @staticmethod
+    def decompress(cur, stored: bytes, codec: str, dict_id: int | None) -> bytes:
+        """
+        Turns stored bytes back into the content compress() was given.
+        """
+        if codec == 'none':
+            return stored
+        if codec == 'zstd':
+            if dict_id is None:
+                return zstandard.ZstdDecompressor().decompress(stored)
+            return zstandard.ZstdDecompressor(dict_data=compressor._load_dictionary(cur, dict_id)).decompress(stored)
+        raise ValueError(f"Unknown blob codec {codec}.")
+
+    @staticmethod
+    def open_stream(cur, source, codec: str, dict_id: int | None):
+        """
+        Like decompress(), but returns a file-like object that decompresses source as it is read.
+        Closing it closes source.
+        """
+        if codec == 'none':
+            return source
+        if codec == 'zstd':
+            if dict_id is None:
+                return zstandard.ZstdDecompressor().stream_reader(source, closefd=True)
+            dictionary = compressor._load_dictionary(cur, dict_id)
+            return zstandard.ZstdDecompressor(dict_data=dictionary).stream_reader(source, closefd=True)
+        raise ValueError(f"Unknown blob codec {codec}.")
+
+    @staticmethod
+    def needs_training(cur, repo_id: int) -> bool:
+        """
+        Checks if a repository has no dictionary yet, or one older than blobs.dictionary_retrain_interval.
+        """
+        interval = compressor.config()['dictionary_retrain_interval']
+        if not compressor.config()['compression'] or interval <= 0:
+            return False
+        cur.execute(
+            """
+            SELECT MAX(trained_on) > LOCALTIMESTAMP - make_interval(secs => %s)
+            FROM compression_dicts
+            WHERE repo_id = %s;
+            """,
+            (interval, repo_id)
+        )
+        return not cur.fetchone()[0]
+
+    @staticmethod
+    def train(cur, repo_id: int, samples: list) -> int | None:
+        """
+        Trains a new dictionary for a repository and makes it the one new blobs of the repository use.
+
+        :param cur: The cursor to record the dictionary with. The caller commits.
+        :param samples: The contents of files of the repository. Only the start of each is used.
+        :return: The id of the new dictionary, or None if there was too little to train on.
+        """
+        samples = [bytes(sample[:compressor.SAMPLE_PREFIX]) for sample in samples if sample]
+        samples = samples[:compressor.MAX_SAMPLES]
+        total = sum(len(sample) for sample in samples)
+        if len(samples) < compressor.MIN_SAMPLES or total < compressor.MIN_SAMPLE_BYTES:
+            return None
+
+        try:
+            # A dictionary bigger than a fraction of what it was trained on just memorises the samples.
+            trained = zstandard.train_dictionary(
+                min(compressor.DICTIONARY_SIZE, total // 4), samples, level=compressor.LEVEL
+            )
+        except zstandard.ZstdError:
+            logging.warning(f"Could not train a compression dictionary for repository {repo_id}.", exc_info=True)
+            return None
+
+        cur.execute(
+            """
+            INSERT INTO compression_dicts (repo_id, codec, data, sample_count)
+            VALUES (%s, 'zstd', %s, %s)
+            RETURNING dict_id;
+            """,
+            (repo_id, trained.as_bytes(), len(samples))
+        )
+        dict_id = cur.fetchone()[0]
+        with compressor._lock:
+            # Forgotten rather than set, as the caller may still roll back.
+            compressor._latest.pop(repo_id, None)
+            compressor.stats['trained'] += 1
+        logging.info(f"Trained compression dictionary {dict_id} for repository {repo_id} on {len(samples)} files.")
+        return dict_id
+
+    @staticmethod
+    def statistics(cur) -> dict:
+        cur.execute(
+            'SELECT codec, COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(stored_size), 0) FROM blobs GROUP BY codec;'
+        )
+        codecs = {
+            codec: {'blobs': count, 'bytes': int(size), 'stored_bytes': int(stored_size)}
+            for codec, count, size, stored_size in cur.fetchall()
+        }
+        cur.execute('SELECT COUNT(*), COUNT(DISTINCT repo_id) FROM compression_dicts;')
+        dictionaries, repositories = cur.fetchone()
+        stats = {
+            'codecs': codecs,
+            'dictionaries': dictionaries,
+            'repositories_with_dictionaries': repositories,
+        }
+        with compressor._lock:
+            stats.update(compressor.stats)
+        return stats
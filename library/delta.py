@@ -0,0 +1,178 @@
+import collections
+import threading
+
+class delta:
+    """
+    A binary delta format for file versions. A delta is a list of instructions that build the target from
+    pieces of a base: copy a range of the base, or insert literal bytes.
+
+    Matching is done line by line, which is fast in Python and works well for source code and other text,
+    where most of a new version is lines the old one already had. Content without line breaks mostly
+    ends up as inserts, and the packer then keeps it whole instead.
+    """
+    MAGIC = b'RDD1'
+    _INSERT = 0
+    _COPY = 1
+    # Copies shorter than this cost more to describe than the bytes themselves.
+    MIN_COPY = 8
+
+    @staticmethod
+    def _write_varint(out: bytearray, value: int):
+        while value >= 0x80:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+
+    @staticmethod
+    def _read_varint(data: bytes, position: int) -> tuple[int, int]:
+        value = 0
+        shift = 0
+        while True:
+            byte = data[position]
+            position += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value, position
+            shift += 7
+
+    @staticmethod
+    def _flush_insert(out: bytearray, target: bytes, start: int, end: int):
+        if end > start:
+            out.append(delta._INSERT)
+            delta._write_varint(out, end - start)
+            out += target[start:end]
+
+    @staticmethod
+    def encode(base: bytes, target: bytes) -> bytes:
+        """
+        Makes a delta that turns base into target.
+        """
+        # Where each distinct line of the base first starts
+        base_lines = {}
+        offset = 0
+        for line in base.splitlines(keepends=True):
+            base_lines.setdefault(line, offset)
+            offset += len(line)
+
+        out = bytearray(delta.MAGIC)
+        delta._write_varint(out, len(base))
+        delta._write_varint(out, len(target))
+
+        insert_start = 0  # Start of the target bytes not yet covered by an instruction
+        copy_start = copy_end = None  # The base range of the copy being built
+        copy_target_start = 0
+        position = 0
+
+        def flush_copy():
+            nonlocal insert_start
+            if copy_start is None:
+                return
+            if copy_end - copy_start >= delta.MIN_COPY:
+                delta._flush_insert(out, target, insert_start, copy_target_start)
+                out.append(delta._COPY)
+                delta._write_varint(out, copy_start)
+                delta._write_varint(out, copy_end - copy_start)
+                insert_start = copy_target_start + (copy_end - copy_start)
+            # A copy too short to be worth it stays part of the pending insert.
+
+        for line in target.splitlines(keepends=True):
+            length = len(line)
+            if copy_start is not None and base[copy_end:copy_end + length] == line:
+                # The next line of the base matches too, so grow the copy.
+                copy_end += length
+            else:
+                flush_copy()
+                base_offset = base_lines.get(line)
+                if base_offset is None:
+                    copy_start = copy_end = None
+                else:
+                    copy_start, copy_end = base_offset, base_offset + length
+                    copy_target_start = position
+            position += length
+
+        flush_copy()
+        delta._flush_insert(out, target, insert_start, len(target))
+        return bytes(out)
+
+    @staticmethod
+    def apply(base: bytes, patch: bytes) -> bytes:
+        """
+        Rebuilds the target from its base and a delta made by encode().
+
+        :raises ValueError: If the delta is damaged or was made for a different base.
+        """
+        if not patch.startswith(delta.MAGIC):
+            raise ValueError("Not a Raindrop delta.")
+        base_length, position = delta._read_varint(patch, len(delta.MAGIC))
+        target_length, position = delta._read_varint(patch, position)
+        if base_length != len(base):
+            raise ValueError("The delta was made against a different base.")
+
+        pieces = []
+        view = memoryview(patch)
+        while position < len(patch):
+            instruction = patch[position]
+            position += 1
+            if instruction == delta._COPY:
+                offset, position = delta._read_varint(patch, position)
+                length, position = delta._read_varint(patch, position)
+                pieces.append(base[offset:offset + length])
+            elif instruction == delta._INSERT:
+                length, position = delta._read_varint(patch, position)
+                pieces.append(view[position:position + length])
+                position += length
+            else:
+                raise ValueError(f"Unknown delta instruction {instruction}.")
+
+        target = b''.join(pieces)
+        if len(target) != target_length:
+            raise ValueError("The delta did not rebuild a target of the right size.")
+        return target
+
+class base_cache:
+    """
+    The most recently rebuilt delta bases, so reading several versions of a file does not rebuild
+    the same chain over and over. Bounded by the total size of the cached content.
+    """
+    _lock = threading.Lock()
+    _entries = collections.OrderedDict()  # Blob hash: content
+    _size = 0
+    max_bytes = 64 * 1024 * 1024
+    stats = {
+        'hits': 0,
+        'misses': 0,
+    }
+
+    @staticmethod
+    def get(blob_hash: str) -> bytes | None:
+        with base_cache._lock:
+            content = base_cache._entries.get(blob_hash)
+            if content is None:
+                base_cache.stats['misses'] += 1
+                return None
+            base_cache._entries.move_to_end(blob_hash)
+            base_cache.stats['hits'] += 1
+            return content
+
+    @staticmethod
+    def put(blob_hash: str, content: bytes):
+        # Anything over a quarter of the cache would push out too much else.
+        if len(content) > base_cache.max_bytes // 4:
+            return
+        with base_cache._lock:
+            if blob_hash in base_cache._entries:
+                base_cache._entries.move_to_end(blob_hash)
+                return
+            base_cache._entries[blob_hash] = content
+            base_cache._size += len(content)
+            while base_cache._size > base_cache.max_bytes:
+                _, evicted = base_cache._entries.popitem(last=False)
+                base_cache._size -= len(evicted)
+
+    @staticmethod
+    def statistics() -> dict:
+        with base_cache._lock:
+            stats = dict(base_cache.stats)
+            stats['entries'] = len(base_cache._entries)
+            stats['bytes'] = base_cache._size
+        return stats
@@ -0,0 +1,324 @@
+from library.blobstore import blob_store
+from library.settings import var, dt
+from library.errors import error
+import collections
+import threading
+
+class diff_engine:
+    """
+    Line diffs between two blobs, as JSON hunks or as a unified diff.
+
+    Lines are matched with Myers' algorithm, in its linear space form, so memory stays in proportion to the
+    size of the files however different they are. The lines the files start and end with in common are
+    skipped before it runs, which is most of a file for a typical commit. Very different files would take
+    the algorithm a long time, so past MAX_COST edits it settles for a diff that is correct but may not
+    be the shortest.
+
+    Blobs never change, so the diff of two blobs never does either. Results are cached by the pair of hashes,
+    up to diffs.cache_size bytes, so a comparison that is viewed often is only worked out once, whichever
+    repository, file or version it is viewed through.
+    """
+    CONTEXT = 3
+    MAX_CONTEXT = 100
+    # How many edits a middle snake search looks for before it gives up on finding the shortest diff.
+    MAX_COST = 512
+    # Content with a NUL byte in this much of its start is treated as binary, as git does.
+    BINARY_CHECK_SIZE = 8000
+    # Roughly what a cached line costs besides its text.
+    LINE_OVERHEAD = 64
+
+    _lock = threading.Lock()
+    _config_cache = None
+    _cache = collections.OrderedDict()  # (old hash, new hash, context): diff
+    _cached_bytes = 0
+    stats = {
+        'hits': 0,
+        'misses': 0,
+        'identical': 0,  # Asked to diff a blob with itself, which needs no work at all
+        'binary': 0,
+        'too_large': 0,
+        'evicted': 0,
+    }
+
+    @staticmethod
+    def config() -> dict:
+        if diff_engine._config_cache is None:
+            diff_engine._config_cache = {
+                'cache_size': int(var.get('diffs.cache_size', dt.SETTINGS['diffs']['cache_size'])),
+                'max_file_size': int(var.get('diffs.max_file_size', dt.SETTINGS['diffs']['max_file_size'])),
+            }
+        return diff_engine._config_cache
+
+    @staticmethod
+    def _lines(data: bytes) -> list[str] | None:
+        """
+        :return: The lines of the content, with their line endings, or None if it is not text.
+        """
+        if b'\0' in data[:diff_engine.BINARY_CHECK_SIZE]:
+            return None
+        try:
+            text = data.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+        # Only split at \n, as unified diffs do. str.splitlines() would also split at form feeds and the like.
+        lines = [line + '\n' for line in text.split('\n')]
+        lines[-1] = lines[-1][:-1]
+        if not lines[-1]:
+            lines.pop()
+        return lines
+
+    @staticmethod
+    def _middle_snake(a: list, b: list, a_lo: int, a_hi: int, b_lo: int, b_hi: int) -> tuple[int, int, int, int]:
+        """
+        Finds the snake that the middle of a shortest edit script of a[a_lo:a_hi] into b[b_lo:b_hi] goes through,
+        by searching from both ends at once. Both ranges must not be empty.
+
+        :return: Where the snake starts and ends, as (x, y, u, v) in indexes of a and b. x, y splits the problem
+        into one before the snake and one after it, each with at most half the edits.
+        """
+        n = a_hi - a_lo
+        m = b_hi - b_lo
+        delta = n - m
+        odd = delta % 2 != 0
+        offset = n + m + 1
+        forward = [0] * (2 * offset + 1)
+        backward = [0] * (2 * offset + 1)
+
+        for d in range((n + m + 1) // 2 + 1):
+            if d > diff_engine.MAX_COST:
+                # Settle for the point the forward search got furthest to. Both halves are still smaller.
+                best_x, best_k = -1, 0
+                for k in range(-d + 1, d, 2):
+                    x = min(forward[offset + k], n, m + k)
+                    if x - k >= 0 and (best_x < 0 or 2 * x - k > 2 * best_x - best_k):
+                        best_x, best_k = x, k
+                x, y = a_lo + best_x, b_lo + best_x - best_k
+                return x, y, x, y
+
+            for k in range(-d, d + 1, 2):
+                if k == -d or (k != d and forward[offset + k - 1] < forward[offset + k + 1]):
+                    x = forward[offset + k + 1]
+                else:
+                    x = forward[offset + k - 1] + 1
+                y = x - k
+                start_x, start_y = x, y
+                while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                    x += 1
+                    y += 1
+                forward[offset + k] = x
+                # The backward search on diagonal delta - k has got as far back as n - backward[...].
+                if odd and delta - (d - 1) <= k <= delta + (d - 1):
+                    if x + backward[offset + delta - k] >= n:
+                        return a_lo + start_x, b_lo + start_y, a_lo + x, b_lo + y
+
+            # The backward search runs forwards over both sequences reversed.
+            for k in range(-d, d + 1, 2):
+                if k == -d or (k != d and backward[offset + k - 1] < backward[offset + k + 1]):
+                    x = backward[offset + k + 1]
+                else:
+                    x = backward[offset + k - 1] + 1
+                y = x - k
+                start_x, start_y = x, y
+                while x < n and y < m and a[a_hi - 1 - x] == b[b_hi - 1 - y]:
+                    x += 1
+                    y += 1
+                backward[offset + k] = x
+                if not odd and -d <= delta - k <= d:
+                    if x + forward[offset + delta - k] >= n:
+                        return a_hi - x, b_hi - y, a_hi - start_x, b_hi - start_y
+
+        raise AssertionError("The searches from both ends never met.")
+
+    @staticmethod
+    def matching_lines(old: list, new: list) -> list[tuple[int, int]]:
+        """
+        Finds which lines of old are kept in new, by a shortest edit script between them.
+
+        :return: (index in old, index in new) of every kept line, in order.
+        """
+        # Lines are compared as small ints, which is much faster than comparing strings.
+        ids = {}
+        a = [ids.setdefault(line, len(ids)) for line in old]
+        b = [ids.setdefault(line, len(ids)) for line in new]
+        # A line only one side has can never be kept, so only the others are searched. When a file was mostly
+        # rewritten, that is most of its lines.
+        in_a, in_b = set(a), set(b)
+        a_index = [index for index, line in enumerate(a) if line in in_b]
+        b_index = [index for index, line in enumerate(b) if line in in_a]
+        a = [a[index] for index in a_index]
+        b = [b[index] for index in b_index]
+
+        matches = []
+        ranges = [(0, len(a), 0, len(b))]
+        while ranges:
+            a_lo, a_hi, b_lo, b_hi = ranges.pop()
+            while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+                matches.append((a_lo, b_lo))
+                a_lo += 1
+                b_lo += 1
+            while a_lo < a_hi and b_lo < b_hi and a[a_hi - 1] == b[b_hi - 1]:
+                a_hi -= 1
+                b_hi -= 1
+                matches.append((a_hi, b_hi))
+            if a_lo == a_hi or b_lo == b_hi:
+                continue
+
+            x, y, u, v = diff_engine._middle_snake(a, b, a_lo, a_hi, b_lo, b_hi)
+            matches.extend(zip(range(x, u), range(y, v)))
+            ranges.append((a_lo, x, b_lo, y))
+            ranges.append((u, a_hi, v, b_hi))
+
+        matches.sort()
+        return [(a_index[i], b_index[j]) for i, j in matches]
+
+    @staticmethod
+    def hunks(old: list, new: list, context: int = CONTEXT) -> list[dict]:
+        """
+        Diffs two lists of lines.
+
+        :param context: How many unchanged lines to show around each change. Changes closer together than twice
+        this are put in the same hunk.
+        :return: The hunks. old_start and new_start count from 1, as in a unified diff, and each line is
+        [' ', '-' or '+', text], the text with its line ending.
+        """
+        # Every line of both, in order, as (op, index in old, index in new).
+        ops = []
+        i = j = 0
+        for match_i, match_j in diff_engine.matching_lines(old, new) + [(len(old), len(new))]:
+            ops.extend(('-', line, j) for line in range(i, match_i))
+            ops.extend(('+', match_i, line) for line in range(j, match_j))
+            if match_i < len(old):
+                ops.append((' ', match_i, match_j))
+            i, j = match_i + 1, match_j + 1
+
+        changed = [position for position, op in enumerate(ops) if op[0] != ' ']
+        hunks = []
+        first = 0
+        while first < len(changed):
+            last = first
+            while last + 1 < len(changed) and changed[last + 1] - changed[last] - 1 <= 2 * context:
+                last += 1
+            start = max(changed[first] - context, 0)
+            end = min(changed[last] + context + 1, len(ops))
+            first = last + 1
+
+            lines = [
+                [op, old[old_index] if op != '+' else new[new_index]] for op, old_index, new_index in ops[start:end]
+            ]
+            old_lines = sum(1 for line in lines if line[0] != '+')
+            new_lines = sum(1 for line in lines if line[0] != '-')
+            hunks.append({
+                # An empty side starts at the line before it, as in a unified diff.
+                'old_start': ops[start][1] + (1 if old_lines else 0),
+                'old_lines': old_lines,
+                'new_start': ops[start][2] + (1 if new_lines else 0),
+                'new_lines': new_lines,
+                'lines': lines,
+            })
+        return hunks
+
+    @staticmethod
+    def _remember(key: tuple, result: dict):
+        size = sum(
+            len(line[1]) + diff_engine.LINE_OVERHEAD for hunk in result['hunks'] for line in hunk['lines']
+        ) + diff_engine.LINE_OVERHEAD
+        limit = diff_engine.config()['cache_size']
+        if size > limit:
+            return
+        with diff_engine._lock:
+            if key in diff_engine._cache:
+                return
+            diff_engine._cache[key] = (result, size)
+            diff_engine._cached_bytes += size
+            while diff_engine._cached_bytes > limit:
+                _, (_, evicted_size) = diff_engine._cache.popitem(last=False)
+                diff_engine._cached_bytes -= evicted_size
+                diff_engine.stats['evicted'] += 1
+
+    @staticmethod
+    def diff(cur, old_hash: str | None, new_hash: str | None, context: int = CONTEXT) -> dict:
+        """
+        Diffs two blobs, or one against nothing for a file that was added or removed.
+        The result is shared with the cache, so do not change it.
+
+        :param old_hash: The blob before, or None if the file did not exist.
+        :param new_hash: The blob after, or None if the file no longer exists.
+        :return: hunks as hunks() makes them, how many lines were added and removed, and whether either blob
+        was binary or bigger than diffs.max_file_size. Those two have no hunks.
+        """
+        if old_hash == new_hash:
+            with diff_engine._lock:
+                diff_engine.stats['identical'] += 1
+            return {'binary': False, 'too_large': False, 'added': 0, 'removed': 0, 'hunks': []}
+
+        key = (old_hash, new_hash, context)
+        with diff_engine._lock:
+            cached = diff_engine._cache.get(key)
+            if cached is not None:
+                diff_engine._cache.move_to_end(key)
+                diff_engine.stats['hits'] += 1
+                return cached[0]
+            diff_engine.stats['misses'] += 1
+
+        hashes = [blob_hash for blob_hash in (old_hash, new_hash) if blob_hash is not None]
+        cur.execute('SELECT hash, size FROM blobs WHERE hash = ANY(%s);', (hashes,))
+        sizes = dict(cur.fetchall())
+        for blob_hash in hashes:
+            if blob_hash not in sizes:
+                raise error.blob_not_found(blob_hash)
+
+        result = {'binary': False, 'too_large': False, 'added': 0, 'removed': 0, 'hunks': []}
+        if any(size > diff_engine.config()['max_file_size'] for size in sizes.values()):
+            result['too_large'] = True
+            with diff_engine._lock:
+                diff_engine.stats['too_large'] += 1
+        else:
+            old = diff_engine._lines(blob_store.get(cur, old_hash)) if old_hash is not None else []
+            new = diff_engine._lines(blob_store.get(cur, new_hash)) if new_hash is not None else []
+            if old is None or new is None:
+                result['binary'] = True
+                with diff_engine._lock:
+                    diff_engine.stats['binary'] += 1
+            else:
+                result['hunks'] = diff_engine.hunks(old, new, context)
+                for hunk in result['hunks']:
+                    result['added'] += hunk['new_lines'] - sum(1 for line in hunk['lines'] if line[0] == ' ')
+                    result['removed'] += hunk['old_lines'] - sum(1 for line in hunk['lines'] if line[0] == ' ')
+
+        diff_engine._remember(key, result)
+        return result
+
+    @staticmethod
+    def unified(result: dict, old_path: str | None, new_path: str | None) -> str:
+        """
+        Writes a diff() result as a unified diff, which patch and git apply understand.
+
+        :param old_path: The path of the file before, or None if it was added.
+        :param new_path: The path of the file after, or None if it was removed.
+        """
+        old_name = f"a/{old_path.lstrip('/')}" if old_path is not None else '/dev/null'
+        new_name = f"b/{new_path.lstrip('/')}" if new_path is not None else '/dev/null'
+        if result['binary'] or result['too_large']:
+            reason = 'Binary files' if result['binary'] else 'Files too large to diff'
+            return f"{reason} {old_name} and {new_name} differ\n"
+        if not result['hunks']:
+            return ''
+
+        out = [f'--- {old_name}\n', f'+++ {new_name}\n']
+        for hunk in result['hunks']:
+            old_range = f"{hunk['old_start']},{hunk['old_lines']}" if hunk['old_lines'] != 1 else str(hunk['old_start'])
+            new_range = f"{hunk['new_start']},{hunk['new_lines']}" if hunk['new_lines'] != 1 else str(hunk['new_start'])
+            out.append(f'@@ -{old_range} +{new_range} @@\n')
+            for op, text in hunk['lines']:
+                out.append(op + text)
+                if not text.endswith('\n'):
+                    out.append('\n\\ No newline at end of file\n')
+        return ''.join(out)
+
+    @staticmethod
+    def statistics() -> dict:
+        with diff_engine._lock:
+            stats = dict(diff_engine.stats)
+            stats['cached'] = len(diff_engine._cache)
+            stats['cached_bytes'] = diff_engine._cached_bytes
+        return stats
@@ -60,4 +60,83 @@ class error:
     class json_content_type_only(Exception):
         def __init__(self):
             self.code_number = 12
-            super().__init__("The content type is invalid. Please use 'application/json'")
\ No newline at end of file
+            super().__init__("The content type is invalid. Please use 'application/json'")
+
+    class db_pool_exhausted(Exception):
+        def __init__(self, timeout):
+            self.code_number = 13
+            self.timeout = timeout
+            super().__init__(f"No database connection became free within {timeout} seconds.")
+
+    class blob_not_found(Exception):
+        def __init__(self, blob_hash):
+            self.code_number = 14
+            self.blob_hash = blob_hash
+            super().__init__(f"No stored file content has the hash {blob_hash}.")
+
+    class file_not_found(Exception):
+        def __init__(self, rel_file_path):
+            self.code_number = 15
+            self.rel_file_path = rel_file_path
+            super().__init__(f"The file \"{rel_file_path}\" does not exist in that repository.")
+
+    class upload_not_found(Exception):
+        def __init__(self, upload_id):
+            self.code_number = 16
+            self.upload_id = upload_id
+            super().__init__(f"There is no upload {upload_id}. It may have expired.")
+
+    class chunk_rejected(Exception):
+        def __init__(self, reason, received):
+            self.code_number = 17
+            self.reason = reason
+            self.received = received  # How many bytes of the file have been received, to resume from
+            super().__init__(f"The chunk was rejected: {reason}")
+
+    class upload_incomplete(Exception):
+        def __init__(self, rel_file_paths):
+            self.code_number = 18
+            self.rel_file_paths = rel_file_paths
+            super().__init__(f"Not all of these files have been uploaded yet: {', '.join(rel_file_paths)}")
+
+    class tree_not_found(Exception):
+        def __init__(self, tree_hash):
+            self.code_number = 19
+            self.tree_hash = tree_hash
+            super().__init__(f"No tree has the hash {tree_hash}.")
+
+    class changeset_not_found(Exception):
+        def __init__(self, changeset_id):
+            self.code_number = 20
+            self.changeset_id = changeset_id
+            super().__init__(f"Changeset {changeset_id} does not exist in that repository.")
+
+    class ref_not_found(Exception):
+        def __init__(self, name):
+            self.code_number = 21
+            self.name = name
+            super().__init__(f"There is no branch or tag called {name}.")
+
+    class ref_conflict(Exception):
+        def __init__(self, name, current):
+            self.code_number = 22
+            self.name = name
+            self.current = current
+            super().__init__(f"{name} is at changeset {current}, not the one expected.")
+
+    class merge_conflict(Exception):
+        def __init__(self, source, target, conflicts):
+            self.code_number = 23
+            self.source = source
+            self.target = target
+            self.conflicts = conflicts
+            super().__init__(f"Merging {source} into {target} conflicts in {len(conflicts)} file(s).")
+
+    class quota_exceeded(Exception):
+        def __init__(self, username, quota, used, needed):
+            self.code_number = 24
+            self.username = username
+            self.quota = quota
+            self.used = used
+            self.needed = needed
+            super().__init__(f"{username} is using {used} of their {quota} bytes, and this needs {needed} more.")
@@ -0,0 +1,251 @@
+from library.errors import error
+import collections
+import threading
+import hashlib
+import heapq
+
+class commit_graph:
+    """
+    An index of the history of every repository, so ancestry questions never need a recursive walk of
+    the changesets table.
+
+    Each changeset has a row with its parents, its generation and a reachability bloom filter. The generation
+    is one more than the highest generation of its parents, so an ancestor always has a lower generation than
+    its descendants. A walk back from a changeset can stop at the generation of what it is looking for, and
+    walks that go newest first can tell when nothing further back can matter.
+
+    History is split into spans of BLOOM_SPAN generations. The bloom of a changeset holds it and every
+    ancestor in the same span, and is made from its parents' blooms when it is added. If a changeset in the
+    same span is not in it, it is certainly not an ancestor, and the walk can skip that whole part of history.
+
+    Rows never change once added, so they are cached, and walks read ahead PREFETCH ancestors at a time.
+    """
+    BLOOM_BITS = 512
+    BLOOM_HASHES = 3
+    BLOOM_SPAN = 64
+    PREFETCH = 256
+    # Which side of a walk reached a changeset.
+    LEFT = 1
+    RIGHT = 2
+
+    _lock = threading.Lock()
+    _cache = collections.OrderedDict()  # changeset_id: (parent ids, generation, bloom)
+    max_cached = 50000
+    stats = {
+        'hits': 0,
+        'misses': 0,
+        'pruned': 0,  # Parts of history a bloom showed a walk did not need to visit
+    }
+
+    @staticmethod
+    def _bloom_bits(changeset_id: int) -> int:
+        digest = hashlib.sha256(changeset_id.to_bytes(8, 'big')).digest()
+        bits = 0
+        for index in range(commit_graph.BLOOM_HASHES):
+            bits |= 1 << (int.from_bytes(digest[index * 4:index * 4 + 4], 'big') % commit_graph.BLOOM_BITS)
+        return bits
+
+    @staticmethod
+    def may_reach(node: tuple, target: int, target_generation: int) -> bool:
+        """
+        :param node: The row of a changeset other than target, as get_many() gives it.
+        :return: False if target is certainly not one of the changeset's ancestors.
+        """
+        _, generation, bloom = node
+        if target_generation >= generation:
+            return False
+        if target_generation // commit_graph.BLOOM_SPAN != generation // commit_graph.BLOOM_SPAN:
+            return True
+        bits = commit_graph._bloom_bits(target)
+        return bloom & bits == bits
+
+    @staticmethod
+    def make_node(changeset_id: int, parents: list) -> tuple[int, int]:
+        """
+        :param parents: The rows of the changeset's parents, as get_many() gives them.
+        :return: The generation and bloom of the changeset.
+        """
+        generation = 1 + max((parent[1] for parent in parents), default=0)
+        bloom = commit_graph._bloom_bits(changeset_id)
+        for _, parent_generation, parent_bloom in parents:
+            if parent_generation // commit_graph.BLOOM_SPAN == generation // commit_graph.BLOOM_SPAN:
+                bloom |= parent_bloom
+        return generation, bloom
+
+    @staticmethod
+    def add(cur, repo_id: int, changeset_id: int, parent_ids: list) -> int:
+        """
+        Adds a changeset to the graph. Call it in the transaction that makes the changeset.
+
+        :return: The generation of the changeset.
+        """
+        parents = commit_graph.get_many(cur, parent_ids)
+        generation, bloom = commit_graph.make_node(changeset_id, [parents[parent] for parent in parent_ids])
+        cur.execute(
+            """
+            INSERT INTO commit_graph (changeset_id, repo_id, parent_ids, generation, bloom)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (changeset_id) DO NOTHING;
+            """,
+            (changeset_id, repo_id, list(parent_ids), generation,
+             bloom.to_bytes(commit_graph.BLOOM_BITS // 8, 'big'))
+        )
+        return generation
+
+    @staticmethod
+    def get_many(cur, changeset_ids, prefetch=False) -> dict:
+        """
+        Reads the rows of changesets, with one query at most.
+
+        :param prefetch: Whether to also read up to PREFETCH of their nearest ancestors into the cache,
+        for a walk back through their history.
+        :return: (parent ids, generation, bloom) of each changeset, by id.
+        :raises error.changeset_not_found: If a changeset is not in the graph.
+        """
+        found = {}
+        with commit_graph._lock:
+            for changeset_id in changeset_ids:
+                node = commit_graph._cache.get(changeset_id)
+                if node is not None:
+                    commit_graph._cache.move_to_end(changeset_id)
+                    found[changeset_id] = node
+            commit_graph.stats['hits'] += len(found)
+
+        missing = {changeset_id for changeset_id in changeset_ids if changeset_id not in found}
+        if not missing:
+            return found
+        with commit_graph._lock:
+            commit_graph.stats['misses'] += len(missing)
+        cur.execute(
+            """
+            WITH RECURSIVE ancestry (changeset_id, parent_ids, generation, bloom) AS (
+                SELECT changeset_id, parent_ids, generation, bloom
+                FROM commit_graph
+                WHERE changeset_id = ANY(%s)
+                UNION
+                SELECT commit_graph.changeset_id, commit_graph.parent_ids, commit_graph.generation, commit_graph.bloom
+                FROM commit_graph
+                JOIN ancestry ON commit_graph.changeset_id = ANY(ancestry.parent_ids)
+            )
+            SELECT changeset_id, parent_ids, generation, bloom FROM ancestry LIMIT %s;
+            """,
+            (list(missing), len(missing) + (commit_graph.PREFETCH if prefetch else 0))
+        )
+        with commit_graph._lock:
+            for changeset_id, parent_ids, generation, bloom in cur.fetchall():
+                node = (tuple(parent_ids), generation, int.from_bytes(bytes(bloom), 'big'))
+                commit_graph._cache[changeset_id] = node
+                commit_graph._cache.move_to_end(changeset_id)
+                if changeset_id in missing:
+                    found[changeset_id] = node
+            while len(commit_graph._cache) > commit_graph.max_cached:
+                commit_graph._cache.popitem(last=False)
+        for changeset_id in missing:
+            if changeset_id not in found:
+                raise error.changeset_not_found(changeset_id)
+        return found
+
+    @staticmethod
+    def _load(cur, nodes: dict, changeset_id: int, queue: list):
+        """
+        Makes sure a walk has the row of a changeset, reading those of everything it has queued along with it.
+        """
+        if changeset_id in nodes:
+            return
+        wanted = [changeset_id] + [queued[2] for queued in queue if queued[2] not in nodes]
+        nodes.update(commit_graph.get_many(cur, wanted, prefetch=True))
+
+    @staticmethod
+    def is_ancestor(cur, ancestor: int, descendant: int) -> bool:
+        """
+        :return: Whether descendant is ancestor, or descends from it.
+        """
+        if ancestor == descendant:
+            return True
+        nodes = commit_graph.get_many(cur, [ancestor, descendant])
+        target_generation = nodes[ancestor][1]
+        queue = [(-nodes[descendant][1], -descendant, descendant)]
+        seen = {descendant}
+        while queue:
+            changeset_id = heapq.heappop(queue)[2]
+            commit_graph._load(cur, nodes, changeset_id, queue)
+            if changeset_id == ancestor:
+                return True
+            if not commit_graph.may_reach(nodes[changeset_id], ancestor, target_generation):
+                with commit_graph._lock:
+                    commit_graph.stats['pruned'] += 1
+                continue
+            for parent in nodes[changeset_id][0]:
+                if parent not in seen:
+                    seen.add(parent)
+                    commit_graph._load(cur, nodes, parent, queue)
+                    heapq.heappush(queue, (-nodes[parent][1], -parent, parent))
+        return False
+
+    @staticmethod
+    def merge_base(cur, left: int, right: int) -> int | None:
+        """
+        :return: The newest changeset that both changesets are, or descend from. None if they share no history.
+        """
+        nodes = commit_graph.get_many(cur, [left, right], prefetch=True)
+        reached = {left: commit_graph.LEFT}
+        reached[right] = reached.get(right, 0) | commit_graph.RIGHT
+        queue = [(-nodes[changeset_id][1], -changeset_id, changeset_id) for changeset_id in reached]
+        heapq.heapify(queue)
+        while queue:
+            changeset_id = heapq.heappop(queue)[2]
+            sides = reached[changeset_id]
+            # Going newest first, a changeset is only reached from ones that have been visited already, so the
+            # first one reached from both sides is the newest they have in common.
+            if sides == commit_graph.LEFT | commit_graph.RIGHT:
+                return changeset_id
+            commit_graph._load(cur, nodes, changeset_id, queue)
+            for parent in nodes[changeset_id][0]:
+                if parent not in reached:
+                    commit_graph._load(cur, nodes, parent, queue)
+                    heapq.heappush(queue, (-nodes[parent][1], -parent, parent))
+                reached[parent] = reached.get(parent, 0) | sides
+        return None
+
+    @staticmethod
+    def log(cur, head: int, exclude: int = None, limit: int = None) -> list[int]:
+        """
+        Lists the history of a changeset, newest first, as git log does.
+
+        :param exclude: If given, its history is left out, so the changesets listed are those since it.
+        :param limit: The most to list.
+        :return: The changeset ids. Every changeset comes before its parents.
+        """
+        wanted = [head] + ([exclude] if exclude is not None else [])
+        nodes = commit_graph.get_many(cur, wanted, prefetch=True)
+        # The changesets reached from exclude are marked LEFT, and left out.
+        reached = {head: commit_graph.RIGHT}
+        if exclude is not None:
+            reached[exclude] = reached.get(exclude, 0) | commit_graph.LEFT
+        queue = [(-nodes[changeset_id][1], -changeset_id, changeset_id) for changeset_id in reached]
+        heapq.heapify(queue)
+        history = []
+        while queue and (limit is None or len(history) < limit):
+            # Once everything queued is in exclude's history, so is everything older.
+            if all(reached[queued[2]] & commit_graph.LEFT for queued in queue):
+                break
+            changeset_id = heapq.heappop(queue)[2]
+            sides = reached[changeset_id]
+            if not sides & commit_graph.LEFT:
+                history.append(changeset_id)
+            commit_graph._load(cur, nodes, changeset_id, queue)
+            for parent in nodes[changeset_id][0]:
+                if parent not in reached:
+                    commit_graph._load(cur, nodes, parent, queue)
+                    heapq.heappush(queue, (-nodes[parent][1], -parent, parent))
+                    reached[parent] = sides
+                else:
+                    reached[parent] |= sides
+        return history
+
+    @staticmethod
+    def statistics() -> dict:
+        with commit_graph._lock:
+            stats = dict(commit_graph.stats)
+            stats['cached'] = len(commit_graph._cache)
+        return stats
@@ -0,0 +1,110 @@
+from library.blobstore import blob_store
+from library.trees import tree_store
+from library.diff import diff_engine
+
+class merge_engine:
+    """
+    Three-way merges of one changeset into another.
+
+    The merge base is the newest changeset both sides descend from, which commit_graph finds.
+
+    The snapshots are merged by tree_store.merge(), which only opens folders both sides changed, and only
+    the files both sides changed are merged line by line, as diff3 does. Lines either side kept from the base
+    anchor the merge, and a stretch between them that both sides changed differently is a conflict.
+    """
+    @staticmethod
+    def merge_lines(base: list, ours: list, theirs: list) -> tuple[list, list]:
+        """
+        Three-way merges lists of lines.
+
+        :return: The merged lines, and the conflicts. Each conflict is where it starts in ours, counting from 1, and
+        the lines base, ours and theirs have there. The merged lines have ours' lines where there is a conflict.
+        """
+        ours_kept = dict(diff_engine.matching_lines(base, ours))
+        theirs_kept = dict(diff_engine.matching_lines(base, theirs))
+        stable = [(line, ours_kept[line], theirs_kept[line]) for line in sorted(ours_kept.keys() & theirs_kept.keys())]
+
+        merged, conflicts = [], []
+        base_at = ours_at = theirs_at = 0
+        for base_next, ours_next, theirs_next in stable + [(len(base), len(ours), len(theirs))]:
+            base_lines = base[base_at:base_next]
+            ours_lines = ours[ours_at:ours_next]
+            theirs_lines = theirs[theirs_at:theirs_next]
+            if ours_lines == theirs_lines or theirs_lines == base_lines:
+                merged.extend(ours_lines)
+            elif ours_lines == base_lines:
+                merged.extend(theirs_lines)
+            else:
+                conflicts.append({
+                    'ours_start': ours_at + 1,
+                    'base': base_lines,
+                    'ours': ours_lines,
+                    'theirs': theirs_lines,
+                })
+                merged.extend(ours_lines)
+            if base_next < len(base):
+                merged.append(base[base_next])
+            base_at, ours_at, theirs_at = base_next + 1, ours_next + 1, theirs_next + 1
+        return merged, conflicts
+
+    @staticmethod
+    def _describe(entry: list | None) -> dict | None:
+        return {'version': list(entry[4:7]), 'blob_hash': entry[2]} if entry is not None else None
+
+    @staticmethod
+    def merge_file(cur, rel_file_path: str, base: list | None, ours: list | None,
+                   theirs: list | None) -> tuple[bytes | None, dict | None]:
+        """
+        Merges a file both sides changed.
+
+        :param base: The file entry in the merge base, or None if neither side had it then. Likewise ours and theirs.
+        :return: The merged content, or None and the conflict, saying what kind it is and, for text that both sides
+        changed in the same place, where.
+        """
+        conflict = {
+            'path': rel_file_path,
+            'base': merge_engine._describe(base),
+            'ours': merge_engine._describe(ours),
+            'theirs': merge_engine._describe(theirs),
+        }
+        if ours is None or theirs is None:
+            return None, {**conflict, 'kind': 'modify/delete'}
+
+        hashes = [entry[2] for entry in (base, ours, theirs) if entry is not None]
+        cur.execute('SELECT size FROM blobs WHERE hash = ANY(%s);', (hashes,))
+        if any(size > diff_engine.config()['max_file_size'] for size, in cur.fetchall()):
+            return None, {**conflict, 'kind': 'too_large'}
+
+        # Two sides that added the same file are merged as if it had been empty.
+        base_lines = diff_engine._lines(blob_store.get(cur, base[2])) if base is not None else []
+        ours_lines = diff_engine._lines(blob_store.get(cur, ours[2]))
+        theirs_lines = diff_engine._lines(blob_store.get(cur, theirs[2]))
+        if base_lines is None or ours_lines is None or theirs_lines is None:
+            return None, {**conflict, 'kind': 'binary'}
+
+        merged, regions = merge_engine.merge_lines(base_lines, ours_lines, theirs_lines)
+        if regions:
+            return None, {**conflict, 'kind': 'content', 'regions': regions}
+        return ''.join(merged).encode('utf-8'), None
+
+    @staticmethod
+    def merge_trees(cur, base_root: str | None, ours_root: str | None,
+                    theirs_root: str | None) -> tuple[str, dict, list]:
+        """
+        Three-way merges two snapshots.
+
+        :return: The hash of the merged root tree, path: (content, version) of each file that was merged line by
+        line, and the conflicts. The merged files are not in the tree yet. They need a commit each, and each is
+        a patch version past the later of its two sides, so it is newer than both.
+        """
+        root, both_changed = tree_store.merge(cur, base_root, ours_root, theirs_root)
+        merged_files, conflicts = {}, []
+        for rel_file_path in sorted(both_changed):
+            base, ours, theirs = both_changed[rel_file_path]
+            content, conflict = merge_engine.merge_file(cur, rel_file_path, base, ours, theirs)
+            if conflict is not None:
+                conflicts.append(conflict)
+                continue
+            major, minor, patch = max(tuple(ours[4:7]), tuple(theirs[4:7]))
+            merged_files[rel_file_path] = (content, (major, minor, patch + 1))
+        return root, merged_files, conflicts
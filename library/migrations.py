@@ -0,0 +1,725 @@
+import psycopg2.extras
+import psycopg2
+import logging
+import hashlib
+import base64
+import os
+
+# Key for the advisory lock that stops two Raindrop processes migrating the same database at once.
+MIGRATION_LOCK_KEY = 0x52444D47
+
+class migration:
+    def __init__(self, version: int, description: str, steps: list, transactional=True):
+        """
+        A single, ordered change to the database schema.
+
+        :param version: The schema version this migration brings the database to. Must be unique and increasing.
+        :param description: A short description, shown in the postgre CLI.
+        :param steps: SQL strings, or functions taking a cursor, run in order.
+        :param transactional: If False, the steps run outside a transaction. Needed for things like
+        CREATE INDEX CONCURRENTLY. Steps of such migrations must be safe to run twice.
+        """
+        self.version = version
+        self.description = description
+        self.steps = steps
+        self.transactional = transactional
+
+    def apply(self, cur):
+        for step in self.steps:
+            if callable(step):
+                step(cur)
+            else:
+                cur.execute(step)
+
+# The tables Raindrop started out with. Kept as a dict so the baseline migration can also add columns that
+# databases made by older versions of Raindrop are missing.
+BASELINE_TABLES = {
+    'tokens': {
+        'username': 'TEXT NOT NULL UNIQUE PRIMARY KEY',
+        'token': 'TEXT NOT NULL UNIQUE'
+    },
+    'accounts': {
+        'user_id': 'SERIAL PRIMARY KEY',
+        'registered_on': 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP',
+        'username': 'TEXT NOT NULL UNIQUE',
+        'password': 'TEXT NOT NULL',
+        'restricted': 'BOOLEAN DEFAULT FALSE',
+        'bio': 'TEXT DEFAULT \'Feeling new? Make a bio!\'',
+    },
+    # The docker containers a user has
+    'user_containers': {
+        'container_id': 'TEXT PRIMARY KEY',
+        'owner': 'TEXT NOT NULL REFERENCES accounts(username)',
+    },
+    'repositories': {
+        'repo_id': 'SERIAL PRIMARY KEY',
+        'owner': 'TEXT NOT NULL REFERENCES accounts(username)',
+        'name': 'TEXT NOT NULL',
+        'description': 'TEXT',
+        'private': 'BOOLEAN DEFAULT FALSE',
+        'created_on': 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP',
+        'last_updated': 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP',
+    },
+    'user_permissions': {
+        'username': 'TEXT NOT NULL REFERENCES accounts(username)',
+        'administrator': 'BOOLEAN DEFAULT FALSE',
+    },
+    # The full file is stored in the commits table
+    'commits': {
+        'commit_id': 'SERIAL PRIMARY KEY',
+        'repo_id': 'INTEGER NOT NULL REFERENCES repositories(repo_id)',
+        'author': 'TEXT NOT NULL REFERENCES accounts(username)',
+        'version_major': 'INTEGER NOT NULL',
+        'version_minor': 'INTEGER NOT NULL',
+        'version_patch': 'INTEGER NOT NULL',
+        'rel_file_path': 'TEXT NOT NULL',  # The relative file path. Eg, '/folder/file.txt' or '/file.txt'
+        'file_data': 'TEXT NOT NULL',  # Base64 encoded file data
+        'commit_message': 'TEXT NOT NULL DEFAULT \'No message provided\'',
+        'commit_date': 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP',
+    }
+}
+
+def _baseline_schema(cur):
+    for table_name, columns in BASELINE_TABLES.items():
+        columns_str = ', '.join(
+            [f'{column_name} {column_properties}' for column_name, column_properties in columns.items()]
+        )
+        cur.execute(f'CREATE TABLE IF NOT EXISTS {table_name} ({columns_str});')
+
+        # Databases made before migrations existed may be missing newer columns.
+        for column_name, column_properties in columns.items():
+            cur.execute(f'ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS {column_name} {column_properties};')
+
+# Secondary indexes for the hot lookup paths. name: (table, definition, is_unique)
+INDEXES = {
+    # get_repo, repository_exists, walk_repository and the uniqueness of a user's repository names
+    'repositories_owner_name_key': ('repositories', '(owner, name)', True),
+    # list_public_repos and list_private_repos, in a stable order
+    'repositories_public_by_owner': ('repositories', '(owner, repo_id) WHERE private = FALSE', False),
+    'repositories_private_by_owner': ('repositories', '(owner, repo_id) WHERE private = TRUE', False),
+    # Reading older versions and per-file history. Its leading column also serves lookups by repo_id alone.
+    'commits_repo_path': (
+        'commits', '(repo_id, rel_file_path, version_major, version_minor, version_patch)', False
+    ),
+    'user_containers_owner': ('user_containers', '(owner)', False),
+}
+
+def _drop_invalid_indexes(cur):
+    """
+    A CREATE INDEX CONCURRENTLY that was interrupted leaves an invalid index behind, which IF NOT EXISTS
+    would then skip. Drop those so they get rebuilt.
+    """
+    cur.execute(
+        """
+        SELECT index_class.relname
+        FROM pg_index
+        JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid
+        WHERE NOT pg_index.indisvalid AND index_class.relname = ANY(%s);
+        """,
+        (list(INDEXES.keys()),)
+    )
+    for (index_name,) in cur.fetchall():
+        logging.info(f"Dropping invalid index '{index_name}' left by an interrupted build.")
+        cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {index_name};')
+
+def _check_duplicate_repositories(cur):
+    cur.execute(
+        """
+        SELECT owner, name, COUNT(*)
+        FROM repositories
+        GROUP BY owner, name
+        HAVING COUNT(*) > 1;
+        """
+    )
+    duplicates = cur.fetchall()
+    if duplicates:
+        listing = ', '.join(f"{owner}/{name} ({count} copies)" for owner, name, count in duplicates)
+        raise RuntimeError(
+            f"Some users have more than one repository with the same name: {listing}. "
+            f"Rename or delete the extras, then restart Raindrop to finish upgrading the database."
+        )
+
+def _create_indexes(cur):
+    for index_name, (table_name, definition, is_unique) in INDEXES.items():
+        cur.execute(
+            f'CREATE {"UNIQUE " if is_unique else ""}INDEX CONCURRENTLY IF NOT EXISTS '
+            f'{index_name} ON {table_name} {definition};'
+        )
+
+def _move_file_data_to_blobs(cur):
+    """
+    Moves the Base64 file_data of existing commits into the blob store, a batch at a time.
+    The blobs are written with plain SQL against the schema as it is at this migration, rather than through
+    blob_store, whose queries follow the latest schema. They go to the database location, and repacking
+    moves them wherever blobs.backend says later.
+    """
+    moved = 0
+    while True:
+        cur.execute(
+            """
+            SELECT commit_id, file_data
+            FROM commits
+            WHERE blob_hash IS NULL AND file_data IS NOT NULL
+            ORDER BY commit_id
+            LIMIT 500;
+            """
+        )
+        rows = cur.fetchall()
+        if not rows:
+            break
+
+        for commit_id, file_data in rows:
+            data = base64.b64decode(file_data)
+            blob_hash = hashlib.sha256(data).hexdigest()
+            cur.execute(
+                """
+                INSERT INTO blobs (hash, size, location, data)
+                VALUES (%s, %s, 'database', %s)
+                ON CONFLICT (hash) DO NOTHING;
+                """,
+                (blob_hash, len(data), data)
+            )
+            cur.execute(
+                'UPDATE commits SET blob_hash = %s, file_data = NULL WHERE commit_id = %s;',
+                (blob_hash, commit_id)
+            )
+        moved += len(rows)
+    if moved:
+        logging.info(f"Moved the content of {moved} commits into the blob store.")
+
+def _rename_delta_files(cur):
+    """
+    Renames the files of blobs stored as deltas from hash.delta to the names blob_store.path_for() gives them now,
+    which also say what the delta is against and how it is compressed.
+    """
+    # Imported here, as library.blobstore needs library.storage, which imports this module.
+    from library.blobstore import blob_store
+
+    cur.execute("SELECT hash, delta_base FROM blobs WHERE location = 'disk' AND delta_base IS NOT NULL;")
+    renamed = 0
+    for blob_hash, delta_base in cur.fetchall():
+        old_path = f'{blob_store.path_for(blob_hash)}.delta'
+        if os.path.exists(old_path):
+            os.replace(old_path, blob_store.path_for(blob_hash, delta_base))
+            renamed += 1
+    if renamed:
+        logging.info(f"Renamed the files of {renamed} delta blobs.")
+
+def _build_trees(cur):
+    """
+    Builds the trees of every repository's history. Commits made before changesets existed each become
+    a changeset of their own. The trees are built in commit order, each from the one before it.
+    """
+    # Imported here, as library.trees is only needed by this migration.
+    from library.trees import tree_store
+
+    cur.execute('SELECT repo_id FROM repositories ORDER BY repo_id;')
+    for (repo_id,) in cur.fetchall():
+        cur.execute(
+            """
+            SELECT commit_id, changeset_id, author, commit_message, commit_date, rel_file_path, blob_hash,
+                version_major, version_minor, version_patch
+            FROM commits
+            WHERE repo_id = %s AND blob_hash IS NOT NULL
+            ORDER BY commit_id;
+            """,
+            (repo_id,)
+        )
+        commits = cur.fetchall()
+
+        # Consecutive commits of the same changeset are applied together.
+        root_hash = tree_store.empty(cur)
+        head = None
+        position = 0
+        while position < len(commits):
+            changeset_id = commits[position][1]
+            end = position + 1
+            while changeset_id is not None and end < len(commits) and commits[end][1] == changeset_id:
+                end += 1
+            group = commits[position:end]
+
+            if changeset_id is None:
+                commit_id, _, author, message, commit_date = group[0][:5]
+                cur.execute(
+                    """
+                    INSERT INTO changesets (repo_id, author, message, created_on)
+                    VALUES (%s, %s, %s, %s)
+                    RETURNING changeset_id;
+                    """,
+                    (repo_id, author, message, commit_date)
+                )
+                changeset_id = cur.fetchone()[0]
+                cur.execute('UPDATE commits SET changeset_id = %s WHERE commit_id = %s;', (changeset_id, commit_id))
+
+            root_hash = tree_store.update(cur, root_hash, {
+                row[5]: (row[6], row[0], (row[7], row[8], row[9])) for row in group
+            })
+            cur.execute('UPDATE changesets SET tree_hash = %s WHERE changeset_id = %s;', (root_hash, changeset_id))
+            head = changeset_id
+            position = end
+
+        cur.execute('UPDATE repositories SET head_changeset = %s WHERE repo_id = %s;', (head, repo_id))
+
+def _build_commit_graph(cur):
+    """
+    Adds every changeset made so far to the commit graph, each after its parents. A changeset usually comes
+    after its parents in changeset_id order, but not always: one that lost a race to move its branch is
+    rebuilt on the changeset that won, which may have been started after it.
+    """
+    # Imported here, as library.graph is only needed by this migration.
+    from library.graph import commit_graph
+
+    cur.execute('SELECT changeset_id, repo_id, parent_id, merge_parent_id FROM changesets ORDER BY changeset_id;')
+    changesets = {
+        changeset_id: (repo_id, [parent for parent in (parent_id, merge_parent_id) if parent is not None])
+        for changeset_id, repo_id, parent_id, merge_parent_id in cur.fetchall()
+    }
+    nodes = {}
+    rows = []
+    for changeset_id in changesets:
+        stack = [changeset_id]
+        while stack:
+            current = stack[-1]
+            if current in nodes:
+                stack.pop()
+                continue
+            repo_id, parent_ids = changesets[current]
+            waiting = [parent for parent in parent_ids if parent not in nodes]
+            if waiting:
+                stack.extend(waiting)
+                continue
+            stack.pop()
+            generation, bloom = commit_graph.make_node(current, [nodes[parent] for parent in parent_ids])
+            nodes[current] = (tuple(parent_ids), generation, bloom)
+            rows.append((
+                current, repo_id, parent_ids, generation, bloom.to_bytes(commit_graph.BLOOM_BITS // 8, 'big')
+            ))
+    psycopg2.extras.execute_values(
+        cur,
+        'INSERT INTO commit_graph (changeset_id, repo_id, parent_ids, generation, bloom) VALUES %s;',
+        rows
+    )
+
+MIGRATIONS = [
+    migration(1, "Baseline schema", [_baseline_schema]),
+    migration(2, "Make user_permissions.username unique so administrator upserts work", [
+        """
+        DO $$
+        BEGIN
+            IF NOT EXISTS (
+                SELECT 1 FROM pg_constraint WHERE conname = 'user_permissions_username_key'
+            ) THEN
+                ALTER TABLE user_permissions ADD CONSTRAINT user_permissions_username_key UNIQUE (username);
+            END IF;
+        END $$;
+        """
+    ]),
+    # Built concurrently so a live server's tables are not locked while the indexes are made.
+    migration(3, "Indexes for the hot lookup paths and unique repository names per owner", [
+        _drop_invalid_indexes,
+        _check_duplicate_repositories,
+        _create_indexes,
+        """
+        DO $$
+        BEGIN
+            IF NOT EXISTS (
+                SELECT 1 FROM pg_constraint WHERE conname = 'repositories_owner_name_key'
+            ) THEN
+                ALTER TABLE repositories
+                    ADD CONSTRAINT repositories_owner_name_key UNIQUE USING INDEX repositories_owner_name_key;
+            END IF;
+        END $$;
+        """
+    ], transactional=False),
+    migration(4, "Content-addressed blob store for file contents", [
+        """
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,  -- Hex SHA-256 of the content
+            size BIGINT NOT NULL,
+            location TEXT NOT NULL,  -- 'disk' or 'database'
+            data BYTEA,  -- Only set when location is 'database'
+            created_on TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        'ALTER TABLE commits ADD COLUMN IF NOT EXISTS blob_hash TEXT REFERENCES blobs(hash);',
+        'ALTER TABLE commits ALTER COLUMN file_data DROP NOT NULL;',
+        _move_file_data_to_blobs,
+        # Garbage collection looks for blobs no commit uses.
+        'CREATE INDEX IF NOT EXISTS commits_blob_hash ON commits (blob_hash);',
+    ]),
+    migration(5, "Delta compressed blobs and repository repacking", [
+        'ALTER TABLE blobs ADD COLUMN IF NOT EXISTS delta_base TEXT REFERENCES blobs(hash);',
+        'ALTER TABLE blobs ADD COLUMN IF NOT EXISTS depth INTEGER NOT NULL DEFAULT 0;',
+        'ALTER TABLE blobs ADD COLUMN IF NOT EXISTS stored_size BIGINT;',
+        'UPDATE blobs SET stored_size = size WHERE stored_size IS NULL;',
+        'ALTER TABLE blobs ALTER COLUMN stored_size SET NOT NULL;',
+        'CREATE INDEX IF NOT EXISTS blobs_delta_base ON blobs (delta_base) WHERE delta_base IS NOT NULL;',
+        # When a repository was last repacked. It needs repacking again once last_updated is later.
+        'ALTER TABLE repositories ADD COLUMN IF NOT EXISTS packed_on TIMESTAMP;',
+    ]),
+    migration(6, "Compressed blobs and per-repository compression dictionaries", [
+        # repo_id has no foreign key, as blobs outlive the repository they were first committed to.
+        """
+        CREATE TABLE IF NOT EXISTS compression_dicts (
+            dict_id SERIAL PRIMARY KEY,
+            repo_id INTEGER NOT NULL,
+            codec TEXT NOT NULL DEFAULT 'zstd',
+            data BYTEA NOT NULL,
+            sample_count INTEGER NOT NULL,
+            trained_on TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        'CREATE INDEX IF NOT EXISTS compression_dicts_repo_id ON compression_dicts (repo_id, dict_id);',
+        # Blobs stored before this are uncompressed, until the repack below.
+        "ALTER TABLE blobs ADD COLUMN IF NOT EXISTS codec TEXT NOT NULL DEFAULT 'none';",
+        'ALTER TABLE blobs ADD COLUMN IF NOT EXISTS dict_id INTEGER REFERENCES compression_dicts(dict_id);',
+        'CREATE INDEX IF NOT EXISTS blobs_dict_id ON blobs (dict_id) WHERE dict_id IS NOT NULL;',
+        _rename_delta_files,
+        # Repacking trains each repository's dictionary and compresses its blobs, so every repository gets one.
+        'UPDATE repositories SET packed_on = NULL;',
+    ]),
+    migration(7, "Multi-file changesets and resumable push uploads", [
+        # A changeset is the set of file versions one push commits together.
+        """
+        CREATE TABLE IF NOT EXISTS changesets (
+            changeset_id SERIAL PRIMARY KEY,
+            repo_id INTEGER NOT NULL REFERENCES repositories(repo_id) ON DELETE CASCADE,
+            author TEXT NOT NULL REFERENCES accounts(username),
+            message TEXT NOT NULL,
+            created_on TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        'ALTER TABLE commits ADD COLUMN IF NOT EXISTS changeset_id INTEGER REFERENCES changesets(changeset_id);',
+        'CREATE INDEX IF NOT EXISTS commits_changeset_id ON commits (changeset_id) WHERE changeset_id IS NOT NULL;',
+        # A push being uploaded. files is the manifest the client started it with, and received how many
+        # verified bytes of each file are on disk. changeset_id is set once it is committed.
+        """
+        CREATE TABLE IF NOT EXISTS uploads (
+            upload_id TEXT PRIMARY KEY,
+            username TEXT NOT NULL REFERENCES accounts(username),
+            repo_id INTEGER NOT NULL REFERENCES repositories(repo_id) ON DELETE CASCADE,
+            commit_message TEXT,
+            files JSONB NOT NULL,
+            received BIGINT[] NOT NULL,
+            changeset_id INTEGER REFERENCES changesets(changeset_id) ON DELETE SET NULL,
+            created_on TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        'CREATE INDEX IF NOT EXISTS uploads_created_on ON uploads (created_on);',
+    ]),
+    migration(8, "Merkle trees of repository snapshots", [
+        # A tree is one folder of a snapshot. See library.trees for what the entries are.
+        """
+        CREATE TABLE IF NOT EXISTS trees (
+            hash TEXT PRIMARY KEY,
+            entries JSONB NOT NULL
+        );
+        """,
+        # The root tree of the repository after the changeset.
+        'ALTER TABLE changesets ADD COLUMN IF NOT EXISTS tree_hash TEXT REFERENCES trees(hash);',
+        # No foreign key, as deleting a repository deletes its changesets, and that would then update the row
+        # being deleted.
+        'ALTER TABLE repositories ADD COLUMN IF NOT EXISTS head_changeset INTEGER;',
+        _build_trees,
+    ]),
+    migration(9, "Table of the newest version of each file, for listing repositories", [
+        # One row per file of a repository: the commit that set its newest version. Kept up to date in the
+        # transaction of each commit, so listing a repository is one range scan of the primary key.
+        """
+        CREATE TABLE IF NOT EXISTS repo_head_files (
+            repo_id INTEGER NOT NULL REFERENCES repositories(repo_id) ON DELETE CASCADE,
+            rel_file_path TEXT NOT NULL,
+            version_major INTEGER NOT NULL,
+            version_minor INTEGER NOT NULL,
+            version_patch INTEGER NOT NULL,
+            commit_id INTEGER NOT NULL,
+            blob_hash TEXT NOT NULL,
+            size BIGINT NOT NULL,
+            commit_message TEXT NOT NULL,
+            commit_date TIMESTAMP,
+            PRIMARY KEY (repo_id, rel_file_path)
+        );
+        """,
+        """
+        INSERT INTO repo_head_files (
+            repo_id, rel_file_path, version_major, version_minor, version_patch, commit_id, blob_hash, size,
+            commit_message, commit_date
+        )
+        SELECT DISTINCT ON (commits.repo_id, commits.rel_file_path)
+            commits.repo_id, commits.rel_file_path, commits.version_major, commits.version_minor,
+            commits.version_patch, commits.commit_id, commits.blob_hash, blobs.size, commits.commit_message,
+            commits.commit_date
+        FROM commits
+        JOIN blobs ON blobs.hash = commits.blob_hash
+        ORDER BY commits.repo_id, commits.rel_file_path, commits.version_major DESC, commits.version_minor DESC,
+            commits.version_patch DESC, commits.commit_id DESC
+        ON CONFLICT (repo_id, rel_file_path) DO NOTHING;
+        """,
+    ]),
+    migration(10, "Branches and tags, and the parent of each changeset", [
+        'ALTER TABLE changesets ADD COLUMN IF NOT EXISTS parent_id INTEGER REFERENCES changesets(changeset_id);',
+        # History so far is a line per repository, in the order the trees were built: that of the first commit
+        # of each changeset.
+        """
+        UPDATE changesets
+        SET parent_id = ordered.parent_id
+        FROM (
+            SELECT changeset_id, LAG(changeset_id) OVER (
+                PARTITION BY repo_id ORDER BY first_commit_id, changeset_id
+            ) AS parent_id
+            FROM (
+                SELECT changesets.changeset_id, changesets.repo_id, MIN(commits.commit_id) AS first_commit_id
+                FROM changesets
+                LEFT JOIN commits ON commits.changeset_id = changesets.changeset_id
+                GROUP BY changesets.changeset_id, changesets.repo_id
+            ) AS firsts
+        ) AS ordered
+        WHERE changesets.changeset_id = ordered.changeset_id AND changesets.parent_id IS NULL;
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS refs (
+            repo_id INTEGER NOT NULL REFERENCES repositories(repo_id) ON DELETE CASCADE,
+            name TEXT NOT NULL,
+            kind TEXT NOT NULL DEFAULT 'branch',  -- 'branch' or 'tag'
+            changeset_id INTEGER NOT NULL REFERENCES changesets(changeset_id),
+            updated_on TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (repo_id, name)
+        );
+        """,
+        # The head of a repository becomes its main branch.
+        """
+        INSERT INTO refs (repo_id, name, kind, changeset_id)
+        SELECT repo_id, 'main', 'branch', head_changeset
+        FROM repositories
+        WHERE head_changeset IS NOT NULL
+        ON CONFLICT (repo_id, name) DO NOTHING;
+        """,
+        'ALTER TABLE repositories DROP COLUMN IF EXISTS head_changeset;',
+        # The branch a push commits to, and the changeset it must still be at, if the client said.
+        "ALTER TABLE uploads ADD COLUMN IF NOT EXISTS branch TEXT NOT NULL DEFAULT 'main';",
+        'ALTER TABLE uploads ADD COLUMN IF NOT EXISTS expected_changeset INTEGER;',
+    ]),
+    migration(11, "The second parent of merge changesets", [
+        'ALTER TABLE changesets ADD COLUMN IF NOT EXISTS merge_parent_id INTEGER REFERENCES changesets(changeset_id);',
+    ]),
+    migration(12, "Commit graph with generation numbers, for ancestry and log queries", [
+        """
+        CREATE TABLE IF NOT EXISTS commit_graph (
+            changeset_id INTEGER PRIMARY KEY REFERENCES changesets(changeset_id) ON DELETE CASCADE,
+            repo_id INTEGER NOT NULL REFERENCES repositories(repo_id) ON DELETE CASCADE,
+            parent_ids INTEGER[] NOT NULL,
+            generation INTEGER NOT NULL,
+            bloom BYTEA NOT NULL  -- See commit_graph in library/graph.py
+        );
+        """,
+        'CREATE INDEX IF NOT EXISTS commit_graph_repo_id ON commit_graph (repo_id);',
+        _build_commit_graph,
+    ]),
+    migration(13, "Trigram index of file content, for code search", [
+        """
+        CREATE TABLE IF NOT EXISTS search_index (
+            blob_hash TEXT PRIMARY KEY REFERENCES blobs(hash) ON DELETE CASCADE,
+            trigrams INTEGER[]  -- NULL for content that is not indexed. See code_search in library/search.py
+        );
+        """,
+        'CREATE INDEX IF NOT EXISTS search_index_trigrams ON search_index USING GIN (trigrams);',
+        'CREATE INDEX IF NOT EXISTS repo_head_files_blob_hash ON repo_head_files (blob_hash);',
+    ]),
+    migration(14, "Daily commit counts of each user, for the commits chart", [
+        """
+        CREATE TABLE IF NOT EXISTS commit_activity (
+            username TEXT NOT NULL,
+            day DATE NOT NULL,
+            commits INTEGER NOT NULL,
+            PRIMARY KEY (username, day) INCLUDE (commits)
+        );
+        """,
+        # Covers the chart of everyone's commits, which adds up each day's rows.
+        'CREATE INDEX IF NOT EXISTS commit_activity_day ON commit_activity (day) INCLUDE (commits);',
+        """
+        INSERT INTO commit_activity (username, day, commits)
+        SELECT author, commit_date::DATE, COUNT(*)
+        FROM commits
+        WHERE commit_date IS NOT NULL
+        GROUP BY author, commit_date::DATE
+        ON CONFLICT (username, day) DO NOTHING;
+        """,
+    ]),
+    migration(15, "Storage used by each repository, and optional storage quotas", [
+        'ALTER TABLE accounts ADD COLUMN IF NOT EXISTS storage_quota BIGINT;',  # In bytes. NULL for no quota
+        """
+        CREATE TABLE IF NOT EXISTS repository_usage (
+            repo_id INTEGER NOT NULL REFERENCES repositories(repo_id) ON DELETE CASCADE,
+            slot SMALLINT NOT NULL,  -- See PostgreSQL.add_storage_usage in library/storage.py
+            bytes BIGINT NOT NULL,
+            files BIGINT NOT NULL,
+            PRIMARY KEY (repo_id, slot) INCLUDE (bytes, files)
+        );
+        """,
+        """
+        INSERT INTO repository_usage (repo_id, slot, bytes, files)
+        SELECT commits.repo_id, 0, SUM(blobs.size), COUNT(*)
+        FROM commits
+        JOIN blobs ON blobs.hash = commits.blob_hash
+        GROUP BY commits.repo_id
+        ON CONFLICT (repo_id, slot) DO NOTHING;
+        """,
+    ]),
+    migration(16, "Spread each user's daily commit count over slots", [
+        # See PostgreSQL.count_commits in library/storage.py. The existing counts are all in slot 0.
+        'ALTER TABLE commit_activity ADD COLUMN IF NOT EXISTS slot SMALLINT NOT NULL DEFAULT 0;',
+        'ALTER TABLE commit_activity ALTER COLUMN slot DROP DEFAULT;',
+        'ALTER TABLE commit_activity DROP CONSTRAINT IF EXISTS commit_activity_pkey;',
+        'ALTER TABLE commit_activity ADD PRIMARY KEY (username, day, slot) INCLUDE (commits);',
+    ]),
+    migration(17, "Storage used by each user, so quotas are checked without adding up every repository", [
+        """
+        CREATE TABLE IF NOT EXISTS user_usage (
+            username TEXT NOT NULL REFERENCES accounts(username) ON DELETE CASCADE,
+            slot SMALLINT NOT NULL,  -- See PostgreSQL.add_storage_usage in library/storage.py
+            bytes BIGINT NOT NULL,
+            files BIGINT NOT NULL,
+            PRIMARY KEY (username, slot) INCLUDE (bytes, files)
+        );
+        """,
+        """
+        INSERT INTO user_usage (username, slot, bytes, files)
+        SELECT repositories.owner, 0, SUM(repository_usage.bytes), SUM(repository_usage.files)
+        FROM repository_usage
+        JOIN repositories ON repositories.repo_id = repository_usage.repo_id
+        GROUP BY repositories.owner
+        ON CONFLICT (username, slot) DO NOTHING;
+        """,
+    ]),
+]
+
+class schema_migrator:
+    def __init__(self, get_connection, migrations: list = None):
+        """
+        Brings the database schema up to date by applying the migrations it has not seen yet.
+        The version the database is at is kept in the schema_version table.
+
+        :param get_connection: A function returning a connection to run the migrations on.
+        :param migrations: The migrations to apply. Defaults to MIGRATIONS.
+        """
+        self.get_connection = get_connection
+        self.migrations = sorted(migrations if migrations is not None else MIGRATIONS, key=lambda m: m.version)
+        assert len({m.version for m in self.migrations}) == len(self.migrations), "Migration versions must be unique."
+
+    @property
+    def latest_version(self) -> int:
+        return self.migrations[-1].version if self.migrations else 0
+
+    @staticmethod
+    def _current_version(conn) -> int:
+        """
+        Gets the schema version of the database, 0 if it has never been migrated.
+        """
+        cur = conn.cursor()
+        try:
+            cur.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version;')
+            version = cur.fetchone()[0]
+            conn.rollback()
+            return version
+        except psycopg2.errors.UndefinedTable:
+            conn.rollback()
+            return 0
+        finally:
+            cur.close()
+
+    def current_version(self) -> int:
+        conn = self.get_connection()
+        try:
+            return self._current_version(conn)
+        finally:
+            conn.close()
+
+    def pending(self) -> list:
+        """
+        Gets the migrations that have not been applied to the database yet, in the order they will be applied.
+        """
+        current = self.current_version()
+        return [m for m in self.migrations if m.version > current]
+
+    def migrate(self) -> list:
+        """
+        Applies every pending migration in order. When the schema is already current, this costs one query.
+
+        :return: The versions that were applied.
+        """
+        conn = self.get_connection()
+        applied = []
+        try:
+            current = self._current_version(conn)
+            if current >= self.latest_version:
+                return applied
+
+            cur = conn.cursor()
+            # Under the lock, as two processes creating the table at once can both find it missing.
+            cur.execute('SELECT pg_advisory_xact_lock(%s);', (MIGRATION_LOCK_KEY,))
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_on TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+                """
+            )
+            conn.commit()
+
+            for step in [m for m in self.migrations if m.version > current]:
+                if step.transactional:
+                    done = self._apply_in_transaction(conn, cur, step)
+                else:
+                    done = self._apply_outside_transaction(conn, cur, step)
+                if done:
+                    applied.append(step.version)
+                    logging.info(f"Applied schema migration {step.version}: {step.description}")
+            cur.close()
+        except Exception:
+            conn.rollback()
+            logging.error("A schema migration failed and was rolled back.", exc_info=True)
+            raise
+        finally:
+            conn.close()
+        return applied
+
+    def _apply_in_transaction(self, conn, cur, step: migration) -> bool:
+        # The lock is released when the transaction ends. Re-checking the version under the lock means
+        # a migration another process applied in the meantime is skipped.
+        cur.execute('SELECT pg_advisory_xact_lock(%s);', (MIGRATION_LOCK_KEY,))
+        if self._version_applied(cur, step.version):
+            conn.rollback()
+            return False
+
+        step.apply(cur)
+        self._record(cur, step)
+        conn.commit()
+        return True
+
+    def _apply_outside_transaction(self, conn, cur, step: migration) -> bool:
+        conn.commit()
+        conn.autocommit = True
+        cur.execute('SELECT pg_advisory_lock(%s);', (MIGRATION_LOCK_KEY,))
+        try:
+            if self._version_applied(cur, step.version):
+                return False
+            step.apply(cur)
+            self._record(cur, step)
+            return True
+        finally:
+            cur.execute('SELECT pg_advisory_unlock(%s);', (MIGRATION_LOCK_KEY,))
+            conn.autocommit = False
+
+    @staticmethod
+    def _version_applied(cur, version: int) -> bool:
+        cur.execute('SELECT EXISTS (SELECT 1 FROM schema_version WHERE version = %s);', (version,))
+        return cur.fetchone()[0]
+
+    @staticmethod
+    def _record(cur, step: migration):
+        cur.execute(
+            'INSERT INTO schema_version (version, description) VALUES (%s, %s);',
+            (step.version, step.description)
+        )
@@ -0,0 +1,301 @@
+from library.storage import var, dt, PostgreSQL
+from library.compression import compressor
+from library.blobstore import blob_store
+from library.delta import delta
+import threading
+import logging
+import random
+import time
+
+class packer:
+    """
+    Repacks the version history of repositories into deltas.
+
+    The newest version of each file is always stored whole, so reading it costs nothing extra.
+    Each older version is stored as a delta against the version after it, so the deltas run backwards in time.
+    Chains are at most blobs.max_delta_depth deep. Past that a version is stored whole and starts a new chain.
+    New commits are stored whole, and the next repack turns the version they replaced into a delta.
+
+    Repacking is also when a repository's compression dictionary is trained, and retrained once it is older than
+    blobs.dictionary_retrain_interval. Everything the repack writes is compressed with the newest one.
+    """
+    # Keys for the advisory lock that stops two processes repacking at once. Blobs are shared between repositories,
+    # so two repacks of different repositories could otherwise make two blobs deltas against each other.
+    LOCK_CLASS = 0x5250
+    LOCK_ID = 0
+    # A delta is only kept if it is at most this fraction of the whole content.
+    MAX_DELTA_RATIO = 0.75
+
+    _thread = None
+    _lock = threading.Lock()
+    _config_cache = None
+    stats = {
+        'repositories': 0,
+        'deltified': 0,
+        'made_whole': 0,
+        'bytes_saved': 0,
+        'compressed': 0,
+    }
+
+    @staticmethod
+    def config() -> dict:
+        if packer._config_cache is None:
+            packer._config_cache = {
+                'max_delta_depth': int(var.get('blobs.max_delta_depth', dt.SETTINGS['blobs']['max_delta_depth'])),
+                'repack_interval': float(var.get('blobs.repack_interval', dt.SETTINGS['blobs']['repack_interval'])),
+            }
+        return packer._config_cache
+
+    @staticmethod
+    def _file_histories(cur, repo_id: int) -> dict:
+        """
+        Gets the distinct contents of each file of a repository, newest first.
+        """
+        cur.execute(
+            """
+            SELECT rel_file_path, blob_hash
+            FROM commits
+            WHERE repo_id = %s AND blob_hash IS NOT NULL
+            ORDER BY rel_file_path, version_major DESC, version_minor DESC, version_patch DESC, commit_id DESC;
+            """,
+            (repo_id,)
+        )
+        histories = {}
+        for rel_file_path, blob_hash in cur.fetchall():
+            history = histories.setdefault(rel_file_path, [])
+            if blob_hash not in history:
+                history.append(blob_hash)
+        return histories
+
+    @staticmethod
+    def _chain_contains(cur, start_hash: str, needle: str) -> bool:
+        """
+        Checks if needle is start_hash or anywhere in the chain of blobs it is a delta against.
+        """
+        current = start_hash
+        for _ in range(blob_store.MAX_CHAIN):
+            if current is None:
+                return False
+            if current == needle:
+                return True
+            current = blob_store.representation(cur, current)[0]
+        return True
+
+    @staticmethod
+    def _is_newest_anywhere(cur, blob_hash: str) -> bool:
+        """
+        Checks if a blob is the newest version of a file in any repository, as another repository's history
+        may have it as an older version. Those are kept whole, so reading them costs nothing extra.
+        """
+        cur.execute('SELECT EXISTS (SELECT 1 FROM repo_head_files WHERE blob_hash = %s);', (blob_hash,))
+        return cur.fetchone()[0]
+
+    @staticmethod
+    def _has_other_dependants(cur, blob_hash: str, allowed: str | None) -> bool:
+        """
+        Checks if blobs other than allowed are deltas against blob_hash. Those would get a deeper chain
+        than they were packed for if blob_hash became a delta itself.
+        """
+        cur.execute(
+            'SELECT EXISTS (SELECT 1 FROM blobs WHERE delta_base = %s AND hash IS DISTINCT FROM %s);',
+            (blob_hash, allowed)
+        )
+        return cur.fetchone()[0]
+
+    @staticmethod
+    def _repack_history(conn, cur, repo_id: int, history: list) -> dict:
+        """
+        Repacks the contents of one file, newest first. Each change is committed on its own,
+        so readers are never held up for long.
+        """
+        max_depth = packer.config()['max_delta_depth']
+        counts = {'deltified': 0, 'made_whole': 0, 'bytes_saved': 0, 'compressed': 0}
+
+        def recompress(blob_hash):
+            # Blobs stored before the repository had a dictionary are compressed with it, even if already packed.
+            if blob_store.recompress(cur, blob_hash, repo_id):
+                conn.commit()
+                blob_store.discard_stale_files(cur, blob_hash)
+                counts['compressed'] += 1
+
+        newer_hash = newer_content = None
+        for position, blob_hash in enumerate(history):
+            current_base, current_depth = blob_store.representation(cur, blob_hash)
+            older_hash = history[position + 1] if position + 1 < len(history) else None
+
+            if newer_hash is None:
+                # The newest version. Keep it whole so it is quick to read.
+                content = blob_store.get(cur, blob_hash)
+                if current_base is not None:
+                    blob_store.store_as_whole(cur, blob_hash, content, repo_id)
+                    conn.commit()
+                    blob_store.discard_stale_files(cur, blob_hash)
+                    counts['made_whole'] += 1
+                else:
+                    recompress(blob_hash)
+                newer_hash, newer_content = blob_hash, content
+                continue
+
+            newer_depth = blob_store.representation(cur, newer_hash)[1]
+            depth = newer_depth + 1
+            if current_base == newer_hash and current_depth == depth:
+                # Already packed the way it should be. Its content is only rebuilt if an older version needs it.
+                recompress(blob_hash)
+                newer_hash, newer_content = blob_hash, None
+                continue
+
+            content = blob_store.get(cur, blob_hash)
+            can_deltify = (
+                depth <= max_depth
+                and not packer._chain_contains(cur, newer_hash, blob_hash)
+                and not packer._has_other_dependants(cur, blob_hash, older_hash)
+                and not packer._is_newest_anywhere(cur, blob_hash)
+            )
+            patch = None
+            if can_deltify:
+                if newer_content is None:
+                    newer_content = blob_store.get(cur, newer_hash)
+                patch = delta.encode(newer_content, content)
+
+            if patch is not None and len(patch) <= len(content) * packer.MAX_DELTA_RATIO:
+                blob_store.store_as_delta(cur, blob_hash, newer_hash, patch, depth, repo_id)
+                conn.commit()
+                blob_store.discard_stale_files(cur, blob_hash)
+                counts['deltified'] += 1
+                counts['bytes_saved'] += len(content) - len(patch)
+            elif current_base is not None:
+                # Too deep, or the delta does not save enough. Store it whole as the start of a new chain.
+                blob_store.store_as_whole(cur, blob_hash, content, repo_id)
+                conn.commit()
+                blob_store.discard_stale_files(cur, blob_hash)
+                counts['made_whole'] += 1
+            else:
+                recompress(blob_hash)
+
+            newer_hash, newer_content = blob_hash, content
+        return counts
+
+    @staticmethod
+    def _train_dictionary(conn, cur, repo_id: int, histories: dict) -> int | None:
+        """
+        Trains a compression dictionary for a repository on the newest version of a sample of its files.
+        """
+        newest = [history[0] for history in histories.values()]
+        if len(newest) < compressor.MIN_SAMPLES:
+            return None
+        if len(newest) > compressor.MAX_SAMPLES:
+            newest = random.sample(newest, compressor.MAX_SAMPLES)
+
+        samples = []
+        sampled_bytes = 0
+        for blob_hash in newest:
+            sample = blob_store.get(cur, blob_hash)[:compressor.SAMPLE_PREFIX]
+            samples.append(sample)
+            sampled_bytes += len(sample)
+            if sampled_bytes >= compressor.MAX_SAMPLE_BYTES:
+                break
+
+        dict_id = compressor.train(cur, repo_id, samples)
+        conn.commit()
+        return dict_id
+
+    @staticmethod
+    def repack_repository(repo_id: int) -> dict | None:
+        """
+        Repacks every file of a repository.
+
+        :return: What was done, or None if another process is repacking right now.
+        """
+        conn = PostgreSQL.shared().get_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute('SELECT pg_try_advisory_lock(%s, %s);', (packer.LOCK_CLASS, packer.LOCK_ID))
+            if not cur.fetchone()[0]:
+                conn.rollback()
+                return None
+            conn.commit()
+
+            try:
+                # The database's clock, as that is the one last_updated is set by.
+                cur.execute('SELECT LOCALTIMESTAMP;')
+                started_at = cur.fetchone()[0]
+                totals = {'deltified': 0, 'made_whole': 0, 'bytes_saved': 0, 'compressed': 0}
+                histories = packer._file_histories(cur, repo_id)
+                # Trained first, so what the repack writes is compressed with the new dictionary.
+                if compressor.needs_training(cur, repo_id):
+                    packer._train_dictionary(conn, cur, repo_id, histories)
+                for history in histories.values():
+                    for key, value in packer._repack_history(conn, cur, repo_id, history).items():
+                        totals[key] += value
+
+                # Commits made while repacking leave last_updated after this, so the next run picks them up.
+                cur.execute('UPDATE repositories SET packed_on = %s WHERE repo_id = %s;', (started_at, repo_id))
+                conn.commit()
+            finally:
+                conn.rollback()
+                cur.execute('SELECT pg_advisory_unlock(%s, %s);', (packer.LOCK_CLASS, packer.LOCK_ID))
+                conn.commit()
+        finally:
+            cur.close()
+            conn.close()
+
+        with packer._lock:
+            packer.stats['repositories'] += 1
+            for key, value in totals.items():
+                packer.stats[key] += value
+        logging.info(f"Repacked repository {repo_id}: {totals}")
+        return totals
+
+    @staticmethod
+    def repack_changed() -> int:
+        """
+        Repacks every repository that changed since it was last repacked.
+
+        :return: How many repositories were repacked.
+        """
+        changed = PostgreSQL.query_db(
+            """
+            SELECT repo_id
+            FROM repositories
+            WHERE packed_on IS NULL OR packed_on < last_updated
+            ORDER BY repo_id;
+            """,
+            (),
+            do_commit=False
+        )
+        repacked = 0
+        for (repo_id,) in changed:
+            if packer.repack_repository(repo_id) is None:
+                # Another process is repacking, and will get to the rest.
+                break
+            repacked += 1
+        return repacked
+
+    @staticmethod
+    def _run_forever(interval: float):
+        while True:
+            time.sleep(interval)
+            try:
+                packer.repack_changed()
+            except Exception:
+                logging.error("The background repack failed. It will be tried again.", exc_info=True)
+
+    @staticmethod
+    def start_background():
+        """
+        Starts repacking changed repositories every blobs.repack_interval seconds, in a background thread.
+        Does nothing if it is already running, or if repacking is turned off.
+        """
+        interval = packer.config()['repack_interval']
+        with packer._lock:
+            if interval <= 0 or (packer._thread is not None and packer._thread.is_alive()):
+                return
+            packer._thread = threading.Thread(
+                target=packer._run_forever, args=(interval,), name='raindrop-repack', daemon=True
+            )
+            packer._thread.start()
+
+    @staticmethod
+    def statistics() -> dict:
+        with packer._lock:
+            return dict(packer.stats)
@@ -1,10 +1,16 @@
-from library.versioncontrolsystem import repository_handler, vcs
-from library.user_login import user_login, users
-from library.storage import var, PostgreSQL
+from library.async_storage import AsyncPostgreSQL
+from library.user_login import user_login, principal, users
+from library.storage import var, PostgreSQL, request_consistency, read_cache
+from library.archives import repository_archive
+from library.uploads import upload_sessions
+from library.diff import diff_engine
+from library.refs import ref_store
 from library.webui import webgui
+from library.packs import packer
 from library.errors import error
 import quart_cors
 import functools
+import asyncio
 import datetime
 import requests
 import uvicorn
@@ -28,6 +34,19 @@ DEBUG = bool(os.environ.get("DEBUG", False))
 app = quart.Quart(__name__, template_folder=template_dir)
 quart_cors.cors(app, allow_origin='*')
 
+@app.before_serving
+async def start_repacking():
+    packer.start_background()
+
+@app.after_serving
+async def close_storage():
+    await AsyncPostgreSQL.shared().close()
+
+@app.before_request
+async def start_request():
+    # Reads may go to a replica until this request writes something, then they go to the primary.
+    request_consistency.begin()
+
 @app.errorhandler(error.user_nonexistant)
 async def handle_user_nonexistant(err: error.user_nonexistant):
     return {
@@ -56,6 +75,94 @@ async def handle_restricted_account(err: error.restricted_account):
         'code': err.code_number
     }, 403
 
+@app.errorhandler(error.insufficient_permissions)
+async def handle_insufficient_permissions(err: error.insufficient_permissions):
+    return {
+        'error': 'You do not have permission to do that',
+        'code': err.code_number
+    }, 403
+
+@app.errorhandler(error.file_not_found)
+async def handle_file_not_found(err: error.file_not_found):
+    return {
+        'error': 'File not found',
+        'code': err.code_number
+    }, 404
+
+@app.errorhandler(error.repository_not_found)
+async def handle_repository_not_found(err: error.repository_not_found):
+    return {
+        'error': 'Repository not found',
+        'code': err.code_number
+    }, 404
+
+@app.errorhandler(error.changeset_not_found)
+async def handle_changeset_not_found(err: error.changeset_not_found):
+    return {
+        'error': 'Changeset not found',
+        'changeset_id': err.changeset_id,
+        'code': err.code_number
+    }, 404
+
+@app.errorhandler(error.ref_not_found)
+async def handle_ref_not_found(err: error.ref_not_found):
+    return {
+        'error': 'Branch or tag not found',
+        'name': err.name,
+        'code': err.code_number
+    }, 404
+
+@app.errorhandler(error.ref_conflict)
+async def handle_ref_conflict(err: error.ref_conflict):
+    # Where the ref is now, so the client can rebase onto it and try again.
+    return {
+        'error': 'The branch or tag is not where you expected',
+        'name': err.name,
+        'current': err.current,
+        'code': err.code_number
+    }, 409
+
+@app.errorhandler(error.merge_conflict)
+async def handle_merge_conflict(err: error.merge_conflict):
+    return {
+        'error': f'Merging {err.source} into {err.target} conflicts',
+        'conflicts': err.conflicts,
+        'code': err.code_number
+    }, 409
+
+@app.errorhandler(error.quota_exceeded)
+async def handle_quota_exceeded(err: error.quota_exceeded):
+    return {
+        'error': 'This would take the repository owner over their storage quota',
+        'quota': err.quota,
+        'used': err.used,
+        'needed': err.needed,
+        'code': err.code_number
+    }, 413
+
+@app.errorhandler(error.upload_not_found)
+async def handle_upload_not_found(err: error.upload_not_found):
+    return {
+        'error': 'Upload not found',
+        'code': err.code_number
+    }, 404
+
+@app.errorhandler(error.chunk_rejected)
+async def handle_chunk_rejected(err: error.chunk_rejected):
+    return {
+        'error': err.reason,
+        'received': err.received,
+        'code': err.code_number
+    }, 409
+
+@app.errorhandler(error.upload_incomplete)
+async def handle_upload_incomplete(err: error.upload_incomplete):
+    return {
+        'error': 'Not every file has been uploaded yet',
+        'incomplete': err.rel_file_paths,
+        'code': err.code_number
+    }, 409
+
 @app.errorhandler(error.bad_password)
 async def handle_bad_password(err: error.bad_password):
     return {
@@ -110,6 +217,77 @@ class QuartAPI:
             return await api_function(*args, **kwargs)
         return wrapper
 
+    # Page sizes for the listing endpoints
+    DEFAULT_PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 1000
+
+    @staticmethod
+    def paginated(api_function):
+        """
+        Decorator that reads the ?after=<repo_id>&limit= keyset pagination arguments and passes them on
+        as after and limit. The limit is capped at MAX_PAGE_SIZE.
+        """
+        @functools.wraps(api_function)
+        async def wrapper(*args, **kwargs):
+            try:
+                after = int(quart.request.args.get('after', 0))
+                limit = int(quart.request.args.get('limit', QuartAPI.DEFAULT_PAGE_SIZE))
+            except ValueError:
+                return {
+                    'error': 'after and limit must be whole numbers'
+                }, 400
+            if after < 0 or limit < 1:
+                return {
+                    'error': 'after can not be negative and limit must be at least 1'
+                }, 400
+            return await api_function(*args, after=after, limit=min(limit, QuartAPI.MAX_PAGE_SIZE), **kwargs)
+        return wrapper
+
+    @staticmethod
+    def page(rows: list, limit: int) -> tuple[list, int | None]:
+        """
+        Splits off the extra row a listing was asked for, to tell if there is another page.
+
+        :param rows: Up to limit + 1 rows, in repo_id order.
+        :param limit: The page size.
+        :return: The rows of the page, and the value of after for the next page, or None if this is the last one.
+        """
+        if len(rows) > limit:
+            rows = rows[:limit]
+            return rows, rows[-1]['repo_id']
+        return rows, None
+
+    @staticmethod
+    def parse_version(version: str) -> tuple | None:
+        """
+        Reads a version given as major.minor.patch, like 1.0.0.
+        :return: The (major, minor, patch) version, or None if it is not one.
+        """
+        try:
+            version = tuple(int(part) for part in version.split('.'))
+        except ValueError:
+            return None
+        return version if len(version) == 3 else None
+
+    @staticmethod
+    async def private_viewer() -> str | None:
+        """
+        For routes where signing in is optional, and only needed for private repositories.
+        :return: The username the request is signed in as, if the user may see their private repositories.
+        """
+        authorization = quart.request.headers.get('Authorization', None)
+        if not authorization:
+            return None
+        user = await user_login.from_token(authorization.split(" ")[-1])
+        return user.username if not user.restricted else None
+
+    @staticmethod
+    async def can_view_private(repo_owner: str) -> bool:
+        """
+        :return: Whether the request is signed in as repo_owner, so may see their private repositories.
+        """
+        return await QuartAPI.private_viewer() == repo_owner
+
     @staticmethod
     def require_authentication(api_function):
         @functools.wraps(api_function)
@@ -122,17 +300,13 @@ class QuartAPI:
                 data = await quart.request.get_json()
                 token = data.get('token')
 
-            # Validate the token
-            if PostgreSQL().validate_token(token) is True:
-                user = user_login(token=token)
+            # Validate the token. Raises error.bad_token if it is not valid.
+            user = await user_login.from_token(token)
 
-                if user.is_restricted():
-                    raise error.restricted_account
+            if user.restricted:
+                raise error.restricted_account
 
-                return await api_function(*args, user=user, **kwargs)
-            else:
-                # Raise an error if the token is not valid
-                raise error.bad_token
+            return await api_function(*args, user=user, **kwargs)
 
         return wrapper
 
@@ -148,17 +322,15 @@ class QuartAPI:
                 data = await quart.request.get_json()
                 token = data.get('token')
 
-            # Validate the token
-            if PostgreSQL().validate_token(token) is True:
-                user = user_login(token=token)
+            # Validate the token. Raises error.bad_token if it is not valid.
+            user = await user_login.from_token(token)
 
-                if not user.is_restricted():
-                    raise error.restricted_account
+            if user.restricted:
+                raise error.restricted_account
+            if not user.is_admin:
+                raise error.insufficient_permissions
 
-                return await api_function(*args, user=user, **kwargs)
-            else:
-                # Raise an error if the token is not valid
-                raise error.bad_token
+            return await api_function(*args, user=user, **kwargs)
 
         return wrapper
 
@@ -178,15 +350,13 @@ class view_routes:
     @staticmethod
     @app.route('/view/<username>/bio', methods=['GET'])
     async def get_bio(username):
-        return users.get_bio(username), 200
+        return await AsyncPostgreSQL.shared().get_bio(username), 200
 
     @staticmethod
     @app.route('/view/<account>/<repository>', methods=['GET'])
     async def get_repository(account, repository):
         # Just checks if the repository exists. Most backend happens else where.
-        try:
-            repository_handler(account, repository)
-        except error.repository_not_found:
+        if not await AsyncPostgreSQL.shared().repository_exists(account, repository):
             # Responds with a 404 error if the repository does not exist
             return await quart.send_file('website/404.html'), 404
 
@@ -200,13 +370,14 @@ class view_routes:
     @staticmethod
     @app.route('/view/<username>', methods=['GET'])
     async def get_account(username):
-        if users.exists(username):
+        db = AsyncPostgreSQL.shared()
+        if await db.check_exists(username, not_exist_ok=True):
             return await quart.render_template(
                 template_name_or_list='account.html',
                 username=username,
                 pfp_address=users.get_pfp_address(username),
                 banner_address=users.get_banner_address(username),
-                user_bio=users.get_bio(username),
+                user_bio=await db.get_bio(username),
             ), 200
         else:
             # Responds with a 404 error if the user does not exist
@@ -222,7 +393,7 @@ class api_routes:
     @app.route('/api/raindrop-status')
     async def status():
         token = quart.request.args.get('token', None)
-        user_restricted = user_login(token=token).is_restricted()
+        user_restricted = (await user_login.from_token(token)).restricted
 
         return {
             "Components": {
@@ -239,6 +410,12 @@ class api_routes:
             "time": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
         }, 200
 
+    @staticmethod
+    @app.route('/api/admin/cache', methods=['GET'])
+    @QuartAPI.administrator_only
+    async def cache_statistics(user: principal):
+        return read_cache.statistics(), 200
+
     @staticmethod
     @app.route('/api/login', methods=['POST'])
     @QuartAPI.require_json
@@ -254,7 +431,7 @@ class api_routes:
             }, 400
 
         try:
-            user = user_login(username=username, password=password)
+            user = await user_login.from_password(username=username, password=password)
         except PermissionError:
             return {
                 'error': 'Username or password is invalid',
@@ -273,7 +450,7 @@ class api_routes:
 
         return {
             "error": None,
-            "token": user.generate_token()
+            "token": await user.generate_token_async()
         }, 200
 
     @staticmethod
@@ -288,7 +465,7 @@ class api_routes:
             return {'error': 'username and password are required'}, 400
 
         try:
-            success = users.register(username=username, password=password)
+            success = await users.register_async(username=username, password=password)
         except error.user_already_exists:
             return {
                 'error': 'User already exists',
@@ -297,90 +474,145 @@ class api_routes:
             'success': success,
         }, 200 if success else 400
 
+    @staticmethod
+    @app.route('/api/admin/quota', methods=['POST'])
+    @QuartAPI.require_json
+    @QuartAPI.administrator_only
+    async def set_storage_quota(user: principal):
+        """
+        Sets how many bytes of file content a user's repositories may store. The JSON body is username and quota,
+        which is null for no limit.
+        """
+        data = await quart.request.get_json()
+        username = data.get('username', None)
+        quota = data.get('quota', None)
+
+        if not isinstance(username, str) or (
+                quota is not None and (not isinstance(quota, int) or isinstance(quota, bool) or quota < 0)):
+            return {
+                'error': 'username is required, and quota must be a number of bytes or null'
+            }, 400
+
+        await AsyncPostgreSQL.shared().set_storage_quota(username, quota)
+        return {
+            'username': username,
+            'quota': quota
+        }, 200
+
+    @staticmethod
+    @app.route('/api/account/usage', methods=['GET'])
+    @QuartAPI.require_authentication
+    async def storage_usage(user: principal):
+        """
+        Says how much file content the signed in user's repositories store, and their quota.
+        """
+        return await AsyncPostgreSQL.shared().storage_usage(user.username), 200
+
     @staticmethod
     @app.route('/api/validate/<token>', methods=['GET'])
     async def is_valid_token(token):
-        is_valid = PostgreSQL().validate_token(token)
+        is_valid = await AsyncPostgreSQL.shared().validate_token(token)
         return {
             'valid': is_valid
         }, 200
 
 class vcs_routes:
+    # How many days the commits chart shows by default, and at most
+    CHART_DAYS = 14
+    MAX_CHART_DAYS = 3660
+
     @staticmethod
     @app.route('/api/vcs/commits_chart', methods=['POST', 'GET'])
     async def commits_data():
+        """
+        Counts the commits of username, or of everyone if it is "*", on each day from start to end, given as
+        ISO dates. They default to the last CHART_DAYS days.
+        """
         if quart.request.method == 'POST':
             data = await quart.request.get_json()
             try:
                 username = data.get('username', None)
+                start = data.get('start', None)
+                end = data.get('end', None)
             except AttributeError:
                 raise error.json_content_type_only
         else:  # GET request
             username = quart.request.args.get('username', None)
+            start = quart.request.args.get('start', None)
+            end = quart.request.args.get('end', None)
 
         if type(username) is not str:
             return {
                 'error': 'username is required and must be a string',
             }, 400
 
+        try:
+            end = datetime.date.fromisoformat(end) if end is not None else datetime.date.today()
+            start = (
+                datetime.date.fromisoformat(start) if start is not None
+                else end - datetime.timedelta(days=vcs_routes.CHART_DAYS - 1)
+            )
+        except (TypeError, ValueError):
+            return {
+                'error': 'start and end must be dates, like 2024-01-31',
+            }, 400
+        if not 0 <= (end - start).days < vcs_routes.MAX_CHART_DAYS:
+            return {
+                'error': f'start must be on or before end, and at most {vcs_routes.MAX_CHART_DAYS} days before it',
+            }, 400
+
         # Check if the user exists
         if not username == "*":
-            users.exists(username)
-        else:
-            # If username is "*", return all commits
-            pass
+            await AsyncPostgreSQL.shared().check_exists(username)
 
-        # Test data.
-        # TODO: Implement this function to return actual data
+        counts = await AsyncPostgreSQL.shared().commit_activity(username, start, end)
         return {
-            1: 10,
-            2: 20,
-            3: 30,
-            4: 40,
-            5: 287,
-            6: 60,
-            7: 70,
-            8: 80,
-            9: 1,
-            10: 2,
-            11: 91,
-            12: 12,
-            13: 40,
-            14: 21,
+            (start + datetime.timedelta(days=offset)).isoformat():
+                counts.get(start + datetime.timedelta(days=offset), 0)
+            for offset in range((end - start).days + 1)
         }, 200
 
     @staticmethod
     @app.route('/api/vcs/repositories/list_private', methods=['GET'])
     @QuartAPI.require_authentication
-    async def list_private_repositories(user: user_login):
-        return {'private': user.list_private_repos()}, 200
+    @QuartAPI.paginated
+    async def list_private_repositories(user: principal, after: int, limit: int):
+        rows = await AsyncPostgreSQL.shared().list_private_repos(user.username, after=after, limit=limit + 1)
+        private_repositories, next_after = QuartAPI.page(rows, limit)
+        return {'private': private_repositories, 'next': next_after}, 200
 
     @staticmethod
     @app.route('/api/vcs/repositories/<username>/list_public', methods=['GET'])
-    async def list_public_repositories(username):
+    @QuartAPI.paginated
+    async def list_public_repositories(username, after: int, limit: int):
+        db = AsyncPostgreSQL.shared()
         # Ensures the user exists
-        if not users.exists(username):
+        if not await db.check_exists(username, not_exist_ok=True):
             raise error.user_nonexistant
-        return {'public': vcs.list_pub_repositories(username)}, 200
+        rows = await db.list_public_repos(username, after=after, limit=limit + 1)
+        public_repositories, next_after = QuartAPI.page(rows, limit)
+        return {'public': public_repositories, 'next': next_after}, 200
 
     @staticmethod
     @app.route('/api/vcs/repositories/list_all', methods=['GET'])
     @QuartAPI.require_authentication
-    async def list_repositories(user: user_login):
-        private_repositories:dict = user.list_private_repos()
-        public_repositories:dict = user.list_public_repos()
+    @QuartAPI.paginated
+    async def list_repositories(user: principal, after: int, limit: int):
+        # One page covers both kinds, so a page may hold only private or only public repositories.
+        rows = await AsyncPostgreSQL.shared().list_repos(user.username, after=after, limit=limit + 1)
+        repositories, next_after = QuartAPI.page(rows, limit)
 
         return {
-            # Format, {repo_name: description}
-            'private': private_repositories,
-            'public': public_repositories,
+            'private': [repo for repo in repositories if repo['private']],
+            'public': [repo for repo in repositories if not repo['private']],
+            'next': next_after,
         }, 200
 
     @staticmethod
     @app.route('/api/vcs/repository/create', methods=['POST'])
     @QuartAPI.require_json
     @QuartAPI.require_authentication
-    async def create_repository(user: user_login):
+    async def create_repository(user: principal):
         data = await quart.request.get_json()
 
         repository_name = data.get('repo_name', None)
@@ -392,7 +624,7 @@ class vcs_routes:
                 'error': 'repository_name is required'
             }, 400
 
-        success = user.create_repository(repository_name, description, is_private)
+        success = await user.create_repository_async(repository_name, description, is_private)
         return {
             'success': success
         }, 200 if success else 400
@@ -401,7 +633,7 @@ class vcs_routes:
     @app.route('/api/vcs/repository/delete', methods=['POST'])
     @QuartAPI.require_json
     @QuartAPI.require_authentication
-    async def delete_repository(user: user_login):
+    async def delete_repository(user: principal):
         data = await quart.request.get_json()
 
         repository_name = data.get('repo_name', None)
@@ -411,10 +643,11 @@ class vcs_routes:
                 'error': 'repository_name is required'
             }, 400
 
-        success = user.delete_repository(repository_name)
+        if not await AsyncPostgreSQL.shared().delete_repository(user.username, repository_name):
+            raise error.repository_not_found(repository_name)
         return {
-            'success': success
-        }, 200 if success else 400
+            'success': True
+        }, 200
 
     @staticmethod
     @app.route('/api/vcs/repository/exists', methods=['GET'])
@@ -427,7 +660,7 @@ class vcs_routes:
                 'error': 'repo_name and owner are required'
             }, 400
 
-        exists = vcs.repository_exists(owner, repo_name)
+        exists = await AsyncPostgreSQL.shared().repository_exists(owner, repo_name)
         return {
             'exists': exists
         }, 200
@@ -439,21 +672,526 @@ class vcs_routes:
         data = await quart.request.get_json()
         repo_owner = data.get('owner', None)
         repo_name = data.get('repo_name', None)
+        # Optional, the changeset to list the files as of. The newest by default.
+        changeset_id = data.get('changeset_id', None)
+        # Optional, the branch or tag to list the files of, instead of a changeset.
+        ref = data.get('ref', None)
 
         if not repo_name or not repo_owner:
             return {
                 'error': 'repo_name and repo_owner are required'
             }, 400
+        if changeset_id is not None and (not isinstance(changeset_id, int) or isinstance(changeset_id, bool)):
+            return {
+                'error': 'changeset_id must be an integer'
+            }, 400
+        if ref is not None and (not isinstance(ref, str) or changeset_id is not None):
+            return {
+                'error': 'ref must be a branch or tag name, and can not be given with changeset_id'
+            }, 400
+
+        db = AsyncPostgreSQL.shared()
+        view_private = await QuartAPI.can_view_private(repo_owner)
+        if not await db.repository_exists(repo_owner, repo_name, view_private):
+            return {
+                'error': 'repository not found'
+            }, 404
+
+        return {
+            'files': await db.walk_repository(repo_name, repo_owner, view_private, changeset_id, ref)
+        }, 200
+
+    @staticmethod
+    @app.route('/api/vcs/repository/refs', methods=['GET'])
+    async def list_refs():
+        """
+        Lists the branches and tags of a repository, given as ?owner= and ?repo_name=, and the changeset each is at.
+        """
+        repo_owner = quart.request.args.get('owner', None)
+        repo_name = quart.request.args.get('repo_name', None)
+
+        if not repo_name or not repo_owner:
+            return {
+                'error': 'owner and repo_name are required'
+            }, 400
+
+        refs = await AsyncPostgreSQL.shared().list_refs(
+            repo_owner, repo_name, await QuartAPI.can_view_private(repo_owner)
+        )
+        if refs is None:
+            raise error.repository_not_found(repo_name)
+        return {
+            'refs': refs
+        }, 200
+
+    @staticmethod
+    @app.route('/api/vcs/repository/log', methods=['GET'])
+    async def changeset_log():
+        """
+        Lists the history of a repository, newest first, given as ?owner= and ?repo_name=. Optionally ?ref= is the
+        branch or tag, or ?to= the changeset, to list the history of, ?since= a changeset to list what came after,
+        and ?limit= how many to list.
+        """
+        repo_owner = quart.request.args.get('owner', None)
+        repo_name = quart.request.args.get('repo_name', None)
+        ref = quart.request.args.get('ref', None)
+        changeset_id = quart.request.args.get('to', None, type=int)
+        since = quart.request.args.get('since', None, type=int)
+        limit = quart.request.args.get('limit', QuartAPI.DEFAULT_PAGE_SIZE, type=int)
+
+        if not repo_name or not repo_owner:
+            return {
+                'error': 'owner and repo_name are required'
+            }, 400
+        if ref is not None and 'to' in quart.request.args:
+            return {
+                'error': 'ref and to can not both be given'
+            }, 400
+        if ('to' in quart.request.args and changeset_id is None) or ('since' in quart.request.args and since is None):
+            return {
+                'error': 'to and since must be changeset ids'
+            }, 400
+        if limit is None or limit < 1:
+            return {
+                'error': 'limit must be a whole number of at least 1'
+            }, 400
+
+        history = await AsyncPostgreSQL.shared().changeset_log(
+            repo_owner, repo_name, ref, changeset_id, since, min(limit, QuartAPI.MAX_PAGE_SIZE),
+            await QuartAPI.can_view_private(repo_owner)
+        )
+        if history is None:
+            raise error.repository_not_found(repo_name)
+        return {
+            'changesets': history
+        }, 200
+
+    @staticmethod
+    @app.route('/api/vcs/repository/ancestry', methods=['GET'])
+    async def is_ancestor():
+        """
+        Says whether a changeset descends from another, given as ?owner=, ?repo_name=, ?ancestor= and ?descendant=.
+        """
+        repo_owner = quart.request.args.get('owner', None)
+        repo_name = quart.request.args.get('repo_name', None)
+        ancestor = quart.request.args.get('ancestor', None, type=int)
+        descendant = quart.request.args.get('descendant', None, type=int)
+
+        if not repo_name or not repo_owner or ancestor is None or descendant is None:
+            return {
+                'error': 'owner, repo_name, ancestor and descendant are required, the last two as changeset ids'
+            }, 400
+
+        result = await AsyncPostgreSQL.shared().is_ancestor(
+            repo_owner, repo_name, ancestor, descendant, await QuartAPI.can_view_private(repo_owner)
+        )
+        if result is None:
+            raise error.repository_not_found(repo_name)
+        return {
+            'is_ancestor': result
+        }, 200
+
+    @staticmethod
+    @app.route('/api/vcs/search', methods=['GET'])
+    async def search_code():
+        """
+        Searches the newest version of every file of the public repositories, and the signed in user's private ones,
+        for ?q=. ?regex=true makes it a regular expression, and ?ignore_case=true ignores case. Optionally ?owner=
+        and ?repo_name= narrow the search, and ?limit= is how many files to list.
+        """
+        query = quart.request.args.get('q', None)
+        regex = quart.request.args.get('regex', 'false').lower() in ('true', '1')
+        ignore_case = quart.request.args.get('ignore_case', 'false').lower() in ('true', '1')
+        repo_owner = quart.request.args.get('owner', None)
+        repo_name = quart.request.args.get('repo_name', None)
+        limit = quart.request.args.get('limit', QuartAPI.DEFAULT_PAGE_SIZE, type=int)
+
+        if not query:
+            return {
+                'error': 'q is required'
+            }, 400
+        if limit is None or limit < 1:
+            return {
+                'error': 'limit must be a whole number of at least 1'
+            }, 400
+
+        try:
+            found = await AsyncPostgreSQL.shared().search_code(
+                query, regex, ignore_case, await QuartAPI.private_viewer(), repo_owner, repo_name,
+                min(limit, QuartAPI.MAX_PAGE_SIZE)
+            )
+        except ValueError as err:
+            return {
+                'error': str(err)
+            }, 400
+        return found, 200
+
+    @staticmethod
+    @app.route('/api/vcs/repository/refs/update', methods=['POST'])
+    @QuartAPI.require_json
+    @QuartAPI.require_authentication
+    async def update_ref(user: principal):
+        """
+        Makes a branch or tag, or moves a branch. The JSON body is repo_name, name, changeset_id, expected and
+        kind ('branch' or 'tag'). expected is the changeset the ref must be at now, or null to make a new one.
+        If it is anywhere else, nothing changes and the answer is a 409 saying where it is.
+        """
+        data = await quart.request.get_json()
+        repo_name = data.get('repo_name', None)
+        name = data.get('name', None)
+        changeset_id = data.get('changeset_id', None)
+        expected = data.get('expected', None)
+
+        if not repo_name or not name or not isinstance(changeset_id, int) or isinstance(changeset_id, bool):
+            return {
+                'error': 'repo_name, name and changeset_id are required, changeset_id as an integer'
+            }, 400
+        if expected is not None and (not isinstance(expected, int) or isinstance(expected, bool)):
+            return {
+                'error': 'expected must be a changeset id or null'
+            }, 400
+
+        try:
+            await asyncio.to_thread(
+                PostgreSQL.shared().update_ref, user.username, repo_name, name, changeset_id, expected,
+                data.get('kind', 'branch')
+            )
+        except ValueError as err:
+            return {
+                'error': str(err)
+            }, 400
+        return {
+            'success': True
+        }, 200
+
+    @staticmethod
+    @app.route('/api/vcs/repository/refs/delete', methods=['POST'])
+    @QuartAPI.require_json
+    @QuartAPI.require_authentication
+    async def delete_ref(user: principal):
+        """
+        Deletes a branch or tag. The JSON body is repo_name, name and expected, the changeset it must be at.
+        """
+        data = await quart.request.get_json()
+        repo_name = data.get('repo_name', None)
+        name = data.get('name', None)
+        expected = data.get('expected', None)
+
+        if not repo_name or not name or not isinstance(expected, int) or isinstance(expected, bool):
+            return {
+                'error': 'repo_name, name and expected are required, expected as a changeset id'
+            }, 400
+
+        try:
+            await asyncio.to_thread(PostgreSQL.shared().delete_ref, user.username, repo_name, name, expected)
+        except ValueError as err:
+            return {
+                'error': str(err)
+            }, 400
+        return {
+            'success': True
+        }, 200
+
+    @staticmethod
+    @app.route('/api/vcs/repository/compare', methods=['GET'])
+    async def compare_changesets():
+        """
+        Lists the files added, removed and changed between two changesets of a repository,
+        given as ?owner=, ?repo_name=, ?from= and ?to=.
+        """
+        repo_owner = quart.request.args.get('owner', None)
+        repo_name = quart.request.args.get('repo_name', None)
+        old_changeset = quart.request.args.get('from', None, type=int)
+        new_changeset = quart.request.args.get('to', None, type=int)
+
+        if not repo_name or not repo_owner or old_changeset is None or new_changeset is None:
+            return {
+                'error': 'owner, repo_name, from and to are required, from and to as changeset ids'
+            }, 400
+
+        comparison = await AsyncPostgreSQL.shared().compare_changesets(
+            repo_owner, repo_name, old_changeset, new_changeset, await QuartAPI.can_view_private(repo_owner)
+        )
+        if comparison is None:
+            raise error.repository_not_found(repo_name)
+        return comparison, 200
+
+    @staticmethod
+    @app.route('/api/vcs/repository/file', methods=['GET'])
+    async def read_file():
+        """
+        Reads a file, given as ?owner=, ?repo_name= and ?path=. Optionally ?ref= is the branch or tag to read it
+        from, the default branch by default, and ?version=1.0.0 a version from that branch's history.
+        """
+        repo_owner = quart.request.args.get('owner', None)
+        repo_name = quart.request.args.get('repo_name', None)
+        rel_file_path = quart.request.args.get('path', None)
+        version = quart.request.args.get('version', None)
+        ref = quart.request.args.get('ref', None)
+
+        if not repo_name or not repo_owner or not rel_file_path:
+            return {
+                'error': 'owner, repo_name and path are required'
+            }, 400
+
+        if version is not None:
+            version = QuartAPI.parse_version(version)
+            if version is None:
+                return {
+                    'error': 'version must look like 1.0.0'
+                }, 400
+
+        data = await AsyncPostgreSQL.shared().get_file(
+            repo_owner, repo_name, rel_file_path, version, await QuartAPI.can_view_private(repo_owner), ref
+        )
+        return data, 200, {'Content-Type': 'application/octet-stream'}
+
+    @staticmethod
+    def _diff_options() -> tuple[str, int, str | None]:
+        """
+        Reads the ?format= and ?context= arguments of the diff routes.
+        :return: The format, the number of context lines, and what is wrong with them, if anything.
+        """
+        diff_format = quart.request.args.get('format', 'json')
+        context = quart.request.args.get('context', diff_engine.CONTEXT, type=int)
+        if diff_format not in ('json', 'unified'):
+            return diff_format, context, 'format must be json or unified'
+        if context is None or not 0 <= context <= diff_engine.MAX_CONTEXT:
+            return diff_format, context, f'context must be a whole number from 0 to {diff_engine.MAX_CONTEXT}'
+        return diff_format, context, None
+
+    @staticmethod
+    @app.route('/api/vcs/repository/diff', methods=['GET'])
+    async def diff_file():
+        """
+        Diffs two versions of a file, given as ?owner=, ?repo_name=, ?path=, ?from=1.0.0 and ?to=1.0.1.
+        The versions are from the history of ?ref=, the default branch by default.
+        ?format=unified gives a unified diff instead of JSON hunks, and ?context= sets how many unchanged
+        lines are shown around each change. Private repositories can only be diffed by their owner.
+        """
+        repo_owner = quart.request.args.get('owner', None)
+        repo_name = quart.request.args.get('repo_name', None)
+        rel_file_path = quart.request.args.get('path', None)
+        old_version = quart.request.args.get('from', None)
+        new_version = quart.request.args.get('to', None)
+        ref = quart.request.args.get('ref', None)
+
+        if not repo_name or not repo_owner or not rel_file_path or not old_version or not new_version:
+            return {
+                'error': 'owner, repo_name, path, from and to are required'
+            }, 400
+        old_version = QuartAPI.parse_version(old_version)
+        new_version = QuartAPI.parse_version(new_version)
+        if old_version is None or new_version is None:
+            return {
+                'error': 'from and to must be versions like 1.0.0'
+            }, 400
+        diff_format, context, problem = vcs_routes._diff_options()
+        if problem is not None:
+            return {
+                'error': problem
+            }, 400
 
-        # Get the repository handler
-        repo = repository_handler(repo_owner, repo_name)
-        repo.walk_repo()
+        view_private = await QuartAPI.can_view_private(repo_owner)
+        result = await AsyncPostgreSQL.shared().diff_file(
+            repo_owner, repo_name, rel_file_path, old_version, new_version, view_private, context, ref
+        )
+        if diff_format == 'unified':
+            return diff_engine.unified(result, rel_file_path, rel_file_path), 200, {'Content-Type': 'text/x-diff'}
+        return result, 200
+
+    @staticmethod
+    @app.route('/api/vcs/repository/diff/changesets', methods=['GET'])
+    async def diff_changesets():
+        """
+        Diffs every file that differs between two changesets, given as ?owner=, ?repo_name=, ?from= and ?to=.
+        Takes ?format= and ?context= like /api/vcs/repository/diff.
+        """
+        repo_owner = quart.request.args.get('owner', None)
+        repo_name = quart.request.args.get('repo_name', None)
+        old_changeset = quart.request.args.get('from', None, type=int)
+        new_changeset = quart.request.args.get('to', None, type=int)
+
+        if not repo_name or not repo_owner or old_changeset is None or new_changeset is None:
+            return {
+                'error': 'owner, repo_name, from and to are required, from and to as changeset ids'
+            }, 400
+        diff_format, context, problem = vcs_routes._diff_options()
+        if problem is not None:
+            return {
+                'error': problem
+            }, 400
+
+        view_private = await QuartAPI.can_view_private(repo_owner)
+        files = await AsyncPostgreSQL.shared().diff_changesets(
+            repo_owner, repo_name, old_changeset, new_changeset, view_private, context
+        )
+        if files is None:
+            raise error.repository_not_found(repo_name)
+        if diff_format == 'unified':
+            patch = ''.join(
+                diff_engine.unified(file, file['path'] if file['old'] else None, file['path'] if file['new'] else None)
+                for file in files
+            )
+            return patch, 200, {'Content-Type': 'text/x-diff'}
+        return {
+            'files': files
+        }, 200
+
+    @staticmethod
+    @app.route('/api/vcs/repository/merge', methods=['POST'])
+    @QuartAPI.require_json
+    @QuartAPI.require_authentication
+    async def merge_branches(user: principal):
+        """
+        Merges a branch or tag into a branch. The JSON body is repo_name, source, target (main by default),
+        and optionally commit_message, and dry_run to only see what would happen. Conflicts are a 409 listing
+        each file, with the lines both sides changed for text files.
+        """
+        data = await quart.request.get_json()
+        repo_name = data.get('repo_name', None)
+        source = data.get('source', None)
+        target = data.get('target', ref_store.DEFAULT_BRANCH)
+        commit_message = data.get('commit_message', None)
+
+        if not repo_name or not isinstance(source, str) or not isinstance(target, str):
+            return {
+                'error': 'repo_name and source are required'
+            }, 400
+        if commit_message is not None and not isinstance(commit_message, str):
+            return {
+                'error': 'commit_message must be a string'
+            }, 400
+
+        try:
+            result = await asyncio.to_thread(
+                PostgreSQL.shared().merge_branches, user.username, repo_name, source, target, user.username,
+                commit_message, bool(data.get('dry_run', False))
+            )
+        except ValueError as err:
+            return {
+                'error': str(err)
+            }, 400
+        return result, 200
+
+    @staticmethod
+    @app.route('/api/vcs/repository/pull', methods=['GET'])
+    async def pull_repository():
+        """
+        Streams a branch or tag of a repository as a tar archive. ?owner= and ?repo_name= say which repository, and
+        ?ref= which branch or tag, the default branch by default. ?version=1.0.0 gives each file at its newest version
+        no later than that in the branch's history (the newest of each by default), and ?format=tar.zst compresses it.
+        Private repositories can only be pulled by their owner.
+        """
+        repo_owner = quart.request.args.get('owner', None)
+        repo_name = quart.request.args.get('repo_name', None)
+        version = quart.request.args.get('version', None)
+        ref = quart.request.args.get('ref', None)
+        archive_format = quart.request.args.get('format', 'tar')
+
+        if not repo_name or not repo_owner:
+            return {
+                'error': 'owner and repo_name are required'
+            }, 400
+        if archive_format not in repository_archive.FORMATS:
+            return {
+                'error': f"format must be one of {', '.join(repository_archive.FORMATS)}"
+            }, 400
+
+        if version is not None:
+            version = QuartAPI.parse_version(version)
+            if version is None:
+                return {
+                    'error': 'version must look like 1.0.0'
+                }, 400
+
+        view_private = await QuartAPI.can_view_private(repo_owner)
+        files = await AsyncPostgreSQL.shared().snapshot_files(repo_owner, repo_name, version, view_private, ref)
+        if files is None:
+            raise error.repository_not_found(repo_name)
+
+        response = quart.Response(
+            repository_archive.stream(files, compress=archive_format == 'tar.zst'),
+            mimetype=repository_archive.FORMATS[archive_format]
+        )
+        file_name = re.sub(r'[^\w.-]', '_', repo_name)
+        response.headers['Content-Disposition'] = f'attachment; filename="{file_name}.{archive_format}"'
+        # A big repository takes longer to send than the default response timeout allows.
+        response.timeout = None
+        return response
+
+    @staticmethod
+    @app.route('/api/vcs/repository/push', methods=['POST'])
+    @QuartAPI.require_json
+    @QuartAPI.require_authentication
+    async def start_push(user: principal):
+        """
+        Starts a push. The JSON body is repo_name, commit_message and files, a list of
+        {path, version ('1.0.0'), size, sha256}. Each file is then uploaded with push_chunk, and the push
+        committed with commit_push. Optionally, branch is the branch to commit to, and expected_changeset
+        the changeset it must still be at when the push is committed.
+        """
+        data = await quart.request.get_json()
+        repo_name = data.get('repo_name', None)
+
+        if not repo_name:
+            return {
+                'error': 'repo_name is required'
+            }, 400
+
+        try:
+            upload = await asyncio.to_thread(
+                upload_sessions.start, user.username, repo_name, data.get('commit_message', None), data.get('files'),
+                data.get('branch', ref_store.DEFAULT_BRANCH), data.get('expected_changeset', None)
+            )
+        except ValueError as err:
+            return {
+                'error': str(err)
+            }, 400
+        return upload, 201
+
+    @staticmethod
+    @app.route('/api/vcs/repository/push/<upload_id>', methods=['GET'])
+    @QuartAPI.require_authentication
+    async def push_status(upload_id, user: principal):
+        # How much of each file has been received. A client resumes a dropped upload from there.
+        return await asyncio.to_thread(upload_sessions.status, upload_id, user.username), 200
+
+    @staticmethod
+    @app.route('/api/vcs/repository/push/<upload_id>/<int:index>', methods=['PUT'])
+    @QuartAPI.require_authentication
+    async def push_chunk(upload_id, index, user: principal):
+        """
+        Uploads the next chunk of a file of a push. The body is the raw bytes of the chunk, ?offset= is where
+        in the file it starts, and the X-Chunk-SHA256 header is its SHA-256. The body is streamed to disk,
+        never read into memory whole.
+        """
+        try:
+            offset = int(quart.request.args.get('offset', ''))
+        except ValueError:
+            return {
+                'error': 'offset must be a whole number'
+            }, 400
+
+        received = await upload_sessions.receive_chunk(
+            upload_id, user.username, index, offset, quart.request.headers.get('X-Chunk-SHA256'), quart.request.body
+        )
+        return {
+            'received': received
+        }, 200
+
+    @staticmethod
+    @app.route('/api/vcs/repository/push/<upload_id>/commit', methods=['POST'])
+    @QuartAPI.require_authentication
+    async def commit_push(upload_id, user: principal):
+        # Every file of the push is committed as one changeset, or none is. Committing again gives the same answer.
+        return await asyncio.to_thread(upload_sessions.commit, upload_id, user.username), 200
 
 class docker_routes:
     @staticmethod
     @app.route('/api/docker/list', methods=['GET'])
     @QuartAPI.require_authentication
-    async def list_containers(user: user_login):
+    async def list_containers(user: principal):
         return {
             'containers': user.list_docker_containers()
         }, 200
@@ -462,7 +1200,7 @@ class docker_routes:
     @app.route('/api/docker/start', methods=['POST'])
     @QuartAPI.require_json
     @QuartAPI.require_authentication
-    async def start_container(user: user_login):
+    async def start_container(user: principal):
         data = await quart.request.get_json()
         container_id = data.get('container_id', None)
 
@@ -480,7 +1218,7 @@ class docker_routes:
     @app.route('/api/docker/stop', methods=['POST'])
     @QuartAPI.require_json
     @QuartAPI.require_authentication
-    async def stop_container(user: user_login):
+    async def stop_container(user: principal):
         data = await quart.request.get_json()
         container_id = data.get('container_id', None)
 
@@ -498,7 +1236,7 @@ class docker_routes:
     @app.route('/api/docker/create', methods=['POST'])
     @QuartAPI.require_json
     @QuartAPI.require_authentication
-    async def create_container(user: user_login):
+    async def create_container(user: principal):
         data = await quart.request.get_json()
 
         container_name = data.get('name', None)
@@ -585,7 +1323,7 @@ class docker_routes:
     @app.route('/api/docker/delete', methods=['POST'])
     @QuartAPI.require_json
     @QuartAPI.require_authentication
-    async def delete_container(user: user_login):
+    async def delete_container(user: principal):
         data = await quart.request.get_json()
         container_id = data.get('container_id', None)
 
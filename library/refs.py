@@ -0,0 +1,103 @@
+from library.errors import error
+import re
+
+class ref_store:
+    """
+    Branches and tags, which name a changeset of a repository. A branch moves forward as changesets are
+    committed to it, and a tag stays where it was made.
+
+    A ref is one row, keyed by the repository and its name, so resolving one is a single primary key lookup.
+    Refs are only ever moved with a compare-and-swap: the update only happens if the ref is still at the
+    changeset the caller built on, which the database checks in the same statement. Pushes to different
+    branches of a repository touch different rows, so they never wait for each other, and a push that
+    lost a race finds out from that one statement instead of holding a lock while it works.
+    """
+    DEFAULT_BRANCH = 'main'
+    KINDS = ('branch', 'tag')
+    # Like git's ref names: no empty parts, no .., and nothing a URL or shell would mangle.
+    NAME_PATTERN = re.compile(r'^(?!.*\.\.)(?!.*//)[A-Za-z0-9_.-][A-Za-z0-9_./-]{0,199}(?<![/.])$')
+    # Stands for "whatever the ref is at", for callers that do not need it at a particular changeset.
+    ANY = object()
+
+    @staticmethod
+    def check_name(name) -> str:
+        """
+        :raises ValueError: If name can not be a branch or tag name. The message says why.
+        """
+        if not isinstance(name, str) or not ref_store.NAME_PATTERN.match(name):
+            raise ValueError(
+                "branch and tag names are up to 200 letters, digits, '_', '-', '.' and '/', "
+                "and can not start with '/', end with '/' or '.', or have '..' or '//' in them"
+            )
+        return name
+
+    @staticmethod
+    def get(cur, repo_id: int, name: str) -> tuple[int, str] | None:
+        """
+        :return: The changeset_id a ref is at and its kind, or None if the repository has no such ref.
+        """
+        cur.execute('SELECT changeset_id, kind FROM refs WHERE repo_id = %s AND name = %s;', (repo_id, name))
+        return cur.fetchone()
+
+    @staticmethod
+    def resolve(cur, repo_id: int, name: str) -> int:
+        """
+        :return: The changeset_id a ref is at.
+        :raises error.ref_not_found: If the repository has no such ref.
+        """
+        ref = ref_store.get(cur, repo_id, name)
+        if ref is None:
+            raise error.ref_not_found(name)
+        return ref[0]
+
+    @staticmethod
+    def list_all(cur, repo_id: int) -> list[dict]:
+        cur.execute(
+            'SELECT name, kind, changeset_id, updated_on FROM refs WHERE repo_id = %s ORDER BY kind, name;',
+            (repo_id,)
+        )
+        return [
+            {'name': name, 'kind': kind, 'changeset_id': changeset_id, 'updated_on': updated_on}
+            for name, kind, changeset_id, updated_on in cur.fetchall()
+        ]
+
+    @staticmethod
+    def compare_and_swap(cur, repo_id: int, name: str, expected: int | None, changeset_id: int,
+                         kind='branch') -> bool:
+        """
+        Points a ref at a changeset, if it is still where the caller expects. Tags can be made, but never moved.
+
+        :param expected: The changeset the ref must be at now, or None if it must not exist yet.
+        :param kind: The kind of ref to make, if expected is None.
+        :return: Whether the ref was moved, or made. If not, something else moved it first.
+        """
+        if expected is None:
+            cur.execute(
+                """
+                INSERT INTO refs (repo_id, name, kind, changeset_id)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (repo_id, name) DO NOTHING;
+                """,
+                (repo_id, name, kind, changeset_id)
+            )
+        else:
+            cur.execute(
+                """
+                UPDATE refs
+                SET changeset_id = %s, updated_on = CURRENT_TIMESTAMP
+                WHERE repo_id = %s AND name = %s AND changeset_id = %s AND kind = 'branch';
+                """,
+                (changeset_id, repo_id, name, expected)
+            )
+        return cur.rowcount == 1
+
+    @staticmethod
+    def delete(cur, repo_id: int, name: str, expected: int) -> bool:
+        """
+        Deletes a ref, if it is still where the caller expects.
+        :return: Whether it was deleted.
+        """
+        cur.execute(
+            'DELETE FROM refs WHERE repo_id = %s AND name = %s AND changeset_id = %s;', (repo_id, name, expected)
+        )
+        return cur.rowcount == 1
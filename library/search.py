@@ -0,0 +1,261 @@
+from library.blobstore import blob_store
+from library.settings import var, dt
+import re2
+import re
+
+class code_search:
+    """
+    Searches the newest version of every file, by substring or regular expression.
+
+    Each blob is indexed once, however many repositories and files have it, by the set of trigrams (runs of three
+    bytes, lowercased) in it. They are kept as an array with a GIN index on it. A search works out the trigrams
+    any match must have, finds the blobs that have all of them with the index, and then only reads those
+    candidates to check for real matches. repo_head_files says which repositories and paths have each blob as
+    their newest version, and is where private repositories are filtered out.
+
+    Blobs are indexed as they become the newest version of a file, in the push's transaction. Binary files
+    and those bigger than search.max_file_size are recorded as not indexed, and never match.
+
+    Anyone can search, so queries are matched with RE2, which takes time in proportion to the text however the
+    expression is written, and a search stops checking candidates once it has read search.max_scan_bytes of them.
+    """
+    MIN_QUERY_LENGTH = 3
+    MAX_QUERY_LENGTH = 256
+    # Lines longer than this are cut short in results.
+    MAX_LINE_LENGTH = 500
+    # Content with a NUL byte in this much of its start is binary, as for diffs.
+    BINARY_CHECK_SIZE = 8000
+    # The inline flags a regular expression can start with, which say nothing about what it matches.
+    FLAGS_PATTERN = re.compile(r'^\(\?[aiLmsux]+\)')
+
+    _config_cache = None
+
+    @staticmethod
+    def config() -> dict:
+        if code_search._config_cache is None:
+            code_search._config_cache = {
+                'max_file_size': int(var.get('search.max_file_size', dt.SETTINGS['search']['max_file_size'])),
+                'max_candidates': int(var.get('search.max_candidates', dt.SETTINGS['search']['max_candidates'])),
+                'max_scan_bytes': int(var.get('search.max_scan_bytes', dt.SETTINGS['search']['max_scan_bytes'])),
+                'max_matches_per_file': int(
+                    var.get('search.max_matches_per_file', dt.SETTINGS['search']['max_matches_per_file'])
+                ),
+            }
+        return code_search._config_cache
+
+    @staticmethod
+    def trigrams(data: bytes) -> list[int]:
+        """
+        :return: Every distinct trigram of the content, lowercased, each as a 24 bit number.
+        """
+        data = data.lower()
+        return sorted(
+            int.from_bytes(trigram, 'big') for trigram in {data[index:index + 3] for index in range(len(data) - 2)}
+        )
+
+    @staticmethod
+    def required_literals(pattern: str) -> list[str]:
+        """
+        Finds text a regular expression can only match if it contains. It errs on the side of finding less:
+        anything inside a group, next to an alternation, or made optional by a quantifier is left out.
+
+        :return: The runs of literal characters every match has.
+        """
+        flags = code_search.FLAGS_PATTERN.match(pattern)
+        # In verbose mode, whitespace and comments are not literals.
+        if '|' in pattern or (flags is not None and 'x' in flags.group()):
+            return []
+        pattern = code_search.FLAGS_PATTERN.sub('', pattern)
+        runs, run = [], ''
+        depth = 0
+        index = 0
+        while index < len(pattern):
+            char = pattern[index]
+            if char == '\\':
+                escaped = pattern[index + 1:index + 2]
+                index += 2
+                # \d, \w, \b, \1 and the like are classes, anchors and backreferences, not literals.
+                if not escaped or escaped.isalnum():
+                    runs.append(run)
+                    run = ''
+                elif depth == 0:
+                    run += escaped
+                continue
+            if char in '*?{':
+                # The character before is optional.
+                run = run[:-1]
+            if char in '.^$()[]{}*+?':
+                runs.append(run)
+                run = ''
+                if char == '[':
+                    # Skip the class. A ] straight after the [ or [^ is part of it.
+                    index += 2 if pattern[index + 1:index + 2] == '^' else 1
+                    index += 1 if pattern[index:index + 1] == ']' else 0
+                    while index < len(pattern) and pattern[index] != ']':
+                        index += 2 if pattern[index] == '\\' else 1
+                elif char == '{':
+                    while index < len(pattern) and pattern[index] != '}':
+                        index += 1
+                elif char == '(':
+                    if pattern[index + 1:index + 2] == '?' and pattern[index + 2:index + 3] != ':':
+                        # Lookarounds, named groups and the like.
+                        return [text for text in runs if text]
+                    depth += 1
+                elif char == ')':
+                    depth = max(depth - 1, 0)
+                index += 1
+                continue
+            if depth == 0:
+                run += char
+            index += 1
+        runs.append(run)
+        return [text for text in runs if text]
+
+    @staticmethod
+    def query_trigrams(literals: list[str]) -> list[int]:
+        trigrams = set()
+        for literal in literals:
+            trigrams.update(code_search.trigrams(literal.encode('utf-8')))
+        return sorted(trigrams)
+
+    @staticmethod
+    def index_blobs(cur, blob_hashes) -> int:
+        """
+        Indexes blobs that are not indexed yet. Call it in the transaction that makes them the newest version
+        of a file.
+
+        :return: How many blobs were indexed.
+        """
+        blob_hashes = list(set(blob_hashes))
+        if not blob_hashes:
+            return 0
+        cur.execute(
+            """
+            SELECT blobs.hash, blobs.size
+            FROM blobs
+            WHERE blobs.hash = ANY(%s)
+            AND NOT EXISTS (SELECT 1 FROM search_index WHERE search_index.blob_hash = blobs.hash);
+            """,
+            (blob_hashes,)
+        )
+        indexed = 0
+        for blob_hash, size in cur.fetchall():
+            trigrams = None
+            if size <= code_search.config()['max_file_size']:
+                data = blob_store.get(cur, blob_hash)
+                if b'\0' not in data[:code_search.BINARY_CHECK_SIZE]:
+                    trigrams = code_search.trigrams(data)
+            cur.execute(
+                'INSERT INTO search_index (blob_hash, trigrams) VALUES (%s, %s) ON CONFLICT (blob_hash) DO NOTHING;',
+                (blob_hash, trigrams)
+            )
+            indexed += cur.rowcount
+        return indexed
+
+    @staticmethod
+    def compile(query: str, regex=False, ignore_case=False) -> tuple:
+        """
+        :return: The pattern to check lines with, and the trigrams a file must have to match it.
+        :raises ValueError: If the query is not a valid regular expression, or can not be looked up in the index.
+        The message says why.
+        """
+        if not isinstance(query, str) or not code_search.MIN_QUERY_LENGTH <= len(query) <= code_search.MAX_QUERY_LENGTH:
+            raise ValueError(
+                f"the query must be {code_search.MIN_QUERY_LENGTH} to {code_search.MAX_QUERY_LENGTH} characters"
+            )
+        options = re2.Options()
+        options.literal = not regex
+        options.case_sensitive = not ignore_case
+        options.log_errors = False
+        try:
+            pattern = re2.compile(query, options)
+        except re2.error as err:
+            reason = err.args[0].decode() if err.args and isinstance(err.args[0], bytes) else str(err)
+            raise ValueError(f"the query is not a regular expression RE2 can run: {reason}")
+
+        literals = code_search.required_literals(query) if regex else [query]
+        if ignore_case:
+            # Only ASCII is lowercased in the index, so other text could match in a case that is not there.
+            literals = [literal for literal in literals if literal.isascii()]
+        trigrams = code_search.query_trigrams(literals)
+        if not trigrams:
+            raise ValueError(
+                f"the query must contain at least {code_search.MIN_QUERY_LENGTH} characters in a row that every "
+                "match has, outside any group, class or alternation"
+            )
+        return pattern, trigrams
+
+    @staticmethod
+    def search(cur, query: str, regex=False, ignore_case=False, username: str = None, owner: str = None,
+               repo_name: str = None, limit: int = 50) -> dict:
+        """
+        Finds the lines that match a query in the newest version of the files of every repository the user
+        can see.
+
+        :param username: The user searching, whose private repositories are searched too. None for anyone.
+        :param owner: Only search the repositories of this user.
+        :param repo_name: Only search repositories of this name.
+        :param limit: The most files to list.
+        :return: results, a list of the owner, repo_name and path of each matching file and its matching lines,
+        and whether there were more to list.
+        :raises ValueError: If the query can not be searched for. The message says why.
+        """
+        pattern, trigrams = code_search.compile(query, regex, ignore_case)
+        max_candidates = code_search.config()['max_candidates']
+        cur.execute(
+            f"""
+            SELECT repositories.owner, repositories.name, repo_head_files.rel_file_path, repo_head_files.blob_hash
+            FROM search_index
+            JOIN repo_head_files ON repo_head_files.blob_hash = search_index.blob_hash
+            JOIN repositories ON repositories.repo_id = repo_head_files.repo_id
+            WHERE search_index.trigrams @> %s::INTEGER[]
+            AND (repositories.private = FALSE OR repositories.owner = %s)
+            {'AND repositories.owner = %s' if owner is not None else ''}
+            {'AND repositories.name = %s' if repo_name is not None else ''}
+            ORDER BY repositories.owner, repositories.name, repo_head_files.rel_file_path
+            LIMIT %s;
+            """,
+            (
+                trigrams, username,
+                *([owner] if owner is not None else []), *([repo_name] if repo_name is not None else []),
+                max_candidates + 1
+            )
+        )
+        candidates = cur.fetchall()
+        truncated = len(candidates) > max_candidates
+        candidates = candidates[:max_candidates]
+
+        # The same content in many files is only read and checked once.
+        matches_of = {}
+        results = []
+        scanned = 0
+        for candidate_owner, candidate_repo, rel_file_path, blob_hash in candidates:
+            if blob_hash not in matches_of:
+                if scanned >= code_search.config()['max_scan_bytes']:
+                    truncated = True
+                    break
+                data = blob_store.get(cur, blob_hash)
+                scanned += len(data)
+                matches_of[blob_hash] = code_search._matching_lines(data, pattern)
+            if matches_of[blob_hash]:
+                if len(results) == limit:
+                    truncated = True
+                    break
+                results.append({
+                    'owner': candidate_owner,
+                    'repo_name': candidate_repo,
+                    'path': rel_file_path,
+                    'matches': matches_of[blob_hash],
+                })
+        return {'results': results, 'truncated': truncated}
+
+    @staticmethod
+    def _matching_lines(data: bytes, pattern) -> list[dict]:
+        text = data.decode('utf-8', errors='replace')
+        matches = []
+        for number, line in enumerate(text.split('\n'), start=1):
+            if pattern.search(line):
+                matches.append({'line': number, 'text': line[:code_search.MAX_LINE_LENGTH]})
+                if len(matches) == code_search.config()['max_matches_per_file']:
+                    break
+        return matches
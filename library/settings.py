@@ -0,0 +1,277 @@
+import inspect
+import logging
+import json
+import os
+
+key_seperator = '.'
+settings_path = 'settings.json'
+DEBUG = os.environ.get('DEBUG', False)
+
+class dt:
+    SETTINGS = {
+        "_comment": "NEVER SHARE THIS DATA FILE TO ANYONE. DOING SO COULD MEAN BAD THINGS.",
+        "hostname": "127.0.0.1",
+        'firstlaunch': {
+            'main': True
+        },
+        'webgui': {
+            'port': 2048,
+            'enabled': True
+        },
+        'api': {
+            'port': 4096,
+        },
+        'db': {
+            'external': False,
+            'host': None,
+            'port': None,
+            'username': None,
+            'raindrop_password': None,
+            'postgres_password': None,
+            'database': None,
+            # Limits for the process-wide connection pool. Times are in seconds.
+            'pool': {
+                'min_size': 1,
+                'max_size': 10,
+                'idle_timeout': 300,
+                'checkout_timeout': 30,
+                'health_check_interval': 30,
+            },
+            # Optional read replicas, eg [{"host": "10.0.0.2", "port": 5432}]. They use the primary's credentials.
+            'replicas': [],
+            # Replicas further behind the primary than this many seconds are not read from.
+            'replica_max_lag': 5,
+            # How often, in seconds, each replica's lag is checked.
+            'replica_check_interval': 5,
+            # Queries slower than this many milliseconds are written to the slow query log. 0 turns it off.
+            'slow_query_ms': 200,
+            # The in-process cache for bios and public repository data. ttl is in seconds.
+            'cache': {
+                'enabled': True,
+                'ttl': 30,
+                'max_entries': 10000,
+            },
+        },
+        # Where file contents are kept. backend is 'disk' (files under path) or 'database' (a bytea column).
+        'blobs': {
+            'backend': 'disk',
+            'path': 'data/blobs',
+            # Older versions of a file are stored as deltas against newer ones, at most this many deep.
+            'max_delta_depth': 50,
+            # Seconds between background repacks of changed repositories. 0 turns them off.
+            'repack_interval': 600,
+            # Blobs are compressed with zstd, using a dictionary trained on each repository's own files.
+            'compression': True,
+            # Seconds before a repository's dictionary is trained again on its current files. 0 never retrains.
+            'dictionary_retrain_interval': 86400,
+        },
+        # Pushes are uploaded in chunks to path, and kept there until they are committed or expire_after seconds pass.
+        'uploads': {
+            'path': 'data/uploads',
+            'chunk_size': 4 * 1024 * 1024,
+            'expire_after': 86400,
+        },
+        # Diffs are cached in memory up to cache_size bytes. Files bigger than max_file_size are not diffed.
+        'diffs': {
+            'cache_size': 64 * 1024 * 1024,
+            'max_file_size': 4 * 1024 * 1024,
+        },
+        # Code search indexes files up to max_file_size bytes. A search checks up to max_candidates files, or
+        # max_scan_bytes of them, for matches, and lists up to max_matches_per_file lines of each.
+        'search': {
+            'max_file_size': 1024 * 1024,
+            'max_candidates': 2000,
+            'max_scan_bytes': 64 * 1024 * 1024,
+            'max_matches_per_file': 20,
+        },
+        # This toggles what is allowed for the program to do if certain components are not available.
+        'fallbacks': {
+            'allow_local_db': True,
+        }
+    }
+
+    REPO_CONFIG = {
+        "repo_id": None,
+        "version": None,
+        "repo_name": None,
+        "description": None,
+    }
+
+
+# noinspection DuplicatedCode,PyTypeChecker
+class var:
+    @staticmethod
+    def set(key, value, file=settings_path, dt_default=dt.SETTINGS) -> bool:
+        """
+        Sets the value of a key in the memory file.
+
+        :param key: The key to set the value of.
+        :param value: The value to set the key to.
+        :param file: The file to set the key in.
+        :param dt_default: The default dictionary to fill a json file with if the file does not exist.
+        :return:
+        """
+        # Logs the file it creates, and which file and line called it.
+        if DEBUG is True:
+            logging.info(f'file \'{file}\' was set by {inspect.stack()[1].filename}:{inspect.stack()[1].lineno}')
+
+        keys = str(key).split(key_seperator)
+        file_dir = os.path.dirname(file)
+        if file_dir == '':
+            file_dir = os.getcwd()
+
+        if os.path.exists(file) is False:
+            os.makedirs(file_dir, exist_ok=True)
+            with open(file, 'w+') as f:
+                json.dump(dt_default, f, indent=4, separators=(',', ':'))
+
+        with open(file, 'r+') as f:
+            data = json.load(f)
+
+        temp = data
+        for k in keys[:-1]:
+            if k not in temp:
+                temp[k] = {}
+            temp = temp[k]
+
+        temp[keys[-1]] = value
+
+        with open(file, 'w+') as f:
+            json.dump(data, f, indent=4)
+
+        return True
+
+    @staticmethod
+    def get(key, default=None, dt_default=dt.SETTINGS, file=settings_path) -> any:
+        """
+        Gets the value of a key in the memory file.
+
+        :param key: The key to get the value of.
+        :param default: The default value to return if the key does not exist.
+        :param dt_default: The default dictionary to fill a json file with if the file does not exist.
+        :param file: The file to get the key from.
+        Set to None if you want to raise an error if the file does not exist.
+        """
+        # Logs the file it creates, and which file and line called it.
+        if DEBUG is True:
+            caller = f"{inspect.stack()[1].filename}:{inspect.stack()[1].lineno}"
+            logging.info(f'file \'{file}\' was retrieved from by {caller}')
+
+        keys = str(key).split(key_seperator)
+        file_dir = os.path.dirname(file)
+        if file_dir == '':
+            file_dir = os.getcwd()
+
+        if os.path.exists(file) is True:
+            with open(file, 'r+') as f:
+                data = dict(json.load(f))
+        else:
+            if dt_default is not None:
+                os.makedirs(file_dir, exist_ok=True)
+                with open(file, 'w+') as f:
+                    json.dump(dt_default, f, indent=4, separators=(',', ':'))
+            else:
+                raise FileNotFoundError(f"file '{file}' does not exist.")
+
+            with open(file, 'r+') as f:
+                data = dict(json.load(f))
+
+        temp = data
+        try:
+            for k in keys[:-1]:
+                if k not in temp:
+                    return default
+                temp = temp[k]
+
+            return temp[keys[-1]]
+        except KeyError as err:
+            logging.error(f"key '{key}' not found in file '{file}'.", err)
+            raise KeyError(f"key '{key}' not found in file '{file}'.")
+
+    @staticmethod
+    def delete(key, file=settings_path, default=dt.SETTINGS):
+        """
+        Delete a key.
+
+        :param key: The key to delete.
+        :param file: The file to delete the key from.
+        :param default: The default dictionary to fill a json file with if the file does not exist.
+        """
+        # Logs the file it creates, and which file and line called it.
+        if DEBUG is True:
+            caller = f"{inspect.stack()[1].filename}:{inspect.stack()[1].lineno}"
+            logging.info(f'file \'{file}\' was had a key deleted by {caller}')
+
+        keys = str(key).split(key_seperator)
+        file_dir = os.path.dirname(file)
+        if file_dir == '':
+            file_dir = os.getcwd()
+
+        if os.path.exists(file) is True:
+            with open(file, 'r+') as f:
+                data = dict(json.load(f))
+        else:
+            if default is not None:
+                os.makedirs(file_dir, exist_ok=True)
+                with open(file, 'w+') as f:
+                    json.dump(default, f, indent=4, separators=(',', ':'))
+            else:
+                raise FileNotFoundError(f"file '{file}' does not exist.")
+
+            with open(file, 'r+') as f:
+                data = dict(json.load(f))
+
+        temp = data
+        for k in keys[:-1]:
+            if k not in temp:
+                return False
+            temp = temp[k]
+
+        if keys[-1] in temp:
+            del temp[keys[-1]]
+            with open(file, 'w+') as f:
+                json.dump(data, f, indent=4)
+            return True
+        else:
+            return False
+
+    @staticmethod
+    def load_all(file: str = settings_path, dt_default={}) -> dict:
+        """
+        Load all the keys in a file. Returns a dictionary with all the keys.
+        :param file: The file to load all the keys from.
+        :param dt_default:
+        :return:
+        """
+        # Logs the file it creates, and which file and line called it.
+        if DEBUG is True:
+            logging.info(
+                f'file \'{file}\' was fully loaded by {inspect.stack()[1].filename}:{inspect.stack()[1].lineno}')
+
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        if not os.path.exists(file):
+            with open(file, 'w+') as f:
+                json.dump(dt_default, f, indent=4, separators=(',', ':'))
+
+        with open(file, 'r+') as f:
+            data = dict(json.load(f))
+
+        return data
+
+    @staticmethod
+    def fill_json(file: str = settings_path, data=dt.SETTINGS):
+        """
+        Fill a json file with a dictionary.
+        :param file: The file to fill with data.
+        :param data: The data to fill the file with.
+        """
+        # Logs the file it creates, and which file and line called it.
+        if DEBUG is True:
+            logging.info(
+                f'file \'{file}\' was filled with data by {inspect.stack()[1].filename}:{inspect.stack()[1].lineno}')
+
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with open(file, 'w+') as f:
+            json.dump(data, f, indent=4, separators=(',', ':'))
+
+        return True
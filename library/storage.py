@@ -1,15 +1,32 @@
+from library.migrations import schema_migrator
+from library.blobstore import blob_store
+from library.search import code_search
+from library.diff import diff_engine
+from library.merge import merge_engine
+from library.settings import var, dt
 from library.cmd_interface import cli_handler, colours
 from library.encryption import encryption
+from library.graph import commit_graph
+from library.trees import tree_store
+from library.refs import ref_store
 from library.errors import error
+import collections
+import contextvars
 import subprocess
+import threading
+import functools
 import psycopg2
 import datetime
 import secrets
 import inspect
 import logging
+import random
 import time
 import json
+import copy
+import sys
 import os
+import re
 
 logging.basicConfig(
     filename=f'logs/{datetime.datetime.now().strftime("%Y-%m-%d")}.log',
@@ -18,224 +35,963 @@ logging.basicConfig(
 )
 
 keys = encryption()
-key_seperator = '.'
-settings_path = 'settings.json'
-DEBUG = os.environ.get('DEBUG', False)
-
-class dt:
-    SETTINGS = {
-        "_comment": "NEVER SHARE THIS DATA FILE TO ANYONE. DOING SO COULD MEAN BAD THINGS.",
-        "hostname": "127.0.0.1",
-        'firstlaunch': {
-            'main': True
-        },
-        'webgui': {
-            'port': 2048,
-            'enabled': True
-        },
-        'api': {
-            'port': 4096,
-        },
-        'db': {
-            'external': False,
-            'host': None,
-            'port': None,
-            'username': None,
-            'raindrop_password': None,
-            'postgres_password': None,
-            'database': None
-        },
-        # This toggles what is allowed for the program to do if certain components are not available.
-        'fallbacks': {
-            'allow_local_db': True,
-        }
-    }
 
-    REPO_CONFIG = {
-        "repo_id": None,
-        "version": None,
-        "repo_name": None,
-        "description": None,
-    }
+class query_stats:
+    """
+    Timing for every query the storage layer runs, grouped by the method that ran it.
+    Queries slower than db.slow_query_ms are also written to the slow query log in logs/, along with their
+    query plan the first time each one is seen. Query arguments are never logged, as they hold tokens and passwords.
+    """
+    _lock = threading.Lock()
+    # Method: {'calls', 'total_time', 'max_time', 'rows', 'wait_time', 'slow'}. Times are in seconds.
+    methods = {}
+    _explained = set()  # (method, query) pairs whose plan has been logged
+    _skipped_code = set()  # Code of helper functions that are never reported as the calling method
+    _slow_logger = None
+    _threshold = None
+
+    # Only these statements can be explained without side effects.
+    EXPLAINABLE = ('select', 'with', 'insert', 'update', 'delete', 'execute')
 
+    @staticmethod
+    def skip(function):
+        """
+        Marks a function as a helper that runs queries for others, so its caller is reported instead.
+        """
+        query_stats._skipped_code.add(function.__code__)
+        return function
 
-# noinspection DuplicatedCode,PyTypeChecker
-class var:
     @staticmethod
-    def set(key, value, file=settings_path, dt_default=dt.SETTINGS) -> bool:
+    def caller() -> str:
         """
-        Sets the value of a key in the memory file.
+        Gets the name of the method that ran the current query, skipping the query helpers.
+        """
+        frame = sys._getframe(2)
+        while frame is not None and frame.f_code in query_stats._skipped_code:
+            frame = frame.f_back
+        return frame.f_code.co_qualname if frame is not None else '<unknown>'
 
-        :param key: The key to set the value of.
-        :param value: The value to set the key to.
-        :param file: The file to set the key in.
-        :param dt_default: The default dictionary to fill a json file with if the file does not exist.
-        :return:
+    @staticmethod
+    def threshold() -> float | None:
+        """
+        The slow query threshold in seconds, or None if slow queries are not logged.
         """
-        # Logs the file it creates, and which file and line called it.
-        if DEBUG is True:
-            logging.info(f'file \'{file}\' was set by {inspect.stack()[1].filename}:{inspect.stack()[1].lineno}')
+        if query_stats._threshold is None:
+            slow_query_ms = var.get('db').get('slow_query_ms', dt.SETTINGS['db']['slow_query_ms'])
+            query_stats._threshold = float(slow_query_ms or 0) / 1000
+        return query_stats._threshold or None
+
+    @staticmethod
+    def is_slow(seconds: float) -> bool:
+        threshold = query_stats.threshold()
+        return threshold is not None and seconds >= threshold
 
-        keys = str(key).split(key_seperator)
-        file_dir = os.path.dirname(file)
-        if file_dir == '':
-            file_dir = os.getcwd()
+    @staticmethod
+    def record(method: str, seconds: float, rows: int, wait: float):
+        with query_stats._lock:
+            stats = query_stats.methods.get(method)
+            if stats is None:
+                stats = {'calls': 0, 'total_time': 0.0, 'max_time': 0.0, 'rows': 0, 'wait_time': 0.0, 'slow': 0}
+                query_stats.methods[method] = stats
+            stats['calls'] += 1
+            stats['total_time'] += seconds
+            stats['max_time'] = max(stats['max_time'], seconds)
+            stats['rows'] += rows
+            stats['wait_time'] += wait
+            if query_stats.is_slow(seconds):
+                stats['slow'] += 1
 
-        if os.path.exists(file) is False:
-            os.makedirs(file_dir, exist_ok=True)
-            with open(file, 'w+') as f:
-                json.dump(dt_default, f, indent=4, separators=(',', ':'))
+    @staticmethod
+    def should_explain(method: str, query: str) -> bool:
+        """
+        True the first time a slow query is seen from a method, if it is a statement that can be explained.
+        """
+        if not query.lstrip().lower().startswith(query_stats.EXPLAINABLE):
+            return False
+        with query_stats._lock:
+            if (method, query) in query_stats._explained:
+                return False
+            query_stats._explained.add((method, query))
+            return True
 
-        with open(file, 'r+') as f:
-            data = json.load(f)
+    @staticmethod
+    def log_slow(method: str, query: str, seconds: float, rows: int, wait: float, plan: str | None = None):
+        if query_stats._slow_logger is None:
+            os.makedirs('logs', exist_ok=True)
+            handler = logging.FileHandler(f'logs/slow-queries-{datetime.datetime.now().strftime("%Y-%m-%d")}.log')
+            handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+            slow_logger = logging.getLogger('raindrop.slow_queries')
+            slow_logger.addHandler(handler)
+            slow_logger.setLevel(logging.INFO)
+            slow_logger.propagate = False
+            query_stats._slow_logger = slow_logger
+
+        message = (f"{method} took {seconds * 1000:.1f}ms ({rows} rows, waited {wait * 1000:.1f}ms for a connection): "
+                   f"{' '.join(query.split())}")
+        if plan is not None:
+            # Plans show the values the query was run with. Hide them, as they may be tokens or passwords.
+            message += "\n" + re.sub(r"'(?:[^']|'')*'", "'?'", plan)
+        query_stats._slow_logger.info(message)
 
-        temp = data
-        for k in keys[:-1]:
-            if k not in temp:
-                temp[k] = {}
-            temp = temp[k]
+    @staticmethod
+    def statistics() -> list:
+        """
+        Gets the stats of each method, the ones that spent the most time in the database first.
+        """
+        with query_stats._lock:
+            methods = [dict(stats, method=method) for method, stats in query_stats.methods.items()]
+        for stats in methods:
+            stats['average_time'] = stats['total_time'] / stats['calls']
+        return sorted(methods, key=lambda stats: stats['total_time'], reverse=True)
 
-        temp[keys[-1]] = value
+    @staticmethod
+    def reset():
+        with query_stats._lock:
+            query_stats.methods.clear()
+            query_stats._explained.clear()
+
+class raindrop_cursor(psycopg2.extensions.cursor):
+    """
+    A cursor that times every query it runs for query_stats.
+    """
+    def execute(self, query, vars=None):
+        wait = self.connection.take_checkout_wait()
+        started = time.perf_counter()
+        result = super().execute(query, vars)
+        elapsed = time.perf_counter() - started
+
+        method = query_stats.caller()
+        rows = max(self.rowcount, 0)
+        query_stats.record(method, elapsed, rows, wait)
+        if query_stats.is_slow(elapsed):
+            query_text = query if isinstance(query, str) else self.mogrify(query).decode()
+            plan = self._explain(query_text, vars) if query_stats.should_explain(method, query_text) else None
+            query_stats.log_slow(method, query_text, elapsed, rows, wait, plan)
+        return result
 
-        with open(file, 'w+') as f:
-            json.dump(data, f, indent=4)
+    def _explain(self, query: str, vars) -> str:
+        conn = self.connection
+        # Inside a transaction, a failed EXPLAIN must not abort the caller's work.
+        in_transaction = conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        cur = psycopg2.extensions.cursor(conn)
+        try:
+            if in_transaction:
+                cur.execute('SAVEPOINT rd_explain;')
+            cur.execute(f'EXPLAIN {query}', vars)
+            plan = '\n'.join(row[0] for row in cur.fetchall())
+            if in_transaction:
+                cur.execute('RELEASE SAVEPOINT rd_explain;')
+            return plan
+        except psycopg2.Error as exc:
+            if in_transaction:
+                cur.execute('ROLLBACK TO SAVEPOINT rd_explain;')
+            return f"Could not get the query plan: {exc}"
+        finally:
+            cur.close()
 
-        return True
+class raindrop_connection(psycopg2.extensions.connection):
+    """
+    The connection type the pool makes. Remembers which prepared statements exist on it,
+    and how long the last checkout waited for it.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = raindrop_cursor
+        self.prepared = set()
+        self.checkout_wait = 0.0
+
+    def take_checkout_wait(self) -> float:
+        """
+        Gets how long the current checkout waited for this connection. Only the first query of a checkout gets it.
+        """
+        wait, self.checkout_wait = self.checkout_wait, 0.0
+        return wait
+
+class prepared_statements:
+    """
+    The hottest queries, prepared once per pooled connection and then run by name, so Postgres does not have to
+    parse and plan them on every call. Queries use $1, $2... placeholders.
+    """
+    QUERIES = {
+        'rd_token_owner': """
+            SELECT username
+            FROM tokens
+            WHERE token = $1
+        """,
+        'rd_resolve_principal': """
+            SELECT accounts.username,
+                   COALESCE((
+                       SELECT bool_or(administrator)
+                       FROM user_permissions
+                       WHERE user_permissions.username = accounts.username
+                   ), FALSE),
+                   COALESCE(accounts.restricted, FALSE)
+            FROM tokens
+            JOIN accounts ON accounts.username = tokens.username
+            WHERE tokens.token = $1
+        """,
+        'rd_check_exists': """
+            SELECT username
+            FROM accounts
+            WHERE username = $1
+        """,
+        'rd_get_repo': """
+            SELECT repo_id, name, description, owner, created_on, last_updated, private
+            FROM repositories
+            WHERE owner = $1 AND name = $2
+        """,
+    }
+
+    _lock = threading.Lock()
+    stats = {
+        'hits': 0,  # Executions that reused a statement already prepared on the connection
+        'misses': 0,  # Executions that had to prepare the statement first
+    }
+
+    @staticmethod
+    @query_stats.skip
+    def execute(conn, cur, name: str, args: tuple):
+        """
+        Runs a registered statement on a cursor, preparing it on the connection first if needed.
+
+        A statement that fails on a read replica is prepared and run again on the primary, which has statements
+        of its own, rather than being left to replica_cursor to run again as it is.
+
+        :param conn: The (pooled) connection the cursor belongs to.
+        :param cur: The cursor to run the statement with.
+        :param name: The name of the statement in QUERIES.
+        :param args: The arguments for the statement.
+        """
+        if getattr(getattr(conn, 'raw', conn), 'prepared', None) is None:
+            # Not one of our pooled connections, so just run the query normally.
+            query = prepared_statements.QUERIES[name]
+            for position in range(len(args), 0, -1):
+                query = query.replace(f'${position}', '%s')
+            cur.execute(query, args)
+            return
+
+        if not isinstance(cur, replica_cursor):
+            prepared_statements._prepare_and_execute(cur, name, args)
+            return
+        try:
+            prepared_statements._prepare_and_execute(cur.raw, name, args)
+        except psycopg2.OperationalError:
+            if not cur.fail_over():
+                raise
+            # cur.raw is on the primary now, so the primary's own prepared statements are the ones looked at.
+            prepared_statements._prepare_and_execute(cur.raw, name, args)
 
     @staticmethod
-    def get(key, default=None, dt_default=dt.SETTINGS, file=settings_path) -> any:
+    def _prepare_and_execute(cur, name: str, args: tuple):
+        """
+        :param cur: A cursor that never fails over, so its connection is the one the statement is prepared on.
         """
-        Gets the value of a key in the memory file.
+        prepared = cur.connection.prepared
+        if name in prepared:
+            with prepared_statements._lock:
+                prepared_statements.stats['hits'] += 1
+        else:
+            cur.execute(f'PREPARE {name} AS {prepared_statements.QUERIES[name]};')
+            prepared.add(name)
+            with prepared_statements._lock:
+                prepared_statements.stats['misses'] += 1
+
+        placeholders = ', '.join(['%s'] * len(args))
+        cur.execute(f'EXECUTE {name} ({placeholders});', args)
 
-        :param key: The key to get the value of.
-        :param default: The default value to return if the key does not exist.
-        :param dt_default: The default dictionary to fill a json file with if the file does not exist.
-        :param file: The file to get the key from.
-        Set to None if you want to raise an error if the file does not exist.
+    @staticmethod
+    def statistics() -> dict:
+        with prepared_statements._lock:
+            stats = dict(prepared_statements.stats)
+        total = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / total if total else 0.0
+        return stats
+
+class request_consistency:
+    """
+    Read-your-writes for the storage layer. Once something has been written in a request, reads in it go to
+    the primary rather than to a replica that may not have the write yet.
+
+    Only requests are tracked. Long-lived threads, such as the packer's, and the CLI would otherwise be pinned
+    to the primary for good by their first write.
+    """
+    _state = contextvars.ContextVar('raindrop_request_consistency', default=None)
+
+    @staticmethod
+    def begin():
+        """
+        Starts a new request. The state is a dict so worker threads started from the request share it.
         """
-        # Logs the file it creates, and which file and line called it.
-        if DEBUG is True:
-            caller = f"{inspect.stack()[1].filename}:{inspect.stack()[1].lineno}"
-            logging.info(f'file \'{file}\' was retrieved from by {caller}')
+        request_consistency._state.set({'wrote': False})
 
-        keys = str(key).split(key_seperator)
-        file_dir = os.path.dirname(file)
-        if file_dir == '':
-            file_dir = os.getcwd()
+    @staticmethod
+    def mark_write():
+        state = request_consistency._state.get()
+        if state is not None:
+            state['wrote'] = True
 
-        if os.path.exists(file) is True:
-            with open(file, 'r+') as f:
-                data = dict(json.load(f))
+    @staticmethod
+    def must_use_primary() -> bool:
+        state = request_consistency._state.get()
+        return state is not None and state['wrote']
+
+class pooled_connection:
+    """
+    A connection borrowed from a connection_pool.
+    It acts just like a psycopg2 connection, except that close() hands it back to the pool instead of closing it.
+    """
+    def __init__(self, pool, raw_conn):
+        self._pool = pool
+        self._raw_conn = raw_conn
+        self._returned = False
+
+    def __getattr__(self, item):
+        return getattr(self._raw_conn, item)
+
+    def __setattr__(self, key, value):
+        # Settings such as 'autocommit' belong to the real connection.
+        if key.startswith('_'):
+            super().__setattr__(key, value)
         else:
-            if dt_default is not None:
-                os.makedirs(file_dir, exist_ok=True)
-                with open(file, 'w+') as f:
-                    json.dump(dt_default, f, indent=4, separators=(',', ':'))
-            else:
-                raise FileNotFoundError(f"file '{file}' does not exist.")
+            setattr(self._raw_conn, key, value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # Same as psycopg2, commit on success and rollback on error. The connection is not given back here.
+        if exc_type is None:
+            self.commit()
+        else:
+            self._raw_conn.rollback()
+
+    @property
+    def raw(self) -> psycopg2.extensions.connection:
+        return self._raw_conn
+
+    def cursor(self, *args, **kwargs):
+        if self._pool.replica:
+            return replica_cursor(self, args, kwargs)
+        return self._raw_conn.cursor(*args, **kwargs)
+
+    def move_to_primary(self) -> bool:
+        """
+        Moves a connection to a replica over to the primary, for the rest of its checkout, after a query on the
+        replica failed. The replica is not read from again until its next health check.
+
+        :return: False if the connection is already to the primary.
+        :raises psycopg2.OperationalError: If the primary can not be reached either.
+        """
+        if not self._pool.replica:
+            return False
+        replica_router.record(replica_router.key(self._pool.details), None)
+        primary = PostgreSQL.shared().pool.getconn()
+        # Swapped, so closing the primary's wrapper hands the replica's connection back to its own pool.
+        self._pool, self._raw_conn, primary._pool, primary._raw_conn = (
+            primary._pool, primary._raw_conn, self._pool, self._raw_conn
+        )
+        primary.close()
+        return True
+
+    def commit(self):
+        self._raw_conn.commit()
+        if not self._pool.replica:
+            request_consistency.mark_write()
 
-            with open(file, 'r+') as f:
-                data = dict(json.load(f))
+    def close(self):
+        if not self._returned:
+            self._returned = True
+            self._pool.putconn(self._raw_conn)
 
-        temp = data
+    def __del__(self):
+        # A connection that was never closed, such as one held by a generator that was dropped part way through,
+        # goes back to the pool once nothing refers to it, rather than being lost to it for good.
         try:
-            for k in keys[:-1]:
-                if k not in temp:
-                    return default
-                temp = temp[k]
+            self.close()
+        except Exception:
+            pass
+
+class replica_cursor:
+    """
+    A cursor of a connection to a read replica. It acts just like a psycopg2 cursor, except that a query the
+    replica fails with an OperationalError, such as when it has gone away or cancelled the query to replay
+    changes, is run once more on the primary. The connection stays on the primary from then on.
+    """
+    def __init__(self, conn: pooled_connection, args: tuple, kwargs: dict):
+        self._conn = conn
+        self._args = args
+        self._kwargs = kwargs
+        self._cursor = conn.raw.cursor(*args, **kwargs)
+
+    def __getattr__(self, item):
+        return getattr(self._cursor, item)
+
+    def __setattr__(self, key, value):
+        if key.startswith('_'):
+            super().__setattr__(key, value)
+        else:
+            setattr(self._cursor, key, value)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._cursor.close()
+
+    @property
+    def raw(self):
+        """
+        The cursor queries run on now, which does not fail over by itself.
+        """
+        return self._cursor
+
+    def fail_over(self) -> bool:
+        """
+        Moves the connection over to the primary after a query failed on the replica, and makes the cursor again
+        on it. Call it while handling the error.
+
+        :return: False if the cursor was already on the primary, so there is nothing to fail over to.
+        :raises psycopg2.OperationalError: If the primary can not be reached either.
+        """
+        # Another cursor may have moved the connection already.
+        if self._cursor.connection is self._conn.raw and not self._conn.move_to_primary():
+            return False
+        logging.warning("A query failed on a read replica. Running it on the primary instead.", exc_info=True)
+        itersize = self._cursor.itersize
+        self._cursor = self._conn.raw.cursor(*self._args, **self._kwargs)
+        self._cursor.itersize = itersize
+        return True
 
-            return temp[keys[-1]]
-        except KeyError as err:
-            logging.error(f"key '{key}' not found in file '{file}'.", err)
-            raise KeyError(f"key '{key}' not found in file '{file}'.")
+    def execute(self, query, vars=None):
+        try:
+            return self._cursor.execute(query, vars)
+        except psycopg2.OperationalError:
+            if not self.fail_over():
+                raise
+            return self._cursor.execute(query, vars)
+
+class connection_pool:
+    """
+    A bounded, thread-safe pool of PostgreSQL connections.
+    There is one pool per set of connection details per process, fetch it with connection_pool.for_details().
+    """
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(self, details: dict, min_size=1, max_size=10, idle_timeout=300, checkout_timeout=30,
+                 health_check_interval=30, replica=False):
+        """
+        :param details: The keyword arguments to pass to psycopg2.connect.
+        :param min_size: How many connections are kept open even when idle.
+        :param max_size: The most connections that can be open at once.
+        :param idle_timeout: Seconds a connection may sit unused before it is closed.
+        :param checkout_timeout: Seconds to wait for a free connection before giving up.
+        :param health_check_interval: Connections idle for longer than this are tested with a query before use.
+        :param replica: True if this pool is for a read replica.
+        """
+        assert max_size >= 1, "The pool must allow at least one connection."
+        assert 0 <= min_size <= max_size, "min_size must be between 0 and max_size."
+        self.details = dict(details)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self.replica = replica
+        self.pid = os.getpid()
+
+        self._condition = threading.Condition()
+        self._idle = collections.deque()  # (connection, time it was returned)
+        self._size = 0  # Open connections, idle and in use
+        self._closed = False
+        self.stats = {
+            'created': 0,
+            'closed': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'timeouts': 0,
+            'failed_health_checks': 0,
+        }
 
     @staticmethod
-    def delete(key, file=settings_path, default=dt.SETTINGS):
+    def for_details(details: dict, replica=False) -> 'connection_pool':
         """
-        Delete a key.
+        Gets the pool for the given connection details, making it if it does not exist yet.
+        Pools made by a parent process are never reused after a fork, as the sockets belong to the parent.
 
-        :param key: The key to delete.
-        :param file: The file to delete the key from.
-        :param default: The default dictionary to fill a json file with if the file does not exist.
+        :param details: The keyword arguments to pass to psycopg2.connect.
+        :param replica: True if the details are for a read replica.
         """
-        # Logs the file it creates, and which file and line called it.
-        if DEBUG is True:
-            caller = f"{inspect.stack()[1].filename}:{inspect.stack()[1].lineno}"
-            logging.info(f'file \'{file}\' was had a key deleted by {caller}')
+        key = (details.get('host'), str(details.get('port')), details.get('user'), details.get('database'), replica)
+        with connection_pool._pools_lock:
+            pool = connection_pool._pools.get(key)
+            if pool is not None and pool.pid == os.getpid() and pool.details == details:
+                return pool
+            if pool is not None and pool.pid == os.getpid():
+                # The details for this server have changed (eg, a new password). Retire the old pool.
+                pool.closeall()
+
+            config = var.get('db').get('pool', dt.SETTINGS['db']['pool'])
+            pool = connection_pool(
+                details,
+                min_size=int(config.get('min_size', 1)),
+                max_size=int(config.get('max_size', 10)),
+                idle_timeout=float(config.get('idle_timeout', 300)),
+                checkout_timeout=float(config.get('checkout_timeout', 30)),
+                health_check_interval=float(config.get('health_check_interval', 30)),
+                replica=replica,
+            )
+            connection_pool._pools[key] = pool
+            return pool
 
-        keys = str(key).split(key_seperator)
-        file_dir = os.path.dirname(file)
-        if file_dir == '':
-            file_dir = os.getcwd()
+    @staticmethod
+    def all_pools() -> list:
+        with connection_pool._pools_lock:
+            return [pool for pool in connection_pool._pools.values() if pool.pid == os.getpid()]
 
-        if os.path.exists(file) is True:
-            with open(file, 'r+') as f:
-                data = dict(json.load(f))
-        else:
-            if default is not None:
-                os.makedirs(file_dir, exist_ok=True)
-                with open(file, 'w+') as f:
-                    json.dump(default, f, indent=4, separators=(',', ':'))
-            else:
-                raise FileNotFoundError(f"file '{file}' does not exist.")
+    def _connect(self) -> psycopg2.extensions.connection:
+        conn = psycopg2.connect(**self.details, connection_factory=raindrop_connection)
+        with self._condition:
+            self.stats['created'] += 1
+        return conn
 
-            with open(file, 'r+') as f:
-                data = dict(json.load(f))
+    def _discard(self, conn):
+        """
+        Closes a connection for good. The caller must hold the lock and has already removed it from the idle list.
+        """
+        self._size -= 1
+        self.stats['closed'] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
 
-        temp = data
-        for k in keys[:-1]:
-            if k not in temp:
-                return False
-            temp = temp[k]
+    def _prune_idle(self):
+        """
+        Closes connections that have sat idle for too long, never going below min_size. Caller must hold the lock.
+        The oldest connections are at the left of the deque.
+        """
+        now = time.monotonic()
+        while self._idle and self._size > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.popleft()
+            self._discard(conn)
 
-        if keys[-1] in temp:
-            del temp[keys[-1]]
-            with open(file, 'w+') as f:
-                json.dump(data, f, indent=4)
+    def _is_healthy(self, conn, idle_for: float) -> bool:
+        if conn.closed:
+            return False
+        if idle_for < self.health_check_interval:
             return True
-        else:
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1;')
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
             return False
 
+    def getconn(self) -> pooled_connection:
+        """
+        Borrows a connection from the pool. Call close() on it when done to hand it back.
+
+        :raises error.db_pool_exhausted: If no connection became free within checkout_timeout.
+        :raises psycopg2.OperationalError: If a new connection was needed and could not be made.
+        """
+        started = time.monotonic()
+        waited = False
+        while True:
+            with self._condition:
+                assert not self._closed, "This connection pool has been closed."
+                self._prune_idle()
+                if self._idle:
+                    # Take the most recently used connection so the old ones can time out.
+                    conn, returned_at = self._idle.pop()
+                    action = 'reuse'
+                elif self._size < self.max_size:
+                    self._size += 1
+                    conn, returned_at = None, None
+                    action = 'connect'
+                else:
+                    remaining = self.checkout_timeout - (time.monotonic() - started)
+                    if remaining <= 0:
+                        self.stats['timeouts'] += 1
+                        raise error.db_pool_exhausted(self.checkout_timeout)
+                    if not waited:
+                        waited = True
+                        self.stats['waits'] += 1
+                    self._condition.wait(remaining)
+                    continue
+
+            # Connecting and health checking happen outside the lock so other threads are not held up.
+            if action == 'connect':
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify()
+                    raise
+            elif not self._is_healthy(conn, time.monotonic() - returned_at):
+                with self._condition:
+                    self.stats['failed_health_checks'] += 1
+                    self._discard(conn)
+                continue
+
+            with self._condition:
+                self.stats['checkouts'] += 1
+                if waited:
+                    self.stats['wait_time'] += time.monotonic() - started
+            conn.checkout_wait = time.monotonic() - started
+            return pooled_connection(self, conn)
+
+    def putconn(self, conn: psycopg2.extensions.connection):
+        """
+        Hands a connection back to the pool. Anything left uncommitted on it is rolled back.
+        """
+        if os.getpid() != self.pid:
+            # This connection belongs to the parent process. Never touch its socket.
+            return
+
+        reusable = not conn.closed
+        if reusable and conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                reusable = False
+        if reusable and conn.autocommit:
+            conn.autocommit = False
+
+        with self._condition:
+            if reusable and not self._closed:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                self._discard(conn)
+            self._condition.notify()
+
+    def closeall(self):
+        with self._condition:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+            self._condition.notify_all()
+
+    def statistics(self) -> dict:
+        with self._condition:
+            stats = dict(self.stats)
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._size - len(self._idle)
+            stats['min_size'] = self.min_size
+            stats['max_size'] = self.max_size
+            return stats
+
+class replica_router:
+    """
+    Decides where read-only queries go. Replicas are listed under db.replicas in settings.json.
+    A replica is read from while it is reachable and no more than db.replica_max_lag seconds behind the primary,
+    otherwise reads fall back to the primary.
+    """
+    # How far behind the primary a replica is, in seconds. A replica that has replayed everything it has received
+    # counts as caught up even if the primary has not written anything for a while.
+    LAG_QUERY = """
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() THEN 0
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+        END;
+    """
+
+    _lock = threading.Lock()
+    _health = {}  # Replica key: (time it was checked, lag in seconds or None if it could not be reached)
+    _config_cache = None
+
+    @staticmethod
+    def config() -> dict:
+        if replica_router._config_cache is None:
+            db_settings = var.get('db')
+            primary = PostgreSQL.get_details()
+            replicas = []
+            for replica in db_settings.get('replicas', []) or []:
+                details = dict(primary)
+                details['host'] = replica['host']
+                details['port'] = replica.get('port', primary['port'])
+                details['database'] = replica.get('database', primary['database'])
+                replicas.append(details)
+            replica_router._config_cache = {
+                'replicas': replicas,
+                'max_lag': float(db_settings.get('replica_max_lag', 5)),
+                'check_interval': float(db_settings.get('replica_check_interval', 5)),
+            }
+        return replica_router._config_cache
+
+    @staticmethod
+    def forget_config():
+        replica_router._config_cache = None
+        with replica_router._lock:
+            replica_router._health.clear()
+
+    @staticmethod
+    def key(details: dict) -> str:
+        return f"{details['host']}:{details['port']}"
+
     @staticmethod
-    def load_all(file: str = settings_path, dt_default={}) -> dict:
+    def shuffled() -> list:
         """
-        Load all the keys in a file. Returns a dictionary with all the keys.
-        :param file: The file to load all the keys from.
-        :param dt_default:
-        :return:
+        Gets the replicas in a random order, to spread reads between them.
+        """
+        replicas = list(replica_router.config()['replicas'])
+        random.shuffle(replicas)
+        return replicas
+
+    @staticmethod
+    def needs_check(key: str) -> bool:
+        with replica_router._lock:
+            checked = replica_router._health.get(key)
+        return checked is None or time.monotonic() - checked[0] > replica_router.config()['check_interval']
+
+    @staticmethod
+    def record(key: str, lag: float | None):
+        """
+        Records how far behind a replica is. None means it could not be reached.
         """
-        # Logs the file it creates, and which file and line called it.
-        if DEBUG is True:
-            logging.info(
-                f'file \'{file}\' was fully loaded by {inspect.stack()[1].filename}:{inspect.stack()[1].lineno}')
+        if lag is None:
+            logging.warning(f"Read replica {key} could not be reached. Reading from the primary instead.")
+        with replica_router._lock:
+            replica_router._health[key] = (time.monotonic(), lag)
 
-        os.makedirs(os.path.dirname(file), exist_ok=True)
-        if not os.path.exists(file):
-            with open(file, 'w+') as f:
-                json.dump(dt_default, f, indent=4, separators=(',', ':'))
+    @staticmethod
+    def usable(key: str) -> bool:
+        with replica_router._lock:
+            checked = replica_router._health.get(key)
+        return checked is not None and checked[1] is not None and checked[1] <= replica_router.config()['max_lag']
+
+    @staticmethod
+    def checkout() -> pooled_connection | None:
+        """
+        Borrows a connection to a healthy replica, or returns None if there is none to use.
+        """
+        for details in replica_router.shuffled():
+            key = replica_router.key(details)
+            if not replica_router.needs_check(key) and not replica_router.usable(key):
+                continue
+
+            pool = connection_pool.for_details(details, replica=True)
+            try:
+                conn = pool.getconn()
+            except (psycopg2.OperationalError, error.db_pool_exhausted):
+                replica_router.record(key, None)
+                continue
+
+            if replica_router.needs_check(key):
+                try:
+                    cur = conn.cursor()
+                    cur.execute(replica_router.LAG_QUERY)
+                    replica_router.record(key, float(cur.fetchone()[0]))
+                    cur.close()
+                    conn.rollback()
+                except psycopg2.Error:
+                    replica_router.record(key, None)
+                    conn.close()
+                    continue
+
+            if replica_router.usable(key):
+                return conn
+            conn.close()
+        return None
+
+    @staticmethod
+    def statistics() -> dict:
+        now = time.monotonic()
+        with replica_router._lock:
+            health = dict(replica_router._health)
+        stats = {}
+        for details in replica_router.config()['replicas']:
+            key = replica_router.key(details)
+            checked = health.get(key)
+            stats[key] = {
+                'lag': checked[1] if checked else None,
+                'usable': replica_router.usable(key),
+                'checked_seconds_ago': round(now - checked[0], 1) if checked else None,
+            }
+        return stats
+
+class read_cache:
+    """
+    An in-process, read-through cache for data that is read on every page view but rarely changes.
+    Entries expire after db.cache.ttl seconds, the least recently used are dropped past db.cache.max_entries,
+    and writes through PostgreSQL or AsyncPostgreSQL remove the entries they affect straight away.
+    Other processes only see a write once their entry expires.
+    """
+    _lock = threading.Lock()
+    # Key: (stored at, {variant: value}). A variant is a page or other extra arguments of the same key,
+    # so invalidating a key drops all of them. A value of _INVALIDATED marks when the key was last invalidated.
+    _entries = collections.OrderedDict()
+    _INVALIDATED = object()
+    MAX_VARIANTS = 16
+    _config_cache = None
+    stats = {
+        'hits': 0,
+        'misses': 0,
+        'invalidations': 0,
+        'evictions': 0,
+        'expirations': 0,
+    }
+
+    @staticmethod
+    def config() -> dict:
+        if read_cache._config_cache is None:
+            config = var.get('db').get('cache', dt.SETTINGS['db']['cache'])
+            read_cache._config_cache = {
+                'enabled': bool(config.get('enabled', True)),
+                'ttl': float(config.get('ttl', 30)),
+                'max_entries': int(config.get('max_entries', 10000)),
+            }
+        return read_cache._config_cache
 
-        with open(file, 'r+') as f:
-            data = dict(json.load(f))
+    @staticmethod
+    def _lookup(key: tuple, variant: tuple):
+        """
+        :return: (True, value) on a hit. On a miss, (False, stamp), where the stamp is passed on to _store.
+        """
+        now = time.monotonic()
+        with read_cache._lock:
+            entry = read_cache._entries.get(key)
+            if entry is not None and entry[1] is not read_cache._INVALIDATED:
+                if now - entry[0] > read_cache.config()['ttl']:
+                    del read_cache._entries[key]
+                    read_cache.stats['expirations'] += 1
+                    entry = None
+                elif variant in entry[1]:
+                    read_cache._entries.move_to_end(key)
+                    read_cache.stats['hits'] += 1
+                    return True, copy.deepcopy(entry[1][variant])
+            read_cache.stats['misses'] += 1
+            return False, entry
 
-        return data
+    @staticmethod
+    def _store(key: tuple, variant: tuple, value, stamp):
+        """
+        Stores a loaded value, unless the key was invalidated while it was loading, as the value may be stale.
+        Shortly after an invalidation nothing is stored either, since a lagging replica could have served the load.
+        """
+        now = time.monotonic()
+        replica_lag = replica_router.config()['max_lag'] if replica_router.config()['replicas'] else 0
+        with read_cache._lock:
+            entry = read_cache._entries.get(key)
+            if entry is not stamp:
+                return
+            if entry is not None and entry[1] is read_cache._INVALIDATED:
+                if now - entry[0] < replica_lag:
+                    return
+                entry = None
+
+            if entry is None:
+                entry = (now, {})
+                read_cache._entries[key] = entry
+            variants = entry[1]
+            variants[variant] = copy.deepcopy(value)
+            if len(variants) > read_cache.MAX_VARIANTS:
+                del variants[next(iter(variants))]
+
+            read_cache._entries.move_to_end(key)
+            while len(read_cache._entries) > read_cache.config()['max_entries']:
+                read_cache._entries.popitem(last=False)
+                read_cache.stats['evictions'] += 1
 
     @staticmethod
-    def fill_json(file: str = settings_path, data=dt.SETTINGS):
+    def cached(namespace: str, key_args: int = None):
         """
-        Fill a json file with a dictionary.
-        :param file: The file to fill with data.
-        :param data: The data to fill the file with.
+        Caches what a storage method returns, keyed by the namespace and the method's arguments.
+        Works on both regular and async methods. Any self argument is left out of the key.
+
+        :param namespace: The name the entries are kept under. Used by invalidate().
+        :param key_args: How many leading arguments make up the key. The rest, such as a page,
+        are cached under the same key so they are invalidated with it. Defaults to all of them.
         """
-        # Logs the file it creates, and which file and line called it.
-        if DEBUG is True:
-            logging.info(
-                f'file \'{file}\' was filled with data by {inspect.stack()[1].filename}:{inspect.stack()[1].lineno}')
+        def decorator(function):
+            skip_self = 'self' in inspect.signature(function).parameters
+
+            def make_key(args, kwargs) -> tuple:
+                args = args[1:] if skip_self else args
+                split = len(args) if key_args is None else key_args
+                return (namespace, *args[:split]), (*args[split:], *sorted(kwargs.items()))
+
+            if inspect.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def async_wrapper(*args, **kwargs):
+                    if not read_cache.config()['enabled']:
+                        return await function(*args, **kwargs)
+                    key, variant = make_key(args, kwargs)
+                    hit, value = read_cache._lookup(key, variant)
+                    if hit:
+                        return value
+                    result = await function(*args, **kwargs)
+                    read_cache._store(key, variant, result, value)
+                    return result
+                return async_wrapper
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not read_cache.config()['enabled']:
+                    return function(*args, **kwargs)
+                key, variant = make_key(args, kwargs)
+                hit, value = read_cache._lookup(key, variant)
+                if hit:
+                    return value
+                result = function(*args, **kwargs)
+                read_cache._store(key, variant, result, value)
+                return result
+            return wrapper
+        return decorator
 
-        os.makedirs(os.path.dirname(file), exist_ok=True)
-        with open(file, 'w+') as f:
-            json.dump(data, f, indent=4, separators=(',', ':'))
+    @staticmethod
+    def invalidate(*keys: tuple):
+        now = time.monotonic()
+        with read_cache._lock:
+            for key in keys:
+                read_cache._entries[key] = (now, read_cache._INVALIDATED)
+                read_cache._entries.move_to_end(key)
+                read_cache.stats['invalidations'] += 1
+            while len(read_cache._entries) > read_cache.config()['max_entries']:
+                read_cache._entries.popitem(last=False)
+                read_cache.stats['evictions'] += 1
 
-        return True
+    @staticmethod
+    def invalidate_user(username: str):
+        """
+        Drops everything cached about a user, their repositories included, as those go when the user is deleted.
+        Only the repositories with entries are known here, and they are found by looking through the cache.
+        A repository first read while the user was being deleted is cached afterwards, but only until the ttl.
+        """
+        with read_cache._lock:
+            repositories = [
+                key for key in read_cache._entries if key[0] in ('repo', 'repo_exists') and key[1] == username
+            ]
+        read_cache.invalidate(('bio', username), ('public_repos', username), *repositories)
+
+    @staticmethod
+    def invalidate_repository(owner: str, name: str):
+        read_cache.invalidate(('public_repos', owner), ('repo', owner, name), ('repo_exists', owner, name))
+
+    @staticmethod
+    def clear():
+        with read_cache._lock:
+            read_cache._entries.clear()
+
+    @staticmethod
+    def statistics() -> dict:
+        with read_cache._lock:
+            stats = dict(read_cache.stats)
+            stats['size'] = sum(1 for entry in read_cache._entries.values() if entry[1] is not read_cache._INVALIDATED)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        stats.update(read_cache.config())
+        return stats
 
 class postgre_cli:
     def __init__(self):
@@ -267,7 +1023,7 @@ class postgre_cli:
 
         self.cli.register_command(
             'test',
-            func=PostgreSQL.ping_db,
+            func=self.test_connection,
             description="Test the connection to the database."
         )
 
@@ -283,15 +1039,248 @@ class postgre_cli:
             description="Reveal the password for the database."
         )
 
+        self.cli.register_command(
+            'migrations',
+            func=self.show_migrations,
+            description="Show the database schema version and any pending migrations."
+        )
+
+        self.cli.register_command(
+            'migrate',
+            func=self.apply_migrations,
+            description="Apply any pending database schema migrations."
+        )
+
+        self.cli.register_command(
+            'pool',
+            func=self.pool_stats,
+            description="Show statistics for the database connection pools."
+        )
+
+        self.cli.register_command(
+            'blobs',
+            func=self.blob_stats,
+            description="Show how much file content is stored, and where."
+        )
+
+        self.cli.register_command(
+            'blobs-gc',
+            func=self.collect_blob_garbage,
+            description="Delete stored file content that no commit uses any more, and blob files nothing is stored in."
+        )
+
+        self.cli.register_command(
+            'repack',
+            func=self.repack,
+            description="Store older file versions of changed repositories as deltas now."
+        )
+
+        self.cli.register_command(
+            'head-files-rebuild',
+            func=self.rebuild_head_files,
+            description="Recompute the table of the newest version of each file from the commit history."
+        )
+
+        self.cli.register_command(
+            'search-reindex',
+            func=self.rebuild_search_index,
+            description="Index the newest version of each file for code search, where it is not indexed yet."
+        )
+
+        self.cli.register_command(
+            'queries',
+            func=self.show_query_stats,
+            description="Show how much database time each storage method has used."
+        )
+
+        self.cli.register_command(
+            'cache',
+            func=self.cache_stats,
+            description="Show how well the read cache for bios and public repositories is doing."
+        )
+
+        self.cli.register_command(
+            'replicas',
+            func=self.replica_stats,
+            description="Show the read replicas and how far behind the primary they are."
+        )
+
+        self.cli.register_command(
+            'prepared',
+            func=self.prepared_stats,
+            description="Show how often the prepared statements for hot queries are reused."
+        )
+
     def main(self):
         self.cli.main()
         return True
 
+    @staticmethod
+    def enter():
+        """
+        Builds the PostgreSQL CLI and enters it. Used so the CLI is only made when someone actually opens it.
+        A new one is made each time, as a CLI handler cannot be re-entered once exited.
+        """
+        return postgre_cli().main()
+
+    def test_connection(self):
+        PostgreSQL.shared().ping_db(do_print=True)
+        return True
+
     def reveal_password(self):
         print(f"Username: {self.details['user']}")
         print(f"Password: {PostgreSQL.get_details()['password']}")
         return True
 
+    def show_migrations(self):
+        migrator = schema_migrator(PostgreSQL.shared().get_connection)
+        print(f"The database schema is at version {migrator.current_version()} of {migrator.latest_version}.")
+        pending = migrator.pending()
+        if not pending:
+            print("There are no pending migrations.")
+        for step in pending:
+            concurrent_note = '' if step.transactional else ' (runs outside a transaction)'
+            print(f"{colours['yellow']}Pending {step.version}: {step.description}{concurrent_note}")
+        return True
+
+    def apply_migrations(self):
+        applied = PostgreSQL.shared().modernize()
+        if applied:
+            print(f"{colours['green']}Applied migrations: {', '.join(str(version) for version in applied)}")
+        else:
+            print("The database schema is already up to date.")
+        return True
+
+    def pool_stats(self):
+        pools = connection_pool.all_pools()
+        if not pools:
+            print("No connections have been made to the database yet.")
+            return True
+
+        for pool in pools:
+            stats = pool.statistics()
+            print(f"{colours['green']}{pool.details['user']}@{pool.details['host']}:{pool.details['port']}")
+            print(f"Open: {stats['size']} ({stats['in_use']} in use, {stats['idle']} idle), "
+                  f"limits {stats['min_size']}-{stats['max_size']}")
+            print(f"Checkouts: {stats['checkouts']}, waited {stats['waits']} times for {stats['wait_time']:.3f}s, "
+                  f"{stats['timeouts']} timed out")
+            print(f"Connections made: {stats['created']}, closed: {stats['closed']}, "
+                  f"failed health checks: {stats['failed_health_checks']}\n")
+        return True
+
+    def replica_stats(self):
+        stats = replica_router.statistics()
+        if not stats:
+            print("No read replicas are configured. Add them under 'db.replicas' in settings.json.")
+            return True
+
+        for key, health in stats.items():
+            colour = colours['green'] if health['usable'] else colours['red']
+            lag = 'unknown' if health['lag'] is None else f"{health['lag']:.2f}s"
+            print(f"{colour}{key}{colours['end']} lag: {lag}, in use: {health['usable']}")
+        return True
+
+    def prepared_stats(self):
+        stats = prepared_statements.statistics()
+        print(f"Prepared statements reused: {stats['hits']}, prepared: {stats['misses']} "
+              f"(hit rate {stats['hit_rate']:.1%})")
+        print(f"Statements: {', '.join(prepared_statements.QUERIES)}")
+        return True
+
+    def cache_stats(self):
+        stats = read_cache.statistics()
+        if not stats['enabled']:
+            print("The read cache is turned off. Turn it on with 'db.cache.enabled' in settings.json.")
+            return True
+
+        print(f"Read cache hits: {stats['hits']}, misses: {stats['misses']} (hit rate {stats['hit_rate']:.1%})")
+        print(f"Entries: {stats['size']}/{stats['max_entries']}, TTL: {stats['ttl']}s")
+        print(f"Invalidations: {stats['invalidations']}, evictions: {stats['evictions']}, "
+              f"expirations: {stats['expirations']}")
+
+        diffs = diff_engine.statistics()
+        print(f"Diff cache hits: {diffs['hits']}, misses: {diffs['misses']}, "
+              f"{diffs['cached']} diffs in {diffs['cached_bytes'] / 1024 / 1024:.1f} MiB, evictions: {diffs['evicted']}")
+
+        graph = commit_graph.statistics()
+        print(f"Commit graph hits: {graph['hits']}, misses: {graph['misses']}, {graph['cached']} changesets cached, "
+              f"walks pruned by bloom: {graph['pruned']}")
+        return True
+
+    def blob_stats(self):
+        conn = PostgreSQL.shared().get_connection()
+        cur = conn.cursor()
+        try:
+            stats = blob_store.statistics(cur)
+        finally:
+            cur.close()
+            conn.close()
+
+        print(f"Blobs are stored on the {stats['backend']} backend.")
+        for location, totals in stats['locations'].items():
+            print(f"{location}: {totals['blobs']} blobs ({totals['deltas']} as deltas), "
+                  f"{totals['bytes'] / 1024 / 1024:.1f} MiB of content in {totals['stored_bytes'] / 1024 / 1024:.1f} MiB")
+        print(f"Since start up: {stats['stored']} stored, {stats['deduplicated']} deduplicated, {stats['read']} read")
+        cache = stats['base_cache']
+        print(f"Delta base cache: {cache['entries']} entries, {cache['bytes'] / 1024 / 1024:.1f} MiB, "
+              f"{cache['hits']} hits, {cache['misses']} misses")
+        compression = stats['compression']
+        for codec, totals in compression['codecs'].items():
+            print(f"Codec {codec}: {totals['blobs']} blobs, "
+                  f"{totals['bytes'] / 1024 / 1024:.1f} MiB of content in {totals['stored_bytes'] / 1024 / 1024:.1f} MiB")
+        print(f"{compression['dictionaries']} compression dictionaries, "
+              f"for {compression['repositories_with_dictionaries']} repositories")
+        return True
+
+    def collect_blob_garbage(self):
+        conn = PostgreSQL.shared().get_connection()
+        try:
+            deleted = blob_store.collect_garbage(conn)
+        finally:
+            conn.close()
+        print(f"Deleted {deleted} blobs that no commit uses.")
+        return True
+
+    def rebuild_head_files(self):
+        rows = PostgreSQL.shared().rebuild_head_files()
+        print(f"Rebuilt the newest versions of {rows} files.")
+        return True
+
+    def rebuild_search_index(self):
+        indexed = PostgreSQL.shared().rebuild_search_index()
+        print(f"Indexed {indexed} files for code search.")
+        return True
+
+    def repack(self):
+        # Imported here, as library.packs imports this module.
+        from library.packs import packer
+
+        repacked = packer.repack_changed()
+        stats = packer.statistics()
+        print(f"Repacked {repacked} repositories. {stats['deltified']} versions were stored as deltas, "
+              f"saving {stats['bytes_saved'] / 1024 / 1024:.1f} MiB, and {stats['made_whole']} were stored whole.")
+        return True
+
+    def show_query_stats(self):
+        methods = query_stats.statistics()
+        if not methods:
+            print("No queries have been run yet.")
+            return True
+
+        print(f"{'Method':<48}{'Calls':>8}{'Total ms':>11}{'Avg ms':>9}{'Max ms':>9}{'Rows':>9}{'Wait ms':>10}{'Slow':>6}")
+        for stats in methods:
+            colour = colours['red'] if stats['slow'] else colours['green']
+            print(
+                f"{colour}{stats['method']:<48}{colours['end']}{stats['calls']:>8}"
+                f"{stats['total_time'] * 1000:>11.1f}{stats['average_time'] * 1000:>9.2f}"
+                f"{stats['max_time'] * 1000:>9.1f}{stats['rows']:>9}{stats['wait_time'] * 1000:>10.1f}{stats['slow']:>6}"
+            )
+
+        threshold = query_stats.threshold()
+        if threshold is not None:
+            print(f"Queries over {threshold * 1000:.0f}ms are logged to logs/slow-queries-<date>.log")
+        return True
+
     def query_db(self):
         query = self.cli.ask_question("What's the query you want to run?")
         args = ()
@@ -426,13 +1415,55 @@ class postgre_cli:
             return True
 
 class PostgreSQL:
-    def __init__(self):
-        self.details = PostgreSQL.get_details()
+    _shared = None
+    _shared_lock = threading.Lock()
+    _details_cache = None
+    # How many rows a server-side cursor fetches at a time when listing repositories.
+    LISTING_BATCH_SIZE = 500
+    # How many times a commit is built again on a branch that other commits keep moving, before giving up.
+    MAX_REF_RETRIES = 20
+    # How many rows the storage used by a repository, and a user's commits of a day, are spread over.
+    # See add_storage_usage() and count_commits().
+    USAGE_SLOTS = 8
+
+    def __init__(self, ping=False):
+        """
+        Cheap to make. The credentials are read from settings.json once per process and only when first needed.
+        Prefer PostgreSQL.shared() over making new instances.
+
+        :param ping: If True, makes a test connection to the database straight away.
+        """
+        self._cli = None
 
-        self.cli = postgre_cli()
+        if ping:
+            self.ping_db()
 
-        # Makes a test connection to the database
-        self.ping_db()
+    @staticmethod
+    def shared(ping=False) -> 'PostgreSQL':
+        """
+        Gets the storage object shared by everything in this process.
+
+        :param ping: If True, makes a test connection to the database.
+        """
+        with PostgreSQL._shared_lock:
+            if PostgreSQL._shared is None or PostgreSQL._shared[0] != os.getpid():
+                PostgreSQL._shared = (os.getpid(), PostgreSQL())
+            instance = PostgreSQL._shared[1]
+
+        if ping:
+            instance.ping_db()
+        return instance
+
+    @property
+    def details(self) -> dict:
+        return PostgreSQL.get_details()
+
+    @property
+    def cli(self) -> 'postgre_cli':
+        # Only built when the DB shell is actually used, as it sets up a whole CLI handler.
+        if self._cli is None:
+            self._cli = postgre_cli()
+        return self._cli
 
     @staticmethod
     def stop_container():
@@ -444,9 +1475,24 @@ class PostgreSQL:
             check=True,
         )
 
-    def get_connection(self) -> psycopg2.extensions.connection:
+    @property
+    def pool(self) -> connection_pool:
+        return connection_pool.for_details(self.details)
+
+    def get_connection(self, readonly=False) -> pooled_connection:
+        """
+        Borrows a connection from the process-wide pool. Calling close() on it hands it back to the pool.
+
+        :param readonly: If True, the connection may be to a read replica, unless something was already
+        written in this request.
+        """
+        if readonly and not request_consistency.must_use_primary():
+            conn = replica_router.checkout()
+            if conn is not None:
+                return conn
+
         try:
-            return psycopg2.connect(**self.details)
+            return self.pool.getconn()
         except psycopg2.OperationalError as err:
             # Try to start up the docker container for the database
             if not PostgreSQL.start_db():
@@ -465,8 +1511,7 @@ class PostgreSQL:
                         exit(1)
                     else:
                         print("Successfully paired with a local database.")
-                        self.details = self.get_details()
-                        return psycopg2.connect(**self.details)
+                        return self.pool.getconn()
 
             msg = 'The database is starting up. Please wait.'
             print(msg)
@@ -481,7 +1526,7 @@ class PostgreSQL:
                     raise err
                 time_waited += 1
                 time.sleep(1)
-            return psycopg2.connect(**self.details)
+            return self.pool.getconn()
 
     def ping_db(self, do_print=False):
         try:
@@ -499,6 +1544,7 @@ class PostgreSQL:
         return PostgreSQL.check_db_container()
 
     @staticmethod
+    @query_stats.skip
     def query_db(query, args, do_commit=True):
         """
         Query the database.
@@ -507,13 +1553,16 @@ class PostgreSQL:
         :param do_commit: Whether to commit the query.
         :return: The result of the query.
         """
-        conn = psycopg2.connect(**PostgreSQL.get_details())
-        cur = conn.cursor()
-        cur.execute(query, args)
-        if do_commit:
-            conn.commit()
-        result = cur.fetchall()
-        conn.close()
+        conn = connection_pool.for_details(PostgreSQL.get_details()).getconn()
+        try:
+            cur = conn.cursor()
+            cur.execute(query, args)
+            if do_commit:
+                conn.commit()
+            result = cur.fetchall()
+            cur.close()
+        finally:
+            conn.close()
         return result
 
     @staticmethod
@@ -529,6 +1578,10 @@ class PostgreSQL:
         var.set(key='db.postgres_password', value=details['postgres_password'])
         var.set(key='db.database', value=details['database'])
 
+        # Forget the cached credentials so the next connection uses the new ones.
+        PostgreSQL._details_cache = None
+        replica_router.forget_config()
+
     @staticmethod
     def start_db() -> bool:
         """
@@ -634,265 +1687,1111 @@ class PostgreSQL:
         })
 
         try:
-            PostgreSQL().grant_all_perms()
-        except subprocess.CalledProcessError as err:
-            logging.error('Could not grant all permissions to the user.', err)
-            return False
+            PostgreSQL.grant_all_perms()
+        except subprocess.CalledProcessError as err:
+            logging.error('Could not grant all permissions to the user.', err)
+            return False
+
+        var.set('db.external', False)
+
+        PostgreSQL.shared().modernize()
+
+        return True
+
+    @staticmethod
+    def grant_all_perms():
+        subprocess.run(
+            [
+                "docker", "exec", "-i", "raindrop-postgres",
+                "psql", "-U", "postgres",
+                "-c", "GRANT ALL PRIVILEGES ON DATABASE raindrop TO raindrop_api;"
+            ],
+            check=True,
+        )
+
+    @staticmethod
+    def get_details() -> dict:
+        """
+        Gets the connection details for the database. These are cached after the first call,
+        save_details() clears the cache.
+        """
+        if PostgreSQL._details_cache is None:
+            db_settings = var.get('db')
+            PostgreSQL._details_cache = {
+                'host': db_settings['host'],
+                'port': db_settings['port'],
+                'user': 'postgres',
+                'password': keys.decrypt(db_settings['postgres_password']),
+                'database': db_settings['database']
+            }
+        return dict(PostgreSQL._details_cache)
+
+    def modernize(self) -> list:
+        """
+        Brings the database schema up to date by applying any pending migrations (see library/migrations.py).
+        When the schema is already current this costs a single query.
+
+        :return: The migration versions that were applied.
+        """
+        return schema_migrator(self.get_connection).migrate()
+
+    def save_token(self, belongs_to, token):
+        """
+        Saves a token for a user in the database.
+
+        :param belongs_to: The username of the user the token belongs to.
+        :type belongs_to: str
+        :param token: The token to save.
+        :type token: str
+        :raises AssertionError: If the username or token is not a string.
+        """
+        assert type(belongs_to) is str, "The username must be a string."
+        assert type(token) is str, "The token must be a string."
+        # Check if the user exists
+        self.check_exists(belongs_to)
+
+        conn = self.get_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute(
+                """
+                INSERT INTO tokens (username, token)
+                VALUES (%s, %s)
+                ON CONFLICT (username) DO UPDATE SET token = EXCLUDED.token;
+                """,
+                (belongs_to, token)
+            )
+            conn.commit()
+        finally:
+            cur.close()
+            conn.close()
+
+    def get_token_owner(self, token):
+        """
+        Retrieves the username associated with a given token.
+
+        :param token: The token to look up.
+        :type token: str
+        :raises AssertionError: If the token is not a string.
+        :return: The username associated with the token.
+        :rtype: str
+        """
+        assert type(token) is str, "The token must be a string."
+        conn = self.get_connection()
+        cur = conn.cursor()
+        try:
+            prepared_statements.execute(conn, cur, 'rd_token_owner', (token,))
+            return cur.fetchone()[0]
+        finally:
+            cur.close()
+            conn.close()
+
+    def validate_token(self, token):
+        """
+        Validates if the provided token exists in the database.
+
+        :param token: The token to validate.
+        :type token: str
+        :raises AssertionError: If the token is not a string.
+        :return: True if the token is valid, False otherwise.
+        :rtype: bool
+        """
+        assert type(token) is str, "The token must be a string."
+        conn = self.get_connection()
+        cur = conn.cursor()
+        try:
+            prepared_statements.execute(conn, cur, 'rd_token_owner', (token,))
+            valid = cur.fetchone() is not None
+        finally:
+            cur.close()
+            conn.close()
+        return valid
+
+    def resolve_principal(self, token):
+        """
+        Works out who a token belongs to, whether they are an administrator and whether they are restricted,
+        all in one query.
+
+        :param token: The token to look up.
+        :type token: str
+        :return: A tuple of (username, is_admin, is_restricted), or None if the token is not valid.
+        :rtype: tuple | None
+        """
+        assert type(token) is str, "The token must be a string."
+        conn = self.get_connection()
+        cur = conn.cursor()
+        try:
+            prepared_statements.execute(conn, cur, 'rd_resolve_principal', (token,))
+            return cur.fetchone()
+        finally:
+            cur.close()
+            conn.close()
+
+    def _snapshot(self, cur, repo_owner: str, repo_name: str, view_private: bool, changeset_id: int = None):
+        """
+        :return: The repo_id of a repository and the root tree of one of its changesets, the head of its default
+        branch by default. The tree is None if the repository has no changesets yet, and both are None if there is
+        no such repository, or it is private and view_private is False.
+        :raises error.changeset_not_found: If the repository has no such changeset.
+        """
+        cur.execute(
+            'SELECT repo_id, private FROM repositories WHERE owner = %s AND name = %s;', (repo_owner, repo_name)
+        )
+        repo = cur.fetchone()
+        if repo is None or (repo[1] and not view_private):
+            return None, None
+        if changeset_id is None:
+            head = ref_store.get(cur, repo[0], ref_store.DEFAULT_BRANCH)
+            if head is None:
+                return repo[0], None
+            changeset_id = head[0]
+
+        cur.execute(
+            'SELECT tree_hash FROM changesets WHERE changeset_id = %s AND repo_id = %s;', (changeset_id, repo[0])
+        )
+        row = cur.fetchone()
+        if row is None or row[0] is None:
+            raise error.changeset_not_found(changeset_id)
+        return repo[0], row[0]
+
+    def _ref_head(self, cur, repo_owner: str, repo_name: str, view_private: bool, ref: str = None):
+        """
+        :return: The repo_id of a repository and the changeset a branch or tag of it is at, the default branch
+        by default. The changeset is None if the repository has no changesets yet, and both are None if there is
+        no such repository, or it is private and view_private is False.
+        :raises error.ref_not_found: If the repository has no such branch or tag.
+        """
+        repo_id = self._snapshot(cur, repo_owner, repo_name, view_private)[0]
+        if repo_id is None:
+            return None, None
+        if ref is None or ref == ref_store.DEFAULT_BRANCH:
+            head = ref_store.get(cur, repo_id, ref_store.DEFAULT_BRANCH)
+            return repo_id, head[0] if head is not None else None
+        return repo_id, ref_store.resolve(cur, repo_id, ref)
+
+    @staticmethod
+    def _blob_in_history(cur, repo_id: int, head: int | None, rel_file_path: str, version: tuple = None) -> str:
+        """
+        Finds the content of a file at a version, among the commits in the history of a changeset. Other branches
+        may have commits of the same file and version, which are not its.
+
+        :param version: The (major, minor, patch) version. Defaults to the file as the changeset has it.
+        :return: The blob hash.
+        :raises error.file_not_found: If the history has no such file, or not at that version.
+        """
+        if head is not None and version is None:
+            cur.execute('SELECT tree_hash FROM changesets WHERE changeset_id = %s;', (head,))
+            entry = tree_store.find(cur, cur.fetchone()[0], rel_file_path)
+            if entry is not None:
+                return entry[2]
+        elif head is not None:
+            cur.execute(
+                """
+                SELECT blob_hash, changeset_id
+                FROM commits
+                WHERE repo_id = %s AND rel_file_path = %s AND (version_major, version_minor, version_patch) = (%s, %s, %s)
+                ORDER BY commit_id DESC;
+                """,
+                (repo_id, rel_file_path, *version)
+            )
+            for blob_hash, changeset_id in cur.fetchall():
+                if commit_graph.is_ancestor(cur, changeset_id, head):
+                    return blob_hash
+        raise error.file_not_found(rel_file_path)
+
+    def snapshot_files(self, owner: str, repo_name: str, version: tuple = None, view_private=False,
+                       ref: str = None) -> list[dict] | None:
+        """
+        Lists the files of a branch or tag as they were at a version: each file at its newest version no later than
+        it, among the commits in the branch's history. Only what is needed to read them is listed, not their content.
+
+        :param version: The (major, minor, patch) version. Defaults to the files as the branch has them now.
+        :param ref: The branch or tag. Defaults to the default branch.
+        :return: path, blob_hash, size, version and commit_date of each file, in path order.
+        None if there is no such repository, or it is private and view_private is False.
+        :raises error.ref_not_found: If the repository has no such branch or tag.
+        """
+        conn = self.get_connection(readonly=True)
+        cur = conn.cursor()
+        try:
+            repo_id, head = self._ref_head(cur, owner, repo_name, view_private, ref)
+            if repo_id is None:
+                return None
+            if head is None:
+                return []
+            if version is None:
+                cur.execute('SELECT tree_hash FROM changesets WHERE changeset_id = %s;', (head,))
+                files = tree_store.walk(cur, cur.fetchone()[0])
+                cur.execute(
+                    """
+                    SELECT changed.rel_file_path, commits.blob_hash, blobs.size, commits.version_major,
+                        commits.version_minor, commits.version_patch, commits.commit_date
+                    FROM unnest(%s::TEXT[], %s::INTEGER[]) AS changed (rel_file_path, commit_id)
+                    JOIN commits ON commits.commit_id = changed.commit_id
+                    JOIN blobs ON blobs.hash = commits.blob_hash
+                    ORDER BY changed.rel_file_path;
+                    """,
+                    (list(files), [entry[3] for entry in files.values()])
+                )
+            else:
+                cur.execute(
+                    """
+                    SELECT DISTINCT ON (commits.rel_file_path)
+                        commits.rel_file_path, commits.blob_hash, blobs.size,
+                        commits.version_major, commits.version_minor, commits.version_patch, commits.commit_date
+                    FROM commits
+                    JOIN blobs ON blobs.hash = commits.blob_hash
+                    WHERE commits.repo_id = %s AND commits.changeset_id = ANY(%s)
+                    AND (version_major, version_minor, version_patch) <= (%s, %s, %s)
+                    ORDER BY commits.rel_file_path, version_major DESC, version_minor DESC, version_patch DESC,
+                        commits.commit_id DESC;
+                    """,
+                    (repo_id, commit_graph.log(cur, head), *version)
+                )
+            return [
+                {
+                    'path': rel_file_path,
+                    'blob_hash': blob_hash,
+                    'size': size,
+                    'version': (major, minor, patch),
+                    'commit_date': commit_date,
+                }
+                for rel_file_path, blob_hash, size, major, minor, patch, commit_date in cur.fetchall()
+            ]
+        finally:
+            cur.close()
+            conn.close()
+
+    def walk_repository(self, repo_name, repo_owner, view_private=False, changeset_id=None, ref=None):
+        """
+        Constructs a dictionary of all the files, their versions, their commit msg, and their relative paths.
+        The newest files of the default branch are read from repo_head_files, and those of any other changeset
+        from its tree, so the history is never read.
+        :param repo_name: The name of the repository.
+        :param repo_owner: The owner of the repository.
+        :param view_private: Whether to view private repositories.
+        :param changeset_id: The changeset to list the files as of. Defaults to the newest.
+        :param ref: The branch or tag to list the files of, instead of a changeset.
+        :return:
+        :raises error.ref_not_found: If the repository has no such branch or tag.
+        """
+        conn = self.get_connection(readonly=True)
+        cur = conn.cursor()
+        try:
+            if ref is not None and ref != ref_store.DEFAULT_BRANCH:
+                repo_id = self._snapshot(cur, repo_owner, repo_name, view_private)[0]
+                if repo_id is None:
+                    return {}
+                changeset_id = ref_store.resolve(cur, repo_id, ref)
+            if changeset_id is None:
+                cur.execute(
+                    f"""
+                    SELECT repo_head_files.rel_file_path, version_major, version_minor, version_patch, commit_message
+                    FROM repo_head_files
+                    JOIN repositories ON repositories.repo_id = repo_head_files.repo_id
+                    WHERE repositories.owner = %s AND repositories.name = %s
+                    {'' if view_private else 'AND repositories.private = FALSE'}
+                    ORDER BY repo_head_files.rel_file_path;
+                    """,
+                    (repo_owner, repo_name)
+                )
+                return {
+                    rel_file_path: {'version': [major, minor, patch], 'commit_msg': commit_message}
+                    for rel_file_path, major, minor, patch, commit_message in cur.fetchall()
+                }
+
+            root_hash = self._snapshot(cur, repo_owner, repo_name, view_private, changeset_id)[1]
+            if root_hash is None:
+                return {}
+            files = tree_store.walk(cur, root_hash)
+
+            cur.execute(
+                'SELECT commit_id, commit_message FROM commits WHERE commit_id = ANY(%s);',
+                ([entry[3] for entry in files.values()],)
+            )
+            messages = dict(cur.fetchall())
+        finally:
+            cur.close()
+            conn.close()
+
+        files_dict = {}
+        for rel_file_path in sorted(files):
+            entry = files[rel_file_path]
+            files_dict[rel_file_path] = {
+                'version': list(entry[4:7]),
+                'commit_msg': messages.get(entry[3])
+            }
+
+        return files_dict
+
+    def compare_changesets(self, repo_owner: str, repo_name: str, old_changeset: int, new_changeset: int,
+                           view_private=False) -> dict | None:
+        """
+        Finds the files that differ between two changesets of a repository. Folders that did not change
+        between them are skipped without being read.
+
+        :return: The added, removed and changed files, each with its path and old and/or new version and blob hash.
+        None if there is no such repository, or it is private and view_private is False.
+        :raises error.changeset_not_found: If the repository does not have one of the changesets.
+        """
+        conn = self.get_connection(readonly=True)
+        cur = conn.cursor()
+        try:
+            repo_id, old_root = self._snapshot(cur, repo_owner, repo_name, view_private, old_changeset)
+            if repo_id is None:
+                return None
+            new_root = self._snapshot(cur, repo_owner, repo_name, view_private, new_changeset)[1]
+            differences = tree_store.compare(cur, old_root, new_root)
+        finally:
+            cur.close()
+            conn.close()
+
+        def describe(entry):
+            return {'version': list(entry[4:7]), 'blob_hash': entry[2]} if entry is not None else None
+
+        comparison = {'added': [], 'removed': [], 'changed': []}
+        for rel_file_path in sorted(differences):
+            old, new = differences[rel_file_path]
+            kind = 'added' if old is None else 'removed' if new is None else 'changed'
+            comparison[kind].append({'path': rel_file_path, 'old': describe(old), 'new': describe(new)})
+        return comparison
+
+    def diff_file(self, repo_owner: str, repo_name: str, rel_file_path: str, old_version: tuple, new_version: tuple,
+                  view_private=False, context: int = 3, ref: str = None) -> dict:
+        """
+        Diffs two versions of a file.
+
+        :param old_version: The (major, minor, patch) version to diff from.
+        :param new_version: The (major, minor, patch) version to diff to.
+        :param ref: The branch or tag whose history the versions are from. Defaults to the default branch.
+        :return: The versions and blob hashes diffed, and the diff as diff_engine.diff() makes it.
+        :raises error.file_not_found: If the branch has no such file at one of the versions, or the repository
+        is private and view_private is False.
+        :raises error.ref_not_found: If the repository has no such branch or tag.
+        """
+        conn = self.get_connection(readonly=True)
+        cur = conn.cursor()
+        try:
+            repo_id, head = self._ref_head(cur, repo_owner, repo_name, view_private, ref)
+            if repo_id is None:
+                raise error.file_not_found(rel_file_path)
+            blob_hashes = [
+                self._blob_in_history(cur, repo_id, head, rel_file_path, version)
+                for version in (old_version, new_version)
+            ]
+
+            result = diff_engine.diff(cur, *blob_hashes, context=context)
+        finally:
+            cur.close()
+            conn.close()
+
+        return {
+            'path': rel_file_path,
+            'old': {'version': list(old_version), 'blob_hash': blob_hashes[0]},
+            'new': {'version': list(new_version), 'blob_hash': blob_hashes[1]},
+            **result
+        }
+
+    def diff_changesets(self, repo_owner: str, repo_name: str, old_changeset: int, new_changeset: int,
+                        view_private=False, context: int = 3) -> list | None:
+        """
+        Diffs every file that differs between two changesets of a repository.
+
+        :return: Each file in path order, with its status ('added', 'removed' or 'changed'), its old and new version
+        and blob hash as compare_changesets() gives them, and the diff as diff_engine.diff() makes it.
+        None if there is no such repository, or it is private and view_private is False.
+        :raises error.changeset_not_found: If the repository does not have one of the changesets.
+        """
+        comparison = self.compare_changesets(repo_owner, repo_name, old_changeset, new_changeset, view_private)
+        if comparison is None:
+            return None
+
+        files = []
+        conn = self.get_connection(readonly=True)
+        cur = conn.cursor()
+        try:
+            for status in ('added', 'removed', 'changed'):
+                for file in comparison[status]:
+                    result = diff_engine.diff(
+                        cur,
+                        file['old']['blob_hash'] if file['old'] else None,
+                        file['new']['blob_hash'] if file['new'] else None,
+                        context=context
+                    )
+                    files.append({'status': status, **file, **result})
+        finally:
+            cur.close()
+            conn.close()
+
+        files.sort(key=lambda file: file['path'])
+        return files
+
+    @staticmethod
+    def advance_branch(cur, repo_id: int, changeset_id: int, changes: dict, branch: str = ref_store.DEFAULT_BRANCH,
+                       expected=ref_store.ANY) -> str:
+        """
+        Builds the tree of a new changeset from the head of a branch, then moves the branch to it with
+        a compare-and-swap. Call it in the transaction that adds the changeset's commits.
+        Only the branch's row is written, so commits to other branches of the repository do not wait for this one.
+
+        :param changes: Path: (blob hash, commit_id, (major, minor, patch)) of each file the changeset sets.
+        :param branch: The branch to commit to. Only the default branch is made if it does not exist yet.
+        :param expected: The changeset the branch must still be at. By default, the changeset is built on whatever
+        the branch is at, and built again on the new head if another commit moves the branch first.
+        :return: The hash of the changeset's root tree.
+        :raises error.ref_conflict: If the branch is not at expected, or is a tag.
+        :raises error.ref_not_found: If there is no such branch.
+        """
+        for attempt in range(PostgreSQL.MAX_REF_RETRIES):
+            ref = ref_store.get(cur, repo_id, branch)
+            if ref is None and branch != ref_store.DEFAULT_BRANCH:
+                raise error.ref_not_found(branch)
+            if ref is not None and ref[1] != 'branch':
+                raise error.ref_conflict(branch, ref[0])
+            base = ref[0] if ref is not None else None
+            if expected is not ref_store.ANY and base != expected:
+                raise error.ref_conflict(branch, base)
+
+            root_hash = None
+            if base is not None:
+                cur.execute('SELECT tree_hash FROM changesets WHERE changeset_id = %s;', (base,))
+                root_hash = cur.fetchone()[0]
+            root_hash = tree_store.update(cur, root_hash, changes)
+            cur.execute(
+                'UPDATE changesets SET tree_hash = %s, parent_id = %s WHERE changeset_id = %s;',
+                (root_hash, base, changeset_id)
+            )
+            if ref_store.compare_and_swap(cur, repo_id, branch, base, changeset_id):
+                break
+            if expected is not ref_store.ANY:
+                raise error.ref_conflict(branch, ref_store.get(cur, repo_id, branch)[0])
+            logging.info(f"Branch {branch} of repository {repo_id} moved while committing to it. Trying again.")
+        else:
+            raise error.ref_conflict(branch, ref_store.get(cur, repo_id, branch)[0])
+
+        commit_graph.add(cur, repo_id, changeset_id, [base] if base is not None else [])
+        if branch == ref_store.DEFAULT_BRANCH:
+            PostgreSQL._update_head_files(cur, repo_id, changes)
+        return root_hash
+
+    def list_refs(self, repo_owner: str, repo_name: str, view_private=False) -> list | None:
+        """
+        :return: The branches and tags of a repository, with the changeset each is at. None if there is no such
+        repository, or it is private and view_private is False.
+        """
+        conn = self.get_connection(readonly=True)
+        cur = conn.cursor()
+        try:
+            repo_id = self._snapshot(cur, repo_owner, repo_name, view_private)[0]
+            if repo_id is None:
+                return None
+            return ref_store.list_all(cur, repo_id)
+        finally:
+            cur.close()
+            conn.close()
+
+    def update_ref(self, repo_owner: str, repo_name: str, name: str, changeset_id: int, expected: int | None,
+                   kind='branch'):
+        """
+        Makes a branch or tag, or moves a branch, if it is still where the caller expects. Moving the default
+        branch, even back in its history, also updates the newest files and the code search index to match.
+
+        :param changeset_id: The changeset of the repository to point it at.
+        :param expected: The changeset it must be at now, or None to make it, in which case it must not exist yet.
+        :param kind: 'branch' or 'tag', for a new ref.
+        :raises ValueError: If the name or kind is not valid.
+        :raises error.ref_conflict: If it is not at expected, or is a tag, which can not be moved.
+        :raises error.changeset_not_found: If the repository has no such changeset.
+        :raises error.repository_not_found: If the owner has no such repository.
+        """
+        ref_store.check_name(name)
+        if kind not in ref_store.KINDS:
+            raise ValueError(f"kind must be one of {', '.join(ref_store.KINDS)}")
+
+        conn = self.get_connection()
+        cur = conn.cursor()
+        try:
+            repo_id = self._snapshot(cur, repo_owner, repo_name, view_private=True)[0]
+            if repo_id is None:
+                raise error.repository_not_found(repo_name)
+            cur.execute(
+                'SELECT 1 FROM changesets WHERE changeset_id = %s AND repo_id = %s;', (changeset_id, repo_id)
+            )
+            if cur.fetchone() is None:
+                raise error.changeset_not_found(changeset_id)
+            if not ref_store.compare_and_swap(cur, repo_id, name, expected, changeset_id, kind):
+                current = ref_store.get(cur, repo_id, name)
+                raise error.ref_conflict(name, current[0] if current is not None else None)
+            if name == ref_store.DEFAULT_BRANCH and expected != changeset_id:
+                cur.execute(
+                    'SELECT changeset_id, tree_hash FROM changesets WHERE changeset_id = ANY(%s);',
+                    ([changeset for changeset in (expected, changeset_id) if changeset is not None],)
+                )
+                roots = dict(cur.fetchall())
+                PostgreSQL._move_head_files(
+                    cur, repo_id, roots[expected] if expected is not None else tree_store.empty(cur), roots[changeset_id]
+                )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            conn.close()
+        read_cache.invalidate_repository(repo_owner, repo_name)
+
+    def delete_ref(self, repo_owner: str, repo_name: str, name: str, expected: int):
+        """
+        Deletes a branch or tag, if it is still at expected. The default branch can not be deleted.
+
+        :raises ValueError: If it is the default branch.
+        :raises error.ref_conflict: If it is not at expected.
+        :raises error.ref_not_found: If there is no such branch or tag.
+        :raises error.repository_not_found: If the owner has no such repository.
+        """
+        if name == ref_store.DEFAULT_BRANCH:
+            raise ValueError(f"the {ref_store.DEFAULT_BRANCH} branch can not be deleted")
+
+        conn = self.get_connection()
+        cur = conn.cursor()
+        try:
+            repo_id = self._snapshot(cur, repo_owner, repo_name, view_private=True)[0]
+            if repo_id is None:
+                raise error.repository_not_found(repo_name)
+            if not ref_store.delete(cur, repo_id, name, expected):
+                raise error.ref_conflict(name, ref_store.resolve(cur, repo_id, name))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            conn.close()
+        read_cache.invalidate_repository(repo_owner, repo_name)
+
+    def merge_branches(self, repo_owner: str, repo_name: str, source: str, target: str, author: str,
+                       commit_message: str = None, dry_run=False) -> dict:
+        """
+        Merges a branch or tag into a branch. If the target is behind the source, it is moved up to it.
+        Otherwise a merge changeset is made on the target, whose parents are the two heads. Files only one side
+        changed are taken from that side as they are, and only files both sides changed are merged line by line,
+        each as a new commit.
+
+        :param source: The branch or tag to merge.
+        :param target: The branch to merge it into.
+        :param dry_run: If True, nothing is changed, and the conflicts are returned rather than raised.
+        :return: The merge base, the changeset the target is at after the merge (None on a dry run that would
+        make one), whether it was a fast-forward, and the conflicts (empty unless dry_run).
+        :raises ValueError: If source and target are the same.
+        :raises error.merge_conflict: If both sides changed a file in a way that can not be merged.
+        :raises error.ref_not_found: If there is no such branch or tag.
+        :raises error.ref_conflict: If the target is a tag, or kept moving while the merge was being made.
+        :raises error.repository_not_found: If the owner has no such repository.
+        """
+        if source == target:
+            raise ValueError("a branch can not be merged into itself")
+        self.check_exists(author)
+
+        conn = self.get_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute('SELECT repo_id FROM repositories WHERE owner = %s AND name = %s;', (repo_owner, repo_name))
+            repo = cur.fetchone()
+            if repo is None:
+                raise error.repository_not_found(repo_name)
+            repo_id = repo[0]
+
+            for attempt in range(PostgreSQL.MAX_REF_RETRIES):
+                target_ref = ref_store.get(cur, repo_id, target)
+                if target_ref is None:
+                    raise error.ref_not_found(target)
+                if target_ref[1] != 'branch':
+                    raise error.ref_conflict(target, target_ref[0])
+                ours, theirs = target_ref[0], ref_store.resolve(cur, repo_id, source)
+                base = commit_graph.merge_base(cur, ours, theirs)
+                result = {'base': base, 'changeset_id': ours, 'fast_forward': False, 'conflicts': []}
+                if base == theirs:
+                    # Already merged.
+                    return result
+
+                cur.execute(
+                    'SELECT changeset_id, tree_hash FROM changesets WHERE changeset_id = ANY(%s);',
+                    ([changeset for changeset in (base, ours, theirs) if changeset is not None],)
+                )
+                roots = dict(cur.fetchall())
+                if base == ours:
+                    result.update(changeset_id=theirs, fast_forward=True)
+                    if dry_run:
+                        return result
+                    merged_root, changeset_id = roots[theirs], theirs
+                else:
+                    merged_root, merged_files, conflicts = merge_engine.merge_trees(
+                        cur, roots.get(base), roots[ours], roots[theirs]
+                    )
+                    if dry_run:
+                        result.update(changeset_id=None, conflicts=conflicts)
+                        return result
+                    if conflicts:
+                        raise error.merge_conflict(source, target, conflicts)
+
+                    cur.execute(
+                        """
+                        INSERT INTO changesets (repo_id, author, message, parent_id, merge_parent_id)
+                        VALUES (%s, %s, %s, %s, %s)
+                        RETURNING changeset_id;
+                        """,
+                        (repo_id, author, commit_message or f"Merge {source} into {target}", ours, theirs)
+                    )
+                    changeset_id = cur.fetchone()[0]
+                    changes = {}
+                    for rel_file_path, (content, version) in merged_files.items():
+                        blob_hash = blob_store.put(cur, content, repo_id)
+                        cur.execute(
+                            """
+                            INSERT INTO commits (
+                                repo_id, author, version_major, version_minor, version_patch, rel_file_path, blob_hash,
+                                commit_message, changeset_id
+                            )
+                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                            RETURNING commit_id;
+                            """,
+                            (
+                                repo_id, author, *version, rel_file_path, blob_hash,
+                                commit_message or f"Merge {source} into {target}", changeset_id
+                            )
+                        )
+                        changes[rel_file_path] = (blob_hash, cur.fetchone()[0], version)
+                    PostgreSQL.count_commits(cur, author, len(changes))
+                    PostgreSQL.add_storage_usage(
+                        cur, repo_id, repo_owner, sum(len(content) for content, _ in merged_files.values()),
+                        len(changes)
+                    )
+                    merged_root = tree_store.update(cur, merged_root, changes, only_newer=False)
+                    cur.execute(
+                        'UPDATE changesets SET tree_hash = %s WHERE changeset_id = %s;', (merged_root, changeset_id)
+                    )
+                    commit_graph.add(cur, repo_id, changeset_id, [ours, theirs])
+
+                if ref_store.compare_and_swap(cur, repo_id, target, ours, changeset_id):
+                    break
+                # The target moved while merging, so merge into where it is now.
+                conn.rollback()
+                logging.info(f"Branch {target} of repository {repo_id} moved while merging into it. Trying again.")
+            else:
+                raise error.ref_conflict(target, ref_store.resolve(cur, repo_id, target))
+
+            if target == ref_store.DEFAULT_BRANCH:
+                PostgreSQL._move_head_files(cur, repo_id, roots[ours], merged_root)
+            conn.commit()
+            self.touch_repository(cur, repo_id)
+            conn.commit()
+        finally:
+            cur.close()
+            conn.close()
+        read_cache.invalidate_repository(repo_owner, repo_name)
+        result['changeset_id'] = changeset_id
+        return result
+
+    def changeset_log(self, repo_owner: str, repo_name: str, ref: str = None, changeset_id: int = None,
+                      since: int = None, limit: int = 50, view_private=False) -> list | None:
+        """
+        Lists the history of a branch, tag or changeset, newest first. Only as much of the history as is listed
+        is read, from the commit graph.
+
+        :param ref: The branch or tag to list the history of. Defaults to the default branch.
+        :param changeset_id: The changeset to list the history of, instead of a ref.
+        :param since: A changeset whose own history is left out, to only list what came after it.
+        :param limit: The most changesets to list.
+        :return: The changeset_id, parents, author, message and created_on of each changeset. None if there is no
+        such repository, or it is private and view_private is False.
+        :raises error.ref_not_found: If there is no such branch or tag.
+        :raises error.changeset_not_found: If the repository does not have changeset_id or since.
+        """
+        conn = self.get_connection(readonly=True)
+        cur = conn.cursor()
+        try:
+            repo_id = self._snapshot(cur, repo_owner, repo_name, view_private)[0]
+            if repo_id is None:
+                return None
+            if changeset_id is None:
+                if ref is None and ref_store.get(cur, repo_id, ref_store.DEFAULT_BRANCH) is None:
+                    # Nothing has been committed yet.
+                    return []
+                changeset_id = ref_store.resolve(cur, repo_id, ref or ref_store.DEFAULT_BRANCH)
+
+            wanted = [changeset for changeset in (changeset_id, since) if changeset is not None]
+            cur.execute(
+                'SELECT changeset_id FROM changesets WHERE changeset_id = ANY(%s) AND repo_id = %s;', (wanted, repo_id)
+            )
+            found = {row[0] for row in cur.fetchall()}
+            for changeset in wanted:
+                if changeset not in found:
+                    raise error.changeset_not_found(changeset)
+
+            history = commit_graph.log(cur, changeset_id, since, limit)
+            cur.execute(
+                'SELECT changeset_id, author, message, created_on FROM changesets WHERE changeset_id = ANY(%s);',
+                (history,)
+            )
+            details = {row[0]: row[1:] for row in cur.fetchall()}
+            nodes = commit_graph.get_many(cur, history)
+        finally:
+            cur.close()
+            conn.close()
+
+        return [
+            {
+                'changeset_id': changeset,
+                'parents': list(nodes[changeset][0]),
+                'author': details[changeset][0],
+                'message': details[changeset][1],
+                'created_on': details[changeset][2],
+            }
+            for changeset in history
+        ]
+
+    def is_ancestor(self, repo_owner: str, repo_name: str, ancestor: int, descendant: int,
+                    view_private=False) -> bool | None:
+        """
+        :return: Whether descendant is ancestor, or descends from it. None if there is no such repository,
+        or it is private and view_private is False.
+        :raises error.changeset_not_found: If the repository does not have one of the changesets.
+        """
+        conn = self.get_connection(readonly=True)
+        cur = conn.cursor()
+        try:
+            repo_id = self._snapshot(cur, repo_owner, repo_name, view_private)[0]
+            if repo_id is None:
+                return None
+            cur.execute(
+                'SELECT changeset_id FROM changesets WHERE changeset_id = ANY(%s) AND repo_id = %s;',
+                ([ancestor, descendant], repo_id)
+            )
+            found = {row[0] for row in cur.fetchall()}
+            for changeset in (ancestor, descendant):
+                if changeset not in found:
+                    raise error.changeset_not_found(changeset)
+            return commit_graph.is_ancestor(cur, ancestor, descendant)
+        finally:
+            cur.close()
+            conn.close()
+
+    def search_code(self, query: str, regex=False, ignore_case=False, username: str = None, repo_owner: str = None,
+                    repo_name: str = None, limit: int = 50) -> dict:
+        """
+        Searches the newest version of the files of the public repositories, and username's private ones.
+        See code_search.search().
+
+        :raises ValueError: If the query can not be searched for. The message says why.
+        """
+        conn = self.get_connection(readonly=True)
+        cur = conn.cursor()
+        try:
+            return code_search.search(cur, query, regex, ignore_case, username, repo_owner, repo_name, limit)
+        finally:
+            cur.close()
+            conn.close()
 
-        var.set('db.external', False)
+    @staticmethod
+    def count_commits(cur, author: str, commits: int = 1):
+        """
+        Adds commits to today's count of the author's commits, for the commits chart. Call it in the transaction
+        that makes them.
+
+        As with add_storage_usage(), the count is spread over USAGE_SLOTS rows and each connection adds to its own,
+        so an author's pushes to different repositories do not wait on each other. The count is the sum of the rows.
+        """
+        if commits == 0:
+            return
+        cur.execute(
+            """
+            INSERT INTO commit_activity (username, day, slot, commits)
+            VALUES (%s, CURRENT_DATE, pg_backend_pid() %% %s, %s)
+            ON CONFLICT (username, day, slot) DO UPDATE SET commits = commit_activity.commits + EXCLUDED.commits;
+            """,
+            (author, PostgreSQL.USAGE_SLOTS, commits)
+        )
 
-        PostgreSQL().modernize()
+    def commit_activity(self, username: str, start: datetime.date, end: datetime.date) -> dict:
+        """
+        Reads the number of commits made each day, from the daily counts rather than the commits themselves.
 
-        return True
+        :param username: The user whose commits to count, or '*' for everyone's.
+        :param start: The first day to count, and end the last.
+        :return: The number of commits of each day that had any, by day.
+        """
+        conn = self.get_connection(readonly=True)
+        cur = conn.cursor()
+        try:
+            if username == '*':
+                cur.execute(
+                    'SELECT day, SUM(commits) FROM commit_activity WHERE day BETWEEN %s AND %s GROUP BY day;',
+                    (start, end)
+                )
+            else:
+                cur.execute(
+                    """
+                    SELECT day, SUM(commits)
+                    FROM commit_activity
+                    WHERE username = %s AND day BETWEEN %s AND %s
+                    GROUP BY day;
+                    """,
+                    (username, start, end)
+                )
+            return {day: int(commits) for day, commits in cur.fetchall() if commits}
+        finally:
+            cur.close()
+            conn.close()
 
     @staticmethod
-    def grant_all_perms():
-        subprocess.run(
-            [
-                "docker", "exec", "-i", "raindrop-postgres",
-                "psql", "-U", "postgres",
-                "-c", "GRANT ALL PRIVILEGES ON DATABASE raindrop TO raindrop_api;"
-            ],
-            check=True,
+    def check_quota(cur, username: str, needed: int, lock=False):
+        """
+        Checks that a user has room under their storage quota, if they have one, for more file content.
+
+        :param needed: How many bytes of content are to be added.
+        :param lock: Whether to lock the user's quota until the transaction ends, so that two pushes can not
+        both fit under it. Users with no quota are never locked.
+        :raises error.quota_exceeded: If there is not room.
+        """
+        cur.execute(
+            f"""
+            SELECT storage_quota
+            FROM accounts
+            WHERE username = %s AND storage_quota IS NOT NULL{' FOR NO KEY UPDATE' if lock else ''};
+            """,
+            (username,)
         )
+        row = cur.fetchone()
+        if row is None:
+            return
+        used = PostgreSQL._storage_used(cur, username)[0]
+        if used + needed > row[0]:
+            raise error.quota_exceeded(username, row[0], used, needed)
 
     @staticmethod
-    def get_details() -> dict:
-        return {
-            'host': var.get('db.host'),
-            'port': var.get('db.port'),
-            'user': 'postgres',
-            'password': keys.decrypt(var.get('db.postgres_password')),
-            'database': var.get('db.database')
-        }
+    def add_storage_usage(cur, repo_id: int, owner: str, added_bytes: int, added_files: int):
+        """
+        Adds new file versions to the storage a repository uses, after checking they fit under its owner's quota.
+        Call it in the transaction that commits them.
 
-    def modernize(self):
-        # Fetch a database connection
-        conn = self.get_connection()
-        cur = conn.cursor()
+        The usage of a repository is spread over USAGE_SLOTS rows, and each connection adds to its own, so
+        pushes to different branches of a repository do not wait on each other for one row. The total is the
+        sum of the rows. Rows go with the repository when it is deleted.
 
-        # Using this dict, it formats the SQL query to create the tables if they don't exist
-        table_dict = {
-            'tokens': {
-                'username': 'TEXT NOT NULL UNIQUE PRIMARY KEY',
-                'token': 'TEXT NOT NULL UNIQUE'
-            },
-            'accounts': {
-                'user_id': 'SERIAL PRIMARY KEY',
-                'registered_on': 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP',
-                'username': 'TEXT NOT NULL UNIQUE',
-                'password': 'TEXT NOT NULL',
-                'restricted': 'BOOLEAN DEFAULT FALSE',
-                'bio': 'TEXT DEFAULT \'Feeling new? Make a bio!\'',
-            },
-            # The docker containers a user has
-            'user_containers': {
-                'container_id': 'TEXT PRIMARY KEY',
-                'owner': 'TEXT NOT NULL REFERENCES accounts(username)',
-            },
-            'repositories': {
-                'repo_id': 'SERIAL PRIMARY KEY',
-                'owner': 'TEXT NOT NULL REFERENCES accounts(username)',
-                'name': 'TEXT NOT NULL',
-                'description': 'TEXT',
-                'private': 'BOOLEAN DEFAULT FALSE',
-                'created_on': 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP',
-                'last_updated': 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP',
-            },
-            'user_permissions': {
-                'username': 'TEXT NOT NULL REFERENCES accounts(username)',
-                'administrator': 'BOOLEAN DEFAULT FALSE',
-            },
-            # The full file is stored in the commits table
-            'commits': {
-                'commit_id': 'SERIAL PRIMARY KEY',
-                'repo_id': 'INTEGER NOT NULL REFERENCES repositories(repo_id)',
-                'author': 'TEXT NOT NULL REFERENCES accounts(username)',
-                'version_major': 'INTEGER NOT NULL',
-                'version_minor': 'INTEGER NOT NULL',
-                'version_patch': 'INTEGER NOT NULL',
-                'rel_file_path': 'TEXT NOT NULL',  # The relative file path. Eg, '/folder/file.txt' or '/file.txt'
-                'file_data': 'TEXT NOT NULL',  # Base64 encoded file data
-                'commit_message': 'TEXT NOT NULL DEFAULT \'No message provided\'',
-                'commit_date': 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP',
-            }
-        }
+        The owner's usage is kept the same way in user_usage, so a quota is checked against a few rows however
+        many repositories they have. Deleting a repository takes its usage back out of its owner's. The
+        repository's row is key share locked until the transaction ends, so that a delete_repository() waits for
+        the push to finish and takes all of its usage back out, rather than missing what is added while it runs.
+        Pushes do not wait on each other for the lock.
 
-        PostgreSQL.grant_all_perms()
-
-        for table_name, columns in table_dict.items():
-            # Check if the table exists
-            cur.execute('''
-                SELECT EXISTS (
-                    SELECT 1
-                    FROM information_schema.tables
-                    WHERE table_name = %s
-                );
-            ''', (table_name,))
-            table_exist = cur.fetchone()[0]
-
-            # If the table exists, check and update columns
-            if table_exist:
-                for column_name, column_properties in columns.items():
-                    # Check if the column exists
-                    cur.execute('''
-                        SELECT EXISTS (
-                            SELECT 1
-                            FROM information_schema.columns
-                            WHERE table_name = %s AND column_name = %s
-                        );
-                    ''', (table_name, column_name))
-                    column_exist = cur.fetchone()[0]
-
-                    # If the column doesn't exist, add it
-                    if not column_exist:
-                        cur.execute(f'ALTER TABLE {table_name} ADD COLUMN {column_name} {column_properties};')
-
-            # If the table doesn't exist, create it with columns
-            else:
-                columns_str = ', '.join(
-                    [f'{column_name} {column_properties}' for column_name, column_properties in columns.items()]
-                )
-                try:
-                    cur.execute(f'CREATE TABLE {table_name} ({columns_str});')
-                except psycopg2.errors.DuplicateTable:
-                    continue
-                except psycopg2.errors.SyntaxError:
-                    logging.info(f"Could not create table '{table_name}'. Query:\n"
-                                 f"{f'CREATE TABLE {table_name} ({columns_str});'}")
-                    exit(1)
-                except psycopg2.errors.InsufficientPrivilege:
-                    logging.info("Insufficient privileges to create the table. Exiting.")
+        :raises error.quota_exceeded: If they do not fit.
+        :raises error.repository_not_found: If the repository has been deleted.
+        """
+        cur.execute('SELECT repo_id FROM repositories WHERE repo_id = %s FOR KEY SHARE;', (repo_id,))
+        if cur.fetchone() is None:
+            raise error.repository_not_found(str(repo_id))
+        if added_bytes > 0:
+            PostgreSQL.check_quota(cur, owner, added_bytes, lock=True)
+        cur.execute(
+            """
+            INSERT INTO repository_usage (repo_id, slot, bytes, files)
+            VALUES (%s, pg_backend_pid() %% %s, %s, %s)
+            ON CONFLICT (repo_id, slot) DO UPDATE SET
+                bytes = repository_usage.bytes + EXCLUDED.bytes,
+                files = repository_usage.files + EXCLUDED.files;
+            """,
+            (repo_id, PostgreSQL.USAGE_SLOTS, added_bytes, added_files)
+        )
+        cur.execute(
+            """
+            INSERT INTO user_usage (username, slot, bytes, files)
+            VALUES (%s, pg_backend_pid() %% %s, %s, %s)
+            ON CONFLICT (username, slot) DO UPDATE SET
+                bytes = user_usage.bytes + EXCLUDED.bytes,
+                files = user_usage.files + EXCLUDED.files;
+            """,
+            (owner, PostgreSQL.USAGE_SLOTS, added_bytes, added_files)
+        )
 
-        # Commit the changes
-        conn.commit()
+    @staticmethod
+    def _storage_used(cur, username: str) -> tuple[int, int]:
+        cur.execute(
+            """
+            SELECT COALESCE(SUM(bytes), 0)::BIGINT, COALESCE(SUM(files), 0)::BIGINT
+            FROM user_usage
+            WHERE username = %s;
+            """,
+            (username,)
+        )
+        return cur.fetchone()
 
-    def save_token(self, belongs_to, token):
+    def storage_usage(self, username: str) -> dict:
         """
-        Saves a token for a user in the database.
-
-        :param belongs_to: The username of the user the token belongs to.
-        :type belongs_to: str
-        :param token: The token to save.
-        :type token: str
-        :raises AssertionError: If the username or token is not a string.
+        :return: The bytes and number of file versions the user's repositories store, and the user's quota in
+        bytes, or None if they have none. Every version of every file counts, as pushed.
         """
-        assert type(belongs_to) is str, "The username must be a string."
-        assert type(token) is str, "The token must be a string."
-        # Check if the user exists
-        self.check_exists(belongs_to)
-
-        conn = self.get_connection()
+        self.check_exists(username)
+        conn = self.get_connection(readonly=True)
         cur = conn.cursor()
         try:
-            cur.execute(
-                """
-                INSERT INTO tokens (username, token)
-                VALUES (%s, %s)
-                ON CONFLICT (username) DO UPDATE SET token = EXCLUDED.token;
-                """,
-                (belongs_to, token)
-            )
-            conn.commit()
+            stored_bytes, stored_files = self._storage_used(cur, username)
+            cur.execute('SELECT storage_quota FROM accounts WHERE username = %s;', (username,))
+            return {'stored_bytes': stored_bytes, 'stored_files': stored_files, 'quota': cur.fetchone()[0]}
         finally:
             cur.close()
             conn.close()
 
-    def get_token_owner(self, token):
+    def set_storage_quota(self, username: str, quota: int | None):
         """
-        Retrieves the username associated with a given token.
-
-        :param token: The token to look up.
-        :type token: str
-        :raises AssertionError: If the token is not a string.
-        :return: The username associated with the token.
-        :rtype: str
+        :param quota: The most bytes of file content the user's repositories may store, or None for no limit.
+        Lowering it below what they already use only stops further pushes.
         """
-        assert type(token) is str, "The token must be a string."
+        assert quota is None or (isinstance(quota, int) and quota >= 0), "The quota must be a number of bytes."
+        self.check_exists(username)
         conn = self.get_connection()
         cur = conn.cursor()
         try:
-            cur.execute(
-                """
-                SELECT username
-                FROM tokens
-                WHERE token = %s;
-                """,
-                (token,)
-            )
-            return cur.fetchone()[0]
+            cur.execute('UPDATE accounts SET storage_quota = %s WHERE username = %s;', (quota, username))
+            conn.commit()
         finally:
             cur.close()
             conn.close()
 
-    def validate_token(self, token):
+    @staticmethod
+    def touch_repository(cur, repo_id: int):
         """
-        Validates if the provided token exists in the database.
+        Marks a repository as updated, which also has it repacked. Run it in a transaction of its own, after
+        the commit, so commits to the repository's branches never wait on each other for its row.
+        """
+        cur.execute('UPDATE repositories SET last_updated = CURRENT_TIMESTAMP WHERE repo_id = %s;', (repo_id,))
 
-        :param token: The token to validate.
-        :type token: str
-        :raises AssertionError: If the token is not a string.
-        :return: True if the token is valid, False otherwise.
-        :rtype: bool
+    @staticmethod
+    def _update_head_files(cur, repo_id: int, changes: dict, only_newer=True):
+        """
+        Brings repo_head_files up to date with the changes advance_branch() made to the default branch.
+        New content is indexed for code search.
+
+        :param only_newer: If True, like the tree, a file already at a later version than its change keeps its row.
+        """
+        removed = [rel_file_path for rel_file_path, change in changes.items() if change is None]
+        if removed:
+            cur.execute(
+                'DELETE FROM repo_head_files WHERE repo_id = %s AND rel_file_path = ANY(%s);', (repo_id, removed)
+            )
+        changed = [(rel_file_path, change[1]) for rel_file_path, change in changes.items() if change is not None]
+        if not changed:
+            return
+        cur.execute(
+            f"""
+            INSERT INTO repo_head_files (
+                repo_id, rel_file_path, version_major, version_minor, version_patch, commit_id, blob_hash, size,
+                commit_message, commit_date
+            )
+            SELECT commits.repo_id, changed.rel_file_path, commits.version_major, commits.version_minor,
+                commits.version_patch, commits.commit_id, commits.blob_hash, blobs.size, commits.commit_message,
+                commits.commit_date
+            FROM unnest(%s::TEXT[], %s::INTEGER[]) AS changed (rel_file_path, commit_id)
+            JOIN commits ON commits.commit_id = changed.commit_id
+            JOIN blobs ON blobs.hash = commits.blob_hash
+            ON CONFLICT (repo_id, rel_file_path) DO UPDATE SET
+                version_major = EXCLUDED.version_major,
+                version_minor = EXCLUDED.version_minor,
+                version_patch = EXCLUDED.version_patch,
+                commit_id = EXCLUDED.commit_id,
+                blob_hash = EXCLUDED.blob_hash,
+                size = EXCLUDED.size,
+                commit_message = EXCLUDED.commit_message,
+                commit_date = EXCLUDED.commit_date
+            {'''WHERE (EXCLUDED.version_major, EXCLUDED.version_minor, EXCLUDED.version_patch)
+                >= (repo_head_files.version_major, repo_head_files.version_minor, repo_head_files.version_patch)'''
+             if only_newer else ''};
+            """,
+            ([rel_file_path for rel_file_path, _ in changed], [commit_id for _, commit_id in changed])
+        )
+        code_search.index_blobs(cur, [change[0] for change in changes.values() if change is not None])
+
+    @staticmethod
+    def _move_head_files(cur, repo_id: int, old_root: str, new_root: str):
+        """
+        Brings repo_head_files up to date with the default branch moving from one snapshot to another, which need
+        not be newer. Only the files that differ between them are written.
+        """
+        PostgreSQL._update_head_files(cur, repo_id, {
+            rel_file_path: (new[2], new[3], tuple(new[4:7])) if new is not None else None
+            for rel_file_path, (old, new) in tree_store.compare(cur, old_root, new_root).items()
+        }, only_newer=False)
+
+    def rebuild_head_files(self, repo_id: int = None) -> int:
+        """
+        Recomputes repo_head_files from the tree of each repository's default branch, for when it is thought
+        to be wrong.
+
+        :param repo_id: The repository to rebuild the rows of. Defaults to every repository.
+        :return: How many rows there are now.
         """
-        assert type(token) is str, "The token must be a string."
         conn = self.get_connection()
         cur = conn.cursor()
         try:
+            args = () if repo_id is None else (repo_id,)
+            cur.execute(f'DELETE FROM repo_head_files{"" if repo_id is None else " WHERE repo_id = %s"};', args)
             cur.execute(
-                """
-                SELECT username
-                FROM tokens
-                WHERE token = %s;
+                f"""
+                SELECT refs.repo_id, changesets.tree_hash
+                FROM refs
+                JOIN changesets ON changesets.changeset_id = refs.changeset_id
+                WHERE refs.name = %s{'' if repo_id is None else ' AND refs.repo_id = %s'};
                 """,
-                (token,)
+                (ref_store.DEFAULT_BRANCH, *args)
             )
-            valid = cur.fetchone() is not None
+            rows = 0
+            for head_repo_id, root_hash in cur.fetchall():
+                files = tree_store.walk(cur, root_hash)
+                PostgreSQL._update_head_files(
+                    cur, head_repo_id, {path: (entry[2], entry[3], tuple(entry[4:7])) for path, entry in files.items()}
+                )
+                rows += len(files)
+            conn.commit()
+            return rows
+        except Exception:
+            conn.rollback()
+            raise
         finally:
             cur.close()
             conn.close()
-        return valid
 
-    def walk_repository(self, repo_name, repo_owner, view_private=False):
+    def rebuild_search_index(self, batch_size: int = 500) -> int:
         """
-        Constructs a dictionary of all the files, their versions, their commit msg, and their relative paths.
-        :param repo_name: The name of the repository.
-        :param repo_owner: The owner of the repository.
-        :param view_private: Whether to view private repositories.
-        :return:
+        Indexes the newest version of each file for code search where it is not indexed yet, such as content
+        pushed before there was code search. Each batch is committed as it is done.
+
+        :return: How many blobs were indexed.
         """
         conn = self.get_connection()
         cur = conn.cursor()
         try:
-            cur.execute(
-                f"""
-                SELECT version_major, version_minor, version_patch, rel_file_path, commit_message
-                FROM commits
-                WHERE repo_id = (
-                    SELECT repo_id
-                    FROM repositories
-                    WHERE name = %s AND owner = %s{';' if view_private else ' AND private = FALSE;'}
-                );
-                """,
-                (repo_name, repo_owner)
-            )
-            files = cur.fetchall()
+            indexed = 0
+            while True:
+                cur.execute(
+                    """
+                    SELECT DISTINCT blob_hash
+                    FROM repo_head_files
+                    WHERE NOT EXISTS (SELECT 1 FROM search_index WHERE search_index.blob_hash = repo_head_files.blob_hash)
+                    LIMIT %s;
+                    """,
+                    (batch_size,)
+                )
+                blob_hashes = [row[0] for row in cur.fetchall()]
+                if not blob_hashes:
+                    return indexed
+                indexed += code_search.index_blobs(cur, blob_hashes)
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
         finally:
             cur.close()
             conn.close()
 
-        files_dict = {}
-        for file in files:
-            version = [file[0], file[1], file[2]]
-            rel_file_path = file[3]
-            commit_msg = file[4]
-            files_dict[rel_file_path] = {
-                'version': version,
-                'commit_msg': commit_msg
-            }
-
-        return files_dict
-
     # TODO: Add a way for admins to create an account for a user without the user's input
     def add_user(self, username: str, password: str):
         """
@@ -951,6 +2850,7 @@ class PostgreSQL:
                 (username,)
             )
             conn.commit()
+            read_cache.invalidate_user(username)
         finally:
             cur.close()
             conn.close()
@@ -966,7 +2866,7 @@ class PostgreSQL:
         :return: The owner of the repository.
         :rtype: str
         """
-        conn = self.get_connection()
+        conn = self.get_connection(readonly=True)
         cur = conn.cursor()
         try:
             cur.execute(
@@ -990,21 +2890,13 @@ class PostgreSQL:
         :param not_exist_ok: If True, does not raise an error if the user does not exist.
         :return:
         """
-        conn = self.get_connection()
-        cur = conn.cursor()
-
         assert type(username) is str, "The username must be a string."
 
+        conn = self.get_connection()
+        cur = conn.cursor()
         try:
             # Check if the owner exists
-            cur.execute(
-                """
-                SELECT username
-                FROM accounts
-                WHERE username = %s;
-                """,
-                (username,)
-            )
+            prepared_statements.execute(conn, cur, 'rd_check_exists', (username,))
             exists = cur.fetchone() is not None
         finally:
             cur.close()
@@ -1121,15 +3013,17 @@ class PostgreSQL:
                 (bio, username)
             )
             conn.commit()
+            read_cache.invalidate(('bio', username))
         finally:
             cur.close()
             conn.close()
 
+    @read_cache.cached('bio')
     def get_bio(self, username):
         # Check if the user exists
         self.check_exists(username)
 
-        conn = self.get_connection()
+        conn = self.get_connection(readonly=True)
         cur = conn.cursor()
         try:
             cur.execute(
@@ -1236,10 +3130,11 @@ class PostgreSQL:
 
     # TODO: Add way for user to trigger the creation of a repository
     def add_repository(self, owner:str, name:str, description:str, is_private:bool):
-        # Connect to the PostgreSQL database
-        conn = psycopg2.connect(**self.get_details())
-        cur = conn.cursor()
+        """
+        Adds a new repository to the database.
 
+        :return: True if the repository was added, False if the owner already has a repository with that name.
+        """
         assert isinstance(is_private, bool)
         assert isinstance(name, str)
         assert isinstance(description, str)
@@ -1248,6 +3143,9 @@ class PostgreSQL:
         # Check if the owner exists
         self.check_exists(owner)
 
+        conn = self.get_connection()
+        cur = conn.cursor()
+
         # Insert the new repository
         try:
             cur.execute(
@@ -1258,55 +3156,80 @@ class PostgreSQL:
                 (owner, name, description, is_private)
             )
             conn.commit()
+            read_cache.invalidate_repository(owner, name)
+        except psycopg2.errors.UniqueViolation:
+            return False
         finally:
             cur.close()
             conn.close()
+        return True
 
     # TODO: Add way for user to trigger the deletion of a repository
-    def delete_repository(self, owner:str, name:str):
-        # Connect to the PostgreSQL database
-        conn = psycopg2.connect(**self.get_details())
-        cur = conn.cursor()
-
+    def delete_repository(self, owner:str, name:str) -> bool:
+        """
+        :return: Whether the owner had a repository of that name to delete.
+        """
         assert isinstance(name, str)
         assert isinstance(owner, str)
 
         # Check if the owner exists
         self.check_exists(owner)
 
+        conn = self.get_connection()
+        cur = conn.cursor()
+
         try:
-            # Delete all commits associated with the repository
+            # Locked first, so pushes to the repository either finish before the counts are taken out below, or
+            # wait and then find it gone. See add_storage_usage().
+            cur.execute(
+                'SELECT repo_id FROM repositories WHERE owner = %s AND name = %s FOR UPDATE;', (owner, name)
+            )
+            repo = cur.fetchone()
+            if repo is None:
+                conn.rollback()
+                return False
+            repo_id = repo[0]
+
+            # Take the commits out of the daily counts, then delete them. What is taken out goes in this
+            # connection's slot, as in count_commits(), so a slot may go below zero while the sum is right.
             cur.execute(
                 """
-                DELETE FROM commits
-                WHERE repo_id = (
-                    SELECT repo_id
-                    FROM repositories
-                    WHERE owner = %s AND name = %s
-                );
+                INSERT INTO commit_activity (username, day, slot, commits)
+                SELECT author, commit_date::DATE, pg_backend_pid() %% %s, -COUNT(*)
+                FROM commits
+                WHERE commit_date IS NOT NULL AND repo_id = %s
+                GROUP BY author, commit_date::DATE
+                ON CONFLICT (username, day, slot) DO UPDATE SET commits = commit_activity.commits + EXCLUDED.commits;
                 """,
-                (owner, name)
+                (PostgreSQL.USAGE_SLOTS, repo_id)
             )
-
-            # Delete the repository
+            # Likewise the storage it used, out of its owner's. Its own usage rows go with it.
             cur.execute(
                 """
-                DELETE FROM repositories
-                WHERE owner = %s AND name = %s;
+                INSERT INTO user_usage (username, slot, bytes, files)
+                SELECT %s, pg_backend_pid() %% %s, -SUM(bytes), -SUM(files)
+                FROM repository_usage
+                WHERE repo_id = %s
+                HAVING COUNT(*) > 0
+                ON CONFLICT (username, slot) DO UPDATE SET
+                    bytes = user_usage.bytes + EXCLUDED.bytes,
+                    files = user_usage.files + EXCLUDED.files;
                 """,
-                (owner, name)
+                (owner, PostgreSQL.USAGE_SLOTS, repo_id)
             )
+            cur.execute('DELETE FROM commits WHERE repo_id = %s;', (repo_id,))
+
+            # Delete the repository
+            cur.execute('DELETE FROM repositories WHERE repo_id = %s;', (repo_id,))
             conn.commit()
+            read_cache.invalidate_repository(owner, name)
+            return True
         finally:
             cur.close()
             conn.close()
 
     # TODO: Add way for user to trigger updating if its private or not
     def update_repository_is_private(self, owner, name, is_private):
-        # Connect to the PostgreSQL database
-        conn = psycopg2.connect(**self.get_details())
-        cur = conn.cursor()
-
         assert isinstance(is_private, bool)
         assert isinstance(name, str)
         assert isinstance(owner, str)
@@ -1314,6 +3237,9 @@ class PostgreSQL:
         # Check if the owner exists
         self.check_exists(owner)
 
+        conn = self.get_connection()
+        cur = conn.cursor()
+
         # Update the repository
         try:
             cur.execute(
@@ -1325,16 +3251,13 @@ class PostgreSQL:
                 (is_private, owner, name,)
             )
             conn.commit()
+            read_cache.invalidate_repository(owner, name)
         finally:
             cur.close()
             conn.close()
 
     # TODO: Add way for user to trigger updating the name of the repository
     def update_repository_name(self, owner, old_name, new_name):
-        # Connect to the PostgreSQL database
-        conn = psycopg2.connect(**self.get_details())
-        cur = conn.cursor()
-
         assert isinstance(new_name, str)
         assert isinstance(old_name, str)
         assert isinstance(owner, str)
@@ -1342,6 +3265,9 @@ class PostgreSQL:
         # Check if the owner exists
         self.check_exists(owner)
 
+        conn = self.get_connection()
+        cur = conn.cursor()
+
         # Update the repository
         try:
             cur.execute(
@@ -1353,16 +3279,14 @@ class PostgreSQL:
                 (new_name, owner, old_name,)
             )
             conn.commit()
+            read_cache.invalidate_repository(owner, old_name)
+            read_cache.invalidate_repository(owner, new_name)
         finally:
             cur.close()
             conn.close()
 
     # TODO: Add way for user to trigger updating the description of the repository
     def update_repository_description(self, owner, name, description):
-        # Connect to the PostgreSQL database
-        conn = psycopg2.connect(**self.get_details())
-        cur = conn.cursor()
-
         assert isinstance(description, str)
         assert isinstance(name, str)
         assert isinstance(owner, str)
@@ -1370,6 +3294,9 @@ class PostgreSQL:
         # Check if the owner exists
         self.check_exists(owner)
 
+        conn = self.get_connection()
+        cur = conn.cursor()
+
         # Update the repository
         try:
             cur.execute(
@@ -1381,6 +3308,7 @@ class PostgreSQL:
                 (description, owner, name,)
             )
             conn.commit()
+            read_cache.invalidate_repository(owner, name)
         finally:
             cur.close()
             conn.close()
@@ -1390,66 +3318,181 @@ class PostgreSQL:
         columns = [desc[0] for desc in cursor.description]
         return [dict(zip(columns, item)) for item in cursor.fetchall()]
 
-    def list_public_repos(self, username):
-        # Check if the user exists
-        self.check_exists(username)
+    def add_commit(self, owner: str, repo_name: str, author: str, rel_file_path: str, version: tuple, data: bytes,
+                   commit_message: str = None, branch: str = ref_store.DEFAULT_BRANCH) -> int:
+        """
+        Stores a new version of a file. The content goes to the blob store, so content that is already stored,
+        in any repository, is not stored again.
+
+        :param version: The (major, minor, patch) version of the file.
+        :param data: The raw file content.
+        :param branch: The branch to commit to.
+        :return: The commit_id of the new commit.
+        :raises error.ref_not_found: If there is no such branch.
+        """
+        assert isinstance(rel_file_path, str)
+        assert len(version) == 3, "The version must be (major, minor, patch)."
+
+        self.check_exists(author)
 
         conn = self.get_connection()
         cur = conn.cursor()
         try:
-            # Execute the query to get repository data
+            # Locked as in add_storage_usage(), so the repository can not be deleted while this commits to it.
+            cur.execute(
+                'SELECT repo_id FROM repositories WHERE owner = %s AND name = %s FOR KEY SHARE;', (owner, repo_name)
+            )
+            repo = cur.fetchone()
+            if repo is None:
+                raise error.repository_not_found(repo_name)
+
+            self.add_storage_usage(cur, repo[0], owner, len(data), 1)
+            blob_hash = blob_store.put(cur, data, repo[0])
+            # A commit of one file is a changeset of its own.
             cur.execute(
                 """
-                SELECT *
-                FROM repositories
-                WHERE owner = %s AND private = FALSE;
+                INSERT INTO changesets (repo_id, author, message)
+                VALUES (%s, %s, COALESCE(%s, 'No message provided'))
+                RETURNING changeset_id;
                 """,
-                (username,)
+                (repo[0], author, commit_message)
+            )
+            changeset_id = cur.fetchone()[0]
+            cur.execute(
+                """
+                INSERT INTO commits (
+                    repo_id, author, version_major, version_minor, version_patch, rel_file_path, blob_hash,
+                    commit_message, changeset_id
+                )
+                VALUES (%s, %s, %s, %s, %s, %s, %s, COALESCE(%s, 'No message provided'), %s)
+                RETURNING commit_id;
+                """,
+                (repo[0], author, *version, rel_file_path, blob_hash, commit_message, changeset_id)
             )
+            commit_id = cur.fetchone()[0]
+            self.count_commits(cur, author)
+            self.advance_branch(
+                cur, repo[0], changeset_id, {rel_file_path: (blob_hash, commit_id, tuple(version))}, branch
+            )
+            conn.commit()
+            self.touch_repository(cur, repo[0])
+            conn.commit()
+            read_cache.invalidate_repository(owner, repo_name)
+            return commit_id
+        finally:
+            cur.close()
+            conn.close()
+
+    def get_file(self, owner: str, repo_name: str, rel_file_path: str, version: tuple = None,
+                 view_private=False, ref: str = None) -> bytes:
+        """
+        Reads a file from a branch or tag of a repository.
 
-            return PostgreSQL.sort_to_dict(cur)
+        :param version: The (major, minor, patch) version to read, from the branch's history. Defaults to the latest.
+        :param view_private: Whether files of private repositories can be read.
+        :param ref: The branch or tag. Defaults to the default branch.
+        :raises error.file_not_found: If the branch has no such file, or not at that version.
+        :raises error.ref_not_found: If the repository has no such branch or tag.
+        """
+        conn = self.get_connection(readonly=True)
+        cur = conn.cursor()
+        try:
+            if version is not None or (ref is not None and ref != ref_store.DEFAULT_BRANCH):
+                # Other versions and branches are looked up in the history of the branch.
+                repo_id, head = self._ref_head(cur, owner, repo_name, view_private, ref)
+                if repo_id is None:
+                    raise error.file_not_found(rel_file_path)
+                return blob_store.get(cur, self._blob_in_history(cur, repo_id, head, rel_file_path, version))
+
+            # The newest version of the default branch is looked up in repo_head_files.
+            cur.execute(
+                f"""
+                SELECT repo_head_files.blob_hash
+                FROM repo_head_files
+                JOIN repositories ON repositories.repo_id = repo_head_files.repo_id
+                WHERE repositories.owner = %s AND repositories.name = %s AND repo_head_files.rel_file_path = %s
+                {'' if view_private else 'AND repositories.private = FALSE'};
+                """,
+                (owner, repo_name, rel_file_path)
+            )
+            row = cur.fetchone()
+            if row is None:
+                raise error.file_not_found(rel_file_path)
+            return blob_store.get(cur, row[0])
         finally:
             cur.close()
             conn.close()
 
-    def list_private_repos(self, username):
+    def iter_repos(self, username, private=None, after=0, limit=None):
+        """
+        Streams a user's repositories in repo_id order. A server-side cursor is used, so only a batch of them
+        is in memory at a time.
+
+        :param username: The owner of the repositories.
+        :param private: True for only private repositories, False for only public ones, None for both.
+        :param after: Only repositories with a repo_id above this are listed. Pass the last repo_id of a page
+        to get the next one.
+        :param limit: The most repositories to list. None for no limit.
+        """
         # Check if the user exists
         self.check_exists(username)
 
-        conn = self.get_connection()
-        cur = conn.cursor()
-
+        # The connection is only handed back once the generator is finished or closed. One that is dropped part
+        # way through is closed when it is garbage collected, and pooled_connection hands it back then too.
+        conn = self.get_connection(readonly=True)
+        cur = None
         try:
+            cur = conn.cursor(name=f'rd_repos_{secrets.token_hex(4)}')
+            cur.itersize = PostgreSQL.LISTING_BATCH_SIZE
             cur.execute(
-                """
-                SELECT repo_id, name, description, owner, created_on, last_updated, private
+                f"""
+                SELECT repo_id, name, description, owner, created_on, last_updated, private,
+                    COALESCE(usage.bytes, 0) AS stored_bytes, COALESCE(usage.files, 0) AS stored_files
                 FROM repositories
-                WHERE owner = %s AND private = TRUE;
+                LEFT JOIN LATERAL (
+                    SELECT SUM(bytes)::BIGINT AS bytes, SUM(files)::BIGINT AS files
+                    FROM repository_usage
+                    WHERE repository_usage.repo_id = repositories.repo_id
+                ) AS usage ON TRUE
+                WHERE owner = %s AND repo_id > %s{'' if private is None else ' AND private = %s'}
+                ORDER BY repo_id
+                LIMIT %s;
                 """,
-                (username,)
+                (username, after, limit) if private is None else (username, after, private, limit)
             )
 
-            # Return the data and sort it into a dictionary
-            return PostgreSQL.sort_to_dict(cur)
+            columns = None
+            for row in cur:
+                if columns is None:
+                    columns = [desc[0] for desc in cur.description]
+                yield dict(zip(columns, row))
         finally:
-            cur.close()
+            if cur is not None:
+                cur.close()
             conn.close()
 
+    @read_cache.cached('public_repos', key_args=1)
+    def list_public_repos(self, username, after=0, limit=None):
+        return list(self.iter_repos(username, private=False, after=after, limit=limit))
+
+    def list_private_repos(self, username, after=0, limit=None):
+        return list(self.iter_repos(username, private=True, after=after, limit=limit))
+
+    def list_repos(self, username, after=0, limit=None):
+        """
+        Lists both the public and private repositories of a user, in one repo_id order.
+        """
+        return list(self.iter_repos(username, after=after, limit=limit))
+
+    @read_cache.cached('repo')
     def get_repo(self, owner, name):
         # Check if the user exists
         self.check_exists(owner)
 
-        conn = self.get_connection()
+        conn = self.get_connection(readonly=True)
         cur = conn.cursor()
         try:
-            cur.execute(
-                """
-                SELECT repo_id, name, description, owner, created_on, last_updated, private
-                FROM repositories
-                WHERE owner = %s AND name = %s;
-                """,
-                (owner, name)
-            )
+            prepared_statements.execute(conn, cur, 'rd_get_repo', (owner, name))
             return cur.fetchone()
         finally:
             cur.close()
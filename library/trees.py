@@ -0,0 +1,304 @@
+from library.errors import error
+import collections
+import threading
+import hashlib
+import json
+
+class tree_store:
+    """
+    Immutable snapshots of what a repository holds, as a Merkle tree of its folders.
+
+    A tree is the sorted list of the entries of one folder. A file entry is [name, 'blob', blob hash, commit_id,
+    major, minor, patch], saying which commit set the file to which content at which version. A folder entry is
+    [name, 'tree', tree hash]. A tree is stored under the SHA-256 of its entries, so a folder that did not change
+    between two snapshots is the same tree in both, and is only stored once. Every changeset records the
+    root tree of the repository after it, and the repository's branches say which changesets are the newest.
+
+    Changing files only rebuilds the folders on their paths, and comparing two snapshots skips every folder
+    whose hash is the same in both. Both cost time in proportion to what changed, not to the size of the repository.
+
+    The methods only use the trees table, so the migration that builds the trees of older commits can use them too.
+    """
+    _lock = threading.Lock()
+    # Trees never change, so they can be cached for as long as there is room.
+    _cache = collections.OrderedDict()  # Tree hash: entries
+    max_cached = 20000
+    stats = {
+        'hits': 0,
+        'misses': 0,
+        'stored': 0,
+    }
+
+    @staticmethod
+    def split_path(rel_file_path: str) -> tuple[tuple, str]:
+        """
+        Splits a path like '/folder/file.txt' into its folders and its file name.
+        """
+        parts = [part for part in rel_file_path.split('/') if part]
+        if not parts:
+            raise ValueError(f"{rel_file_path!r} is not a file path.")
+        return tuple(parts[:-1]), parts[-1]
+
+    @staticmethod
+    def hash_entries(entries: list) -> str:
+        return hashlib.sha256(
+            json.dumps(entries, separators=(',', ':'), ensure_ascii=False).encode()
+        ).hexdigest()
+
+    @staticmethod
+    def put(cur, entries: list) -> str:
+        """
+        Stores a tree, unless the same tree is already stored.
+
+        :param entries: The entries of the folder. They are sorted here.
+        :return: The hash of the tree.
+        """
+        entries = sorted(entries, key=lambda entry: (entry[0], entry[1]))
+        tree_hash = tree_store.hash_entries(entries)
+        cur.execute(
+            'INSERT INTO trees (hash, entries) VALUES (%s, %s) ON CONFLICT (hash) DO NOTHING;',
+            (tree_hash, json.dumps(entries, ensure_ascii=False))
+        )
+        with tree_store._lock:
+            tree_store.stats['stored'] += cur.rowcount
+        return tree_hash
+
+    @staticmethod
+    def _remember(tree_hash: str, entries: list):
+        with tree_store._lock:
+            tree_store._cache[tree_hash] = entries
+            tree_store._cache.move_to_end(tree_hash)
+            while len(tree_store._cache) > tree_store.max_cached:
+                tree_store._cache.popitem(last=False)
+
+    @staticmethod
+    def get_many(cur, tree_hashes: list) -> dict:
+        """
+        Reads several trees with one query at most.
+
+        :return: The entries of each tree, by hash.
+        :raises error.tree_not_found: If a tree is not stored.
+        """
+        found = {}
+        with tree_store._lock:
+            for tree_hash in tree_hashes:
+                entries = tree_store._cache.get(tree_hash)
+                if entries is not None:
+                    tree_store._cache.move_to_end(tree_hash)
+                    found[tree_hash] = entries
+            tree_store.stats['hits'] += len(found)
+
+        missing = [tree_hash for tree_hash in set(tree_hashes) if tree_hash not in found]
+        if missing:
+            with tree_store._lock:
+                tree_store.stats['misses'] += len(missing)
+            cur.execute('SELECT hash, entries FROM trees WHERE hash = ANY(%s);', (missing,))
+            for tree_hash, entries in cur.fetchall():
+                found[tree_hash] = entries
+                tree_store._remember(tree_hash, entries)
+            for tree_hash in missing:
+                if tree_hash not in found:
+                    raise error.tree_not_found(tree_hash)
+        return found
+
+    @staticmethod
+    def get(cur, tree_hash: str) -> list:
+        return tree_store.get_many(cur, [tree_hash])[tree_hash]
+
+    @staticmethod
+    def empty(cur) -> str:
+        """
+        :return: The hash of the tree of an empty repository.
+        """
+        return tree_store.put(cur, [])
+
+    @staticmethod
+    def update(cur, root_hash: str | None, changes: dict, only_newer=True) -> str:
+        """
+        Makes the tree of a snapshot from the one before it. Only the folders on the paths of the changes are
+        read and rebuilt. The rest of the new tree is shared with the old one.
+
+        :param root_hash: The root tree to change, or None to start from an empty repository.
+        :param changes: Path: (blob hash, commit_id, (major, minor, patch)) of each file to set, or None to remove it.
+        :param only_newer: If True, a file already at a later version than the change is left as it is.
+        :return: The hash of the new root tree.
+        """
+        # The files set directly in each folder, and the subfolders each folder has changes in.
+        direct = collections.defaultdict(dict)
+        children = collections.defaultdict(set)
+        for rel_file_path, change in changes.items():
+            folders, name = tree_store.split_path(rel_file_path)
+            direct[folders][name] = change
+            for depth in range(len(folders)):
+                children[folders[:depth]].add(folders[depth])
+
+        def rebuild(folders: tuple, tree_hash: str | None) -> str | None:
+            entries = {
+                (entry[0], entry[1]): entry for entry in (tree_store.get(cur, tree_hash) if tree_hash else [])
+            }
+            for name, change in direct.get(folders, {}).items():
+                if change is None:
+                    entries.pop((name, 'blob'), None)
+                    continue
+                blob_hash, commit_id, version = change
+                existing = entries.get((name, 'blob'))
+                if only_newer and existing is not None and tuple(existing[4:7]) > tuple(version):
+                    continue
+                entries[(name, 'blob')] = [name, 'blob', blob_hash, commit_id, *version]
+
+            for name in children.get(folders, ()):
+                existing = entries.get((name, 'tree'))
+                subtree = rebuild(folders + (name,), existing[2] if existing else None)
+                if subtree is None:
+                    entries.pop((name, 'tree'), None)
+                else:
+                    entries[(name, 'tree')] = [name, 'tree', subtree]
+
+            # Folders with nothing left in them go, except the root.
+            if not entries and folders:
+                return None
+            return tree_store.put(cur, list(entries.values()))
+
+        return rebuild((), root_hash)
+
+    @staticmethod
+    def find(cur, root_hash: str | None, rel_file_path: str) -> list | None:
+        """
+        Looks up one file of a snapshot, reading only the folders on its path.
+
+        :return: The file entry, or None if the snapshot has no such file.
+        """
+        folders, name = tree_store.split_path(rel_file_path)
+        tree_hash = root_hash
+        for folder in folders:
+            if tree_hash is None:
+                return None
+            subtree = next(
+                (entry for entry in tree_store.get(cur, tree_hash) if entry[0] == folder and entry[1] == 'tree'), None
+            )
+            tree_hash = subtree[2] if subtree is not None else None
+        if tree_hash is None:
+            return None
+        return next((entry for entry in tree_store.get(cur, tree_hash) if entry[0] == name and entry[1] == 'blob'), None)
+
+    @staticmethod
+    def walk(cur, root_hash: str) -> dict:
+        """
+        Lists every file of a snapshot. Each level of folders is read with one query.
+
+        :return: Path: file entry, for every file.
+        """
+        files = {}
+        level = [('', root_hash)]
+        while level:
+            trees = tree_store.get_many(cur, [tree_hash for _, tree_hash in level])
+            next_level = []
+            for prefix, tree_hash in level:
+                for entry in trees[tree_hash]:
+                    path = f'{prefix}/{entry[0]}'
+                    if entry[1] == 'tree':
+                        next_level.append((path, entry[2]))
+                    else:
+                        files[path] = entry
+            level = next_level
+        return files
+
+    @staticmethod
+    def compare(cur, old_root: str, new_root: str) -> dict:
+        """
+        Finds the files that differ between two snapshots. Folders with the same hash in both are skipped
+        without being read.
+
+        :return: Path: (old file entry, new file entry) of each file that was added (old is None),
+        removed (new is None), or changed.
+        """
+        differences = {}
+        level = [('', old_root, new_root)] if old_root != new_root else []
+        while level:
+            trees = tree_store.get_many(
+                cur, [tree_hash for _, old, new in level for tree_hash in (old, new) if tree_hash is not None]
+            )
+            next_level = []
+            for prefix, old, new in level:
+                old_entries = {(entry[0], entry[1]): entry for entry in trees[old]} if old else {}
+                new_entries = {(entry[0], entry[1]): entry for entry in trees[new]} if new else {}
+                for key in old_entries.keys() | new_entries.keys():
+                    old_entry, new_entry = old_entries.get(key), new_entries.get(key)
+                    if old_entry == new_entry:
+                        continue
+                    path = f'{prefix}/{key[0]}'
+                    if key[1] == 'tree':
+                        next_level.append((
+                            path, old_entry[2] if old_entry else None, new_entry[2] if new_entry else None
+                        ))
+                    else:
+                        differences[path] = (old_entry, new_entry)
+            level = next_level
+        return differences
+
+    @staticmethod
+    def merge(cur, base_root: str | None, ours_root: str | None, theirs_root: str | None) -> tuple[str, dict]:
+        """
+        Three-way merges two snapshots that both came from base_root. A folder that only one side changed, or that
+        both changed the same way, is taken whole, without reading what is in it. Only folders that both sides
+        changed differently are opened, so the cost is in proportion to what changed, not to the size of the
+        repository.
+
+        :return: The hash of the merged root tree, and path: (base, ours, theirs) file entries of each file both
+        sides changed differently. In the merged tree, those files are as ours has them, for the caller to resolve.
+        """
+        both_changed = {}
+
+        def merge_folder(folders: tuple, base: str | None, ours: str | None, theirs: str | None) -> str | None:
+            if ours == theirs or base == theirs:
+                return ours
+            if base == ours:
+                return theirs
+
+            trees = tree_store.get_many(cur, [tree_hash for tree_hash in (base, ours, theirs) if tree_hash])
+            base_entries, ours_entries, theirs_entries = (
+                {(entry[0], entry[1]): entry for entry in trees[tree_hash]} if tree_hash else {}
+                for tree_hash in (base, ours, theirs)
+            )
+            merged = []
+            for key in sorted(base_entries.keys() | ours_entries.keys() | theirs_entries.keys()):
+                name, kind = key
+                base_entry, ours_entry, theirs_entry = (
+                    entries.get(key) for entries in (base_entries, ours_entries, theirs_entries)
+                )
+                if kind == 'tree':
+                    subtree = merge_folder(
+                        folders + (name,),
+                        *(entry[2] if entry else None for entry in (base_entry, ours_entry, theirs_entry))
+                    )
+                    if subtree is not None:
+                        merged.append([name, 'tree', subtree])
+                    continue
+
+                if ours_entry == theirs_entry or base_entry == theirs_entry:
+                    entry = ours_entry
+                elif base_entry == ours_entry:
+                    entry = theirs_entry
+                elif ours_entry is not None and theirs_entry is not None and ours_entry[2] == theirs_entry[2]:
+                    # The same content from different commits. The later version wins.
+                    entry = max(ours_entry, theirs_entry, key=lambda entry: tuple(entry[4:7]))
+                else:
+                    both_changed['/'.join(('',) + folders + (name,))] = (base_entry, ours_entry, theirs_entry)
+                    entry = ours_entry
+                if entry is not None:
+                    merged.append(entry)
+
+            # Folders with nothing left in them go, except the root.
+            if not merged and folders:
+                return None
+            return tree_store.put(cur, merged)
+
+        root = merge_folder((), base_root, ours_root, theirs_root)
+        return root if root is not None else tree_store.empty(cur), both_changed
+
+    @staticmethod
+    def statistics() -> dict:
+        with tree_store._lock:
+            stats = dict(tree_store.stats)
+            stats['cached'] = len(tree_store._cache)
+        return stats
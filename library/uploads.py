@@ -0,0 +1,387 @@
+from library.storage import var, dt, PostgreSQL, read_cache
+from library.async_storage import AsyncPostgreSQL
+from library.blobstore import blob_store
+from library.refs import ref_store
+from library.errors import error
+import psycopg2.extras
+import threading
+import asyncio
+import datetime
+import hashlib
+import logging
+import secrets
+import json
+import shutil
+import re
+import os
+
+class upload_sessions:
+    """
+    Pushes, uploaded in chunks and committed as one changeset.
+
+    A push starts with a manifest of the files it will commit, each with its size and SHA-256.
+    Each file is then uploaded in order, a chunk at a time, with the SHA-256 of each chunk, and a chunk only counts
+    once it has been written to disk and its hash checked. How much of each file has been received is kept
+    in the uploads table, so after a dropped connection the client asks for it and carries on from there.
+    Committing checks every file against the manifest, and stores them all as one changeset in a single transaction.
+
+    Chunks are streamed to disk as they arrive, and files are streamed from there into the blob store,
+    so the memory used does not depend on the size of the push.
+    """
+    # Chunks bigger than twice the advertised chunk size are refused.
+    MAX_CHUNK_FACTOR = 2
+    MAX_FILES = 10000
+    SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+    _lock = threading.Lock()
+    _config_cache = None
+    _receiving = set()  # (upload_id, file index) of the chunks being received right now
+
+    @staticmethod
+    def config() -> dict:
+        if upload_sessions._config_cache is None:
+            upload_sessions._config_cache = {
+                'path': var.get('uploads.path', dt.SETTINGS['uploads']['path']),
+                'chunk_size': int(var.get('uploads.chunk_size', dt.SETTINGS['uploads']['chunk_size'])),
+                'expire_after': float(var.get('uploads.expire_after', dt.SETTINGS['uploads']['expire_after'])),
+            }
+        return upload_sessions._config_cache
+
+    @staticmethod
+    def part_path(upload_id: str, index: int) -> str:
+        return os.path.join(upload_sessions.config()['path'], upload_id, f'{index}.part')
+
+    @staticmethod
+    def _check_manifest(files) -> list:
+        """
+        Checks the manifest a push is started with.
+
+        :return: The files, as dicts of path, version, size and sha256.
+        :raises ValueError: If the manifest is not valid. The message says why.
+        """
+        if not isinstance(files, list) or not files:
+            raise ValueError("files must be a list of at least one file")
+        if len(files) > upload_sessions.MAX_FILES:
+            raise ValueError(f"a push can have at most {upload_sessions.MAX_FILES} files")
+
+        checked = []
+        for file in files:
+            if not isinstance(file, dict):
+                raise ValueError("each file must be an object of path, version, size and sha256")
+            path, version, size, sha256 = file.get('path'), file.get('version'), file.get('size'), file.get('sha256')
+            if not isinstance(path, str) or not path.startswith('/'):
+                raise ValueError("each path must start with /")
+            # Format, major.minor.patch
+            try:
+                version = [int(part) for part in str(version).split('.')]
+            except ValueError:
+                version = []
+            if len(version) != 3 or min(version) < 0:
+                raise ValueError(f"the version of {path} must look like 1.0.0")
+            if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+                raise ValueError(f"the size of {path} must be a whole number of bytes")
+            if not isinstance(sha256, str) or not upload_sessions.SHA256_PATTERN.match(sha256.lower()):
+                raise ValueError(f"the sha256 of {path} must be 64 hex digits")
+            checked.append({'path': path, 'version': version, 'size': size, 'sha256': sha256.lower()})
+
+        if len({file['path'] for file in checked}) != len(checked):
+            raise ValueError("each path can only be in a push once")
+        return checked
+
+    @staticmethod
+    def _describe(upload_id: str, files: list, received: list, changeset_id: int | None) -> dict:
+        return {
+            'upload_id': upload_id,
+            'chunk_size': upload_sessions.config()['chunk_size'],
+            'files': [
+                {'index': index, 'path': file['path'], 'size': file['size'], 'received': received[index]}
+                for index, file in enumerate(files)
+            ],
+            'changeset_id': changeset_id,
+        }
+
+    @staticmethod
+    def start(username: str, repo_name: str, commit_message: str | None, files,
+              branch: str = ref_store.DEFAULT_BRANCH, expected_changeset: int = None) -> dict:
+        """
+        Starts a push to one of a user's repositories.
+
+        :param files: The manifest. A list of {'path', 'version' ('1.0.0'), 'size', 'sha256'}.
+        :param branch: The branch to commit to.
+        :param expected_changeset: The changeset the branch must still be at when the push is committed.
+        If it is not, the commit is refused. By default, it is committed on top of wherever the branch is by then.
+        :return: The upload, as status() describes it.
+        :raises ValueError: If the manifest or branch is not valid.
+        :raises error.repository_not_found: If the user has no repository of that name.
+        :raises error.ref_not_found: If the repository has no such branch.
+        :raises error.quota_exceeded: If the files would take the user over their storage quota.
+        """
+        files = upload_sessions._check_manifest(files)
+        ref_store.check_name(branch)
+        if expected_changeset is not None and (
+                not isinstance(expected_changeset, int) or isinstance(expected_changeset, bool)):
+            raise ValueError("expected_changeset must be a changeset id")
+        upload_sessions.expire()
+
+        upload_id = secrets.token_urlsafe(24)
+        conn = PostgreSQL.shared().get_connection()
+        cur = conn.cursor()
+        try:
+            cur.execute('SELECT repo_id FROM repositories WHERE owner = %s AND name = %s;', (username, repo_name))
+            repo = cur.fetchone()
+            if repo is None:
+                raise error.repository_not_found(repo_name)
+            # Checked now, so the client does not upload everything only to find out when committing.
+            if branch != ref_store.DEFAULT_BRANCH:
+                ref_store.resolve(cur, repo[0], branch)
+            PostgreSQL.check_quota(cur, username, sum(file['size'] for file in files))
+
+            os.makedirs(os.path.join(upload_sessions.config()['path'], upload_id))
+            cur.execute(
+                """
+                INSERT INTO uploads (
+                    upload_id, username, repo_id, commit_message, files, received, branch, expected_changeset
+                )
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
+                """,
+                (
+                    upload_id, username, repo[0], commit_message, psycopg2.extras.Json(files), [0] * len(files),
+                    branch, expected_changeset
+                )
+            )
+            conn.commit()
+        finally:
+            cur.close()
+            conn.close()
+
+        logging.info(f"{username} started upload {upload_id} of {len(files)} files to {repo_name}.")
+        return upload_sessions._describe(upload_id, files, [0] * len(files), None)
+
+    @staticmethod
+    def _load(cur, upload_id: str, username: str, lock=False) -> tuple:
+        """
+        :return: The files, received, changeset_id, repo_id, commit_message, branch and expected_changeset
+        of an upload of the user.
+        :raises error.upload_not_found: If the user has no such upload.
+        """
+        cur.execute(
+            f"""
+            SELECT files, received, changeset_id, repo_id, commit_message, branch, expected_changeset
+            FROM uploads
+            WHERE upload_id = %s AND username = %s
+            {'FOR UPDATE' if lock else ''};
+            """,
+            (upload_id, username)
+        )
+        row = cur.fetchone()
+        if row is None:
+            raise error.upload_not_found(upload_id)
+        return row
+
+    @staticmethod
+    def status(upload_id: str, username: str) -> dict:
+        """
+        Gets how much of each file of an upload has been received, to resume it from.
+        """
+        # Not from a replica, as one that is behind would have the client resume from too early.
+        conn = PostgreSQL.shared().get_connection()
+        cur = conn.cursor()
+        try:
+            files, received, changeset_id = upload_sessions._load(cur, upload_id, username)[:3]
+        finally:
+            cur.close()
+            conn.close()
+        return upload_sessions._describe(upload_id, files, received, changeset_id)
+
+    @staticmethod
+    async def receive_chunk(upload_id: str, username: str, index: int, offset: int, sha256: str, body) -> int:
+        """
+        Appends a chunk to a file of an upload. The chunk is written to disk as it arrives, and only counts
+        once all of it is there and its hash matches. Otherwise the file is cut back to where it was.
+
+        :param index: The position of the file in the manifest.
+        :param offset: Where in the file the chunk starts. It must be how much has been received so far.
+        :param sha256: The SHA-256 of the chunk.
+        :param body: The request body, to read the chunk from as it arrives.
+        :return: How much of the file has been received now.
+        :raises error.chunk_rejected: If the chunk does not fit, or is damaged. The client resumes from its received.
+        """
+        db = AsyncPostgreSQL.shared()
+
+        row = await db.fetchrow(
+            'SELECT files, received, changeset_id FROM uploads WHERE upload_id = $1 AND username = $2;',
+            upload_id, username
+        )
+        if row is None:
+            raise error.upload_not_found(upload_id)
+        files, received = json.loads(row['files']), list(row['received'])
+        if row['changeset_id'] is not None:
+            raise error.chunk_rejected("the upload has already been committed", None)
+        if not 0 <= index < len(files):
+            raise error.chunk_rejected(f"there is no file {index} in the upload", None)
+        if offset != received[index]:
+            raise error.chunk_rejected(f"the chunk must start at {received[index]}", received[index])
+        if not isinstance(sha256, str) or not upload_sessions.SHA256_PATTERN.match(sha256.lower()):
+            raise error.chunk_rejected("the chunk's sha256 must be 64 hex digits", received[index])
+
+        key = (upload_id, index)
+        with upload_sessions._lock:
+            if key in upload_sessions._receiving:
+                raise error.chunk_rejected("another chunk of the file is being received", received[index])
+            upload_sessions._receiving.add(key)
+        try:
+            remaining = files[index]['size'] - offset
+            max_chunk = upload_sessions.config()['chunk_size'] * upload_sessions.MAX_CHUNK_FACTOR
+            path = upload_sessions.part_path(upload_id, index)
+            hasher = hashlib.sha256()
+            length = 0
+            try:
+                part = await asyncio.to_thread(open, path, 'ab')
+            except FileNotFoundError:
+                # The upload expired and its folder was cleaned up since it was looked up.
+                raise error.upload_not_found(upload_id)
+            try:
+                # Anything past what was received is from a chunk that never finished.
+                await asyncio.to_thread(part.truncate, offset)
+                try:
+                    async for piece in body:
+                        length += len(piece)
+                        if length > min(remaining, max_chunk):
+                            raise error.chunk_rejected(
+                                "the chunk is bigger than the chunk size or the rest of the file", offset
+                            )
+                        hasher.update(piece)
+                        await asyncio.to_thread(part.write, piece)
+                    if hasher.hexdigest() != sha256.lower():
+                        raise error.chunk_rejected("the chunk does not match its sha256", offset)
+                    await asyncio.to_thread(part.flush)
+                    await asyncio.to_thread(os.fsync, part.fileno())
+                except BaseException:
+                    await asyncio.to_thread(part.truncate, offset)
+                    raise
+            finally:
+                part.close()
+
+            # Only counted if nothing else has moved the file on, or committed the upload, since it was read.
+            # Another process can be receiving the same file, as the check above only covers this one.
+            updated = await db.fetchval(
+                """
+                UPDATE uploads SET received[$1] = $2
+                WHERE upload_id = $3 AND received[$1] = $4 AND changeset_id IS NULL
+                RETURNING upload_id;
+                """,
+                index + 1, offset + length, upload_id, offset
+            )
+            if updated is None:
+                raise error.chunk_rejected("the file was changed by another chunk while this one was received", None)
+        finally:
+            with upload_sessions._lock:
+                upload_sessions._receiving.discard(key)
+        return offset + length
+
+    @staticmethod
+    def commit(upload_id: str, username: str) -> dict:
+        """
+        Commits a fully uploaded push as one changeset. Either every file is committed, or none is.
+        Committing an upload again gives the same changeset, so a client that lost the answer can just ask again.
+
+        :return: The changeset_id and the commit_id of each file.
+        :raises error.upload_incomplete: If some files have not been fully received.
+        :raises error.chunk_rejected: If a file does not match the sha256 of the manifest. It has to be uploaded again.
+        :raises error.ref_conflict: If the branch is not at the changeset the push expected.
+        """
+        conn = PostgreSQL.shared().get_connection()
+        cur = conn.cursor()
+        try:
+            # Locked, so committing the same upload twice at once makes one changeset.
+            files, received, changeset_id, repo_id, commit_message, branch, expected = upload_sessions._load(
+                cur, upload_id, username, lock=True
+            )
+            if changeset_id is None:
+                changeset_id = upload_sessions._commit_files(
+                    conn, cur, upload_id, username, repo_id, commit_message, files, received, branch,
+                    expected if expected is not None else ref_store.ANY
+                )
+            cur.execute(
+                'SELECT rel_file_path, commit_id FROM commits WHERE changeset_id = %s ORDER BY commit_id;',
+                (changeset_id,)
+            )
+            commits = dict(cur.fetchall())
+            cur.execute('SELECT owner, name FROM repositories WHERE repo_id = %s;', (repo_id,))
+            owner, repo_name = cur.fetchone()
+            conn.commit()
+            PostgreSQL.touch_repository(cur, repo_id)
+            conn.commit()
+        finally:
+            cur.close()
+            conn.close()
+
+        read_cache.invalidate_repository(owner, repo_name)
+        shutil.rmtree(os.path.join(upload_sessions.config()['path'], upload_id), ignore_errors=True)
+        return {
+            'changeset_id': changeset_id,
+            'commits': commits,
+        }
+
+    @staticmethod
+    def _commit_files(conn, cur, upload_id: str, username: str, repo_id: int, commit_message: str | None,
+                      files: list, received: list, branch: str, expected) -> int:
+        incomplete = [file['path'] for file, have in zip(files, received) if have != file['size']]
+        if incomplete:
+            raise error.upload_incomplete(incomplete)
+
+        # Checked before anything is stored, so a bad file leaves nothing behind in the blob store.
+        for index, file in enumerate(files):
+            path = upload_sessions.part_path(upload_id, index)
+            if file['size'] == 0 and not os.path.exists(path):
+                open(path, 'wb').close()
+            if blob_store.hash_file(path) != file['sha256']:
+                cur.execute('UPDATE uploads SET received[%s] = 0 WHERE upload_id = %s;', (index + 1, upload_id))
+                conn.commit()
+                os.remove(path)
+                raise error.chunk_rejected(f"{file['path']} does not match its sha256, so upload it again", 0)
+
+        PostgreSQL.add_storage_usage(cur, repo_id, username, sum(file['size'] for file in files), len(files))
+        message = commit_message or 'No message provided'
+        cur.execute(
+            'INSERT INTO changesets (repo_id, author, message) VALUES (%s, %s, %s) RETURNING changeset_id;',
+            (repo_id, username, message)
+        )
+        changeset_id = cur.fetchone()[0]
+        changes = {}
+        for index, file in enumerate(files):
+            blob_hash = blob_store.put_file(cur, upload_sessions.part_path(upload_id, index), file['sha256'], repo_id)
+            cur.execute(
+                """
+                INSERT INTO commits (
+                    repo_id, author, version_major, version_minor, version_patch, rel_file_path, blob_hash,
+                    commit_message, changeset_id
+                )
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                RETURNING commit_id;
+                """,
+                (repo_id, username, *file['version'], file['path'], blob_hash, message, changeset_id)
+            )
+            changes[file['path']] = (blob_hash, cur.fetchone()[0], tuple(file['version']))
+        PostgreSQL.count_commits(cur, username, len(files))
+        PostgreSQL.advance_branch(cur, repo_id, changeset_id, changes, branch, expected)
+        cur.execute('UPDATE uploads SET changeset_id = %s WHERE upload_id = %s;', (changeset_id, upload_id))
+        logging.info(f"{username} committed upload {upload_id} as changeset {changeset_id} of {len(files)} files.")
+        return changeset_id
+
+    @staticmethod
+    def expire() -> int:
+        """
+        Deletes the uploads older than uploads.expire_after seconds, committed or not, and their files.
+
+        :return: How many uploads were deleted.
+        """
+        expired = PostgreSQL.query_db(
+            'DELETE FROM uploads WHERE created_on < %s RETURNING upload_id;',
+            (datetime.datetime.now() - datetime.timedelta(seconds=upload_sessions.config()['expire_after']),)
+        )
+        for (upload_id,) in expired:
+            shutil.rmtree(os.path.join(upload_sessions.config()['path'], upload_id), ignore_errors=True)
+        if expired:
+            logging.info(f"Deleted {len(expired)} expired uploads.")
+        return len(expired)
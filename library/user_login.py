@@ -1,3 +1,4 @@
+from library.async_storage import AsyncPostgreSQL
 from library.storage import var, PostgreSQL, dt
 from library.errors import error
 import subprocess
@@ -15,12 +16,12 @@ class users:
         """
         assert type(username) == str, "Username must be a string."
         assert type(password) == str, "Password must be a string."
-        if PostgreSQL().check_exists(username, not_exist_ok=True) is True:
+        if PostgreSQL.shared().check_exists(username, not_exist_ok=True) is True:
             raise error.user_already_exists
         if not len(password) >= 4: raise error.password_too_short
-        success = PostgreSQL().add_user(username, password)
+        success = PostgreSQL.shared().add_user(username, password)
         # Always make the first user to be created an admin. Check what their serial user ID is.
-        conn = PostgreSQL().get_connection()
+        conn = PostgreSQL.shared().get_connection()
         cur = conn.cursor()
 
         cur.execute(
@@ -31,20 +32,45 @@ class users:
         )
 
         if cur.fetchone() is None:
-            PostgreSQL().make_user_administrator(username)
+            PostgreSQL.shared().make_user_administrator(username)
 
         cur.close()
         conn.close()
 
         return success
 
+    @staticmethod
+    async def register_async(username, password):
+        """
+        Registers a user without blocking the event loop. Same as register().
+        :return:
+        """
+        assert type(username) == str, "Username must be a string."
+        assert type(password) == str, "Password must be a string."
+        db = AsyncPostgreSQL.shared()
+        if await db.check_exists(username, not_exist_ok=True) is True:
+            raise error.user_already_exists
+        if not len(password) >= 4: raise error.password_too_short
+        success = await db.add_user(username, password)
+        # Always make the first user to be created an admin. Check what their serial user ID is.
+        first_user = await db.fetchrow(
+            """
+            SELECT * FROM accounts
+            WHERE user_id = 1
+            """
+        )
+        if first_user is None:
+            await db.make_user_administrator(username)
+
+        return success
+
     @staticmethod
     def delete(username):
         """
         Deletes a user
         :return:
         """
-        PostgreSQL().delete_user(username)
+        PostgreSQL.shared().delete_user(username)
 
     @staticmethod
     def exists(username):
@@ -52,7 +78,7 @@ class users:
         Checks if a user exists
         :return:
         """
-        return PostgreSQL().check_exists(username)
+        return PostgreSQL.shared().check_exists(username)
 
     @staticmethod
     def get_pfp(username, dir_only=False) -> bytes | str:
@@ -110,7 +136,7 @@ class users:
         Returns the bio of the user
         :return:
         """
-        return PostgreSQL().get_bio(username)
+        return PostgreSQL.shared().get_bio(username)
 
 # noinspection PyMethodMayBeStatic
 class user_login:
@@ -123,65 +149,151 @@ class user_login:
         if not username is None:
             self.username = username
 
-            exists = PostgreSQL().check_exists(username)
+            exists = PostgreSQL.shared().check_exists(username)
             if not exists:
                 raise error.user_nonexistant
 
         self.password = password
 
         if password is not None and token is None:
-            if not PostgreSQL().get_password(username) == password:
+            if not PostgreSQL.shared().get_password(username) == password:
                 raise error.bad_password
+            self.is_admin = PostgreSQL.shared().is_user_administrator(self.username)
         elif password is None and token is not None:
-            if not PostgreSQL().validate_token(token):
+            # Determines who the token belongs to, and whether they are an admin, in one query
+            resolved = PostgreSQL.shared().resolve_principal(token)
+            if resolved is None:
                 raise error.bad_token
-            # Determines who the token belongs to
-            self.username = PostgreSQL().get_token_owner(token)
+            self.username, self.is_admin, _ = resolved
         else:
             raise PermissionError("Either password or token must be provided.")
 
-        self.is_admin = PostgreSQL().is_user_administrator(self.username)
         self.user_config = f'data/users/{self.username}/config.json'
 
+    @classmethod
+    def _logged_in(cls, username, is_admin, password=None) -> 'user_login':
+        """
+        Makes a user_login for a user whose identity has already been checked, without touching the database.
+        """
+        user = cls.__new__(cls)
+        user.username = username
+        user.password = password
+        user.is_admin = is_admin
+        user.user_config = f'data/users/{username}/config.json'
+        return user
+
+    @classmethod
+    async def from_password(cls, username:str, password:str) -> 'user_login':
+        """
+        The async version of user_login(username=..., password=...), for use inside the API.
+        """
+        db = AsyncPostgreSQL.shared()
+        await db.check_exists(username)
+        if not await db.get_password(username) == password:
+            raise error.bad_password
+        return cls._logged_in(username, await db.is_user_administrator(username), password=password)
+
+    @staticmethod
+    async def from_token(token:str) -> 'principal':
+        """
+        The async version of user_login(token=...), for use inside the API.
+        Resolves the token's owner, admin flag and restricted flag in a single query.
+
+        :raises error.bad_token: If the token is not valid.
+        """
+        if not isinstance(token, str):
+            raise error.bad_token
+        resolved = await AsyncPostgreSQL.shared().resolve_principal(token)
+        if resolved is None:
+            raise error.bad_token
+        username, is_admin, restricted = resolved
+        return principal(username, is_admin, restricted, token=token)
+
     def generate_token(self):
         """
         Generates a token for the user
         :return:
         """
         token = secrets.token_urlsafe(128)
-        PostgreSQL().save_token(
+        PostgreSQL.shared().save_token(
+            belongs_to=self.username,
+            token=token
+        )
+        return token
+
+    async def generate_token_async(self):
+        """
+        Generates a token for the user without blocking the event loop
+        :return:
+        """
+        token = secrets.token_urlsafe(128)
+        await AsyncPostgreSQL.shared().save_token(
             belongs_to=self.username,
             token=token
         )
         return token
 
     def is_restricted(self):
-        return PostgreSQL().is_restricted(self.username)
+        return PostgreSQL.shared().is_restricted(self.username)
 
     def set_restricted(self, status:bool):
-        return PostgreSQL().set_restricted(self.username, status)
+        return PostgreSQL.shared().set_restricted(self.username, status)
 
     def list_private_repos(self):
-        return PostgreSQL().list_private_repos(self.username)
+        return PostgreSQL.shared().list_private_repos(self.username)
 
     def list_public_repos(self):
-        return PostgreSQL().list_public_repos(self.username)
+        return PostgreSQL.shared().list_public_repos(self.username)
 
     def create_repository(self, repo_name, description, is_private):
         """
         Register a repository in the database.
         """
-        PostgreSQL().add_repository(
+        added = PostgreSQL.shared().add_repository(
+            owner=self.username,
+            name=repo_name,
+            description=description,
+            is_private=is_private
+        )
+        if not added:
+            return False
+
+        repo_path = f'data/users/{self.username}/repositories/{repo_name}'
+        os.makedirs(repo_path, exist_ok=True)
+
+        # Create the .rdvcs file
+        # A copy, so the defaults are not changed for every repository made after this one.
+        config = dict(dt.REPO_CONFIG)
+        config["repo_id"] = repo_name
+        config["version"] = [1,0,0]  # Major, Minor, Patch
+        config["repo_name"] = repo_name
+        config["description"] = description
+
+        var.fill_json(
+            file=os.path.join(repo_path, '.rdvcs'),
+            data=config
+        )
+        return True
+
+    async def create_repository_async(self, repo_name, description, is_private) -> bool:
+        """
+        Register a repository in the database without blocking the event loop.
+        """
+        added = await AsyncPostgreSQL.shared().add_repository(
             owner=self.username,
             name=repo_name,
             description=description,
             is_private=is_private
         )
+        if not added:
+            return False
+
         repo_path = f'data/users/{self.username}/repositories/{repo_name}'
         os.makedirs(repo_path, exist_ok=True)
 
         # Create the .rdvcs file
-        config = dt.REPO_CONFIG
+        # A copy, so the defaults are not changed for every repository made after this one.
+        config = dict(dt.REPO_CONFIG)
         config["repo_id"] = repo_name
         config["version"] = [1,0,0]  # Major, Minor, Patch
         config["repo_name"] = repo_name
@@ -191,21 +303,22 @@ class user_login:
             file=os.path.join(repo_path, '.rdvcs'),
             data=config
         )
+        return True
 
     def delete_repository(self, repo_name):
         """
         Deletes a repository
         """
-        PostgreSQL().delete_repository(self.username, repo_name)
+        PostgreSQL.shared().delete_repository(self.username, repo_name)
 
     def walk_repository(self, repo_name):
         """
         Walks through the repository
         """
-        return PostgreSQL().walk_repository(repo_name, self.username)
+        return PostgreSQL.shared().walk_repository(repo_name, self.username, view_private=True)
 
     def list_docker_containers(self) -> list:
-        containers_owned = PostgreSQL().list_users_docker_containers(self.username)
+        containers_owned = PostgreSQL.shared().list_users_docker_containers(self.username)
         if not containers_owned:
             return []
 
@@ -267,7 +380,7 @@ class user_login:
             container_id = result.stdout.decode().strip()
 
             # Register the container in the database
-            PostgreSQL().register_docker_container(
+            PostgreSQL.shared().register_docker_container(
                 username=self.username,
                 container_id=container_id
             )
@@ -294,7 +407,7 @@ class user_login:
             print(f"Error deleting container {container_id}: {e}")
             return False
 
-        PostgreSQL().remove_docker_container(container_id)
+        PostgreSQL.shared().remove_docker_container(container_id)
         return True
 
     def start_docker_container(self, container_id:str) -> bool:
@@ -304,7 +417,7 @@ class user_login:
         :return:
         """
         # Checks if the user has authority over the container
-        users_containers = PostgreSQL().list_users_docker_containers(self.username)
+        users_containers = PostgreSQL.shared().list_users_docker_containers(self.username)
         if container_id not in users_containers:
             return False
 
@@ -327,7 +440,7 @@ class user_login:
         :return:
         """
         # Checks if the user has authority over the container
-        users_containers = PostgreSQL().list_users_docker_containers(self.username)
+        users_containers = PostgreSQL.shared().list_users_docker_containers(self.username)
         if container_id not in users_containers:
             return False
 
@@ -341,4 +454,20 @@ class user_login:
             print(f"Error stopping container {container_id}: {e}")
             return False
 
-        return True
\ No newline at end of file
+        return True
+
+class principal(user_login):
+    """
+    A user who has been authenticated by token, with their admin and restricted flags already looked up.
+    This is what QuartAPI.require_authentication hands to API handlers as 'user'.
+    """
+    def __init__(self, username:str, is_admin:bool, restricted:bool, token:str=None):
+        self.username = username
+        self.password = None
+        self.token = token
+        self.is_admin = bool(is_admin)
+        self.restricted = bool(restricted)
+        self.user_config = f'data/users/{self.username}/config.json'
+
+    def is_restricted(self):
+        return self.restricted
@@ -1,4 +1,4 @@
-from library.storage import PostgreSQL
+from library.storage import PostgreSQL, read_cache
 from library.errors import error
 
 class vcs:
@@ -7,17 +7,18 @@ class vcs:
     """
     @staticmethod
     def list_pub_repositories(owner):
-        return PostgreSQL().list_public_repos(owner)
+        return PostgreSQL.shared().list_public_repos(owner)
 
     @staticmethod
+    @read_cache.cached('repo_exists')
     def repository_exists(owner, repo_name):
-        conn = PostgreSQL().get_connection()
+        conn = PostgreSQL.shared().get_connection(readonly=True)
         cursor = conn.cursor()
 
         # Do not show if a private repository exists.
         cursor.execute(
             """
-            SELECT EXISTS(SELECT 1 FROM repositories WHERE owner = %s AND name = %s AND is_private = FALSE)
+            SELECT EXISTS(SELECT 1 FROM repositories WHERE owner = %s AND name = %s AND private = FALSE)
             """,
             (owner, repo_name)
         )
@@ -45,15 +46,15 @@ class repository_handler:
             raise error.repository_not_found(repo_name)
 
         # If the owner of the repository is not what's set as 'username', raise a permission error.
-        if not PostgreSQL().get_repository_owner(self.repo_name) == self.owner:
+        if not PostgreSQL.shared().get_repository_owner(self.repo_name) == self.owner:
             raise error.insufficient_permissions
 
     def get_is_private(self):
-        conn = PostgreSQL().get_connection()
+        conn = PostgreSQL.shared().get_connection(readonly=True)
         cursor = conn.cursor()
 
         cursor.execute(
-            'SELECT is_private FROM repositories WHERE name = %s AND owner = %s',
+            'SELECT private FROM repositories WHERE name = %s AND owner = %s',
             (self.repo_name, self.owner)
         )
         is_private = cursor.fetchone()[0]
@@ -64,10 +65,10 @@ class repository_handler:
         return is_private
 
     def set_privacy(self, is_private):
-        return PostgreSQL().update_repository_is_private(self.owner, self.repo_name, is_private)
+        return PostgreSQL.shared().update_repository_is_private(self.owner, self.repo_name, is_private)
 
     def get_description(self):
-        conn = PostgreSQL().get_connection()
+        conn = PostgreSQL.shared().get_connection(readonly=True)
         cursor = conn.cursor()
 
         cursor.execute(
@@ -94,4 +95,28 @@ class repository_handler:
         Walks the repository and returns a list of files and directories.
         :return:
         """
-        return PostgreSQL().walk_repository(self.owner, self.repo_name)
+        return PostgreSQL.shared().walk_repository(self.repo_name, self.owner)
+
+    def diff_file(self, rel_file_path: str, old_version: tuple, new_version: tuple) -> dict:
+        """
+        Diffs two versions of a file of the repository.
+        :return: The diff, as PostgreSQL.diff_file() gives it.
+        """
+        return PostgreSQL.shared().diff_file(self.owner, self.repo_name, rel_file_path, old_version, new_version,
+                                             view_private=True)
+
+    def diff_changesets(self, old_changeset: int, new_changeset: int) -> list:
+        """
+        Diffs every file that differs between two changesets of the repository.
+        :return: The diffs, as PostgreSQL.diff_changesets() gives them.
+        """
+        return PostgreSQL.shared().diff_changesets(self.owner, self.repo_name, old_changeset, new_changeset,
+                                                   view_private=True)
+
+    def merge(self, source: str, target: str, author: str, commit_message: str = None, dry_run=False) -> dict:
+        """
+        Merges a branch or tag of the repository into one of its branches.
+        :return: The outcome, as PostgreSQL.merge_branches() gives it.
+        """
+        return PostgreSQL.shared().merge_branches(self.owner, self.repo_name, source, target, author, commit_message,
+                                                  dry_run)
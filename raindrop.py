@@ -42,9 +42,9 @@ class raindrop:
                 webgui.start_container()
 
         # Ensures the DB Is running
-        if not PostgreSQL().container_running():
+        if not PostgreSQL.shared().container_running():
             print("PostgreSQL is not running. Starting the PostgreSQL container...")
-            PostgreSQL().start_db()
+            PostgreSQL.shared().start_db()
 
         # Start the API
         API_Process = multiprocessing.Process(
@@ -71,11 +71,11 @@ class raindrop:
 
         self.cli.register_command(
             cmd='postgre',
-            func=postgre_cli().main,
+            func=postgre_cli.enter,
             aliases=['pg', 'db', 'database', 'postgres', 'postgresql', 'storage', 'dbcli'],
         )
 
-        PostgreSQL().modernize()
+        PostgreSQL.shared().modernize()
         try:
             self.cli.main()
         except KeyboardInterrupt:
@@ -0,0 +1,79 @@
+from library.storage import PostgreSQL, connection_pool
+from library.migrations import schema_migrator
+import psycopg2.extensions
+import unittest
+import tempfile
+import psycopg2
+import secrets
+import os
+
+# The tests that need a PostgreSQL server only run when this is set to a libpq connection string for a user that
+# can create databases, eg "host=localhost port=5432 user=postgres password=secret dbname=postgres".
+DSN = os.environ.get('RAINDROP_TEST_DATABASE')
+
+class database_test(unittest.TestCase):
+    """
+    Runs a test class against a database made for it, which is dropped once the class is done. PostgreSQL and
+    everything built on it connect to that database. The working folder is a temporary one for the class, so
+    settings.json, blob files and logs stay out of the checkout.
+    """
+    # If False, the database is left empty, for tests of the migrations themselves.
+    migrate = True
+
+    @classmethod
+    def setUpClass(cls):
+        if not DSN:
+            raise unittest.SkipTest("RAINDROP_TEST_DATABASE is not set.")
+
+        cls.admin_details = psycopg2.extensions.parse_dsn(DSN)
+        cls.database_name = f'rd_test_{secrets.token_hex(4)}'
+        cls._admin(f'CREATE DATABASE {cls.database_name};')
+
+        # The same keys as PostgreSQL.get_details() gives, which asyncpg needs all of.
+        cls.details = {key: cls.admin_details.get(key) for key in ('host', 'port', 'user', 'password')}
+        cls.details['database'] = cls.database_name
+
+        cls._previous_folder = os.getcwd()
+        cls._folder = tempfile.TemporaryDirectory()
+        os.chdir(cls._folder.name)
+        os.makedirs('logs', exist_ok=True)
+        cls._previous_details = PostgreSQL._details_cache
+        PostgreSQL._details_cache = dict(cls.details)
+
+        if cls.migrate:
+            schema_migrator(PostgreSQL.shared().get_connection).migrate()
+
+    @classmethod
+    def tearDownClass(cls):
+        for pool in connection_pool.all_pools():
+            if pool.details.get('database') == cls.database_name:
+                pool.closeall()
+        PostgreSQL._details_cache = cls._previous_details
+        os.chdir(cls._previous_folder)
+        cls._folder.cleanup()
+        cls._admin(f'DROP DATABASE IF EXISTS {cls.database_name} WITH (FORCE);')
+
+    @classmethod
+    def _admin(cls, statement: str):
+        # CREATE and DROP DATABASE can not run inside a transaction.
+        conn = psycopg2.connect(**cls.admin_details)
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(statement)
+        finally:
+            conn.close()
+
+    def query(self, query: str, args: tuple = ()) -> list:
+        """
+        Runs a query on a connection of its own and commits it.
+
+        :return: The rows it returned, or [] if it returns none.
+        """
+        conn = psycopg2.connect(**self.details)
+        try:
+            with conn, conn.cursor() as cur:
+                cur.execute(query, args)
+                return cur.fetchall() if cur.description is not None else []
+        finally:
+            conn.close()
@@ -0,0 +1,84 @@
+from library.storage import PostgreSQL
+from tests.database import database_test
+import unittest
+import datetime
+
+class test_commit_activity(database_test):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        db = PostgreSQL.shared()
+        for username in ('ada', 'bob'):
+            db.add_user(username, 'correct horse battery staple')
+            db.add_repository(username, 'docs', '', False)
+
+    def setUp(self):
+        self.db = PostgreSQL.shared()
+        # The database's day, which is the one commits are counted under.
+        self.today = self.query('SELECT CURRENT_DATE;')[0][0]
+
+    def tearDown(self):
+        self.query('DELETE FROM commits;')
+        self.query('DELETE FROM commit_activity;')
+
+    def counted(self, username: str) -> dict:
+        return self.db.commit_activity(username, self.today - datetime.timedelta(days=30), self.today)
+
+    def commit(self, author: str, repo_owner: str, rel_file_path: str):
+        self.db.add_commit(repo_owner, 'docs', author, rel_file_path, (1, 0, 0), rel_file_path.encode())
+
+    def test_counts_match_commits(self):
+        for rel_file_path in ('/a.txt', '/b.txt', '/c.txt'):
+            self.commit('ada', 'ada', rel_file_path)
+        self.commit('bob', 'bob', '/a.txt')
+        # To someone else's repository, which counts for the author.
+        self.commit('bob', 'ada', '/d.txt')
+
+        self.assertEqual(self.counted('ada'), {self.today: 3})
+        self.assertEqual(self.counted('bob'), {self.today: 2})
+        self.assertEqual(self.counted('*'), {self.today: 5})
+        self.assertEqual(
+            self.counted('*'),
+            dict(self.query('SELECT commit_date::DATE, COUNT(*)::INTEGER FROM commits GROUP BY 1;'))
+        )
+
+    def test_slots_add_up(self):
+        # Counts from different connections go in different rows, which are added up when read.
+        connections = [self.db.pool.getconn() for _ in range(3)]
+        try:
+            for commits, conn in enumerate(connections, start=1):
+                cur = conn.cursor()
+                PostgreSQL.count_commits(cur, 'ada', commits)
+                PostgreSQL.count_commits(cur, 'ada', 0)
+                conn.commit()
+                cur.close()
+        finally:
+            for conn in connections:
+                conn.close()
+        self.assertGreater(self.query("SELECT COUNT(*) FROM commit_activity WHERE username = 'ada';")[0][0], 1)
+        self.assertEqual(self.counted('ada'), {self.today: 6})
+
+    def test_range(self):
+        days = [self.today - datetime.timedelta(days=offset) for offset in (0, 1, 5, 40)]
+        for slot, day in enumerate(days):
+            self.query(
+                'INSERT INTO commit_activity (username, day, slot, commits) VALUES (%s, %s, %s, 2), (%s, %s, %s, 1);',
+                ('ada', day, slot, 'bob', day, slot)
+            )
+        self.assertEqual(self.db.commit_activity('ada', days[2], days[1]), {days[1]: 2, days[2]: 2})
+        self.assertEqual(self.db.commit_activity('*', days[2], days[2]), {days[2]: 3})
+        self.assertEqual(self.counted('bob'), {day: 1 for day in days[:3]})
+
+    def test_delete_repository(self):
+        self.db.add_repository('bob', 'scratch', '', False)
+        self.commit('bob', 'bob', '/a.txt')
+        self.db.add_commit('bob', 'scratch', 'bob', '/a.txt', (1, 0, 0), b'a')
+        self.db.add_commit('bob', 'scratch', 'ada', '/b.txt', (1, 0, 0), b'b')
+
+        self.assertTrue(self.db.delete_repository('bob', 'scratch'))
+        self.assertEqual(self.counted('bob'), {self.today: 1})
+        # Days left with no commits are not listed.
+        self.assertEqual(self.counted('ada'), {})
+
+if __name__ == '__main__':
+    unittest.main()
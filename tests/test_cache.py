@@ -0,0 +1,84 @@
+from library.async_storage import AsyncPostgreSQL
+from library.storage import PostgreSQL, read_cache
+from tests.database import database_test
+import unittest
+import asyncio
+
+class test_read_cache(database_test):
+    def setUp(self):
+        read_cache.clear()
+        self.addCleanup(read_cache.clear)
+        self.db = PostgreSQL.shared()
+        self.username = f'user{self.id().rsplit("_", 1)[-1]}'
+        self.db.add_user(self.username, 'correct horse battery staple')
+
+    def test_bio(self):
+        self.db.set_bio(self.username, 'first')
+        self.assertEqual(self.db.get_bio(self.username), 'first')
+        # Changed behind the cache's back, so it is only seen once the entry is dropped.
+        self.query('UPDATE accounts SET bio = %s WHERE username = %s;', ('behind', self.username))
+        self.assertEqual(self.db.get_bio(self.username), 'first')
+
+        self.db.set_bio(self.username, 'second')
+        self.assertEqual(self.db.get_bio(self.username), 'second')
+
+    def test_repository(self):
+        self.db.add_repository(self.username, 'docs', 'first', False)
+        self.assertEqual(self.db.get_repo(self.username, 'docs')[2], 'first')
+        self.assertEqual(len(self.db.list_public_repos(self.username)), 1)
+        self.assertEqual(len(self.db.list_public_repos(self.username, 0, 1)), 1)
+
+        self.db.update_repository_description(self.username, 'docs', 'second')
+        self.assertEqual(self.db.get_repo(self.username, 'docs')[2], 'second')
+
+        # Every page of the list goes with the repository's entries.
+        self.db.add_repository(self.username, 'site', '', False)
+        self.assertEqual(len(self.db.list_public_repos(self.username)), 2)
+        self.assertEqual(len(self.db.list_public_repos(self.username, 0, 1)), 1)
+        self.db.update_repository_is_private(self.username, 'site', True)
+        self.assertEqual(len(self.db.list_public_repos(self.username)), 1)
+        self.assertTrue(self.db.get_repo(self.username, 'site')[6])
+
+        self.db.update_repository_name(self.username, 'docs', 'manual')
+        self.assertIsNone(self.db.get_repo(self.username, 'docs'))
+        self.assertEqual(self.db.get_repo(self.username, 'manual')[2], 'second')
+
+        self.assertTrue(self.db.delete_repository(self.username, 'manual'))
+        self.assertIsNone(self.db.get_repo(self.username, 'manual'))
+
+    def test_delete_user(self):
+        self.db.add_repository(self.username, 'docs', '', False)
+        self.assertIsNotNone(self.db.get_repo(self.username, 'docs'))
+        self.query('DELETE FROM repositories WHERE owner = %s;', (self.username,))
+        self.db.delete_user(self.username)
+        self.db.add_user(self.username, 'correct horse battery staple')
+        self.assertIsNone(self.db.get_repo(self.username, 'docs'))
+        self.assertEqual(self.db.list_public_repos(self.username), [])
+
+    def test_sync_and_async(self):
+        # Both share one cache, so a write through either drops what the other has cached.
+        async_db = AsyncPostgreSQL.shared()
+
+        async def run():
+            try:
+                await async_db.set_bio(self.username, 'async')
+                self.assertEqual(self.db.get_bio(self.username), 'async')
+                self.db.set_bio(self.username, 'sync')
+                self.assertEqual(await async_db.get_bio(self.username), 'sync')
+
+                self.db.add_repository(self.username, 'docs', '', True)
+                self.assertFalse(await async_db.repository_exists(self.username, 'docs'))
+                self.assertTrue(await async_db.repository_exists(self.username, 'docs', True))
+                await async_db.update_repository_is_private(self.username, 'docs', False)
+                self.assertTrue(await async_db.repository_exists(self.username, 'docs'))
+                self.assertFalse(self.db.get_repo(self.username, 'docs')[6])
+                await async_db.delete_repository(self.username, 'docs')
+                self.assertFalse(await async_db.repository_exists(self.username, 'docs', True))
+                self.assertIsNone(self.db.get_repo(self.username, 'docs'))
+            finally:
+                await async_db.close()
+
+        asyncio.run(run())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+from library.delta import delta
+import unittest
+import random
+
+class test_delta(unittest.TestCase):
+    def round_trip(self, base: bytes, target: bytes) -> bytes:
+        patch = delta.encode(base, target)
+        self.assertEqual(delta.apply(base, patch), target)
+        return patch
+
+    def test_edited_text(self):
+        rng = random.Random(1)
+        for _ in range(100):
+            lines = [f'line {index} {rng.random()}\n'.encode() for index in range(rng.randint(0, 200))]
+            edited = list(lines)
+            for _ in range(rng.randint(0, 10)):
+                position = rng.randint(0, len(edited))
+                if rng.random() < 0.5 and position < len(edited):
+                    del edited[position]
+                else:
+                    edited.insert(position, f'new {rng.random()}\n'.encode())
+            self.round_trip(b''.join(lines), b''.join(edited))
+
+    def test_random_bytes(self):
+        rng = random.Random(2)
+        for _ in range(100):
+            base = bytes(rng.choice(b'ab\n\r\0') for _ in range(rng.randint(0, 300)))
+            target = bytes(rng.choice(b'ab\n\r\0') for _ in range(rng.randint(0, 300)))
+            self.round_trip(base, target)
+
+    def test_empty(self):
+        self.round_trip(b'', b'')
+        self.round_trip(b'', b'something\n')
+        self.round_trip(b'something\n', b'')
+
+    def test_similar_content_is_small(self):
+        base = b''.join(f'line {index}\n'.encode() for index in range(1000))
+        target = base.replace(b'line 500\n', b'changed\n')
+        self.assertLess(len(self.round_trip(base, target)), 100)
+
+    def test_wrong_base(self):
+        patch = delta.encode(b'base content\n', b'target content\n')
+        with self.assertRaises(ValueError):
+            delta.apply(b'a longer base than before\n', patch)
+        with self.assertRaises(ValueError):
+            delta.apply(b'base content\n', b'not a delta')
+
+if __name__ == '__main__':
+    unittest.main()
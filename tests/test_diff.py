@@ -0,0 +1,115 @@
+from library.diff import diff_engine
+import unittest
+import random
+
+def lcs_length(old: list, new: list) -> int:
+    table = [[0] * (len(new) + 1) for _ in range(len(old) + 1)]
+    for i in range(len(old) - 1, -1, -1):
+        for j in range(len(new) - 1, -1, -1):
+            if old[i] == new[j]:
+                table[i][j] = table[i + 1][j + 1] + 1
+            else:
+                table[i][j] = max(table[i + 1][j], table[i][j + 1])
+    return table[0][0]
+
+def apply_hunks(old: list, hunks: list) -> list:
+    """
+    Applies hunks to the lines they were made from, checking every line they say old has.
+    """
+    new = []
+    at = 0
+    for hunk in hunks:
+        start = hunk['old_start'] - 1 if hunk['old_lines'] else hunk['old_start']
+        assert start >= at, "Hunks overlap or are out of order."
+        new.extend(old[at:start])
+        at = start
+        for op, text in hunk['lines']:
+            if op in ' -':
+                assert old[at] == text, f"Line {at + 1} of old is not {text!r}."
+                at += 1
+            if op in ' +':
+                new.append(text)
+    new.extend(old[at:])
+    return new
+
+def random_lines(rng: random.Random, count: int, alphabet: str) -> list:
+    return [f'{rng.choice(alphabet)}\n' for _ in range(count)]
+
+class test_matching_lines(unittest.TestCase):
+    def test_is_a_longest_common_subsequence(self):
+        rng = random.Random(1)
+        for _ in range(300):
+            alphabet = 'abcdefgh'[:rng.randint(1, 8)]
+            old = random_lines(rng, rng.randint(0, 30), alphabet)
+            new = random_lines(rng, rng.randint(0, 30), alphabet)
+            matches = diff_engine.matching_lines(old, new)
+
+            for (i, j), (next_i, next_j) in zip(matches, matches[1:]):
+                self.assertLess(i, next_i)
+                self.assertLess(j, next_j)
+            for i, j in matches:
+                self.assertEqual(old[i], new[j])
+            self.assertEqual(len(matches), lcs_length(old, new), (old, new))
+
+    def test_edits_of_a_file(self):
+        rng = random.Random(2)
+        old = [f'line {index}\n' for index in range(200)]
+        for _ in range(50):
+            new = list(old)
+            for _ in range(rng.randint(1, 10)):
+                position = rng.randrange(len(new) + 1)
+                if rng.random() < 0.5 and position < len(new):
+                    del new[position]
+                else:
+                    new.insert(position, f'added {rng.random()}\n')
+            self.assertEqual(len(diff_engine.matching_lines(old, new)), lcs_length(old, new))
+
+class test_hunks(unittest.TestCase):
+    def test_round_trip(self):
+        rng = random.Random(3)
+        for _ in range(300):
+            alphabet = 'abcdef'[:rng.randint(1, 6)]
+            old = random_lines(rng, rng.randint(0, 40), alphabet)
+            new = random_lines(rng, rng.randint(0, 40), alphabet)
+            context = rng.randint(0, 4)
+            self.assertEqual(apply_hunks(old, diff_engine.hunks(old, new, context)), new, (old, new, context))
+
+    def test_identical_has_no_hunks(self):
+        lines = ['a\n', 'b\n', 'c\n']
+        self.assertEqual(diff_engine.hunks(lines, list(lines)), [])
+
+    def test_context_and_numbering(self):
+        old = [f'{index}\n' for index in range(1, 21)]
+        new = list(old)
+        new[9] = 'ten\n'
+        hunks = diff_engine.hunks(old, new, 3)
+        self.assertEqual(len(hunks), 1)
+        self.assertEqual(
+            (hunks[0]['old_start'], hunks[0]['old_lines'], hunks[0]['new_start'], hunks[0]['new_lines']), (7, 7, 7, 7)
+        )
+        self.assertEqual(hunks[0]['lines'][3:5], [['-', '10\n'], ['+', 'ten\n']])
+
+    def test_changes_far_apart_are_separate_hunks(self):
+        old = [f'{index}\n' for index in range(1, 31)]
+        new = list(old)
+        new[2] = 'three\n'
+        new[27] = 'twenty eight\n'
+        self.assertEqual(len(diff_engine.hunks(old, new, 3)), 2)
+        self.assertEqual(len(diff_engine.hunks(old, new, 12)), 1)
+
+    def test_added_file_starts_at_zero(self):
+        hunks = diff_engine.hunks([], ['a\n', 'b\n'])
+        self.assertEqual((hunks[0]['old_start'], hunks[0]['old_lines']), (0, 0))
+        self.assertEqual((hunks[0]['new_start'], hunks[0]['new_lines']), (1, 2))
+
+class test_lines(unittest.TestCase):
+    def test_keeps_line_endings(self):
+        self.assertEqual(diff_engine._lines(b'a\r\nb\n\x0cc'), ['a\r\n', 'b\n', '\x0cc'])
+        self.assertEqual(diff_engine._lines(b''), [])
+
+    def test_binary_is_none(self):
+        self.assertIsNone(diff_engine._lines(b'a\0b'))
+        self.assertIsNone(diff_engine._lines(b'\xff\xfe'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+from library.graph import commit_graph
+import unittest
+import random
+
+class no_database:
+    """
+    A cursor for when every row should come from the cache.
+    """
+    def execute(self, query, args=None):
+        raise AssertionError("The graph went to the database for a changeset that is cached.")
+
+def random_dag(rng: random.Random, size: int, first_id: int = 1) -> dict:
+    """
+    :return: The parent ids of each changeset. Ids go up with time, and some changesets start a new root.
+    """
+    parents = {}
+    ids = []
+    for changeset_id in range(first_id, first_id + size):
+        if not ids or rng.random() < 0.03:
+            chosen = []
+        else:
+            # Mostly a recent changeset, as a branch is, sometimes an old one, and sometimes two, as a merge is.
+            recent = ids[-rng.randint(1, min(len(ids), 8)):]
+            chosen = {rng.choice(recent)}
+            if rng.random() < 0.25:
+                chosen.add(rng.choice(ids))
+            chosen = sorted(chosen)
+        parents[changeset_id] = chosen
+        ids.append(changeset_id)
+    return parents
+
+def ancestors(parents: dict, changeset_id: int) -> set:
+    found = set()
+    stack = [changeset_id]
+    while stack:
+        current = stack.pop()
+        if current not in found:
+            found.add(current)
+            stack.extend(parents[current])
+    return found
+
+class test_commit_graph(unittest.TestCase):
+    def setUp(self):
+        commit_graph._cache.clear()
+        self.cur = no_database()
+
+    def load(self, parents: dict) -> dict:
+        """
+        Puts a graph in the cache, as add() would have stored it.
+
+        :return: The generation of each changeset.
+        """
+        nodes = {}
+        for changeset_id in sorted(parents):
+            generation, bloom = commit_graph.make_node(
+                changeset_id, [nodes[parent] for parent in parents[changeset_id]]
+            )
+            nodes[changeset_id] = (tuple(parents[changeset_id]), generation, bloom)
+        commit_graph.max_cached = max(commit_graph.max_cached, len(nodes))
+        commit_graph._cache.update(nodes)
+        return {changeset_id: node[1] for changeset_id, node in nodes.items()}
+
+    def test_is_ancestor(self):
+        rng = random.Random(1)
+        for _ in range(5):
+            # Big enough to span several bloom spans.
+            parents = random_dag(rng, 300)
+            self.load(parents)
+            history = {changeset_id: ancestors(parents, changeset_id) for changeset_id in parents}
+            for _ in range(400):
+                ancestor, descendant = rng.choice(list(parents)), rng.choice(list(parents))
+                self.assertEqual(
+                    commit_graph.is_ancestor(self.cur, ancestor, descendant), ancestor in history[descendant],
+                    (ancestor, descendant)
+                )
+
+    def test_merge_base(self):
+        rng = random.Random(2)
+        for _ in range(5):
+            parents = random_dag(rng, 200)
+            generations = self.load(parents)
+            for _ in range(200):
+                left, right = rng.choice(list(parents)), rng.choice(list(parents))
+                common = ancestors(parents, left) & ancestors(parents, right)
+                expected = max(common, key=lambda changeset_id: (generations[changeset_id], changeset_id), default=None)
+                self.assertEqual(commit_graph.merge_base(self.cur, left, right), expected, (left, right))
+
+    def test_log(self):
+        rng = random.Random(3)
+        for _ in range(5):
+            parents = random_dag(rng, 200)
+            self.load(parents)
+            for _ in range(100):
+                head = rng.choice(list(parents))
+                exclude = rng.choice(list(parents)) if rng.random() < 0.5 else None
+                history = commit_graph.log(self.cur, head, exclude)
+
+                expected = ancestors(parents, head) - (ancestors(parents, exclude) if exclude is not None else set())
+                self.assertEqual(len(history), len(set(history)))
+                self.assertEqual(set(history), expected)
+                position = {changeset_id: index for index, changeset_id in enumerate(history)}
+                for changeset_id in history:
+                    for parent in parents[changeset_id]:
+                        if parent in position:
+                            self.assertLess(position[changeset_id], position[parent])
+
+                limit = rng.randint(1, 10)
+                self.assertEqual(commit_graph.log(self.cur, head, exclude, limit), history[:limit])
+
+    def test_generations_go_up(self):
+        parents = random_dag(random.Random(4), 100)
+        generations = self.load(parents)
+        for changeset_id, parent_ids in parents.items():
+            for parent in parent_ids:
+                self.assertGreater(generations[changeset_id], generations[parent])
+
+if __name__ == '__main__':
+    unittest.main()
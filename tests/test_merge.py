@@ -0,0 +1,76 @@
+from library.merge import merge_engine
+import unittest
+
+def lines(text: str) -> list:
+    return [f'{line}\n' for line in text.split()]
+
+class test_merge_lines(unittest.TestCase):
+    def test_changes_in_different_places(self):
+        base = lines('a b c d e f g')
+        ours = lines('a B c d e f g')
+        theirs = lines('a b c d e F g')
+        merged, conflicts = merge_engine.merge_lines(base, ours, theirs)
+        self.assertEqual(merged, lines('a B c d e F g'))
+        self.assertEqual(conflicts, [])
+
+    def test_only_one_side_changed(self):
+        base = lines('a b c')
+        changed = lines('a x y c')
+        self.assertEqual(merge_engine.merge_lines(base, changed, base), (changed, []))
+        self.assertEqual(merge_engine.merge_lines(base, base, changed), (changed, []))
+
+    def test_same_change_on_both_sides(self):
+        base = lines('a b c')
+        changed = lines('a B c d')
+        self.assertEqual(merge_engine.merge_lines(base, changed, list(changed)), (changed, []))
+
+    def test_additions_at_both_ends(self):
+        base = lines('m n o')
+        merged, conflicts = merge_engine.merge_lines(base, lines('start m n o'), lines('m n o end'))
+        self.assertEqual(merged, lines('start m n o end'))
+        self.assertEqual(conflicts, [])
+
+    def test_conflicting_changes(self):
+        base = lines('a b c d')
+        ours = lines('a b1 c d')
+        theirs = lines('a b2 c d')
+        merged, conflicts = merge_engine.merge_lines(base, ours, theirs)
+        self.assertEqual(merged, ours)
+        self.assertEqual(conflicts, [{'ours_start': 2, 'base': lines('b'), 'ours': lines('b1'), 'theirs': lines('b2')}])
+
+    def test_removed_on_one_side_and_changed_on_the_other(self):
+        base = lines('a b c')
+        ours = lines('a c')
+        theirs = lines('a B c')
+        merged, conflicts = merge_engine.merge_lines(base, ours, theirs)
+        self.assertEqual(merged, ours)
+        self.assertEqual(len(conflicts), 1)
+        self.assertEqual((conflicts[0]['ours'], conflicts[0]['theirs']), ([], lines('B')))
+
+    def test_different_additions_in_the_same_place(self):
+        base = lines('a b')
+        merged, conflicts = merge_engine.merge_lines(base, lines('a x b'), lines('a y b'))
+        self.assertEqual(merged, lines('a x b'))
+        self.assertEqual(
+            conflicts, [{'ours_start': 2, 'base': [], 'ours': lines('x'), 'theirs': lines('y')}]
+        )
+
+    def test_conflict_positions_count_in_ours(self):
+        base = lines('a b c d e f')
+        ours = lines('new1 new2 a b c D1 e f')
+        theirs = lines('a b c D2 e f')
+        merged, conflicts = merge_engine.merge_lines(base, ours, theirs)
+        self.assertEqual(merged, ours)
+        self.assertEqual([conflict['ours_start'] for conflict in conflicts], [6])
+        self.assertEqual(ours[conflicts[0]['ours_start'] - 1], 'D1\n')
+
+    def test_clean_merge_and_conflict_together(self):
+        base = lines('a b c d e f g h')
+        ours = lines('A b c d1 e f g h')
+        theirs = lines('a b c d2 e f g H')
+        merged, conflicts = merge_engine.merge_lines(base, ours, theirs)
+        self.assertEqual(merged, lines('A b c d1 e f g H'))
+        self.assertEqual(len(conflicts), 1)
+
+if __name__ == '__main__':
+    unittest.main()
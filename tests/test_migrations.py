@@ -0,0 +1,113 @@
+from library.migrations import schema_migrator, migration, MIGRATIONS
+from library.storage import PostgreSQL
+from tests.database import database_test
+import psycopg2.errors
+import threading
+import unittest
+import base64
+
+FILES = [
+    # path, version, content
+    ('/readme.md', (1, 0, 0), b'# Docs\n'),
+    ('/readme.md', (1, 1, 0), b'# Docs\n\nNow with more words.\n'),
+    ('/src/main.py', (1, 0, 0), b'print("hello")\n'),
+    # The same content as another file, so it is stored once.
+    ('/src/copy.py', (1, 0, 0), b'print("hello")\n'),
+]
+
+class test_schema_migrator(database_test):
+    migrate = False
+
+    def test_upgrade_baseline_with_file_data(self):
+        # A database as Raindrop made it before there were migrations, with files in commits.file_data.
+        schema_migrator(PostgreSQL.shared().get_connection, MIGRATIONS[:1]).migrate()
+        self.query("INSERT INTO accounts (username, password) VALUES ('ada', 'hash');")
+        repo_id = self.query(
+            "INSERT INTO repositories (owner, name, description) VALUES ('ada', 'docs', '') RETURNING repo_id;"
+        )[0][0]
+        for rel_file_path, version, content in FILES:
+            self.query(
+                """
+                INSERT INTO commits (repo_id, author, version_major, version_minor, version_patch, rel_file_path,
+                                     file_data)
+                VALUES (%s, 'ada', %s, %s, %s, %s, %s);
+                """,
+                (repo_id, *version, rel_file_path, base64.b64encode(content).decode())
+            )
+
+        migrator = schema_migrator(PostgreSQL.shared().get_connection)
+        self.assertEqual(migrator.migrate(), [m.version for m in MIGRATIONS[1:]])
+        self.assertEqual(migrator.migrate(), [])
+
+        self.assertEqual(
+            self.query('SELECT COUNT(*) FROM commits WHERE file_data IS NOT NULL OR blob_hash IS NULL;'), [(0,)]
+        )
+        self.assertEqual(self.query('SELECT COUNT(*) FROM blobs;'), [(3,)])
+        db = PostgreSQL.shared()
+        self.assertEqual(db.get_file('ada', 'docs', '/readme.md'), FILES[1][2])
+        self.assertEqual(db.get_file('ada', 'docs', '/readme.md', (1, 0, 0)), FILES[0][2])
+        self.assertEqual(db.get_file('ada', 'docs', '/src/copy.py'), FILES[3][2])
+
+class test_migration_steps(database_test):
+    migrate = False
+
+    def setUp(self):
+        self.query('DROP SCHEMA public CASCADE; CREATE SCHEMA public;')
+        self.migrator = lambda migrations: schema_migrator(PostgreSQL.shared().get_connection, migrations)
+
+    def tables(self) -> set:
+        return {row[0] for row in self.query("SELECT tablename FROM pg_tables WHERE schemaname = 'public';")}
+
+    def test_fresh_database(self):
+        migrator = self.migrator(MIGRATIONS)
+        self.assertEqual(migrator.migrate(), [m.version for m in MIGRATIONS])
+        self.assertEqual(migrator.current_version(), migrator.latest_version)
+        self.assertEqual(migrator.pending(), [])
+        self.assertEqual(self.query('SELECT COUNT(*) FROM schema_version;'), [(len(MIGRATIONS),)])
+
+    def test_failed_migration_rolls_back(self):
+        first = migration(1, 'first', ['CREATE TABLE first (id INTEGER);'])
+        broken = migration(2, 'broken', ['CREATE TABLE second (id INTEGER);', 'SELECT 1 / 0;'])
+        with self.assertRaises(psycopg2.errors.DivisionByZero):
+            self.migrator([first, broken]).migrate()
+        self.assertEqual(self.migrator([first]).current_version(), 1)
+        self.assertEqual(self.tables(), {'schema_version', 'first'})
+
+        fixed = migration(2, 'fixed', ['CREATE TABLE second (id INTEGER);'])
+        self.assertEqual(self.migrator([first, fixed]).migrate(), [2])
+        self.assertEqual(self.tables(), {'schema_version', 'first', 'second'})
+
+    def test_outside_transaction(self):
+        migrations = [
+            migration(1, 'table', ['CREATE TABLE items (id INTEGER);']),
+            migration(2, 'index', ['CREATE INDEX CONCURRENTLY IF NOT EXISTS items_id ON items (id);'], False),
+        ]
+        self.assertEqual(self.migrator(migrations).migrate(), [1, 2])
+        self.assertEqual(self.query("SELECT indexname FROM pg_indexes WHERE tablename = 'items';"), [('items_id',)])
+
+    def test_concurrent_migrators(self):
+        # Slow enough that both migrators find the migrations pending before either has applied them.
+        migrations = [
+            migration(version, f'table {version}', ['SELECT pg_sleep(0.2);', f'CREATE TABLE t{version} (id INTEGER);'])
+            for version in (1, 2, 3)
+        ]
+        applied, errors = [], []
+
+        def migrate():
+            try:
+                applied.extend(self.migrator(migrations).migrate())
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=migrate) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(applied), [1, 2, 3])
+        self.assertEqual(self.tables(), {'schema_version', 't1', 't2', 't3'})
+
+if __name__ == '__main__':
+    unittest.main()
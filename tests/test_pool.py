@@ -0,0 +1,99 @@
+from library.storage import connection_pool
+from tests.database import database_test
+from library.errors import error
+import threading
+import unittest
+
+class test_connection_pool(database_test):
+    migrate = False
+
+    def make_pool(self, **kwargs) -> connection_pool:
+        options = {'min_size': 0, 'max_size': 2, 'checkout_timeout': 0.2, 'health_check_interval': 30}
+        options.update(kwargs)
+        pool = connection_pool(self.details, **options)
+        self.addCleanup(pool.closeall)
+        return pool
+
+    def test_reuse(self):
+        pool = self.make_pool()
+        conn = pool.getconn()
+        raw = conn.raw
+        conn.close()
+        # Closing twice hands it back once.
+        conn.close()
+        self.assertEqual(pool.statistics()['idle'], 1)
+
+        conn = pool.getconn()
+        self.assertIs(conn.raw, raw)
+        conn.close()
+        stats = pool.statistics()
+        self.assertEqual((stats['created'], stats['checkouts'], stats['size']), (1, 2, 1))
+
+    def test_exhausted(self):
+        pool = self.make_pool()
+        first, second = pool.getconn(), pool.getconn()
+        with self.assertRaises(error.db_pool_exhausted):
+            pool.getconn()
+        self.assertEqual(pool.statistics()['timeouts'], 1)
+
+        # A checkout that is waiting gets the connection handed back.
+        pool.checkout_timeout = 10
+        got = []
+        waiting = threading.Thread(target=lambda: got.append(pool.getconn()))
+        waiting.start()
+        waiting.join(0.2)
+        self.assertTrue(waiting.is_alive())
+        raw = first.raw
+        first.close()
+        waiting.join()
+        self.assertIs(got[0].raw, raw)
+        got[0].close()
+        second.close()
+        self.assertEqual(pool.statistics()['size'], 2)
+
+    def test_rolls_back_on_return(self):
+        self.query('CREATE TABLE pool_test (value INTEGER);')
+        pool = self.make_pool(max_size=1)
+        conn = pool.getconn()
+        cur = conn.cursor()
+        cur.execute('INSERT INTO pool_test VALUES (1);')
+        cur.close()
+        conn.close()
+
+        self.assertEqual(self.query('SELECT COUNT(*) FROM pool_test;'), [(0,)])
+        conn = pool.getconn()
+        cur = conn.cursor()
+        cur.execute('SELECT COUNT(*) FROM pool_test;')
+        self.assertEqual(cur.fetchone(), (0,))
+        cur.close()
+        conn.close()
+
+    def test_broken_connection_replaced(self):
+        pool = self.make_pool(health_check_interval=0)
+        conn = pool.getconn()
+        pid = conn.get_backend_pid()
+        conn.close()
+        self.query('SELECT pg_terminate_backend(%s);', (pid,))
+
+        conn = pool.getconn()
+        self.assertNotEqual(conn.get_backend_pid(), pid)
+        conn.close()
+        stats = pool.statistics()
+        self.assertEqual((stats['failed_health_checks'], stats['created'], stats['size']), (1, 2, 1))
+
+    def test_idle_connections_closed(self):
+        pool = self.make_pool(min_size=1, max_size=3, idle_timeout=0)
+        connections = [pool.getconn() for _ in range(3)]
+        for conn in connections:
+            conn.close()
+        pool.getconn().close()
+        # All but min_size timed out. The one kept is the most recently used.
+        stats = pool.statistics()
+        self.assertEqual((stats['size'], stats['closed']), (1, 2))
+
+    def test_for_details(self):
+        self.assertIs(connection_pool.for_details(self.details), connection_pool.for_details(dict(self.details)))
+        self.assertIsNot(connection_pool.for_details(self.details), connection_pool.for_details(self.details, True))
+
+if __name__ == '__main__':
+    unittest.main()
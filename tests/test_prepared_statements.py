@@ -0,0 +1,179 @@
+from library.storage import PostgreSQL, connection_pool, pooled_connection, prepared_statements, replica_router
+from tests.database import database_test
+from unittest import mock
+import psycopg2.errors
+import unittest
+import psycopg2
+
+class fake_server:
+    """
+    A database server that only knows PREPARE and EXECUTE. Statements of the kinds in fail_on fail as they do
+    when a replica goes away.
+    """
+    def __init__(self, host: str, fail_on=()):
+        self.host = host
+        self.fail_on = set(fail_on)
+        self.statements = set()
+        self.executed = []
+
+class fake_connection:
+    def __init__(self, server: fake_server):
+        self.server = server
+        self.prepared = set()
+
+    def cursor(self, *args, **kwargs):
+        return fake_cursor(self)
+
+class fake_cursor:
+    def __init__(self, connection: fake_connection):
+        self.connection = connection
+        self.itersize = 2000
+
+    def execute(self, query, vars=None):
+        server = self.connection.server
+        kind, name = query.split()[:2]
+        if kind in server.fail_on:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        if kind == 'PREPARE':
+            if name in server.statements:
+                raise psycopg2.errors.DuplicatePreparedStatement(f'prepared statement "{name}" already exists')
+            server.statements.add(name)
+        elif name not in server.statements:
+            raise psycopg2.errors.InvalidSqlStatementName(f'prepared statement "{name}" does not exist')
+        server.executed.append((kind, name))
+
+class fake_pool:
+    def __init__(self, server: fake_server, replica: bool):
+        self.server = server
+        self.replica = replica
+        self.details = {'host': server.host, 'port': 5432}
+        self.returned = []
+
+    def getconn(self) -> pooled_connection:
+        return pooled_connection(self, fake_connection(self.server))
+
+    def putconn(self, raw_conn):
+        self.returned.append(raw_conn)
+
+class test_replica_fail_over(unittest.TestCase):
+    def run_on_failing_replica(self, fail_on: str):
+        """
+        Runs rd_get_repo on a replica that fails at fail_on, then again on the same checkout.
+
+        :return: The replica's and the primary's server.
+        """
+        replica, primary = fake_server('replica', fail_on=[fail_on]), fake_server('primary')
+        replica_pool, primary_pool = fake_pool(replica, True), fake_pool(primary, False)
+        with mock.patch.object(PostgreSQL, 'pool', new=property(lambda self: primary_pool)):
+            conn = replica_pool.getconn()
+            replica_conn = conn.raw
+            cur = conn.cursor()
+            prepared_statements.execute(conn, cur, 'rd_get_repo', ('ada', 'docs'))
+            # The next query on the checkout finds the statement prepared on the primary.
+            prepared_statements.execute(conn, conn.cursor(), 'rd_get_repo', ('ada', 'docs'))
+
+        self.assertIs(conn.raw.server, primary)
+        self.assertEqual(replica_pool.returned, [replica_conn])
+        # What each connection thinks is prepared is what its server has prepared.
+        self.assertEqual(replica_conn.prepared, replica.statements)
+        self.assertEqual(conn.raw.prepared, primary.statements)
+        self.assertEqual(primary.executed, [
+            ('PREPARE', 'rd_get_repo'), ('EXECUTE', 'rd_get_repo'), ('EXECUTE', 'rd_get_repo')
+        ])
+        return replica, primary
+
+    def tearDown(self):
+        # The replicas are fake, so forget that one of them failed.
+        replica_router._health.pop('replica:5432', None)
+
+    def test_prepare_fails(self):
+        replica, _ = self.run_on_failing_replica('PREPARE')
+        self.assertEqual(replica.statements, set())
+
+    def test_execute_fails(self):
+        replica, _ = self.run_on_failing_replica('EXECUTE')
+        self.assertEqual(replica.statements, {'rd_get_repo'})
+
+    def test_primary_does_not_fail_over(self):
+        primary = fake_server('primary', fail_on=['EXECUTE'])
+        conn = fake_pool(primary, False).getconn()
+        with self.assertRaises(psycopg2.OperationalError):
+            prepared_statements.execute(conn, conn.cursor(), 'rd_get_repo', ('ada', 'docs'))
+
+class test_prepared_statements(database_test):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        db = PostgreSQL.shared()
+        db.add_user('ada', 'correct horse battery staple')
+        db.add_repository('ada', 'docs', 'The docs', False)
+        db.make_user_administrator('ada')
+        cls.token = 'a-token'
+        db.save_token('ada', cls.token)
+
+    def setUp(self):
+        self.pool = connection_pool(self.details, min_size=0, max_size=1)
+        self.addCleanup(self.pool.closeall)
+
+    def run_statement(self, conn, name: str, args: tuple) -> list:
+        cur = conn.cursor()
+        try:
+            prepared_statements.execute(conn, cur, name, args)
+            return cur.fetchall()
+        finally:
+            cur.close()
+
+    def server_statements(self, conn) -> set:
+        cur = conn.cursor()
+        try:
+            cur.execute('SELECT name FROM pg_prepared_statements;')
+            return {row[0] for row in cur.fetchall()}
+        finally:
+            cur.close()
+
+    def test_queries(self):
+        # Every statement prepares against the current schema, and finds what the plain query finds.
+        args = {
+            'rd_token_owner': (self.token,),
+            'rd_resolve_principal': (self.token,),
+            'rd_check_exists': ('ada',),
+            'rd_get_repo': ('ada', 'docs'),
+        }
+        self.assertEqual(set(args), set(prepared_statements.QUERIES))
+        plain = psycopg2.connect(**self.details)
+        conn = self.pool.getconn()
+        try:
+            for name, statement_args in args.items():
+                with self.subTest(name):
+                    rows = self.run_statement(conn, name, statement_args)
+                    self.assertEqual(len(rows), 1)
+                    self.assertEqual(rows, self.run_statement(plain, name, statement_args))
+            self.assertEqual(self.server_statements(conn), set(args))
+            self.assertEqual(self.server_statements(plain), set())
+        finally:
+            conn.close()
+            plain.close()
+
+    def test_prepared_once_per_connection(self):
+        before = prepared_statements.statistics()
+        for _ in range(3):
+            conn = self.pool.getconn()
+            try:
+                self.assertEqual(self.run_statement(conn, 'rd_check_exists', ('ada',)), [('ada',)])
+                # Statements outlive the transaction, even one that is rolled back.
+                conn.rollback()
+            finally:
+                conn.close()
+        after = prepared_statements.statistics()
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertEqual(after['hits'] - before['hits'], 2)
+
+        conn = self.pool.getconn()
+        try:
+            self.assertEqual(self.server_statements(conn), {'rd_check_exists'})
+            self.assertEqual(conn.raw.prepared, {'rd_check_exists'})
+        finally:
+            conn.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+from library.storage import PostgreSQL
+from tests.database import database_test
+from library.errors import error
+import threading
+import unittest
+import psycopg2
+
+class test_storage_usage(database_test):
+    def setUp(self):
+        self.db = PostgreSQL.shared()
+        self.username = f'user{self.id().rsplit("_", 1)[-1]}'
+        self.db.add_user(self.username, 'correct horse battery staple')
+        self.db.add_repository(self.username, 'docs', '', False)
+
+    def usage(self) -> tuple[int, int]:
+        usage = self.db.storage_usage(self.username)
+        return usage['stored_bytes'], usage['stored_files']
+
+    def test_quota(self):
+        self.db.add_commit(self.username, 'docs', self.username, '/a.txt', (1, 0, 0), b'12345')
+        self.db.set_storage_quota(self.username, 8)
+        self.assertEqual(self.db.storage_usage(self.username)['quota'], 8)
+        with self.assertRaises(error.quota_exceeded):
+            self.db.add_commit(self.username, 'docs', self.username, '/b.txt', (1, 0, 0), b'6789')
+        # Nothing of the refused commit is counted.
+        self.assertEqual(self.usage(), (5, 1))
+        self.db.add_commit(self.username, 'docs', self.username, '/b.txt', (1, 0, 0), b'678')
+        self.assertEqual(self.usage(), (8, 2))
+
+        self.assertTrue(self.db.delete_repository(self.username, 'docs'))
+        self.assertEqual(self.usage(), (0, 0))
+        self.assertFalse(self.db.delete_repository(self.username, 'docs'))
+
+    def test_delete_waits_for_push(self):
+        self.db.add_commit(self.username, 'docs', self.username, '/a.txt', (1, 0, 0), b'12345')
+        repo_id = self.query('SELECT repo_id FROM repositories WHERE name = %s AND owner = %s;',
+                             ('docs', self.username))[0][0]
+
+        # A push that has counted its usage but not yet committed.
+        conn = self.db.get_connection()
+        cur = conn.cursor()
+        try:
+            PostgreSQL.add_storage_usage(cur, repo_id, self.username, 100, 2)
+            deleted = []
+            delete = threading.Thread(target=lambda: deleted.append(self.db.delete_repository(self.username, 'docs')))
+            delete.start()
+            delete.join(1)
+            self.assertTrue(delete.is_alive(), "The delete did not wait for the push.")
+            conn.commit()
+        finally:
+            cur.close()
+            conn.close()
+        delete.join()
+
+        self.assertEqual(deleted, [True])
+        self.assertEqual(self.usage(), (0, 0))
+
+    def test_push_waits_for_delete(self):
+        repo_id = self.query('SELECT repo_id FROM repositories WHERE name = %s AND owner = %s;',
+                             ('docs', self.username))[0][0]
+
+        # A delete that has locked the repository but not yet committed.
+        delete = psycopg2.connect(**self.details)
+        try:
+            with delete.cursor() as cur:
+                cur.execute('SELECT repo_id FROM repositories WHERE repo_id = %s FOR UPDATE;', (repo_id,))
+            errors = []
+
+            def push():
+                try:
+                    self.db.add_commit(self.username, 'docs', self.username, '/a.txt', (1, 0, 0), b'12345')
+                except error.repository_not_found as err:
+                    errors.append(err)
+
+            pushing = threading.Thread(target=push)
+            pushing.start()
+            pushing.join(1)
+            self.assertTrue(pushing.is_alive(), "The push did not wait for the delete.")
+            with delete.cursor() as cur:
+                cur.execute('DELETE FROM repositories WHERE repo_id = %s;', (repo_id,))
+            delete.commit()
+        finally:
+            delete.close()
+        pushing.join()
+
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(self.usage(), (0, 0))
+
+if __name__ == '__main__':
+    unittest.main()
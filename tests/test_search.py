@@ -0,0 +1,68 @@
+from library.search import code_search
+import unittest
+
+class test_required_literals(unittest.TestCase):
+    def test_plain_text(self):
+        self.assertEqual(code_search.required_literals('hello world'), ['hello world'])
+
+    def test_split_at_classes_and_wildcards(self):
+        self.assertEqual(code_search.required_literals(r'def\s+main\('), ['def', 'main('])
+        self.assertEqual(code_search.required_literals('foo.*bar'), ['foo', 'bar'])
+        self.assertEqual(code_search.required_literals('abc[xyz]def'), ['abc', 'def'])
+        self.assertEqual(code_search.required_literals(r'abc[]x]def'), ['abc', 'def'])
+
+    def test_optional_characters_are_left_out(self):
+        self.assertEqual(code_search.required_literals('colou?r'), ['colo', 'r'])
+        self.assertEqual(code_search.required_literals('abcd*e'), ['abc', 'e'])
+        self.assertEqual(code_search.required_literals('abcd{0,2}e'), ['abc', 'e'])
+        self.assertEqual(code_search.required_literals('abcd+e'), ['abcd', 'e'])
+
+    def test_groups_and_alternation_are_left_out(self):
+        self.assertEqual(code_search.required_literals('abc(def)ghi'), ['abc', 'ghi'])
+        self.assertEqual(code_search.required_literals('abc(?:def)?ghi'), ['abc', 'ghi'])
+        self.assertEqual(code_search.required_literals('abc|def'), [])
+
+    def test_escapes(self):
+        self.assertEqual(code_search.required_literals(r'a\.b\(c'), ['a.b(c'])
+        self.assertEqual(code_search.required_literals(r'abc\dxyz'), ['abc', 'xyz'])
+
+    def test_flags(self):
+        self.assertEqual(code_search.required_literals('(?i)hello'), ['hello'])
+        # In verbose mode, whitespace is not part of what matches.
+        self.assertEqual(code_search.required_literals('(?x)hel lo'), [])
+
+    def test_every_literal_is_in_every_match(self):
+        cases = {
+            r'def\s+main\(': 'def  main():',
+            'colou?r': 'color',
+            'ab+c': 'abbbc',
+            'abcd{0,2}e': 'abce',
+            'x(yz)*w': 'xw',
+        }
+        for pattern, text in cases.items():
+            for literal in code_search.required_literals(pattern):
+                self.assertIn(literal, text, pattern)
+
+class test_compile(unittest.TestCase):
+    def test_substring_is_literal(self):
+        pattern, trigrams = code_search.compile('a.b+c')
+        self.assertTrue(pattern.search('xa.b+cx'))
+        self.assertFalse(pattern.search('aXbbc'))
+        self.assertEqual(trigrams, code_search.query_trigrams(['a.b+c']))
+
+    def test_ignore_case(self):
+        pattern, _ = code_search.compile('Hello.*World', regex=True, ignore_case=True)
+        self.assertTrue(pattern.search('hello there world'))
+
+    def test_rejected(self):
+        for query, regex in (('ab', False), ('a' * 257, False), ('a|bcd', True), ('(abc', True), (r'(a)\1bc', True)):
+            with self.assertRaises(ValueError):
+                code_search.compile(query, regex)
+
+    def test_trigrams_are_lowercased(self):
+        self.assertEqual(code_search.trigrams(b'ABcd'), code_search.trigrams(b'abcd'))
+        self.assertEqual(len(code_search.trigrams(b'abcd')), 2)
+        self.assertEqual(code_search.trigrams(b'ab'), [])
+
+if __name__ == '__main__':
+    unittest.main()
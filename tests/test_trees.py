@@ -0,0 +1,156 @@
+from library.trees import tree_store
+from library.errors import error
+import unittest
+import random
+import json
+
+class memory_cursor:
+    """
+    Stands in for a database cursor, with the trees table in a dict. Only knows the queries tree_store makes.
+    """
+    def __init__(self):
+        self.trees = {}
+        self.rowcount = 0
+        self._rows = []
+
+    def execute(self, query, args=None):
+        if query.startswith('INSERT INTO trees'):
+            tree_hash, entries = args
+            self.rowcount = int(tree_hash not in self.trees)
+            self.trees.setdefault(tree_hash, json.loads(entries))
+        elif query.startswith('SELECT hash, entries FROM trees'):
+            self._rows = [(tree_hash, self.trees[tree_hash]) for tree_hash in args[0] if tree_hash in self.trees]
+        else:
+            raise AssertionError(f"Unexpected query: {query}")
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+PATHS = ['/a.txt', '/b.txt', '/src/main.py', '/src/util.py', '/src/lib/x.py', '/src/lib/y.py', '/docs/readme.md']
+
+def random_files(rng: random.Random, commit_ids) -> dict:
+    """
+    :return: Path: (blob hash, commit_id, version) of a random set of files.
+    """
+    return {
+        path: (f'blob-{rng.randint(1, 4)}', next(commit_ids), (1, rng.randint(0, 3), 0))
+        for path in PATHS if rng.random() < 0.6
+    }
+
+def entry(path: str, change: tuple) -> list:
+    blob_hash, commit_id, version = change
+    return [path.rsplit('/', 1)[1], 'blob', blob_hash, commit_id, *version]
+
+class test_tree_store(unittest.TestCase):
+    def setUp(self):
+        # Cleared, so trees are really read back through the cursor.
+        tree_store._cache.clear()
+        self.cur = memory_cursor()
+        self.commit_ids = iter(range(1, 1000000))
+
+    def build(self, files: dict) -> str:
+        return tree_store.update(self.cur, None, files)
+
+    def test_update_and_walk(self):
+        rng = random.Random(1)
+        for _ in range(100):
+            files = random_files(rng, self.commit_ids)
+            root = self.build(files)
+            self.assertEqual(tree_store.walk(self.cur, root), {path: entry(path, change) for path, change in files.items()})
+            for path in PATHS:
+                found = tree_store.find(self.cur, root, path)
+                self.assertEqual(found, entry(path, files[path]) if path in files else None)
+
+    def test_same_files_same_hash(self):
+        files = random_files(random.Random(2), self.commit_ids)
+        first = self.build(files)
+        tree_store._cache.clear()
+        self.assertEqual(self.build(dict(reversed(list(files.items())))), first)
+
+    def test_removing_files_removes_empty_folders(self):
+        root = self.build({'/src/lib/x.py': ('blob-1', 1, (1, 0, 0)), '/a.txt': ('blob-2', 2, (1, 0, 0))})
+        root = tree_store.update(self.cur, root, {'/src/lib/x.py': None})
+        self.assertEqual([entry[0] for entry in tree_store.get(self.cur, root)], ['a.txt'])
+        root = tree_store.update(self.cur, root, {'/a.txt': None})
+        self.assertEqual(root, tree_store.empty(self.cur))
+
+    def test_only_newer(self):
+        root = self.build({'/a.txt': ('blob-new', 2, (2, 0, 0))})
+        older = {'/a.txt': ('blob-old', 1, (1, 0, 0))}
+        self.assertEqual(tree_store.update(self.cur, root, older), root)
+        forced = tree_store.update(self.cur, root, older, only_newer=False)
+        self.assertEqual(tree_store.walk(self.cur, forced)['/a.txt'][2], 'blob-old')
+
+    def test_compare(self):
+        rng = random.Random(3)
+        for _ in range(100):
+            old_files, new_files = random_files(rng, self.commit_ids), random_files(rng, self.commit_ids)
+            # Some files the same in both, so whole folders are too.
+            for path in old_files.keys() & new_files.keys():
+                if rng.random() < 0.5:
+                    new_files[path] = old_files[path]
+            old_walk = {path: entry(path, change) for path, change in old_files.items()}
+            new_walk = {path: entry(path, change) for path, change in new_files.items()}
+            expected = {
+                path: (old_walk.get(path), new_walk.get(path))
+                for path in old_walk.keys() | new_walk.keys() if old_walk.get(path) != new_walk.get(path)
+            }
+            self.assertEqual(tree_store.compare(self.cur, self.build(old_files), self.build(new_files)), expected)
+
+    def test_compare_same_root_reads_nothing(self):
+        root = self.build(random_files(random.Random(4), self.commit_ids))
+        tree_store._cache.clear()
+        self.cur.trees.clear()
+        self.assertEqual(tree_store.compare(self.cur, root, root), {})
+
+    def test_merge(self):
+        rng = random.Random(5)
+        for _ in range(200):
+            base = random_files(rng, self.commit_ids)
+            sides = []
+            for _ in range(2):
+                side = dict(base)
+                for path in PATHS:
+                    roll = rng.random()
+                    if roll < 0.15:
+                        side.pop(path, None)
+                    elif roll < 0.35:
+                        side[path] = (f'blob-{rng.randint(1, 4)}', next(self.commit_ids), (1, rng.randint(0, 3), 1))
+                sides.append(side)
+            ours, theirs = sides
+
+            root, both_changed = tree_store.merge(self.cur, self.build(base), self.build(ours), self.build(theirs))
+
+            # The same rules, file by file.
+            walks = [{path: entry(path, change) for path, change in files.items()} for files in (base, ours, theirs)]
+            expected, expected_both = {}, {}
+            for path in PATHS:
+                base_entry, ours_entry, theirs_entry = (walk.get(path) for walk in walks)
+                if ours_entry == theirs_entry or base_entry == theirs_entry:
+                    merged = ours_entry
+                elif base_entry == ours_entry:
+                    merged = theirs_entry
+                elif ours_entry is not None and theirs_entry is not None and ours_entry[2] == theirs_entry[2]:
+                    merged = max(ours_entry, theirs_entry, key=lambda file: tuple(file[4:7]))
+                else:
+                    expected_both[path] = (base_entry, ours_entry, theirs_entry)
+                    merged = ours_entry
+                if merged is not None:
+                    expected[path] = merged
+
+            self.assertEqual(tree_store.walk(self.cur, root), expected)
+            self.assertEqual(both_changed, expected_both)
+
+    def test_missing_tree(self):
+        with self.assertRaises(error.tree_not_found):
+            tree_store.get(self.cur, 'not a tree')
+
+    def test_split_path(self):
+        self.assertEqual(tree_store.split_path('/src/lib/x.py'), (('src', 'lib'), 'x.py'))
+        self.assertEqual(tree_store.split_path('/a.txt'), ((), 'a.txt'))
+        with self.assertRaises(ValueError):
+            tree_store.split_path('/')
+
+if __name__ == '__main__':
+    unittest.main()
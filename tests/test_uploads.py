@@ -0,0 +1,43 @@
+from library.uploads import upload_sessions
+import unittest
+
+SHA256 = 'ab' * 32
+
+def manifest_file(**changes) -> dict:
+    return {'path': '/src/main.py', 'version': '1.2.3', 'size': 10, 'sha256': SHA256, **changes}
+
+class test_check_manifest(unittest.TestCase):
+    def test_valid(self):
+        files = upload_sessions._check_manifest([
+            manifest_file(), manifest_file(path='/empty', size=0, sha256=SHA256.upper(), version='0.0.0')
+        ])
+        self.assertEqual(files, [
+            {'path': '/src/main.py', 'version': [1, 2, 3], 'size': 10, 'sha256': SHA256},
+            {'path': '/empty', 'version': [0, 0, 0], 'size': 0, 'sha256': SHA256},
+        ])
+
+    def test_invalid(self):
+        cases = {
+            'not a list': 'files',
+            'empty': [],
+            'not an object': ['/src/main.py'],
+            'relative path': [manifest_file(path='src/main.py')],
+            'no path': [manifest_file(path=None)],
+            'two part version': [manifest_file(version='1.2')],
+            'negative version': [manifest_file(version='1.-2.3')],
+            'words for a version': [manifest_file(version='one.two.three')],
+            'negative size': [manifest_file(size=-1)],
+            'size as text': [manifest_file(size='10')],
+            'size as a bool': [manifest_file(size=True)],
+            'short sha256': [manifest_file(sha256='ab' * 31)],
+            'sha256 not hex': [manifest_file(sha256='zz' * 32)],
+            'same path twice': [manifest_file(), manifest_file(size=20)],
+            'too many files': [manifest_file(path=f'/{index}') for index in range(upload_sessions.MAX_FILES + 1)],
+        }
+        for name, files in cases.items():
+            with self.subTest(name):
+                with self.assertRaises(ValueError):
+                    upload_sessions._check_manifest(files)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -20,14 +20,30 @@ function list_containers() {
     const api_url = `${currentProtocol}//${currentHost}:2048`;
     const token = localStorage.getItem('token');
 
-    function fetchData() {
-        fetch(`${api_url}/api/vcs/repositories/list_all`, {
+    // The list is paginated, so keep following 'next' until every page has been fetched.
+    function fetchPages(after, collected) {
+        return fetch(`${api_url}/api/vcs/repositories/list_all?after=${after}`, {
             method: 'GET',
             headers: {
             'Authorization': `Bearer ${token}` // Include token in the request headers
             },
         })
             .then(response => response.json())
+            .then(data => {
+            if (data['error'] !== undefined) {
+                return data;
+            }
+            collected['private'].push(...data['private']);
+            collected['public'].push(...data['public']);
+            if (data['next'] !== null && data['next'] !== undefined) {
+                return fetchPages(data['next'], collected);
+            }
+            return collected;
+            });
+    }
+
+    function fetchData() {
+        fetchPages(0, {'private': [], 'public': []})
             .then(data => {
             // Data format: {'repos_list': {repo_name: repo_desc}}
             const repo_list = document.getElementById('repo_list');